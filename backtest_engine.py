@@ -0,0 +1,401 @@
+"""
+组合回测引擎 - 基于缓存日线的向量化配置回放。
+
+本模块提供：
+1. 以历史汇率折算的人民币价格矩阵（日期 × 标的）
+2. 定期再平衡的向量化模拟（净值曲线、换手率、交易成本）
+3. 当前持仓（买入持有）与拟调整配置的对比回测及 Markdown 报告
+
+模拟按"再平衡区间"分段：区间内持股数不变，净值 = 区间起点净值 × Σ 权重 × 相对价格，
+区间之间的衔接用一次 cumprod 完成，全程不在日期维度上做 Python 循环，
+5 年 × 50 个标的的回放耗时在毫秒级。
+"""
+
+import logging
+from typing import Dict, Any, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from valuation_engine import (
+    detect_ticker_currency,
+    fetch_exchange_rates,
+    fetch_price_history,
+    format_universal_ticker,
+)
+from risk_engine import TRADING_DAYS_PER_YEAR, build_price_matrix, max_drawdown
+
+logger = logging.getLogger(__name__)
+
+# 历史汇率的 yfinance 代码（CNY 无需折算）
+FX_HISTORY_TICKERS: Dict[str, str] = {"USD": "USDCNY=X", "HKD": "HKDCNY=X"}
+
+# 再平衡频率 -> pandas Period 频率（none 表示买入持有）
+REBALANCE_FREQUENCIES: Dict[str, Optional[str]] = {
+    "none": None,
+    "weekly": "W",
+    "monthly": "M",
+    "quarterly": "Q",
+}
+
+DEFAULT_BACKTEST_DAYS = 365
+MAX_BACKTEST_DAYS = 5 * 366
+
+# 拟调整配置在没有当前持仓可参照时使用的初始资金
+DEFAULT_INITIAL_CAPITAL = 1_000_000.0
+
+MIN_OBSERVATIONS = 20
+
+
+def parse_allocation(spec: str) -> Dict[str, float]:
+    """
+    解析拟调整配置字符串为归一化权重。
+
+    Args:
+        spec: 如 "AAPL=40;0700.HK=30;600519=30"，数值为百分比（不要求恰好加总 100，会自动归一化）
+
+    Returns:
+        Dict[str, float]: 格式化代码 -> 权重（和为 1）
+
+    Raises:
+        ValueError: 格式不正确、权重为负或总权重为 0
+    """
+    weights: Dict[str, float] = {}
+    for item in (spec or "").replace('；', ';').replace('，', ';').replace(',', ';').split(';'):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' not in item:
+            raise ValueError(f"配置应写成 代码=权重，收到 '{item}'")
+        ticker, weight = item.split('=', 1)
+        value = float(weight.strip().rstrip('%'))
+        if value < 0:
+            raise ValueError(f"权重不能为负数：'{item}'")
+        formatted = format_universal_ticker(ticker)
+        weights[formatted] = weights.get(formatted, 0.0) + value
+
+    total = sum(weights.values())
+    if total <= 0:
+        raise ValueError("配置总权重必须大于 0")
+    return {t: w / total for t, w in weights.items()}
+
+
+def build_cny_price_matrix(
+    history: Dict[str, pd.DataFrame],
+    tickers: List[str],
+    spot_rates: Optional[Dict[str, float]] = None,
+) -> Tuple[np.ndarray, List[str], pd.DatetimeIndex]:
+    """
+    构建以历史汇率折算后的人民币收盘价矩阵。
+
+    标的与汇率序列一并对齐到日期并集后向前填充；上市前的空缺向后填充为首个价格
+    （视为零收益），汇率历史缺失时退化为即期汇率常数。
+
+    Args:
+        history: fetch_price_history 返回的日线字典，需同时包含 FX_HISTORY_TICKERS 中的汇率序列
+        tickers: 参与回测的格式化代码（决定列顺序）
+        spot_rates: 汇率历史缺失时使用的即期汇率 {"USD_CNY": ..., "HKD_CNY": ...}
+
+    Returns:
+        Tuple[np.ndarray, List[str], pd.DatetimeIndex]: (CNY 价格矩阵 T×N, 实际列顺序, 日期索引)
+    """
+    fx_columns = [t for t in FX_HISTORY_TICKERS.values() if t in history]
+    prices, columns, dates = build_price_matrix(history, list(tickers) + fx_columns)
+    if not columns:
+        return np.empty((0, 0)), [], pd.DatetimeIndex([])
+
+    prices = pd.DataFrame(prices).bfill().to_numpy()
+    asset_columns = [c for c in columns if c in tickers]
+    asset_prices = prices[:, [columns.index(c) for c in asset_columns]]
+
+    currencies = [detect_ticker_currency(c) for c in asset_columns]
+    fx = np.ones_like(asset_prices)
+    for currency, fx_ticker in FX_HISTORY_TICKERS.items():
+        mask = np.array([c == currency for c in currencies], dtype=bool)
+        if not mask.any():
+            continue
+        if fx_ticker in columns:
+            fx[:, mask] = prices[:, [columns.index(fx_ticker)]]
+        else:
+            rate = (spot_rates or {}).get(f"{currency}_CNY", 1.0)
+            logger.warning(f"{fx_ticker} 历史汇率缺失，以即期汇率 {rate} 折算")
+            fx[:, mask] = rate
+
+    # 汇率序列仅在外汇交易日有值，非交易日前值填充后仍可能出现头部 NaN
+    fx = np.where(np.isnan(fx), 1.0, fx)
+    return asset_prices * fx, asset_columns, dates
+
+
+def rebalance_mask(dates: pd.DatetimeIndex, frequency: str = "none") -> np.ndarray:
+    """
+    生成再平衡日布尔向量：每个周期的最后一个交易日收盘再平衡，首日恒为建仓日。
+
+    Args:
+        dates: 回测日期索引
+        frequency: REBALANCE_FREQUENCIES 的键
+
+    Returns:
+        np.ndarray: 长度 T 的布尔向量
+
+    Raises:
+        ValueError: 不支持的再平衡频率
+    """
+    if frequency not in REBALANCE_FREQUENCIES:
+        raise ValueError(f"不支持的再平衡频率 '{frequency}'，可选：{', '.join(REBALANCE_FREQUENCIES)}")
+
+    mask = np.zeros(len(dates), dtype=bool)
+    if len(dates) == 0:
+        return mask
+    mask[0] = True
+
+    period = REBALANCE_FREQUENCIES[frequency]
+    if period is not None:
+        periods = dates.to_period(period).asi8
+        mask[:-1] |= periods[1:] != periods[:-1]
+    return mask
+
+
+def simulate_allocation(
+    prices: np.ndarray,
+    weights: np.ndarray,
+    rebalance: np.ndarray,
+    initial_capital: float,
+    cost_bps: float = 0.0,
+) -> Dict[str, np.ndarray]:
+    """
+    向量化模拟目标权重配置在价格矩阵上的净值演变（纯函数，不做任何 I/O）。
+
+    每个再平衡日收盘时将持仓调回目标权重，两次再平衡之间持股数保持不变（权重随价格漂移）。
+    交易成本按单边成交额 × cost_bps 从净值中扣除。
+
+    Args:
+        prices: 价格矩阵 T×N（同一计价货币，且无 NaN）
+        weights: 目标权重向量 N（和为 1）
+        rebalance: 长度 T 的再平衡日布尔向量，首日必须为 True
+        initial_capital: 初始资金
+        cost_bps: 交易成本（基点），默认 0
+
+    Returns:
+        dict: {
+            "equity": T 净值曲线, "rebalance_index": K 再平衡日下标（不含建仓日）,
+            "turnover": K 每次再平衡的单边换手率, "costs": K 每次再平衡扣除的成本金额
+        }
+    """
+    t_obs = prices.shape[0]
+    reb_idx = np.flatnonzero(rebalance)
+
+    # 每个交易日所属区间的起点：严格早于当日的最近一个再平衡日（首日归属自身）
+    segment = np.searchsorted(reb_idx, np.arange(t_obs), side='left') - 1
+    segment[0] = 0
+    start_idx = reb_idx[segment]
+
+    relative = prices / prices[start_idx]
+    growth = relative @ weights
+
+    # 再平衡前的漂移权重与目标权重之差即为换手
+    later = reb_idx[1:]
+    drifted = relative[later] * weights / growth[later][:, None]
+    turnover = 0.5 * np.abs(drifted - weights).sum(axis=1)
+    cost_rate = 2.0 * turnover * cost_bps / 10_000
+
+    # 各区间末净值倍数（含成本），cumprod 衔接出每个再平衡日的净值
+    multipliers = growth[later] * (1.0 - cost_rate)
+    reb_values = initial_capital * np.concatenate([[1.0], np.cumprod(multipliers)])
+
+    equity = reb_values[segment] * growth
+    equity[later] = reb_values[1:]
+
+    # 再平衡日当天收盘成交，扣除成本前的净值用于计算成本金额
+    costs = reb_values[:-1] * growth[later] * cost_rate
+
+    return {
+        "equity": equity,
+        "rebalance_index": later,
+        "turnover": turnover,
+        "costs": costs,
+    }
+
+
+def summarize_equity(equity: np.ndarray, dates: pd.DatetimeIndex) -> Dict[str, Any]:
+    """
+    由净值曲线计算收益与风险摘要。
+
+    Args:
+        equity: 净值曲线 T
+        dates: 日期索引 T
+
+    Returns:
+        dict: start_value / end_value / total_return / annualized_return / volatility / max_drawdown
+    """
+    returns = equity[1:] / equity[:-1] - 1.0
+    years = max((dates[-1] - dates[0]).days / 365.25, 1 / 365.25)
+    total_return = equity[-1] / equity[0] - 1.0
+    return {
+        "start_value": round(float(equity[0]), 2),
+        "end_value": round(float(equity[-1]), 2),
+        "total_return": round(float(total_return), 4),
+        "annualized_return": round(float((1.0 + total_return) ** (1.0 / years) - 1.0), 4),
+        "volatility": round(float(returns.std(ddof=1) * np.sqrt(TRADING_DAYS_PER_YEAR)), 4) if len(returns) > 1 else 0.0,
+        "max_drawdown": round(float(max_drawdown(returns)), 4),
+    }
+
+
+def _sample_curve(equity: np.ndarray, dates: pd.DatetimeIndex, points: int = 12) -> List[Dict[str, Any]]:
+    """按月末抽样净值曲线（供报告与 JSON 序列化），超过 points 个月时等距抽取"""
+    series = pd.Series(equity, index=dates)
+    monthly = series.groupby(dates.to_period("M")).last()
+    if len(monthly) > points:
+        monthly = monthly.iloc[np.linspace(0, len(monthly) - 1, points).round().astype(int)]
+    return [{"date": str(period), "value": round(float(v), 2)} for period, v in monthly.items()]
+
+
+def run_backtest(
+    positions: Dict[str, Dict[str, Any]],
+    allocation: Optional[Dict[str, float]] = None,
+    days: int = DEFAULT_BACKTEST_DAYS,
+    rebalance: str = "monthly",
+    cost_bps: float = 0.0,
+) -> Dict[str, Any]:
+    """
+    回放当前持仓（买入持有）及可选的拟调整配置。
+
+    当前持仓以 parse_user_profile_to_positions 的股数在回测起点建仓，拟调整配置
+    使用与当前持仓相同的起点资金并按 rebalance 频率再平衡，二者共享同一价格矩阵以便对比。
+
+    Args:
+        positions: parse_user_profile_to_positions 返回的标准持仓
+        allocation: parse_allocation 返回的目标权重；None 表示只回放当前持仓
+        days: 回看的自然日天数（上限 MAX_BACKTEST_DAYS）
+        rebalance: 拟调整配置的再平衡频率
+        cost_bps: 拟调整配置的交易成本（基点）
+
+    Returns:
+        dict: 可 JSON 序列化的回测结果；历史数据不足时返回空字典
+    """
+    days = max(MIN_OBSERVATIONS, min(int(days), MAX_BACKTEST_DAYS))
+    shares_by_column: Dict[str, float] = {}
+    for ticker, position in positions.items():
+        column = format_universal_ticker(ticker)
+        shares_by_column[column] = shares_by_column.get(column, 0.0) + float(position.get("shares", 0))
+    shares_by_column = {c: s for c, s in shares_by_column.items() if s > 0}
+
+    tickers = list(dict.fromkeys(list(shares_by_column) + list(allocation or {})))
+    if not tickers:
+        return {}
+
+    history = fetch_price_history(tickers + list(FX_HISTORY_TICKERS.values()), days=days)
+    spot_rates = None
+    if any(t not in history for t in FX_HISTORY_TICKERS.values()):
+        spot_rates = fetch_exchange_rates()
+
+    prices, columns, dates = build_cny_price_matrix(history, tickers, spot_rates)
+    if not columns or prices.shape[0] <= MIN_OBSERVATIONS:
+        logger.warning("日线历史不足，跳过组合回测")
+        return {}
+
+    missing = [t for t in tickers if t not in columns]
+    strategies: Dict[str, Dict[str, Any]] = {}
+
+    held = [c for c in columns if c in shares_by_column]
+    capital = DEFAULT_INITIAL_CAPITAL
+    if held:
+        shares = np.array([shares_by_column.get(c, 0.0) for c in columns])
+        start_values = shares * prices[0]
+        capital = float(start_values.sum())
+        current = simulate_allocation(prices, start_values / capital, rebalance_mask(dates, "none"), capital)
+        strategies["当前持仓"] = {
+            "rebalance": "none",
+            "weights": {c: round(float(w), 4) for c, w in zip(columns, start_values / capital) if w > 0},
+            "summary": summarize_equity(current["equity"], dates),
+            "turnover": 0.0,
+            "costs": 0.0,
+            "rebalances": 0,
+            "curve": _sample_curve(current["equity"], dates),
+        }
+
+    if allocation:
+        target = np.array([allocation.get(c, 0.0) for c in columns])
+        if target.sum() > 0:
+            target = target / target.sum()
+            proposed = simulate_allocation(prices, target, rebalance_mask(dates, rebalance), capital, cost_bps)
+            strategies["拟调整配置"] = {
+                "rebalance": rebalance,
+                "weights": {c: round(float(w), 4) for c, w in zip(columns, target) if w > 0},
+                "summary": summarize_equity(proposed["equity"], dates),
+                "turnover": round(float(proposed["turnover"].sum()), 4),
+                "costs": round(float(proposed["costs"].sum()), 2),
+                "rebalances": int(len(proposed["rebalance_index"])),
+                "curve": _sample_curve(proposed["equity"], dates),
+            }
+
+    if not strategies:
+        return {}
+
+    return {
+        "start": dates[0].strftime("%Y-%m-%d"),
+        "end": dates[-1].strftime("%Y-%m-%d"),
+        "observations": int(len(dates)),
+        "tickers": columns,
+        "missing_history": missing,
+        "cost_bps": cost_bps,
+        "strategies": strategies,
+    }
+
+
+def format_backtest_report(backtest: Dict[str, Any]) -> str:
+    """
+    将回测结果格式化为 Markdown 报告。
+
+    Args:
+        backtest: run_backtest 的返回值
+
+    Returns:
+        str: Markdown 报告
+    """
+    if not backtest:
+        return "暂无足够的历史数据进行组合回测"
+
+    strategies = backtest["strategies"]
+    names = list(strategies.keys())
+    lines = [
+        "### ⏪ 组合历史回测（人民币计价，含历史汇率）",
+        "",
+        f"- **回测区间**: {backtest['start']} ~ {backtest['end']}（{backtest['observations']} 个交易日）",
+    ]
+    if backtest.get("missing_history"):
+        lines.append(f"- **缺少历史数据（未参与回测）**: {', '.join(backtest['missing_history'])}")
+    lines.extend([
+        "",
+        "| 指标 | " + " | ".join(names) + " |",
+        "| :--- |" + " :--- |" * len(names),
+    ])
+
+    def row(label: str, fmt) -> str:
+        return f"| {label} | " + " | ".join(fmt(strategies[n]) for n in names) + " |"
+
+    lines.extend([
+        row("起始市值", lambda s: f"¥{s['summary']['start_value']:,.2f}"),
+        row("期末市值", lambda s: f"¥{s['summary']['end_value']:,.2f}"),
+        row("累计收益率", lambda s: f"{s['summary']['total_return'] * 100:+.2f}%"),
+        row("年化收益率", lambda s: f"{s['summary']['annualized_return'] * 100:+.2f}%"),
+        row("年化波动率", lambda s: f"{s['summary']['volatility'] * 100:.2f}%"),
+        row("最大回撤", lambda s: f"{s['summary']['max_drawdown'] * 100:.2f}%"),
+        row("再平衡", lambda s: f"{s['rebalance']}（{s['rebalances']} 次）"),
+        row("累计单边换手", lambda s: f"{s['turnover'] * 100:.1f}%"),
+        row("交易成本", lambda s: f"¥{s['costs']:,.2f}"),
+    ])
+
+    lines.extend([
+        "",
+        "**月末净值（CNY）**",
+        "",
+        "| 月份 | " + " | ".join(names) + " |",
+        "| :--- |" + " :--- |" * len(names),
+    ])
+    curves = {n: {p["date"]: p["value"] for p in strategies[n]["curve"]} for n in names}
+    months = list(dict.fromkeys(p["date"] for n in names for p in strategies[n]["curve"]))
+    for month in sorted(months):
+        cells = [f"¥{curves[n][month]:,.0f}" if month in curves[n] else "-" for n in names]
+        lines.append(f"| {month} | " + " | ".join(cells) + " |")
+
+    return "\n".join(lines)
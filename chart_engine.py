@@ -0,0 +1,1226 @@
+"""
+绘图引擎 - 常驻预热进程池中的 K 线渲染。
+
+本模块提供：
+1. TradingView 旗舰暗黑风格（色板 / 样式对象在每个绘图进程内只构建一次）
+2. 常驻绘图进程池：Agg 后端、mplfinance 与样式对象在 worker 启动时预热
+3. 有界并发（超过排队上限的请求等待空位，超时拒绝）与队列深度指标
+4. 崩溃自愈：worker 异常退出导致进程池损坏时自动重建并重试一次
+5. 内容寻址的图表缓存：按 (代码, 天数, 最新 K 线, 样式版本, 渲染档位) 命名，命中直接复用，配合工作区清理淘汰
+6. 面向输出渠道的渲染档位：telegram（适配客户端的位图）/ pdf（矢量 SVG）/ thumbnail（缩略图）
+7. 双渲染器：mplfinance，以及直接在复用的 Agg 画布上用 PolyCollection / LineCollection 绘制的原生渲染器
+8. 多标的小图矩阵：一张图内为全部持仓绘制迷你走势 / 迷你 K 线
+9. 多标的归一化对比图：各标的起点统一为 100 后叠加在同一坐标系
+
+mplfinance 渲染是纯 CPU 计算且全程持有 GIL，放在 Telegram 机器人的事件循环线程池里执行时，
+并发绘图会互相串行并拖慢整个事件循环；放到独立进程后，调用线程只在等待结果时阻塞（不持有 GIL）。
+"""
+
+import os
+import json
+import re
+import time
+import uuid
+import atexit
+import hashlib
+import logging
+import multiprocessing
+import threading
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from math import ceil
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# 常驻绘图进程数；设为 0 时退化为在调用线程内串行渲染（调试 / 受限环境）
+CHART_POOL_WORKERS = int(os.getenv("CHART_POOL_WORKERS", "2"))
+
+# 同时在途（执行中 + 排队中）的绘图请求上限，超过后新请求等待空位
+CHART_POOL_MAX_PENDING = int(os.getenv("CHART_POOL_MAX_PENDING", "8"))
+
+# 绘图请求的超时秒数（等待在途空位与等待渲染结果分别计时）
+CHART_RENDER_TIMEOUT_SECONDS = float(os.getenv("CHART_RENDER_TIMEOUT_SECONDS", "60"))
+
+# 绘图样式版本：修改配色 / 尺寸 / 均线等视觉参数时递增，旧缓存图随之自然失效
+CHART_STYLE_VERSION = "tv-dark-1"
+
+# 图表缓存淘汰策略：超过 TTL 未被命中的图删除；总数超过上限时按最近使用时间淘汰
+CHART_CACHE_TTL_DAYS = float(os.getenv("CHART_CACHE_TTL_DAYS", "7"))
+CHART_CACHE_MAX_FILES = int(os.getenv("CHART_CACHE_MAX_FILES", "200"))
+
+# 缓存图命名：{代码}_{天数}d_{内容哈希}.{png|svg}；渲染中的临时文件以 "." 开头，完成后原子替换
+_CHART_FILE_PATTERN = re.compile(r"^\w+_\d+d_[0-9a-f]{12}\.(png|svg)$")
+_CHART_TMP_PATTERN = re.compile(r"^\.\w+_\d+d_[0-9a-f]{12}\.[0-9a-f]+\.(png|svg)$")
+
+# 位图缓存图内嵌的来源元数据键（值为 "代码|天数"）
+CHART_SOURCE_METADATA_KEY = "OmniStock-Chart"
+
+# 位图 K 线图的绘图数据（{缓存键}.json）：PDF 导出时用同一份数据重绘矢量版本，不重新拉取行情，
+# 保证 PDF 与用户看到的位图一致。存放在沙盒之外且只用 JSON：沙盒目录对大模型可写，其中的文件一律不反序列化
+CHART_SERIES_DIR = Path(os.getenv("CHART_SERIES_DIR", "./memory/chart_series")).resolve()
+_CHART_KEY_PATTERN = re.compile(r"_\d+d_([0-9a-f]{12})\.png$")
+_CHART_SERIES_COLUMNS = ("Open", "High", "Low", "Close", "Volume")
+
+# 残留临时文件（渲染进程崩溃遗留）超过该时长即视为孤儿
+_CHART_TMP_MAX_AGE_SECONDS = 3600
+
+# 同一张图的并发请求只渲染一次：每个缓存键一把锁，不同的图互不阻塞；无人持有时即移除
+_chart_key_locks: Dict[str, List[Any]] = {}  # {缓存键: [锁, 引用数]}
+_chart_key_locks_guard = threading.Lock()
+
+# TradingView 经典配色
+TV_UP_COLOR = '#089981'           # TV 经典翠绿
+TV_DOWN_COLOR = '#f23645'         # TV 经典猩红
+TV_BACKGROUND = '#131722'         # TV 经典外框背景色（深邃蓝灰）
+TV_GRID_COLOR = '#1e222d'         # 极度弱化的网格线
+TV_TEXT_COLOR = '#d1d4dc'         # 柔和的银灰色文字
+MA_WINDOWS = (5, 10)
+MA_COLORS = ['#c481ec', '#2962ff']  # 🌟 视觉点睛：霓虹紫 + 电光蓝 均线
+
+# 两个渲染器共用的 matplotlib 全局样式
+TV_RC_PARAMS: Dict[str, Any] = {
+    'text.color': TV_TEXT_COLOR,            # 柔和的银灰色文字
+    'axes.labelcolor': TV_TEXT_COLOR,
+    'xtick.color': TV_TEXT_COLOR,
+    'ytick.color': TV_TEXT_COLOR,
+    'axes.spines.top': False,               # 🔪 物理切除四周边框
+    'axes.spines.right': False,
+    'axes.spines.left': False,
+    'axes.spines.bottom': False,
+    'font.size': 10,
+    'font.weight': 'bold',                  # 字体加粗更具科技感
+    'lines.linewidth': 1.5                  # 稍微加粗均线，增加发光感
+}
+
+# K 线渲染器：mplfinance（默认）/ native（collections 直绘，复用画布）
+CHART_RENDERERS = ("mplfinance", "native")
+DEFAULT_CHART_RENDERER = os.getenv("CHART_RENDERER", "mplfinance")
+
+
+
+@dataclass(frozen=True)
+class RenderProfile:
+    """
+    图表渲染档位。
+
+    Attributes:
+        figsize: 画布尺寸（英寸）
+        dpi: 位图分辨率；矢量格式下只影响线宽与字号的换算
+        fmt: 输出格式（png / svg）
+        volume: 是否绘制成交量副图
+    """
+    figsize: Tuple[float, float]
+    dpi: int
+    fmt: str
+    volume: bool = True
+
+
+# 各输出渠道的渲染档位：Telegram 客户端会把宽图压缩到 1280 px，高于该尺寸的像素只会白白增加上传体积
+RENDER_PROFILES: Dict[str, RenderProfile] = {
+    "telegram": RenderProfile(figsize=(12, 6), dpi=107, fmt="png"),     # ≈ 1280 × 640 px
+    "pdf": RenderProfile(figsize=(12, 6), dpi=72, fmt="svg"),           # 矢量图，打印 / 缩放不失真
+    "thumbnail": RenderProfile(figsize=(6, 3), dpi=64, fmt="png", volume=False),  # ≈ 384 × 192 px
+}
+DEFAULT_RENDER_PROFILE = "telegram"
+
+# 当前进程（绘图 worker 或内联模式下的主进程）的预热状态：{"mpf": 模块, "style": 样式对象}
+_renderer_state: Dict[str, Any] = {}
+
+# 多标的小图矩阵：面板样式、单图最多面板数，以及 telegram 档位下每行面板数
+SMALL_MULTIPLE_STYLES = ("sparkline", "candle")
+MAX_SMALL_MULTIPLES = 36
+
+# 归一化对比图的曲线色板（与暗黑背景对比度足够，按标的顺序循环使用）
+COMPARISON_COLORS = [
+    '#2962ff', '#ff9800', '#c481ec', '#00bcd4', '#ffeb3b',
+    '#e91e63', '#8bc34a', '#9e9e9e', '#ff5722', '#4dd0e1',
+]
+
+# 原生渲染器的复用画布：{(画布尺寸, 是否含成交量): (Figure, 价格轴, 成交量轴)}
+_native_canvases: Dict[Tuple[Tuple[float, float], bool], Tuple[Any, Any, Any]] = {}
+_renderer_state_lock = threading.Lock()
+
+# 内联模式下 matplotlib 不是线程安全的，渲染需串行
+_inline_render_lock = threading.Lock()
+
+
+def build_tradingview_style(mpf: Any) -> Any:
+    """
+    构建 TradingView 旗舰暗黑风格的 mplfinance 样式对象。
+
+    Args:
+        mpf: 已导入的 mplfinance 模块
+
+    Returns:
+        mplfinance 样式字典
+    """
+    # 1. 极致色彩：边框、影线与主体同色，消除发虚感；成交量颜色跟随 K 线涨跌
+    mc = mpf.make_marketcolors(
+        up=TV_UP_COLOR,
+        down=TV_DOWN_COLOR,
+        edge='inherit',
+        wick='inherit',
+        volume='in'
+    )
+
+    # 2. 旗舰质感：去边框化、深邃蓝灰背景、极度弱化网格
+    return mpf.make_mpf_style(
+        marketcolors=mc,
+        figcolor=TV_BACKGROUND,
+        facecolor=TV_BACKGROUND,      # 图表内背景色（无缝融合）
+        edgecolor=TV_BACKGROUND,      # 隐藏坐标系边框，打造悬浮感
+        gridcolor=TV_GRID_COLOR,
+        gridstyle=':',                # 点状网格，绝不喧宾夺主
+        rc=TV_RC_PARAMS
+    )
+
+
+def init_renderer() -> Dict[str, Any]:
+    """
+    预热当前进程的绘图环境：切换 Agg 后端、导入 mplfinance、构建样式对象（幂等）。
+
+    作为进程池 initializer 在每个 worker 启动时执行一次；内联模式下由首次渲染触发。
+
+    Returns:
+        dict: {"mpf": mplfinance 模块, "style": 样式对象}
+    """
+    with _renderer_state_lock:
+        if not _renderer_state:
+            import matplotlib
+            matplotlib.use("Agg")
+            import mplfinance as mpf
+
+            _renderer_state["mpf"] = mpf
+            _renderer_state["style"] = build_tradingview_style(mpf)
+        return _renderer_state
+
+
+def _warmup_worker() -> int:
+    """预热探针：确保 worker 已完成初始化，返回 worker 进程号"""
+    init_renderer()
+    return os.getpid()
+
+
+def get_render_profile(profile: str) -> RenderProfile:
+    """
+    按名称获取渲染档位。
+
+    Raises:
+        ValueError: 未知档位
+    """
+    if profile not in RENDER_PROFILES:
+        raise ValueError(f"不支持的渲染档位：{profile}，可选 {', '.join(RENDER_PROFILES)}")
+    return RENDER_PROFILES[profile]
+
+
+def _render_mplfinance(
+    hist: pd.DataFrame,
+    chart_path: str,
+    title: str,
+    render_profile: RenderProfile,
+    savefig: Dict[str, Any],
+) -> None:
+    state = init_renderer()
+    state["mpf"].plot(
+        hist,
+        type='candle',
+        volume=render_profile.volume and "Volume" in hist.columns,
+        style=state["style"],
+        title=title,
+        mav=MA_WINDOWS,
+        mavcolors=MA_COLORS,
+        figsize=render_profile.figsize,
+        savefig=dict(fname=chart_path, **savefig)
+    )
+
+
+def _get_native_canvas(figsize: Tuple[float, float], with_volume: bool) -> Tuple[Any, Any, Any]:
+    """获取（首次调用时创建）复用的 Figure 与坐标轴；Figure 直接绑定 Agg 画布，不经过 pyplot 全局状态"""
+    key = (figsize, with_volume)
+    if key not in _native_canvases:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        fig = Figure(figsize=figsize, facecolor=TV_BACKGROUND)
+        FigureCanvasAgg(fig)
+        if with_volume:
+            grid = fig.add_gridspec(2, 1, height_ratios=(3, 1), hspace=0.08)
+            ax_price = fig.add_subplot(grid[0])
+            ax_volume = fig.add_subplot(grid[1], sharex=ax_price)
+        else:
+            ax_price = fig.add_subplot(1, 1, 1)
+            ax_volume = None
+        _native_canvases[key] = (fig, ax_price, ax_volume)
+    return _native_canvases[key]
+
+
+def _style_native_axis(ax: Any, ylabel: str) -> None:
+    ax.set_facecolor(TV_BACKGROUND)
+    ax.grid(True, color=TV_GRID_COLOR, linestyle=':')
+    ax.set_axisbelow(True)
+    ax.tick_params(length=0)
+    ax.set_ylabel(ylabel)
+
+
+def _moving_average(values: Any, window: int) -> Any:
+    import numpy as np
+
+    if len(values) < window:
+        return np.empty(0)
+    cumsum = np.cumsum(np.insert(values, 0, 0.0))
+    return (cumsum[window:] - cumsum[:-window]) / window
+
+
+def _draw_candles(ax: Any, hist: pd.DataFrame, half: float = 0.3) -> Any:
+    """
+    用预计算的几何数组在坐标轴上绘制蜡烛图：实体为 n 个矩形多边形（PolyCollection），
+    影线为 n 条竖线段（LineCollection），并按价格区间设置坐标范围。
+
+    Returns:
+        np.ndarray: 每根 K 线的涨跌颜色（供成交量柱复用）
+    """
+    import numpy as np
+    from matplotlib.collections import LineCollection, PolyCollection
+
+    opens = hist["Open"].to_numpy(dtype=float)
+    highs = hist["High"].to_numpy(dtype=float)
+    lows = hist["Low"].to_numpy(dtype=float)
+    closes = hist["Close"].to_numpy(dtype=float)
+    n = len(closes)
+    x = np.arange(n, dtype=float)
+    colors = np.where(closes >= opens, TV_UP_COLOR, TV_DOWN_COLOR)
+
+    bottoms = np.minimum(opens, closes)
+    tops = np.maximum(opens, closes)
+    bodies = np.stack([
+        np.column_stack([x - half, bottoms]),
+        np.column_stack([x - half, tops]),
+        np.column_stack([x + half, tops]),
+        np.column_stack([x + half, bottoms]),
+    ], axis=1)
+    wicks = np.stack([np.column_stack([x, lows]), np.column_stack([x, highs])], axis=1)
+
+    ax.add_collection(LineCollection(wicks, colors=colors, linewidths=0.8))
+    ax.add_collection(PolyCollection(bodies, facecolors=colors, edgecolors=colors, linewidths=0.5))
+    price_pad = (highs.max() - lows.min()) * 0.05 or abs(highs.max()) * 0.01 or 1.0
+    ax.set_ylim(lows.min() - price_pad, highs.max() + price_pad)
+    ax.set_xlim(-1, n)
+    return colors
+
+
+def _render_native(
+    hist: pd.DataFrame,
+    chart_path: str,
+    title: str,
+    render_profile: RenderProfile,
+    savefig: Dict[str, Any],
+) -> None:
+    import numpy as np
+    from matplotlib import rc_context
+    from matplotlib.collections import PolyCollection
+
+    closes = hist["Close"].to_numpy(dtype=float)
+    n = len(closes)
+    x = np.arange(n, dtype=float)
+
+    with_volume = render_profile.volume and "Volume" in hist.columns
+    with rc_context(TV_RC_PARAMS):
+        fig, ax_price, ax_volume = _get_native_canvas(render_profile.figsize, with_volume)
+        ax_price.cla()
+        _style_native_axis(ax_price, "Price")
+        colors = _draw_candles(ax_price, hist)
+        for window, color in zip(MA_WINDOWS, MA_COLORS):
+            average = _moving_average(closes, window)
+            if len(average):
+                ax_price.plot(x[window - 1:], average, color=color)
+
+        tick_axis = ax_price
+        if ax_volume is not None:
+            half = 0.3  # 与蜡烛实体同宽
+            volumes = hist["Volume"].to_numpy(dtype=float)
+            zeros = np.zeros(n)
+            bars = np.stack([
+                np.column_stack([x - half, zeros]),
+                np.column_stack([x - half, volumes]),
+                np.column_stack([x + half, volumes]),
+                np.column_stack([x + half, zeros]),
+            ], axis=1)
+            ax_volume.cla()
+            _style_native_axis(ax_volume, "Volume")
+            ax_volume.add_collection(PolyCollection(bars, facecolors=colors, edgecolors=colors, linewidths=0.5))
+            ax_volume.set_ylim(0, (volumes.max() or 1.0) * 1.1)
+            ax_price.tick_params(labelbottom=False)
+            tick_axis = ax_volume
+
+        # 日期刻度：等距取 8 个交易日，避免非交易日留白
+        ticks = np.unique(np.linspace(0, n - 1, min(n, 8)).round().astype(int))
+        date_format = "%b %d" if (hist.index[-1] - hist.index[0]).days < 300 else "%Y-%m"
+        tick_axis.set_xticks(ticks)
+        tick_axis.set_xticklabels([pd.Timestamp(hist.index[i]).strftime(date_format) for i in ticks])
+
+        fig.suptitle(title)
+        fig.savefig(chart_path, facecolor=TV_BACKGROUND, **savefig)
+
+
+def render_small_multiples(
+    histories: Dict[str, pd.DataFrame],
+    chart_path: str,
+    title: str,
+    profile: str = DEFAULT_RENDER_PROFILE,
+    style: str = "sparkline",
+) -> str:
+    """
+    在一张图内为多个标的绘制小图矩阵（每个面板标注代码、最新价与区间涨跌幅）。
+
+    Args:
+        histories: {格式化代码: OHLCV 日线}，按字典顺序排布面板
+        chart_path: 图片保存路径
+        title: 图表总标题
+        profile: 渲染档位名称（决定整图宽度、分辨率与格式）
+        style: "sparkline"（收盘价迷你走势 + 面积填充）或 "candle"（迷你 K 线）
+
+    Returns:
+        str: 图片保存路径
+    """
+    import numpy as np
+    from matplotlib import rc_context
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    init_renderer()
+    render_profile = get_render_profile(profile)
+    count = len(histories)
+    cols = min(count, 3 if count <= 9 else 4)
+    rows = ceil(count / cols)
+    width = render_profile.figsize[0]
+    panel_height = width / cols * 0.55
+
+    with rc_context(TV_RC_PARAMS):
+        fig = Figure(figsize=(width, rows * panel_height + 0.6), facecolor=TV_BACKGROUND)
+        FigureCanvasAgg(fig)
+        axes = fig.subplots(rows, cols, squeeze=False)
+        for ax, (ticker, hist) in zip(axes.flat, histories.items()):
+            closes = hist["Close"].to_numpy(dtype=float)
+            change = closes[-1] / closes[0] - 1 if closes[0] else 0.0
+            color = TV_UP_COLOR if change >= 0 else TV_DOWN_COLOR
+            x = np.arange(len(closes), dtype=float)
+
+            ax.set_facecolor(TV_BACKGROUND)
+            ax.grid(True, color=TV_GRID_COLOR, linestyle=':')
+            ax.set_axisbelow(True)
+            ax.tick_params(length=0, labelsize=8, labelbottom=False, labelleft=False, labelright=True)
+            if style == "candle" and {"Open", "High", "Low"}.issubset(hist.columns):
+                _draw_candles(ax, hist, half=0.35)
+            else:
+                ax.plot(x, closes, color=color, linewidth=1.2)
+                ax.fill_between(x, closes, closes.min(), color=color, alpha=0.12, linewidth=0)
+                ax.set_xlim(0, max(len(closes) - 1, 1))
+            ax.set_title(f"{ticker}  {closes[-1]:,.2f}  {change:+.2%}", loc="left", fontsize=10, color=color)
+
+        for ax in axes.flat[count:]:
+            ax.set_visible(False)
+
+        fig.suptitle(title)
+        fig.savefig(
+            chart_path, format=render_profile.fmt, dpi=render_profile.dpi,
+            bbox_inches='tight', pad_inches=0.2, facecolor=TV_BACKGROUND
+        )
+    return chart_path
+
+
+def render_comparison(
+    rebased: pd.DataFrame,
+    chart_path: str,
+    title: str,
+    profile: str = DEFAULT_RENDER_PROFILE,
+) -> str:
+    """
+    将多个标的的归一化走势（起点 = 100）叠加绘制在同一坐标系中。
+
+    Args:
+        rebased: 日期 × 标的的归一化价格（列顺序决定配色与图例顺序）
+        chart_path: 图片保存路径
+        title: 图表标题
+        profile: 渲染档位名称
+
+    Returns:
+        str: 图片保存路径
+    """
+    import numpy as np
+    from matplotlib import rc_context
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    init_renderer()
+    render_profile = get_render_profile(profile)
+    n = len(rebased)
+    x = np.arange(n, dtype=float)
+
+    with rc_context(TV_RC_PARAMS):
+        fig = Figure(figsize=render_profile.figsize, facecolor=TV_BACKGROUND)
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(1, 1, 1)
+        _style_native_axis(ax, "Rebased (start = 100)")
+        ax.axhline(100.0, color=TV_TEXT_COLOR, linewidth=0.8, linestyle='--', alpha=0.5)
+        for i, column in enumerate(rebased.columns):
+            values = rebased[column].to_numpy(dtype=float)
+            ax.plot(x, values, color=COMPARISON_COLORS[i % len(COMPARISON_COLORS)], label=f"{column}  {values[-1] - 100:+.1f}%")
+        ax.set_xlim(0, max(n - 1, 1))
+
+        ticks = np.unique(np.linspace(0, n - 1, min(n, 8)).round().astype(int))
+        date_format = "%b %d" if (rebased.index[-1] - rebased.index[0]).days < 300 else "%Y-%m"
+        ax.set_xticks(ticks)
+        ax.set_xticklabels([pd.Timestamp(rebased.index[i]).strftime(date_format) for i in ticks])
+        ax.legend(loc="upper left", frameon=False, fontsize=9, labelcolor=TV_TEXT_COLOR)
+
+        fig.suptitle(title)
+        fig.savefig(
+            chart_path, format=render_profile.fmt, dpi=render_profile.dpi,
+            bbox_inches='tight', pad_inches=0.2, facecolor=TV_BACKGROUND
+        )
+    return chart_path
+
+
+_RENDERER_FUNCTIONS: Dict[str, Callable[..., None]] = {
+    "mplfinance": _render_mplfinance,
+    "native": _render_native,
+}
+
+
+def get_renderer(renderer: Optional[str]) -> str:
+    """
+    校验并返回渲染器名称（None 时使用 CHART_RENDERER 配置）。
+
+    Raises:
+        ValueError: 未知渲染器
+    """
+    name = renderer or DEFAULT_CHART_RENDERER
+    if name not in _RENDERER_FUNCTIONS:
+        raise ValueError(f"不支持的 K 线渲染器：{name}，可选 {', '.join(CHART_RENDERERS)}")
+    return name
+
+
+def render_kline(
+    hist: pd.DataFrame,
+    chart_path: str,
+    title: str,
+    profile: str = DEFAULT_RENDER_PROFILE,
+    source: str = "",
+    renderer: Optional[str] = None,
+) -> str:
+    """
+    将 OHLCV 日线渲染为 TradingView 风格 K 线图（含成交量与 5/10 日均线）。
+
+    Args:
+        hist: 带 Open/High/Low/Close/Volume 列、DatetimeIndex 的日线
+        chart_path: 图片保存路径（扩展名需与档位格式一致）
+        title: 图表标题
+        profile: 渲染档位名称
+        source: 写入位图元数据的来源标识（"代码|天数"），为空时不写入
+        renderer: 渲染器名称（mplfinance / native），None 时使用 CHART_RENDERER 配置
+
+    Returns:
+        str: 图片保存路径
+    """
+    render_profile = get_render_profile(profile)
+    render_fn = _RENDERER_FUNCTIONS[get_renderer(renderer)]
+    savefig: Dict[str, Any] = dict(
+        format=render_profile.fmt, dpi=render_profile.dpi, bbox_inches='tight', pad_inches=0.2
+    )
+    if source and render_profile.fmt == "png":
+        savefig["metadata"] = {CHART_SOURCE_METADATA_KEY: source}
+
+    init_renderer()
+    render_fn(hist, chart_path, title, render_profile, savefig)
+    return chart_path
+
+
+class ChartRenderPool:
+    """
+    常驻预热的绘图进程池。
+
+    Args:
+        max_workers: 绘图进程数，<= 0 时在调用线程内串行渲染
+        max_pending: 同时在途（执行中 + 排队中）的请求上限
+    """
+
+    def __init__(self, max_workers: int = CHART_POOL_WORKERS, max_pending: int = CHART_POOL_MAX_PENDING):
+        self.max_workers = max_workers
+        self.max_pending = max(max_pending, 1)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._in_flight = 0
+        self._peak_queue_depth = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._restarts = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn 启动：避免 fork 继承父进程中的线程与锁状态
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_renderer,
+                )
+            return self._executor
+
+    def _discard_executor(self, broken: ProcessPoolExecutor) -> None:
+        """丢弃已损坏的进程池，下一次提交时重建（并发请求只会触发一次重建）"""
+        with self._lock:
+            if self._executor is broken:
+                broken.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+                self._restarts += 1
+
+    def warm_up(self, timeout: float = CHART_RENDER_TIMEOUT_SECONDS) -> int:
+        """
+        提前拉起全部 worker 并完成预热，避免首个绘图请求承担进程启动与 mplfinance 导入开销。
+
+        Returns:
+            int: 已就绪的 worker 数
+        """
+        if self.max_workers <= 0:
+            init_renderer()
+            return 0
+        executor = self._get_executor()
+        futures = [executor.submit(_warmup_worker) for _ in range(self.max_workers)]
+        pids = {f.result(timeout=timeout) for f in futures}
+        logger.info(f"🎨 绘图进程池预热完成：{len(pids)} 个 worker 就绪")
+        return len(pids)
+
+    def run(self, fn: Callable[..., Any], *args: Any, timeout: float = CHART_RENDER_TIMEOUT_SECONDS) -> Any:
+        """
+        在绘图进程中执行 fn(*args) 并等待结果。
+
+        Args:
+            fn: 可被 pickle 的模块级函数
+            *args: 参数（需可被 pickle）
+            timeout: 等待空位与等待结果各自的超时秒数
+
+        Returns:
+            fn 的返回值
+
+        Raises:
+            TimeoutError: 排队或渲染超时（渲染超时的请求在 worker 真正结束前继续占用在途名额）
+            RuntimeError: 进程池重建后仍然崩溃
+        """
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self._rejected += 1
+            raise TimeoutError(f"绘图队列已满（在途 {self.max_pending} 个请求），请稍后重试")
+
+        with self._lock:
+            self._in_flight += 1
+            depth = self._queue_depth_locked()
+            self._peak_queue_depth = max(self._peak_queue_depth, depth)
+        if depth > 0:
+            logger.info(f"🎨 绘图请求排队中，当前队列深度 {depth}")
+
+        try:
+            result = self._run_with_recovery(fn, args, timeout)
+        except Exception:
+            with self._lock:
+                self._failed += 1
+            raise
+        else:
+            with self._lock:
+                self._completed += 1
+            return result
+
+    def _release_slot(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _run_with_recovery(self, fn: Callable[..., Any], args: tuple, timeout: float) -> Any:
+        """执行渲染并负责归还在途名额：正常结束时立即归还，等待超时则推迟到 worker 真正结束时"""
+        if self.max_workers <= 0:
+            try:
+                with _inline_render_lock:
+                    return fn(*args)
+            finally:
+                self._release_slot()
+
+        release_now = True
+        try:
+            for attempt in (1, 2):
+                executor = self._get_executor()
+                try:
+                    future = executor.submit(fn, *args)
+                    return future.result(timeout=timeout)
+                except BrokenProcessPool as e:
+                    logger.warning(f"⚠️ 绘图进程异常退出，重建进程池（第 {attempt} 次）：{e}")
+                    self._discard_executor(executor)
+                except TimeoutError:
+                    # 超时的渲染仍占着 worker：排队中的直接取消，执行中的结束后才归还名额，
+                    # 否则新请求会在 worker 全部被卡住时继续涌入
+                    release_now = False
+                    future.add_done_callback(lambda _: self._release_slot())
+                    future.cancel()
+                    raise
+            raise RuntimeError("绘图进程连续崩溃，本次渲染失败")
+        finally:
+            if release_now:
+                self._release_slot()
+
+    def _queue_depth_locked(self) -> int:
+        workers = self.max_workers if self.max_workers > 0 else 1
+        return max(self._in_flight - workers, 0)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        进程池运行指标。
+
+        Returns:
+            dict: workers / in_flight / queue_depth / peak_queue_depth / completed / failed / rejected / restarts
+        """
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "in_flight": self._in_flight,
+                "queue_depth": self._queue_depth_locked(),
+                "peak_queue_depth": self._peak_queue_depth,
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "restarts": self._restarts,
+            }
+
+    def shutdown(self) -> None:
+        """关闭进程池（进程退出时由 atexit 调用）"""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+_chart_pool: Optional[ChartRenderPool] = None
+_chart_pool_lock = threading.Lock()
+
+
+def get_chart_pool() -> ChartRenderPool:
+    """
+    获取进程级常驻的绘图进程池（懒加载，线程安全）。
+
+    Returns:
+        ChartRenderPool: 进程数由 CHART_POOL_WORKERS 控制
+    """
+    global _chart_pool
+    with _chart_pool_lock:
+        if _chart_pool is None:
+            _chart_pool = ChartRenderPool()
+            atexit.register(_chart_pool.shutdown)
+        return _chart_pool
+
+
+def render_kline_chart(
+    hist: pd.DataFrame,
+    chart_path: str,
+    title: str,
+    profile: str = DEFAULT_RENDER_PROFILE,
+    source: str = "",
+    renderer: Optional[str] = None,
+) -> str:
+    """
+    通过常驻绘图进程池渲染 K 线图。
+
+    Args:
+        hist: OHLCV 日线
+        chart_path: 图片保存路径
+        title: 图表标题
+        profile: 渲染档位名称
+        source: 写入位图元数据的来源标识
+        renderer: 渲染器名称，None 时使用 CHART_RENDERER 配置
+
+    Returns:
+        str: 图片保存路径
+    """
+    return get_chart_pool().run(render_kline, hist, chart_path, title, profile, source, get_renderer(renderer))
+
+
+def chart_cache_key(
+    ticker: str,
+    days: int,
+    hist: pd.DataFrame,
+    profile: str = DEFAULT_RENDER_PROFILE,
+    renderer: Optional[str] = None,
+) -> str:
+    """
+    计算图表的内容寻址缓存键。
+
+    键由 (格式化代码, 天数, 最新 K 线日期, 最新 K 线 OHLCV, 样式版本, 渲染档位, 渲染器) 决定：
+    盘中最新一根 K 线仍在变化时会生成新图，收盘后同一交易日的重复请求全部命中。
+
+    Args:
+        ticker: 格式化后的股票代码
+        days: 时间跨度（天数）
+        hist: 绘图使用的日线
+        profile: 渲染档位名称
+        renderer: 渲染器名称，None 时使用 CHART_RENDERER 配置
+
+    Returns:
+        str: 12 位十六进制缓存键
+    """
+    last_bar = hist.iloc[-1]
+    parts = [ticker, str(days), pd.Timestamp(hist.index[-1]).strftime("%Y-%m-%d")]
+    parts.extend(f"{float(last_bar[c]):.6g}" for c in ("Open", "High", "Low", "Close", "Volume") if c in hist.columns)
+    parts.extend([CHART_STYLE_VERSION, profile, get_renderer(renderer)])
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:12]
+
+
+def chart_file_name(ticker: str, days: int, key: str, fmt: str = "png") -> str:
+    """缓存图文件名（代码中的特殊字符替换为下划线）"""
+    safe_name = ''.join(c if c.isalnum() else '_' for c in ticker)
+    return f"{safe_name}_{days}d_{key}.{fmt}"
+
+
+def render_kline_chart_cached(
+    hist: pd.DataFrame,
+    save_dir: Path,
+    ticker: str,
+    days: int,
+    title: str,
+    profile: str = DEFAULT_RENDER_PROFILE,
+    renderer: Optional[str] = None,
+) -> Tuple[Path, bool]:
+    """
+    带内容寻址缓存的 K 线渲染：命中时跳过渲染，未命中时渲染到临时文件后原子替换。
+
+    Args:
+        hist: OHLCV 日线
+        save_dir: 图片保存目录
+        ticker: 格式化后的股票代码
+        days: 时间跨度（天数）
+        title: 图表标题
+        profile: 渲染档位名称（telegram / pdf / thumbnail）
+        renderer: 渲染器名称（mplfinance / native），None 时使用 CHART_RENDERER 配置
+
+    Returns:
+        Tuple[Path, bool]: (图片路径, 是否命中缓存)
+
+    Raises:
+        ValueError: 未知档位或渲染器
+    """
+    fmt = get_render_profile(profile).fmt
+    renderer = get_renderer(renderer)
+    key = chart_cache_key(ticker, days, hist, profile, renderer)
+    chart_path = (save_dir / chart_file_name(ticker, days, key, fmt)).resolve()
+
+    cache_hit = _materialize_chart(
+        chart_path, key,
+        lambda tmp_path: render_kline_chart(hist, tmp_path, title, profile, f"{ticker}|{days}", renderer)
+    )
+    if fmt == "png":
+        _save_chart_series(key, hist, ticker, days, title, profile, renderer)
+    return chart_path, cache_hit
+
+
+def _save_chart_series(
+    key: str, hist: pd.DataFrame, ticker: str, days: int, title: str, profile: str, renderer: str
+) -> None:
+    """按缓存键原子写入位图的绘图数据（JSON；缓存键相同则数据相同，已存在时只刷新使用时间）"""
+    series_path = CHART_SERIES_DIR / f"{key}.json"
+    try:
+        if series_path.exists():
+            os.utime(series_path)
+            return
+        CHART_SERIES_DIR.mkdir(parents=True, exist_ok=True)
+        payload = {
+            "ticker": ticker, "days": days, "title": title, "profile": profile, "renderer": renderer,
+            "index": [pd.Timestamp(ts).isoformat() for ts in hist.index],
+            "columns": {str(c): [float(v) for v in hist[c]] for c in hist.columns if c in _CHART_SERIES_COLUMNS},
+        }
+        tmp_path = series_path.with_name(f".{key}.{uuid.uuid4().hex[:8]}.json")
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(payload, f)
+            os.replace(tmp_path, series_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning(f"绘图数据保存失败，PDF 导出将沿用位图：{key} - {e}")
+
+
+def load_chart_series(chart_path: Path) -> Optional[Dict[str, Any]]:
+    """
+    读取位图 K 线缓存图对应的绘图数据。
+
+    只按文件名中的缓存键到沙盒之外的 CHART_SERIES_DIR 查找 JSON，并用数据重新计算缓存键校验，
+    沙盒内的任何文件都不会被读取或反序列化。
+
+    Args:
+        chart_path: 位图缓存图路径
+
+    Returns:
+        Optional[dict]: {"hist", "ticker", "days", "title", "renderer"}，可直接传回 render_kline_chart_cached；
+        非缓存图、位图不存在、数据缺失 / 损坏或与缓存键不符时返回 None
+    """
+    match = _CHART_KEY_PATTERN.search(chart_path.name)
+    if not _CHART_FILE_PATTERN.match(chart_path.name) or match is None or not chart_path.exists():
+        return None
+    key = match.group(1)
+    try:
+        with open(CHART_SERIES_DIR / f"{key}.json", "r", encoding="utf-8") as f:
+            payload = json.load(f)
+        hist = pd.DataFrame(payload["columns"], index=pd.DatetimeIndex(pd.to_datetime(payload["index"])))
+        ticker, days, profile = str(payload["ticker"]), int(payload["days"]), str(payload["profile"])
+        renderer = get_renderer(payload["renderer"])
+        if chart_cache_key(ticker, days, hist, profile, renderer) != key:
+            logger.warning(f"绘图数据与缓存键不符，已忽略：{key}")
+            return None
+    except FileNotFoundError:
+        return None
+    except (OSError, KeyError, TypeError, ValueError, IndexError) as e:
+        logger.debug(f"绘图数据读取失败：{key} - {type(e).__name__}")
+        return None
+    return {"hist": hist, "ticker": ticker, "days": days, "title": str(payload["title"]), "renderer": renderer}
+
+
+def _acquire_chart_key_lock(key: str) -> None:
+    """取得缓存键对应的锁并加锁（与 _release_chart_key_lock 成对调用）"""
+    with _chart_key_locks_guard:
+        entry = _chart_key_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    entry[0].acquire()
+
+
+def _release_chart_key_lock(key: str) -> None:
+    """释放缓存键对应的锁，最后一个持有者负责移除"""
+    with _chart_key_locks_guard:
+        entry = _chart_key_locks[key]
+        entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _chart_key_locks[key]
+
+
+def _materialize_chart(chart_path: Path, key: str, render: Callable[[str], Any]) -> bool:
+    """
+    缓存图落盘：已存在则刷新最近使用时间并返回命中；否则渲染到临时文件后原子替换。
+
+    Args:
+        chart_path: 缓存图最终路径
+        key: 缓存键（按键加锁，同一张图的并发请求只渲染一次）
+        render: 接收临时文件路径并完成渲染的函数
+
+    Returns:
+        bool: 是否命中缓存
+    """
+    _acquire_chart_key_lock(key)
+    try:
+        if chart_path.exists():
+            # 刷新修改时间，作为缓存淘汰的最近使用时间
+            os.utime(chart_path)
+            return True
+
+        tmp_path = chart_path.with_name(f".{chart_path.stem}.{uuid.uuid4().hex[:8]}{chart_path.suffix}")
+        try:
+            render(str(tmp_path))
+            os.replace(tmp_path, chart_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+    finally:
+        _release_chart_key_lock(key)
+    return False
+
+
+def render_small_multiples_cached(
+    histories: Dict[str, pd.DataFrame],
+    save_dir: Path,
+    days: int,
+    title: str,
+    profile: str = DEFAULT_RENDER_PROFILE,
+    style: str = "sparkline",
+) -> Tuple[Path, bool]:
+    """
+    带内容寻址缓存的多标的小图矩阵渲染（经常驻绘图进程池执行）。
+
+    缓存键由面板顺序、各标的最新 K 线、天数、面板样式、渲染档位与样式版本决定。
+
+    Args:
+        histories: {格式化代码: OHLCV 日线}
+        save_dir: 图片保存目录
+        days: 时间跨度（天数）
+        title: 图表总标题
+        profile: 渲染档位名称
+        style: 面板样式（sparkline / candle）
+
+    Returns:
+        Tuple[Path, bool]: (图片路径, 是否命中缓存)
+
+    Raises:
+        ValueError: 面板数量为 0 或超过上限、未知面板样式或渲染档位
+    """
+    if not histories:
+        raise ValueError("没有可绘制的标的")
+    if len(histories) > MAX_SMALL_MULTIPLES:
+        raise ValueError(f"单张小图矩阵最多 {MAX_SMALL_MULTIPLES} 个标的，当前 {len(histories)} 个")
+    if style not in SMALL_MULTIPLE_STYLES:
+        raise ValueError(f"不支持的面板样式：{style}，可选 {', '.join(SMALL_MULTIPLE_STYLES)}")
+    fmt = get_render_profile(profile).fmt
+
+    parts = [str(days), style, profile, CHART_STYLE_VERSION]
+    for ticker, hist in histories.items():
+        parts.extend([ticker, pd.Timestamp(hist.index[-1]).strftime("%Y-%m-%d"), f"{float(hist['Close'].iloc[-1]):.6g}", str(len(hist))])
+    key = hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:12]
+    chart_path = (save_dir / chart_file_name("portfolio", days, key, fmt)).resolve()
+
+    cache_hit = _materialize_chart(
+        chart_path, key,
+        lambda tmp_path: get_chart_pool().run(render_small_multiples, histories, tmp_path, title, profile, style)
+    )
+    return chart_path, cache_hit
+
+
+def render_comparison_cached(
+    rebased: pd.DataFrame,
+    save_dir: Path,
+    days: int,
+    title: str,
+    profile: str = DEFAULT_RENDER_PROFILE,
+    variant: str = "",
+) -> Tuple[Path, bool]:
+    """
+    带内容寻址缓存的归一化对比图渲染（经常驻绘图进程池执行）。
+
+    缓存键由列顺序、区间首尾日期、各列末值、天数、计价口径、渲染档位与样式版本决定。
+
+    Args:
+        rebased: 日期 × 标的的归一化价格
+        save_dir: 图片保存目录
+        days: 时间跨度（天数）
+        title: 图表标题
+        profile: 渲染档位名称
+        variant: 影响曲线数值的附加口径（如计价货币），参与缓存键
+
+    Returns:
+        Tuple[Path, bool]: (图片路径, 是否命中缓存)
+
+    Raises:
+        ValueError: 数据为空或未知渲染档位
+    """
+    if rebased.empty or rebased.shape[1] == 0:
+        raise ValueError("没有可绘制的对比数据")
+    fmt = get_render_profile(profile).fmt
+
+    parts = [str(days), variant, profile, CHART_STYLE_VERSION, str(len(rebased))]
+    parts.append(pd.Timestamp(rebased.index[0]).strftime("%Y-%m-%d"))
+    parts.append(pd.Timestamp(rebased.index[-1]).strftime("%Y-%m-%d"))
+    for column in rebased.columns:
+        parts.extend([str(column), f"{float(rebased[column].iloc[-1]):.6g}"])
+    key = hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:12]
+    chart_path = (save_dir / chart_file_name("compare", days, key, fmt)).resolve()
+
+    cache_hit = _materialize_chart(
+        chart_path, key,
+        lambda tmp_path: get_chart_pool().run(render_comparison, rebased, tmp_path, title, profile)
+    )
+    return chart_path, cache_hit
+
+
+def read_chart_source(chart_path: Path) -> Optional[Tuple[str, int]]:
+    """
+    读取位图缓存图内嵌的来源元数据。
+
+    Args:
+        chart_path: 图片路径
+
+    Returns:
+        Optional[Tuple[str, int]]: (格式化代码, 天数)；非缓存图或缺少元数据时返回 None
+    """
+    if not _CHART_FILE_PATTERN.match(chart_path.name) or chart_path.suffix != ".png" or not chart_path.exists():
+        return None
+    try:
+        from PIL import Image
+        with Image.open(chart_path) as image:
+            source = getattr(image, "text", {}).get(CHART_SOURCE_METADATA_KEY, "")
+        ticker, days = source.split("|")
+        return ticker, int(days)
+    except Exception:
+        return None
+
+
+def evict_chart_cache(
+    directory: Path,
+    ttl_days: float = CHART_CACHE_TTL_DAYS,
+    max_files: int = CHART_CACHE_MAX_FILES,
+) -> Tuple[int, int]:
+    """
+    淘汰目录中的缓存图：删除超过 TTL 未使用的图与渲染残留的临时文件，
+    剩余数量超过上限时按最近使用时间从旧到新删除；被删位图的绘图数据（CHART_SERIES_DIR）随之删除，
+    超过 TTL 未使用的绘图数据也一并清理。非缓存图文件不受影响。
+
+    Args:
+        directory: 缓存图所在目录（agent_workspace）
+        ttl_days: 未使用超过该天数即删除
+        max_files: 保留的缓存图数量上限
+
+    Returns:
+        Tuple[int, int]: (删除文件数, 释放字节数)
+    """
+    if not directory.exists():
+        return 0, 0
+
+    now = time.time()
+    charts = []
+    expired = []
+    for f in directory.iterdir():
+        if not f.is_file():
+            continue
+        try:
+            stat = f.stat()
+        except OSError:
+            continue
+        if _CHART_FILE_PATTERN.match(f.name):
+            if now - stat.st_mtime > ttl_days * 86400:
+                expired.append((f, stat.st_size))
+            else:
+                charts.append((stat.st_mtime, f, stat.st_size))
+        elif _CHART_TMP_PATTERN.match(f.name) and now - stat.st_mtime > _CHART_TMP_MAX_AGE_SECONDS:
+            expired.append((f, stat.st_size))
+
+    charts.sort(key=lambda item: item[0], reverse=True)
+    expired.extend((f, size) for _, f, size in charts[max(max_files, 0):])
+    expired_keys = {m.group(1) for f, _ in expired if (m := _CHART_KEY_PATTERN.search(f.name))}
+    if CHART_SERIES_DIR.exists():
+        for f in CHART_SERIES_DIR.glob("*.json"):
+            try:
+                stat = f.stat()
+            except OSError:
+                continue
+            if f.stem in expired_keys or now - stat.st_mtime > ttl_days * 86400:
+                expired.append((f, stat.st_size))
+
+    deleted_count = 0
+    deleted_bytes = 0
+    for f, size in expired:
+        try:
+            f.unlink()
+            deleted_count += 1
+            deleted_bytes += size
+        except OSError as e:
+            logger.warning(f"缓存图删除失败：{f.name} - {e}")
+    return deleted_count, deleted_bytes
+
+
+def _synthetic_ohlcv(days: int, seed: int = 42) -> pd.DataFrame:
+    """生成与 days 自然日跨度等长（按交易日计）的随机游走日线，供基准测试使用"""
+    import numpy as np
+
+    bars = max(int(days * 5 / 7), 2)
+    rng = np.random.default_rng(seed)
+    closes = 100 * np.cumprod(1 + rng.normal(0, 0.015, bars))
+    opens = np.r_[closes[0], closes[:-1]] * (1 + rng.normal(0, 0.004, bars))
+    return pd.DataFrame(
+        {
+            "Open": opens,
+            "High": np.maximum(opens, closes) * 1.01,
+            "Low": np.minimum(opens, closes) * 0.99,
+            "Close": closes,
+            "Volume": rng.integers(1_000_000, 9_000_000, bars).astype(float),
+        },
+        index=pd.bdate_range("2025-01-01", periods=bars),
+    )
+
+
+def _benchmark_case(renderer: str, days: int, repeats: int, profile: str) -> Dict[str, Any]:
+    """在独立进程中测量单个 (渲染器, 跨度) 组合：预热后取中位耗时，并记录内存峰值"""
+    import resource
+    import statistics
+    import tempfile
+    import tracemalloc
+
+    hist = _synthetic_ohlcv(days)
+    init_renderer()
+    rss_before_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        chart_path = str(Path(tmp_dir) / f"bench.{get_render_profile(profile).fmt}")
+        render_kline(hist, chart_path, "bench", profile, renderer=renderer)  # 预热（原生渲染器在此创建复用画布）
+
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            render_kline(hist, chart_path, "bench", profile, renderer=renderer)
+            timings.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        render_kline(hist, chart_path, "bench", profile, renderer=renderer)
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        file_bytes = os.path.getsize(chart_path)
+
+    return {
+        "renderer": renderer,
+        "days": days,
+        "bars": len(hist),
+        "wall_ms": round(statistics.median(timings) * 1000, 1),
+        "python_peak_kb": round(traced_peak / 1024, 1),
+        "rss_growth_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before_kb,
+        "file_kb": round(file_bytes / 1024, 1),
+    }
+
+
+def benchmark_renderers(
+    day_ranges: Tuple[int, ...] = (30, 180, 365),
+    repeats: int = 5,
+    profile: str = DEFAULT_RENDER_PROFILE,
+) -> list:
+    """
+    对比 mplfinance 与原生渲染器在不同时间跨度下的耗时与内存。
+
+    每个组合在全新的 spawn 子进程中运行，互不共享已导入模块、画布与内存高水位。
+
+    Args:
+        day_ranges: 参与对比的时间跨度（自然日）
+        repeats: 每个组合预热后重复渲染的次数（耗时取中位数）
+        profile: 渲染档位名称
+
+    Returns:
+        list: 每个组合一行 {renderer, days, bars, wall_ms, python_peak_kb, rss_growth_kb, file_kb}
+    """
+    rows = []
+    context = multiprocessing.get_context("spawn")
+    for days in day_ranges:
+        for renderer in CHART_RENDERERS:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                rows.append(executor.submit(_benchmark_case, renderer, days, repeats, profile).result())
+    return rows
+
+
+def format_benchmark_report(rows: list) -> str:
+    """
+    将基准测试结果格式化为 Markdown 表格。
+
+    Args:
+        rows: benchmark_renderers 的返回值
+
+    Returns:
+        str: Markdown 表格（含原生渲染器相对 mplfinance 的加速比）
+    """
+    baseline = {row["days"]: row["wall_ms"] for row in rows if row["renderer"] == "mplfinance"}
+    lines = [
+        "| 渲染器 | 跨度 (天) | K 线数 | 耗时 (ms) | 加速比 | Python 内存峰值 (KB) | RSS 增长 (KB) | 文件 (KB) |",
+        "| :--- | :--- | :--- | :--- | :--- | :--- | :--- | :--- |",
+    ]
+    for row in rows:
+        speedup = baseline.get(row["days"], 0) / row["wall_ms"] if row["wall_ms"] else 0
+        lines.append(
+            f"| {row['renderer']} | {row['days']} | {row['bars']} | {row['wall_ms']:.1f} | {speedup:.2f}x | "
+            f"{row['python_peak_kb']:,.1f} | {row['rss_growth_kb']:,} | {row['file_kb']:.1f} |"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # 基准测试：python chart_engine.py
+    print(format_benchmark_report(benchmark_renderers()))
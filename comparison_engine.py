@@ -0,0 +1,240 @@
+"""
+多标的对比引擎 - 归一化走势叠加与向量化区间统计。
+
+本模块提供：
+1. 一次批量拉取多个标的（及历史汇率）的日线，对齐到共同起点
+2. 可选按历史汇率折算为人民币计价，消除不同市场的货币差异
+3. 起点归一化为 100 的价格矩阵与单张叠加对比图
+4. 区间收益、年化收益、年化波动率、最大回撤、最好 / 最差单日、相关系数矩阵（numpy 向量化计算）
+
+所有统计数值都由本模块算出，大模型只负责解读，不参与任何计算。
+"""
+
+import logging
+from pathlib import Path
+from typing import Dict, Any, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from valuation_engine import fetch_exchange_rates, fetch_price_history, format_universal_ticker
+from risk_engine import TRADING_DAYS_PER_YEAR, build_price_matrix, max_drawdown, price_to_returns
+from backtest_engine import FX_HISTORY_TICKERS, build_cny_price_matrix
+from chart_engine import render_comparison_cached
+
+logger = logging.getLogger(__name__)
+
+# 计价口径：native 为各自原生货币（归一化后可直接对比涨跌幅），CNY 为按历史汇率折算后的人民币
+COMPARISON_CURRENCIES = ("native", "CNY")
+
+DEFAULT_COMPARISON_DAYS = 180
+MAX_COMPARISON_DAYS = 5 * 366
+
+# 单张对比图最多叠加的曲线数（超过后图例与配色难以分辨）
+MAX_COMPARISON_TICKERS = 10
+
+# 计算统计指标所需的最少交易日数
+MIN_OBSERVATIONS = 5
+
+
+def rebase_to_100(prices: np.ndarray) -> np.ndarray:
+    """
+    将价格矩阵按首行归一化，使每列起点均为 100。
+
+    Args:
+        prices: 价格矩阵 T×N（首行无 NaN 且大于 0）
+
+    Returns:
+        np.ndarray: 归一化价格矩阵 T×N
+    """
+    if prices.shape[0] == 0:
+        return prices.copy()
+    return prices / prices[0] * 100.0
+
+
+def compute_comparison_stats(prices: np.ndarray, dates: pd.DatetimeIndex) -> Dict[str, np.ndarray]:
+    """
+    向量化计算各标的的区间统计（纯函数，不做任何 I/O）。
+
+    Args:
+        prices: 对齐后的价格矩阵 T×N（同一列内计价货币一致，且无 NaN）
+        dates: 日期索引 T
+
+    Returns:
+        dict: {
+            "total_return": N, "annualized_return": N, "volatility": N, "max_drawdown": N,
+            "best_day": N, "worst_day": N, "correlation": N×N
+        }，所有数组均为 numpy 类型
+    """
+    returns = price_to_returns(prices)
+    years = max((dates[-1] - dates[0]).days / 365.25, 1 / 365.25)
+    total_return = prices[-1] / prices[0] - 1.0
+
+    if returns.shape[0] >= 2:
+        volatility = returns.std(axis=0, ddof=1) * np.sqrt(TRADING_DAYS_PER_YEAR)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            correlation = np.corrcoef(returns, rowvar=False).reshape(prices.shape[1], prices.shape[1])
+        # 零波动（停牌）的列与任何标的均无相关性
+        correlation = np.nan_to_num(correlation, nan=0.0)
+        np.fill_diagonal(correlation, 1.0)
+    else:
+        volatility = np.zeros(prices.shape[1])
+        correlation = np.eye(prices.shape[1])
+
+    return {
+        "total_return": total_return,
+        "annualized_return": (1.0 + total_return) ** (1.0 / years) - 1.0,
+        "volatility": volatility,
+        "max_drawdown": max_drawdown(returns),
+        "best_day": returns.max(axis=0) if returns.shape[0] else np.zeros(prices.shape[1]),
+        "worst_day": returns.min(axis=0) if returns.shape[0] else np.zeros(prices.shape[1]),
+        "correlation": correlation,
+    }
+
+
+def _align_from_common_start(
+    history: Dict[str, pd.DataFrame],
+    tickers: List[str],
+    currency: str,
+) -> Tuple[np.ndarray, List[str], pd.DatetimeIndex]:
+    """
+    截取所有标的都有数据的共同区间并对齐为价格矩阵（CNY 口径下叠加历史汇率）。
+
+    归一化的基准日必须相同，否则上市较晚的标的会被「前值回填」成一段假的平线。
+    """
+    columns = [t for t in tickers if t in history and not history[t].empty and "Close" in history[t].columns]
+    if not columns:
+        return np.empty((0, 0)), [], pd.DatetimeIndex([])
+
+    common_start = max(history[t].index[0] for t in columns)
+    trimmed = {t: df[df.index >= common_start] for t, df in history.items() if not df.empty}
+
+    if currency == "CNY":
+        spot_rates = None
+        if any(t not in trimmed for t in FX_HISTORY_TICKERS.values()):
+            spot_rates = fetch_exchange_rates()
+        return build_cny_price_matrix(trimmed, columns, spot_rates)
+
+    prices, columns, dates = build_price_matrix(trimmed, columns)
+    return pd.DataFrame(prices).bfill().to_numpy(), columns, dates
+
+
+def compare_tickers(
+    tickers: List[str],
+    save_dir: Path,
+    days: int = DEFAULT_COMPARISON_DAYS,
+    currency: str = "native",
+    profile: str = "telegram",
+) -> Dict[str, Any]:
+    """
+    批量拉取多个标的的日线，归一化到 100 后生成一张叠加对比图并计算区间统计。
+
+    Args:
+        tickers: 股票代码列表（原始代码即可，内部自动格式化）
+        save_dir: 图片保存目录
+        days: 回看的自然日天数（上限 MAX_COMPARISON_DAYS）
+        currency: 计价口径，"native"（原生货币）或 "CNY"（按历史汇率折算）
+        profile: 渲染档位（telegram / pdf / thumbnail）
+
+    Returns:
+        dict: 可 JSON 序列化的对比结果，含 tickers / missing_history / start / end / observations /
+        currency / stats（逐标的）/ correlation / file_name / file_path / cache_hit
+
+    Raises:
+        ValueError: 标的数量不足或超过上限、不支持的计价口径、共同区间的历史数据不足
+    """
+    if currency not in COMPARISON_CURRENCIES:
+        raise ValueError(f"不支持的计价口径：{currency}，可选 {', '.join(COMPARISON_CURRENCIES)}")
+    formatted = list(dict.fromkeys(format_universal_ticker(t) for t in tickers if t.strip()))
+    if len(formatted) < 2:
+        raise ValueError("对比至少需要 2 个标的")
+    if len(formatted) > MAX_COMPARISON_TICKERS:
+        raise ValueError(f"单张对比图最多 {MAX_COMPARISON_TICKERS} 个标的，当前 {len(formatted)} 个")
+    days = max(MIN_OBSERVATIONS, min(int(days), MAX_COMPARISON_DAYS))
+
+    # 标的与汇率序列合并为一次批量请求
+    fetch_list = formatted + (list(FX_HISTORY_TICKERS.values()) if currency == "CNY" else [])
+    history = fetch_price_history(fetch_list, days=days)
+
+    prices, columns, dates = _align_from_common_start(history, formatted, currency)
+    if not columns or prices.shape[0] < MIN_OBSERVATIONS:
+        raise ValueError("共同区间内的历史数据不足，无法对比")
+
+    rebased = rebase_to_100(prices)
+    stats = compute_comparison_stats(prices, dates)
+
+    label = "CNY" if currency == "CNY" else "native ccy"
+    chart_path, cache_hit = render_comparison_cached(
+        pd.DataFrame(rebased, index=dates, columns=columns),
+        save_dir, days, f"\nRebased Performance ({label}, start = 100)", profile, currency
+    )
+
+    return {
+        "tickers": columns,
+        "missing_history": [t for t in formatted if t not in columns],
+        "start": dates[0].strftime("%Y-%m-%d"),
+        "end": dates[-1].strftime("%Y-%m-%d"),
+        "observations": int(len(dates)),
+        "currency": currency,
+        "stats": {
+            column: {
+                "rebased_end": round(float(rebased[-1, i]), 2),
+                "total_return": round(float(stats["total_return"][i]), 4),
+                "annualized_return": round(float(stats["annualized_return"][i]), 4),
+                "volatility": round(float(stats["volatility"][i]), 4),
+                "max_drawdown": round(float(stats["max_drawdown"][i]), 4),
+                "best_day": round(float(stats["best_day"][i]), 4),
+                "worst_day": round(float(stats["worst_day"][i]), 4),
+            }
+            for i, column in enumerate(columns)
+        },
+        "correlation": {
+            "tickers": columns,
+            "matrix": np.round(stats["correlation"], 4).tolist(),
+        },
+        "file_name": chart_path.name,
+        "file_path": str(chart_path),
+        "cache_hit": cache_hit,
+    }
+
+
+def format_comparison_report(comparison: Dict[str, Any]) -> str:
+    """
+    将 compare_tickers 的结果格式化为 Markdown 对比报告（不含图片语法）。
+
+    Args:
+        comparison: compare_tickers 的返回值
+
+    Returns:
+        str: Markdown 报告
+    """
+    currency_label = "人民币计价（含历史汇率）" if comparison["currency"] == "CNY" else "各自原生货币计价"
+    lines = [
+        f"### 📊 多标的归一化对比（{currency_label}，起点 = 100）",
+        "",
+        f"- **对比区间**: {comparison['start']} ~ {comparison['end']}（{comparison['observations']} 个交易日）",
+    ]
+    if comparison.get("missing_history"):
+        lines.append(f"- **缺少历史数据（未参与对比）**: {', '.join(comparison['missing_history'])}")
+    lines.extend([
+        "",
+        "| 标的代码 | 期末指数 | 区间收益 | 年化收益 | 年化波动率 | 最大回撤 | 最好单日 | 最差单日 |",
+        "| :--- | :--- | :--- | :--- | :--- | :--- | :--- | :--- |",
+    ])
+    ranked = sorted(comparison["stats"].items(), key=lambda item: item[1]["total_return"], reverse=True)
+    for ticker, row in ranked:
+        lines.append(
+            f"| {ticker} | {row['rebased_end']:.2f} | {row['total_return'] * 100:+.2f}% | "
+            f"{row['annualized_return'] * 100:+.2f}% | {row['volatility'] * 100:.2f}% | "
+            f"{row['max_drawdown'] * 100:.2f}% | {row['best_day'] * 100:+.2f}% | {row['worst_day'] * 100:+.2f}% |"
+        )
+
+    tickers: List[str] = comparison["correlation"]["tickers"]
+    if len(tickers) >= 2:
+        matrix = np.array(comparison["correlation"]["matrix"])
+        upper_i, upper_j = np.triu_indices(len(tickers), k=1)
+        pairs = sorted(zip(matrix[upper_i, upper_j], upper_i, upper_j), reverse=True)
+        pair_text = "；".join(f"{tickers[i]} / {tickers[j]} {value:.2f}" for value, i, j in pairs[:3])
+        lines.extend(["", f"**日收益相关性最高的组合**: {pair_text}"])
+
+    return "\n".join(lines)
@@ -32,15 +32,25 @@ from notifier import send_market_report_email
 
 socket.setdefaulttimeout(30)
 from valuation_engine import (
+    BENCHMARK_INDICES,
     fetch_stock_price_raw,
     parse_user_profile_to_positions,
     calculate_portfolio_valuation,
-    format_portfolio_report,
+    build_portfolio_report,
+    generate_portfolio_chart,
 )
+from report_model import PORTFOLIO_REPORT_PLACEHOLDER, Report, render_with_report
+from risk_engine import calculate_portfolio_risk, format_risk_report
+from backtest_engine import run_backtest, format_backtest_report
+from chart_engine import evict_chart_cache
+from kb_indexer import enqueue_kb_file
 
 
 console: Console = Console()
 
+# 盘后推送中持仓走势总览图的时间跨度（天）
+PORTFOLIO_CHART_DAYS: int = int(os.getenv("PORTFOLIO_CHART_DAYS", "90"))
+
 
 load_dotenv()
 
@@ -67,19 +77,9 @@ def fetch_global_indices() -> str:
         str: 格式化后的指数涨跌幅文本，格式如：
              "【今日核心指数】沪深 300: +1.25%, 恒生指数：-0.50%, 纳斯达克 100: +0.88%"
     """
-    indices_config: Dict[str, Dict[str, str]] = {
-        "沪深 300": {"ticker": "000300.SS", "name": "沪深 300"},
-        "恒生指数": {"ticker": "^HSI", "name": "恒生指数"},
-        "恒生科技指数": {"ticker": "HSTECH.HK", "name": "恒生科技指数"},
-        "纳斯达克 100": {"ticker": "^NDX", "name": "纳斯达克 100"},
-    }
-
     results: List[str] = []
 
-    for config in indices_config.values():
-        ticker: str = config["ticker"]
-        name: str = config["name"]
-
+    for name, ticker in BENCHMARK_INDICES.items():
         try:
             price_data = fetch_stock_price_raw(ticker)
             open_price: float = price_data["open"]
@@ -262,7 +262,7 @@ def generate_market_report(news_text: str, user_memory: str, indices_data: str,
 
     def pm_node(state: ReportState):
         console.print("[bold magenta]👨‍⚖️ [Agent 3] 投资总监正在进行多空对决裁决与最终排版...[/bold magenta]")
-        system_prompt = """你是一位顶级的华尔街投资总监（PM）。你需要审视激进策略师（Bull）和首席风控官（Bear）的辩论，结合用户的【精准财务明细】，输出最终的盘后研报。
+        system_prompt = f"""你是一位顶级的华尔街投资总监（PM）。你需要审视激进策略师（Bull）和首席风控官（Bear）的辩论，结合用户的【精准财务明细】，输出最终的盘后研报。
 
 你的回复必须严格采用 Markdown 格式，并强制包含以下三大核心模块：
 
@@ -271,16 +271,16 @@ def generate_market_report(news_text: str, user_memory: str, indices_data: str,
 - 提炼 Bull 和 Bear 的核心观点冲突，并给出你作为投资总监的最终客观评判（当前市场是该贪婪还是该恐惧？）。
 
 ### 2. 💰 专属市值与盈亏归因分析
-（在此处原封不动地插入系统提供的【精准财务数据】表格）
+（在此处单独一行原样输出占位符 {PORTFOLIO_REPORT_PLACEHOLDER}，系统会在推送前自动替换为【精准财务数据】对账单）
 （在此处结合多空双方的观点，对用户的【累计盈亏】进行深度归因分析）
 
 ### 3. ⚠️ 最终决断与调仓建议
-- 明确指出当前持仓最大的风险敞口在哪里。
+- 明确指出当前持仓最大的风险敞口在哪里（必须引用系统提供的【量化风险指标】中的波动率、Beta、VaR、最大回撤或相关性数值作为论据）。
 - 给出明确的、可操作的调仓建议（如：保持观望、降低某赛道仓位、逢低建仓等）。
 
 ==============================
 🚨【系统内部潜规则】（绝对禁止输出以下任何文字到最终报告中）：
-1. 财务表格防篡改：在第 2 部分开头插入财务表格时，必须一字不差、原样输出系统提供的数据，严禁修改任何一个字符或排版结构。
+1. 财务表格防篡改：第 2 部分开头只输出占位符 {PORTFOLIO_REPORT_PLACEHOLDER}（独占一行），严禁自行抄写、改写或重新排版财务表格。风险指标与回测收益只能引用系统提供的数值，严禁自行估算或编造。
 2. 列表换行强制要求：当你使用短横线 `- ` 输出列表项，或者输出表格时，在列表或表格的上方，必须强制空出一行（敲击两次回车）。严禁将列表项与上一段文字紧贴！
 3. 身份掩饰：绝对不要在报告中提到"根据你的指示"、"系统提示我"或"格式强制红线"等任何暴露你是 AI 或收到过内部指令的话语。
 """
@@ -289,6 +289,8 @@ def generate_market_report(news_text: str, user_memory: str, indices_data: str,
 【激进策略师观点】：\n{state['bull_analysis']}
 【首席风控官观点】：\n{state['bear_analysis']}
 【精准财务数据 - 持仓明细对账单】：\n{state['portfolio_metrics'].get("markdown_report", "暂无明细数据")}
+【量化风险指标】：\n{state['portfolio_metrics'].get("risk_report", "暂无风险指标")}
+【当前持仓近一年回测】：\n{state['portfolio_metrics'].get("backtest_report", "暂无回测数据")}
 
 请生成今日全球盘后报告：
 """
@@ -322,9 +324,27 @@ def generate_market_report(news_text: str, user_memory: str, indices_data: str,
     return final_state["final_report"]
 
 
+def embed_portfolio_chart(text: str, file_name: str) -> str:
+    """
+    将持仓走势总览图嵌入研报正文：紧跟在持仓对账单占位符之后，正文中没有占位符时追加到末尾。
+
+    Args:
+        text: 大模型生成的研报 Markdown 正文
+        file_name: agent_workspace 中的总览图文件名
+
+    Returns:
+        str: 嵌入图片语法后的正文
+    """
+    chart_block = f"📈 **持仓近 {PORTFOLIO_CHART_DAYS} 日走势总览**\n\n![持仓走势总览](./{file_name})"
+    if PORTFOLIO_REPORT_PLACEHOLDER in text:
+        return text.replace(PORTFOLIO_REPORT_PLACEHOLDER, f"{PORTFOLIO_REPORT_PLACEHOLDER}\n\n{chart_block}\n\n", 1)
+    return f"{text}\n\n{chart_block}"
+
+
 def cleanup_agent_workspace(threshold_mb: int = 500) -> None:
     """
     检查 agent_workspace 容量，超过阈值时按修改时间从旧到新删除文件。
+    K 线缓存图先按 chart_engine 的缓存策略淘汰（命中时会刷新修改时间，常用图不会被误删）。
 
     Args:
         threshold_mb: 触发清理的容量阈值（MB），默认 500MB
@@ -333,6 +353,11 @@ def cleanup_agent_workspace(threshold_mb: int = 500) -> None:
     if not workspace.exists():
         return
 
+    # 先按缓存策略淘汰过期 / 超量的 K 线缓存图
+    chart_count, chart_bytes = evict_chart_cache(workspace)
+    if chart_count:
+        console.print(f"[bold dim]🗑️  [图表缓存] 淘汰 {chart_count} 张缓存图，释放 {chart_bytes / (1024 * 1024):.1f} MB[/bold dim]")
+
     files = [f for f in workspace.iterdir() if f.is_file()]
     total_bytes = sum(f.stat().st_size for f in files)
     total_mb = total_bytes / (1024 * 1024)
@@ -385,18 +410,52 @@ def job_routine() -> None:
     positions = parse_user_profile_to_positions(user_memory_dict)
     valuation = {}
     markdown_report = "暂无持仓数据"
+    portfolio_report: Report | None = None
+    risk_metrics: Dict[str, Any] = {}
+    backtest: Dict[str, Any] = {}
     if positions:
         valuation = calculate_portfolio_valuation(positions)
-        markdown_report = format_portfolio_report(valuation)
+        portfolio_report = build_portfolio_report(valuation)
+        markdown_report = portfolio_report.to_markdown()
         console.print(f"[bold dim]💰 [财务计算] 总市值：¥{valuation['total_market_value']:,.2f}, 累计盈亏：¥{valuation['total_profit_loss']:,.2f} ({valuation['profit_loss_percent']:+.2f}%)[/bold dim]")
 
+        try:
+            risk_metrics = calculate_portfolio_risk(valuation)
+            if risk_metrics:
+                console.print(f"[bold dim]🛡️ [风险计算] 年化波动率：{risk_metrics['portfolio']['volatility']}, 单日 VaR：¥{risk_metrics['portfolio']['var_cny']:,.2f}[/bold dim]")
+        except Exception as e:
+            console.print(f"[bold yellow]⚠️  [风险计算] 失败，研报将不含量化风险指标：{type(e).__name__} - {e}[/bold yellow]")
+
+        try:
+            backtest = run_backtest(positions, days=365)
+            if backtest:
+                summary = backtest["strategies"]["当前持仓"]["summary"]
+                console.print(f"[bold dim]⏪ [持仓回测] 近一年累计收益：{summary['total_return'] * 100:+.2f}%, 最大回撤：{summary['max_drawdown'] * 100:.2f}%[/bold dim]")
+        except Exception as e:
+            console.print(f"[bold yellow]⚠️  [持仓回测] 失败，研报将不含历史回测：{type(e).__name__} - {e}[/bold yellow]")
+
     portfolio_metrics = {
         "total_market_value": valuation.get("total_market_value", 0.0),
         "total_pnl": valuation.get("total_profit_loss", 0.0),
         "total_pnl_percent": valuation.get("profit_loss_percent", 0.0),
         "markdown_report": markdown_report,
+        "risk": risk_metrics,
+        "risk_report": format_risk_report(risk_metrics),
+        "backtest": backtest,
+        "backtest_report": format_backtest_report(backtest),
     }
 
+    portfolio_chart_name: str = ""
+    if positions:
+        try:
+            chart_data = generate_portfolio_chart(
+                list(positions), Path("./agent_workspace").resolve(), PORTFOLIO_CHART_DAYS
+            )
+            portfolio_chart_name = chart_data["file_name"]
+            console.print(f"[bold dim]📈 [走势总览] {len(chart_data['tickers'])} 个标的已拼版为一张图：{portfolio_chart_name}[/bold dim]")
+        except Exception as e:
+            console.print(f"[bold yellow]⚠️  [走势总览] 生成失败，推送将不含走势图：{type(e).__name__} - {e}[/bold yellow]")
+
     indices_data: str = fetch_global_indices()
     console.print(f"[bold dim]📊 [指数数据] {indices_data}[/bold dim]")
 
@@ -416,15 +475,24 @@ def job_routine() -> None:
 
     file_name: str = f"盘后日报_{datetime.now().strftime('%Y-%m-%d_%H%M')}.md"
 
+    archived_content: str = render_with_report(
+        report_content, portfolio_report, render_text=lambda text: text, render_report=Report.to_markdown
+    )
     with open(kb_dir / file_name, "w", encoding="utf-8") as f:
-        f.write(report_content)
+        f.write(archived_content)
 
     console.print(f"[bold green]💾 [知识库归档] 报告快照已成功沉淀至：{file_name}[/bold green]")
 
+    # 只投递索引任务，由机器人进程的后台 worker 完成向量化
+    try:
+        enqueue_kb_file(file_name, "daily_report")
+    except Exception as e:
+        console.print(f"[bold yellow]⚠️ [知识库归档] 索引任务投递失败，将在首次检索时建索引：{type(e).__name__} - {e}[/bold yellow]")
+
     subject: str = f"盘后报告 | {datetime.now().strftime('%Y-%m-%d')}"
 
     try:
-        send_market_report_email(subject, report_content)
+        send_market_report_email(subject, report_content, portfolio_report)
         console.print("[bold green]📧 [邮件推送] 报告已成功发送[/bold green]")
     except Exception as e:
         console.print(f"[bold red]❌ [邮件推送] 发送失败：{type(e).__name__} - {str(e)}[/bold red]")
@@ -436,7 +504,8 @@ def job_routine() -> None:
         console.print("[bold yellow]🚀 [Telegram 推送] 正在调用渲染引擎下发移动端...[/bold yellow]")
         
         # 启动 asyncio 事件循环，强行拉起跨进程的推送逻辑
-        asyncio.run(broadcast_to_telegram(report_content))
+        telegram_content = embed_portfolio_chart(report_content, portfolio_chart_name) if portfolio_chart_name else report_content
+        asyncio.run(broadcast_to_telegram(telegram_content, portfolio_report))
         
         console.print("[bold green]📱 [Telegram 推送] 研报已成功渲染并推送到手机！[/bold green]")
     except Exception as e:
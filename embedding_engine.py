@@ -0,0 +1,552 @@
+"""
+向量化引擎 - 文档块向量的持久化缓存。
+
+本模块提供：
+1. 以 hash(模型名, 块文本) 为键的 SQLite 向量缓存（位于 ./embeddings 目录）
+2. 包装任意 LangChain Embeddings 的缓存层：重建索引时只为从未见过的文本块调用远端模型
+3. 命中 / 未命中统计
+4. 批量 + 并发 + 限速的向量化管道：按模型单次请求上限分批，多批并发，令牌桶限制请求速率，
+   网络错误与限流按指数退避重试，并回调进度
+5. 查询向量的持久化 LRU：同一（或仅空白、全半角、结尾标点不同的）问题不再重复请求远端模型
+6. 可插拔的向量后端（EMBEDDING_BACKEND）：dashscope 远端模型、local 纯 CPU 特征哈希、fake 确定性随机向量，
+   后端标识参与缓存键并写入索引元数据，不同后端的向量不会混用
+
+知识库文件被修改甚至只是 touch 一下，mtime 变化都会触发整份文档重新向量化；
+每日盘后日报之间也有大段相同的模板内容。按内容哈希缓存后，这些块只需付费向量化一次。
+"""
+
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import unicodedata
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from tenacity import Retrying, retry_if_exception_type, stop_after_attempt, wait_exponential
+
+from kb_lexical import tokenize
+
+logger = logging.getLogger(__name__)
+
+# 向量缓存数据库路径（与 FAISS 持久化索引同目录）
+EMBEDDING_CACHE_PATH = Path(os.getenv("EMBEDDING_CACHE_PATH", "./embeddings/embedding_cache.sqlite3"))
+
+# SQLite 单条语句的绑定参数上限为 999（旧版本），批量查询按此分段
+_SQLITE_MAX_VARIABLES = 900
+
+# 单次请求的文本块数（text-embedding-v3 服务端上限为 10）
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "10"))
+
+# 同时在途的请求数
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+
+# 每秒最多发起的请求数（<= 0 表示不限速）
+EMBEDDING_RATE_LIMIT = float(os.getenv("EMBEDDING_RATE_LIMIT", "20"))
+
+# 单批请求的最大尝试次数（网络错误 / 限流 / 5xx 时指数退避重试）
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "5"))
+
+# 缓存未命中的块每累计多少块写一次缓存：重建中途失败时已付费的向量不会丢失
+EMBEDDING_CACHE_FLUSH_EVERY = int(os.getenv("EMBEDDING_CACHE_FLUSH_EVERY", "200"))
+
+# 查询向量 LRU 的最大条数（按最近使用时间淘汰）
+QUERY_EMBEDDING_CACHE_MAX = int(os.getenv("QUERY_EMBEDDING_CACHE_MAX", "5000"))
+
+# 向量后端：dashscope（远端，生产默认）/ local（纯 CPU 特征哈希，离线可用）/ fake（确定性随机向量，测试与基准）
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "dashscope").strip().lower()
+EMBEDDING_BACKENDS = ("dashscope", "local", "fake")
+
+# DashScope 远端模型名
+DASHSCOPE_EMBEDDING_MODEL = os.getenv("DASHSCOPE_EMBEDDING_MODEL", "text-embedding-v3")
+
+# 本地后端与假后端的向量维度
+LOCAL_EMBEDDING_DIM = int(os.getenv("LOCAL_EMBEDDING_DIM", "512"))
+FAKE_EMBEDDING_DIM = int(os.getenv("FAKE_EMBEDDING_DIM", "64"))
+
+# 进度回调：(已完成块数, 总块数)
+ProgressCallback = Callable[[int, int], None]
+
+
+def embedding_cache_key(model: str, text: str) -> str:
+    """
+    计算文本块的缓存键：sha256(模型名 + 分隔符 + 文本)。
+
+    同一段文本在不同模型下的向量互不通用，因此模型名必须参与哈希。
+    """
+    return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+
+_TRAILING_PUNCTUATION = "?!.,;:~ \u3002\uff1f\uff01\uff0c\uff1b\uff1a"
+
+
+def normalize_query(text: str) -> str:
+    """
+    查询文本归一化：NFKC（全角转半角）、合并连续空白、去掉结尾标点。
+
+    Example:
+        >>> normalize_query("  茅台  ６００５１９ 的股息率？ ")
+        '茅台 600519 的股息率'
+    """
+    text = re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+    return text.rstrip(_TRAILING_PUNCTUATION)
+
+
+class EmbeddingCache:
+    """
+    基于 SQLite 的文本块向量缓存（向量以 float32 字节存储）。
+
+    单个连接 + 互斥锁即可满足本项目的并发量；WAL 模式允许 Telegram 机器人与
+    定时任务等多个进程同时读写同一个缓存文件。
+    """
+
+    def __init__(self, path: Path = EMBEDDING_CACHE_PATH) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, model TEXT NOT NULL, dim INTEGER NOT NULL, vector BLOB NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS query_embeddings ("
+            "key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL, used_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, List[float]]:
+        """
+        批量读取缓存向量。
+
+        Returns:
+            dict: {键: 向量}，只包含命中的键
+        """
+        found: Dict[str, List[float]] = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            for start in range(0, len(unique), _SQLITE_MAX_VARIABLES):
+                batch = unique[start:start + _SQLITE_MAX_VARIABLES]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, model: str, items: Dict[str, List[float]]) -> None:
+        """批量写入向量（键已存在时覆盖）"""
+        if not items:
+            return
+        rows = [
+            (key, model, len(vector), np.asarray(vector, dtype=np.float32).tobytes())
+            for key, vector in items.items()
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, dim, vector) VALUES (?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
+
+    def count(self, model: Optional[str] = None) -> int:
+        """缓存中的向量条数（可按模型过滤）"""
+        with self._lock:
+            if model is None:
+                return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings WHERE model = ?", (model,)).fetchone()[0]
+
+    def get_query(self, key: str) -> Optional[List[float]]:
+        """读取查询向量（命中时刷新最近使用时间）"""
+        with self._lock:
+            row = self._conn.execute("SELECT vector FROM query_embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE query_embeddings SET used_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return np.frombuffer(row[0], dtype=np.float32).tolist()
+
+    def put_query(self, model: str, key: str, vector: List[float], max_entries: int = QUERY_EMBEDDING_CACHE_MAX) -> None:
+        """写入查询向量，超过 max_entries 时淘汰最久未使用的条目"""
+        blob = np.asarray(vector, dtype=np.float32).tobytes()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO query_embeddings (key, model, vector, used_at) VALUES (?, ?, ?, ?)",
+                (key, model, blob, time.time()),
+            )
+            self._conn.execute(
+                "DELETE FROM query_embeddings WHERE key IN (SELECT key FROM query_embeddings ORDER BY used_at ASC "
+                "LIMIT MAX((SELECT COUNT(*) FROM query_embeddings) - ?, 0))",
+                (max(max_entries, 0),),
+            )
+            self._conn.commit()
+
+    def query_count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    带内容哈希缓存的 Embeddings 包装器。
+
+    embed_documents 只把缓存未命中的文本块交给底层模型，结果写回缓存后按原顺序返回；
+    embed_query 按归一化后的查询文本查持久化 LRU：Agent 在同一轮对话里反复追问、
+    或多个用户在日报推送后问同一个问题时，不再重复请求远端模型。
+    未命中的块每 EMBEDDING_CACHE_FLUSH_EVERY 块落盘一次，并回调 progress(已完成, 未命中总数)。
+    """
+
+    def __init__(
+        self,
+        underlying: Embeddings,
+        model: str,
+        cache: Optional[EmbeddingCache] = None,
+        progress: Optional[ProgressCallback] = None,
+    ) -> None:
+        self.underlying = underlying
+        self.model = model
+        self.cache = cache if cache is not None else get_embedding_cache()
+        self.progress = progress
+        self.hits = 0
+        self.misses = 0
+        self.query_hits = 0
+        self.query_misses = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [embedding_cache_key(self.model, text) for text in texts]
+        cached = self.cache.get_many(keys)
+
+        # 同一批次内重复的文本块也只向量化一次
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        # 分段向量化并逐段落盘
+        pending = list(missing.items())
+        step = max(EMBEDDING_CACHE_FLUSH_EVERY, 1)
+        for start in range(0, len(pending), step):
+            segment = pending[start:start + step]
+            vectors = self.underlying.embed_documents([text for _, text in segment])
+            fresh = {key: vector for (key, _), vector in zip(segment, vectors)}
+            self.cache.put_many(self.model, fresh)
+            cached.update(fresh)
+            if self.progress is not None:
+                self.progress(start + len(segment), len(pending))
+
+        # 命中 = 无需调用底层模型即可得到向量的块（含同批次内的重复块）
+        hits = len(texts) - len(missing)
+        self.hits += hits
+        self.misses += len(missing)
+        if texts:
+            logger.info(f"🧮 文本块向量化：{len(texts)} 块，缓存命中 {hits}，新增 {len(missing)}")
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        # 查询向量与文档向量的编码方式不同（text_type=query），使用独立的键空间
+        key = embedding_cache_key(f"{self.model}#query", normalize_query(text))
+        vector = self.cache.get_query(key)
+        if vector is not None:
+            self.query_hits += 1
+            return vector
+        vector = self.underlying.embed_query(text)
+        self.cache.put_query(self.model, key, vector)
+        self.query_misses += 1
+        return vector
+
+
+class RateLimiter:
+    """
+    线程安全的令牌桶限速器。
+
+    桶容量等于每秒速率，允许短时突发；rate <= 0 时不限速。
+    """
+
+    def __init__(self, rate: float) -> None:
+        self.rate = float(rate)
+        self._capacity = max(self.rate, 1.0)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """取得一个令牌，不足时阻塞等待"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class BatchedEmbeddings(Embeddings):
+    """
+    批量、并发、限速的 Embeddings 包装器。
+
+    把文本块按 batch_size 切批，最多 concurrency 批同时在途，每次请求前向令牌桶取令牌；
+    网络错误、超时与 HTTP 限流 / 5xx（requests 的 HTTPError 属于 OSError）按指数退避重试，
+    参数错误等不可恢复异常直接抛出。返回顺序与输入一致。
+    """
+
+    def __init__(
+        self,
+        underlying: Embeddings,
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+        concurrency: int = EMBEDDING_CONCURRENCY,
+        rate_limit: float = EMBEDDING_RATE_LIMIT,
+        max_retries: int = EMBEDDING_MAX_RETRIES,
+        backoff_base: float = 1.0,
+        progress: Optional[ProgressCallback] = None,
+    ) -> None:
+        self.underlying = underlying
+        self.batch_size = max(int(batch_size), 1)
+        self.concurrency = max(int(concurrency), 1)
+        self.limiter = RateLimiter(rate_limit)
+        self.max_retries = max(int(max_retries), 1)
+        self.backoff_base = max(float(backoff_base), 0.0)
+        self.progress = progress
+        self.retries = 0
+        self.last_run: Dict[str, float] = {}
+        self._retries_lock = threading.Lock()
+
+    def _count_retry(self, retry_state) -> None:
+        with self._retries_lock:
+            self.retries += 1
+        logger.warning(
+            f"⚠️ 向量化请求失败，第 {retry_state.attempt_number} 次重试："
+            f"{type(retry_state.outcome.exception()).__name__}"
+        )
+
+    def _call(self, fn: Callable[[], List]) -> List:
+        for attempt in Retrying(
+            stop=stop_after_attempt(self.max_retries),
+            wait=wait_exponential(multiplier=self.backoff_base, min=0, max=30 * self.backoff_base),
+            retry=retry_if_exception_type((ConnectionError, TimeoutError, OSError)),
+            before_sleep=self._count_retry,
+            reraise=True,
+        ):
+            with attempt:
+                self.limiter.acquire()
+                return fn()
+        return []
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        results: List[Optional[List[List[float]]]] = [None] * len(batches)
+        started = time.perf_counter()
+        done = 0
+
+        workers = min(self.concurrency, len(batches))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embed") as pool:
+            futures = {
+                pool.submit(self._call, lambda batch=batch: self.underlying.embed_documents(batch)): i
+                for i, batch in enumerate(batches)
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                results[index] = future.result()
+                done += len(batches[index])
+                if self.progress is not None:
+                    self.progress(done, len(texts))
+
+        elapsed = time.perf_counter() - started
+        self.last_run = {
+            "chunks": len(texts),
+            "batches": len(batches),
+            "seconds": round(elapsed, 3),
+            "chunks_per_second": round(len(texts) / elapsed, 1) if elapsed > 0 else float("inf"),
+        }
+        logger.info(
+            f"🧮 批量向量化完成：{len(texts)} 块 / {len(batches)} 批，并发 {workers}，"
+            f"耗时 {elapsed:.2f}s（{self.last_run['chunks_per_second']} 块/秒）"
+        )
+        return [vector for batch in results for vector in batch]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._call(lambda: self.underlying.embed_query(text))
+
+
+_embedding_cache: Optional[EmbeddingCache] = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """进程级向量缓存单例（首次使用时打开数据库）"""
+    global _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH)
+        return _embedding_cache
+
+
+# ==========================================
+# 向量后端
+# ==========================================
+class FakeEmbeddings(Embeddings):
+    """
+    确定性假向量：以文本哈希为种子生成标准正态向量。
+
+    同一文本在任何进程中得到相同向量，不同文本之间没有语义关系；用于单元测试与吞吐基准，
+    不适合评估检索质量（那需要 local 后端）。
+    """
+
+    def __init__(self, dim: int = FAKE_EMBEDDING_DIM) -> None:
+        self.dim = dim
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._vector(text)
+
+    def _vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+        return np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32).tolist()
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    纯 CPU 的特征哈希向量：词项（中文字符 n-gram、英文 / 数字整词，分词同 kb_lexical）
+    经 CRC32 映射到固定维度并带符号累加，词频取 1 + log(tf)，最后 L2 归一化。
+
+    不需要模型文件与网络，单核每秒可处理上千个文本块；字面重合度越高向量越接近，
+    语义泛化能力弱于远端模型，适合离线运行、CI 与检索管道的性能基准。
+    """
+
+    def __init__(self, dim: int = LOCAL_EMBEDDING_DIM) -> None:
+        self.dim = dim
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._vector(text)
+
+    def _vector(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        counts: Dict[str, int] = {}
+        for token in tokenize(text):
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            h = zlib.crc32(token.encode("utf-8"))
+            # 最高位决定符号，降低哈希碰撞带来的系统性偏差
+            vector[h % self.dim] += (1.0 + np.log(count)) * (1.0 if h >> 31 else -1.0)
+        norm = float(np.linalg.norm(vector))
+        return (vector / norm if norm > 0 else vector).tolist()
+
+
+def embedding_model_id(backend: str = EMBEDDING_BACKEND) -> str:
+    """
+    向量后端的模型标识：参与向量缓存键，并写入索引元数据用于校验。
+
+    DashScope 沿用模型名本身，已有的缓存与索引保持有效。
+
+    Raises:
+        ValueError: 未知的后端
+    """
+    if backend == "dashscope":
+        return DASHSCOPE_EMBEDDING_MODEL
+    if backend == "local":
+        return f"local-hashing-{LOCAL_EMBEDDING_DIM}"
+    if backend == "fake":
+        return f"fake-{FAKE_EMBEDDING_DIM}"
+    raise ValueError(f"未知的向量后端：{backend}（可选 {', '.join(EMBEDDING_BACKENDS)}）")
+
+
+def create_embeddings(backend: str = EMBEDDING_BACKEND, api_key: Optional[str] = None) -> Tuple[Embeddings, str]:
+    """
+    按配置创建底层向量模型（不含缓存层）。
+
+    Args:
+        backend: dashscope / local / fake
+        api_key: DashScope 向量模型的 API Key（仅 dashscope 需要）
+
+    Returns:
+        (Embeddings, 模型标识)：dashscope 已包装批量并发限速层（重试统一由批量层的指数退避负责）
+
+    Raises:
+        ValueError: 未知的后端，或 dashscope 缺少 API Key
+    """
+    model = embedding_model_id(backend)
+    if backend == "local":
+        return HashingEmbeddings(LOCAL_EMBEDDING_DIM), model
+    if backend == "fake":
+        return FakeEmbeddings(FAKE_EMBEDDING_DIM), model
+    if not api_key:
+        raise ValueError("dashscope 向量后端需要 DASHSCOPE_EMBEDDING_KEY")
+    from langchain_community.embeddings import DashScopeEmbeddings
+
+    return BatchedEmbeddings(DashScopeEmbeddings(dashscope_api_key=api_key, model=model, max_retries=1)), model
+
+
+class _SimulatedRemoteEmbeddings(FakeEmbeddings):
+    """
+    基准测试用的本地替身：在确定性假向量之上模拟远端向量服务的请求往返延迟与逐块计算耗时，
+    不发起任何网络请求。
+    """
+
+    def __init__(self, dim: int = 1024, latency: float = 0.12, per_chunk: float = 0.004) -> None:
+        super().__init__(dim)
+        self.latency = latency
+        self.per_chunk = per_chunk
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency + self.per_chunk * len(texts))
+        return super().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+if __name__ == "__main__":
+    # 用法：python embedding_engine.py [块数]，对比不同批量 / 并发配置的吞吐（块/秒）
+    import sys
+
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    chunks = [f"第 {i} 段：研报正文示例文本。" * 20 for i in range(total)]
+    stand_in = _SimulatedRemoteEmbeddings()
+
+    print(f"| 配置 | 批量 | 并发 | 限速(请求/秒) | 耗时 s | 吞吐 块/秒 |")
+    print("| :--- | ---: | ---: | ---: | ---: | ---: |")
+    configs = [
+        ("逐块串行", 1, 1, 0),
+        ("批量串行（原 DashScope 行为）", 10, 1, 0),
+        ("批量 + 并发 2", 10, 2, EMBEDDING_RATE_LIMIT),
+        ("批量 + 并发 4", 10, 4, EMBEDDING_RATE_LIMIT),
+        ("批量 + 并发 8", 10, 8, EMBEDDING_RATE_LIMIT),
+    ]
+    for label, batch_size, concurrency, rate in configs:
+        sample = chunks if batch_size > 1 else chunks[:max(total // 10, 10)]
+        embedder = BatchedEmbeddings(stand_in, batch_size=batch_size, concurrency=concurrency, rate_limit=rate)
+        embedder.embed_documents(sample)
+        run = embedder.last_run
+        print(
+            f"| {label} | {batch_size} | {concurrency} | {rate or '不限'} | "
+            f"{run['seconds']:.2f} | {run['chunks_per_second']:.1f} |"
+        )
+
+    # 本地后端无网络往返，直接串行计算
+    for label, local in (("本地特征哈希 (local)", HashingEmbeddings()), ("确定性假向量 (fake)", FakeEmbeddings())):
+        started = time.perf_counter()
+        local.embed_documents(chunks)
+        elapsed = time.perf_counter() - started
+        print(f"| {label} | - | 1 | - | {elapsed:.2f} | {total / elapsed:.1f} |")
@@ -0,0 +1,1117 @@
+"""
+知识库引擎 - 向量索引的内存管理与跨文档全局索引。
+
+本模块提供：
+1. 向量库常驻内存体积估算（向量 + 文档库 + 映射表）
+2. 按字节预算（而非文件个数）约束的 LRU 向量库内存池
+3. 按文件名显式失效、文件版本（mtime）变化时自动替换旧条目
+4. 同一文件的并发加载只执行一次（按文件名分段加锁）
+5. 命中 / 未命中 / 淘汰 / 常驻字节数统计
+6. 知识库文档的流式切块与逐批建库（解析细节见 kb_loader）
+7. 跨文档全局索引：每个文本块带来源文件元数据，支持按文件集合精确过滤检索，
+   文件新增 / 修改 / 删除时只增量更新对应文本块
+8. 按规模自动切换索引类型（小库精确 Flat，大库 HNSW / IVF-PQ 近似检索）与检索参数调优
+9. 磁盘索引的内存映射加载与原子落盘
+10. 词法（BM25，见 kb_lexical）+ 向量混合检索；查询向量化超时或向量服务不可用时降级为纯词法检索
+11. 短时检索结果缓存：(文件集合, 查询, k) → 文本块，索引变化时按文件失效
+
+大 PDF 的索引动辄上百 MB，而日报、笔记类小文件只有几百 KB，
+按个数限制会让前者撑爆容器内存、后者被无谓淘汰，因此改为按估算字节数限制。
+"""
+
+import os
+import json
+import math
+import uuid
+import pickle
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from embedding_engine import normalize_query
+from kb_lexical import BM25Index, reciprocal_rank_fusion, search_segments
+from kb_loader import iter_chunk_batches, iter_document_chunks
+
+logger = logging.getLogger(__name__)
+
+# 向量库内存池的字节预算（MB）
+VECTORSTORE_CACHE_MAX_MB = float(os.getenv("VECTORSTORE_CACHE_MAX_MB", "512"))
+
+# 每个文档块在 docstore / 映射表中的固定开销估算（Document 对象、dict 槽位、UUID 字符串）
+_PER_DOCUMENT_OVERHEAD_BYTES = 400
+
+# HNSW 图每个节点每层的邻居表按 int32 存储
+_HNSW_LINK_BYTES = 4
+
+
+def estimate_vectorstore_bytes(vectorstore: Any) -> int:
+    """
+    估算 LangChain FAISS 向量库的常驻内存字节数。
+
+    向量部分按索引的编码长度计算（Flat 为 d × 4 字节，PQ 为子量化器字节数），HNSW 额外计入邻居表；
+    文档部分按正文 UTF-8 字节数 + 元数据字符串长度 + 固定对象开销计算。
+
+    Args:
+        vectorstore: langchain_community.vectorstores.FAISS 对象
+
+    Returns:
+        int: 估算字节数（无法识别的对象返回 0）
+    """
+    index = getattr(vectorstore, "index", None)
+    if index is None:
+        return 0
+
+    ntotal = int(getattr(index, "ntotal", 0))
+    dim = int(getattr(index, "d", 0))
+    code_size = int(getattr(index, "code_size", 0) or dim * 4)
+    # 内存映射加载的向量由系统页缓存承载、可随时回收，不计入常驻内存
+    total = 0 if getattr(vectorstore, "_mmap_backed", False) else ntotal * code_size
+
+    hnsw = getattr(index, "hnsw", None)
+    if hnsw is not None:
+        # HNSW 第 0 层邻居数为 2M，上层平均不到 1 层，按 2M + M 近似
+        total += ntotal * 3 * int(hnsw.nb_neighbors(1)) * _HNSW_LINK_BYTES
+
+    docstore = getattr(getattr(vectorstore, "docstore", None), "_dict", {}) or {}
+    for document in docstore.values():
+        total += len(getattr(document, "page_content", "").encode("utf-8"))
+        total += len(str(getattr(document, "metadata", "")))
+        total += _PER_DOCUMENT_OVERHEAD_BYTES
+
+    lexical = getattr(vectorstore, "_lexical_index", None)
+    if lexical is not None:
+        total += lexical.nbytes
+    return total
+
+
+class VectorStoreCache:
+    """
+    按字节预算淘汰的向量库 LRU 内存池。
+
+    条目以文件名为键并记录文件版本（mtime）：版本不一致视为未命中，旧条目立即释放，
+    不会像以 (文件名, mtime) 为键的 lru_cache 那样让过期索引继续占用内存。
+    单个索引超过整个预算时只返回、不入池。
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        estimate: Callable[[Any], int] = estimate_vectorstore_bytes,
+    ) -> None:
+        self.max_bytes = max(int(max_bytes), 0)
+        self._estimate = estimate
+        self._entries: "OrderedDict[str, Tuple[Any, Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 同一文件的并发加载只执行一次（按文件名分段加锁，锁数量固定）
+        self._load_locks = [threading.Lock() for _ in range(16)]
+        self._resident_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+        self._rejected = 0
+
+    def _drop(self, name: str) -> None:
+        _, _, size = self._entries.pop(name)
+        self._resident_bytes -= size
+
+    def get(self, name: str, version: Any) -> Optional[Any]:
+        """
+        读取缓存的向量库；版本不一致的旧条目会被释放。
+
+        Returns:
+            Optional[Any]: 命中时返回向量库，否则返回 None（同时计一次未命中）
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(name)
+                self._hits += 1
+                return entry[1]
+            if entry is not None:
+                self._drop(name)
+                self._invalidations += 1
+            self._misses += 1
+            return None
+
+    def put(self, name: str, version: Any, value: Any) -> bool:
+        """
+        放入向量库，并按最近使用顺序淘汰直到总字节数回到预算内。
+
+        Returns:
+            bool: 是否入池（超过整个预算的索引不入池）
+        """
+        size = max(int(self._estimate(value)), 0)
+        with self._lock:
+            if name in self._entries:
+                self._drop(name)
+            if size > self.max_bytes:
+                self._rejected += 1
+                logger.warning(f"向量库 {name} 估算 {size / 1024 / 1024:.1f} MB，超过内存池预算，本次不缓存")
+                return False
+            while self._entries and self._resident_bytes + size > self.max_bytes:
+                evicted = next(iter(self._entries))
+                self._drop(evicted)
+                self._evictions += 1
+                logger.info(f"向量库内存池淘汰：{evicted}")
+            self._entries[name] = (version, value, size)
+            self._resident_bytes += size
+            return True
+
+    def get_or_load(self, name: str, version: Any, loader: Callable[[], Any]) -> Any:
+        """
+        读取缓存，未命中时调用 loader 加载并入池（同一文件的并发请求只加载一次）。
+
+        Args:
+            name: 文件名
+            version: 文件版本（如 mtime），变化后旧条目失效
+            loader: 无参加载函数，返回向量库
+
+        Returns:
+            Any: 向量库
+        """
+        value = self.get(name, version)
+        if value is not None:
+            return value
+        with self._load_locks[hash(name) % len(self._load_locks)]:
+            # 等锁期间其他线程可能已完成加载
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is not None and entry[0] == version:
+                    self._entries.move_to_end(name)
+                    return entry[1]
+            value = loader()
+            self.put(name, version, value)
+            return value
+
+    def invalidate(self, name: str) -> bool:
+        """
+        按文件名显式失效（文件被覆盖 / 删除 / 重新归档时调用）。
+
+        Returns:
+            bool: 是否存在并已释放
+        """
+        with self._lock:
+            if name not in self._entries:
+                return False
+            self._drop(name)
+            self._invalidations += 1
+            return True
+
+    def clear(self) -> None:
+        """清空内存池（统计计数保留）"""
+        with self._lock:
+            self._invalidations += len(self._entries)
+            self._entries.clear()
+            self._resident_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        内存池统计。
+
+        Returns:
+            dict: entries / resident_bytes / max_bytes / hits / misses / hit_rate / evictions / invalidations / rejected
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "resident_bytes": self._resident_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+                "rejected": self._rejected,
+            }
+
+
+# 进程级向量库内存池（Agent 工具与 Telegram 机器人共用）
+VECTORSTORE_CACHE = VectorStoreCache(int(VECTORSTORE_CACHE_MAX_MB * 1024 * 1024))
+
+
+# ==========================================
+# 检索结果缓存
+# ==========================================
+# 检索结果的存活时间（秒）与最大条数
+KB_RESULT_CACHE_TTL = float(os.getenv("KB_RESULT_CACHE_TTL", "300"))
+KB_RESULT_CACHE_MAX_ENTRIES = int(os.getenv("KB_RESULT_CACHE_MAX_ENTRIES", "256"))
+
+
+class RetrievalCache:
+    """
+    (命名空间, 文件集合, 查询, k) → 检索结果的短时 LRU 缓存。
+
+    查询按 normalize_query 归一化，仅空白、全半角或结尾标点不同的问题共用结果。
+    文件集合为 None 表示全库检索：任一文件变化都会让它失效；
+    限定文件集合的条目只在其中某个文件变化时失效。TTL 兜底跨进程写入（如盘后日报）等未显式失效的情况。
+    """
+
+    def __init__(self, ttl: float = KB_RESULT_CACHE_TTL, max_entries: int = KB_RESULT_CACHE_MAX_ENTRIES) -> None:
+        self.ttl = ttl
+        self.max_entries = max(int(max_entries), 0)
+        self._entries: "OrderedDict[Tuple, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def _key(namespace: Hashable, files: Optional[Iterable[str]], query: str, k: int) -> Tuple:
+        scope = frozenset(files) if files is not None else None
+        return (namespace, scope, normalize_query(query), k)
+
+    def get(self, namespace: Hashable, files: Optional[Iterable[str]], query: str, k: int) -> Optional[Any]:
+        """读取未过期的检索结果；未命中返回 None"""
+        key = self._key(namespace, files, query, k)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self._misses += 1
+            return None
+
+    def put(self, namespace: Hashable, files: Optional[Iterable[str]], query: str, k: int, value: Any) -> None:
+        key = self._key(namespace, files, query, k)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, file_name: str) -> int:
+        """
+        让涉及某个文件的结果失效（含全部全库检索结果）。
+
+        Returns:
+            int: 失效的条目数
+        """
+        with self._lock:
+            stale = [key for key in self._entries if key[1] is None or file_name in key[1]]
+            for key in stale:
+                del self._entries[key]
+            return len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """entries / hits / misses / hit_rate"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+# 进程级检索结果缓存（单文档检索与全局检索共用，以命名空间区分）
+RETRIEVAL_CACHE = RetrievalCache()
+
+
+def invalidate_vectorstore(file_name: str) -> bool:
+    """按文件名让内存池中的向量库及相关检索结果失效（知识库文件被写入 / 覆盖后调用）"""
+    RETRIEVAL_CACHE.invalidate(file_name)
+    return VECTORSTORE_CACHE.invalidate(file_name)
+
+
+def get_vectorstore_cache_stats() -> Dict[str, Any]:
+    """进程级向量库内存池的统计快照"""
+    return VECTORSTORE_CACHE.stats()
+
+
+# ==========================================
+# 文档解析与切块
+# ==========================================
+def load_document_chunks(path: Path) -> List[Any]:
+    """
+    解析知识库文档并切块（过滤空白块），一次性返回全部文本块。
+
+    大文档请直接消费 kb_loader.iter_document_chunks 的生成器，避免同时持有全部文本块。
+
+    Raises:
+        ValueError: 不支持的文件格式
+    """
+    return list(iter_document_chunks(path))
+
+
+def build_vectorstore_streaming(path: Path, embeddings: Any) -> Optional[Any]:
+    """
+    流式构建单个文档的 LangChain FAISS 向量库：文本块逐批向量化并写入索引。
+
+    Returns:
+        Optional[FAISS]: 向量库；文档没有任何有效文本时返回 None
+
+    Raises:
+        ValueError: 不支持的文件格式
+    """
+    from langchain_community.vectorstores import FAISS
+
+    store = None
+    for batch in iter_chunk_batches(iter_document_chunks(path)):
+        if store is None:
+            store = FAISS.from_documents(batch, embeddings)
+        else:
+            store.add_documents(batch)
+    if store is not None:
+        store._lexical_index = BM25Index.from_vectorstore(store)
+    return store
+
+
+# ==========================================
+# 索引类型选择、构建与持久化
+# ==========================================
+KB_INDEX_TYPES = ("flat", "hnsw", "ivfpq")
+
+# 文本块数达到该阈值后由精确 Flat 切换为近似索引；降到阈值一半以下时切回 Flat（避免来回抖动）
+KB_ANN_THRESHOLD = int(os.getenv("KB_ANN_THRESHOLD", "20000"))
+
+# 近似索引类型：hnsw（召回高、向量全量常驻）或 ivfpq（向量压缩约 64 倍，召回略低）
+KB_ANN_INDEX_TYPE = os.getenv("KB_ANN_INDEX_TYPE", "hnsw")
+
+# HNSW 参数：每个节点的邻居数、构建与检索时的候选队列长度
+KB_HNSW_M = int(os.getenv("KB_HNSW_M", "32"))
+KB_HNSW_EF_CONSTRUCTION = int(os.getenv("KB_HNSW_EF_CONSTRUCTION", "80"))
+KB_HNSW_EF_SEARCH = int(os.getenv("KB_HNSW_EF_SEARCH", "64"))
+
+# IVF 检索时探查的聚类桶数
+KB_IVF_NPROBE = int(os.getenv("KB_IVF_NPROBE", "16"))
+
+# 磁盘索引以内存映射方式加载（冷启动几乎零耗时，向量页由系统按需换入）
+KB_INDEX_MMAP = os.getenv("KB_INDEX_MMAP", "1") == "1"
+
+
+def index_type_of(index: Any) -> str:
+    """识别 FAISS 索引的类型：flat / hnsw / ivfpq"""
+    import faiss
+
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivfpq"
+    return "flat"
+
+
+def target_index_type(ntotal: int, current: str = "flat") -> str:
+    """
+    按文本块数决定应使用的索引类型（带回切滞后区间）。
+
+    Raises:
+        ValueError: KB_ANN_INDEX_TYPE 配置了未知类型
+    """
+    if KB_ANN_INDEX_TYPE not in KB_INDEX_TYPES[1:]:
+        raise ValueError(f"不支持的近似索引类型：{KB_ANN_INDEX_TYPE}，可选 hnsw / ivfpq")
+    if ntotal >= KB_ANN_THRESHOLD:
+        return KB_ANN_INDEX_TYPE
+    if current != "flat" and ntotal >= KB_ANN_THRESHOLD // 2:
+        return current
+    return "flat"
+
+
+def _pq_subquantizers(dim: int) -> int:
+    """PQ 子量化器个数：每 16 维压缩为 1 字节，且必须整除维度"""
+    m = max(dim // 16, 1)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def build_faiss_index(vectors: np.ndarray, index_type: str) -> Any:
+    """
+    用给定向量构建指定类型的 FAISS 索引（向量顺序即索引位置）。
+
+    Args:
+        vectors: N×d float32 向量矩阵
+        index_type: flat / hnsw / ivfpq
+
+    Returns:
+        faiss.Index: 已写入全部向量、检索参数已调优的索引
+    """
+    import faiss
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, dim = vectors.shape
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, KB_HNSW_M)
+        index.hnsw.efConstruction = KB_HNSW_EF_CONSTRUCTION
+    elif index_type == "ivfpq":
+        # 聚类桶数取 4√N，并保证每桶至少约 39 个训练样本
+        nlist = max(1, min(int(4 * math.sqrt(n)), n // 39))
+        index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, nlist, _pq_subquantizers(dim), 8)
+        index.train(vectors)
+    else:
+        index = faiss.IndexFlatL2(dim)
+    index.add(vectors)
+    tune_search_params(index)
+    return index
+
+
+def tune_search_params(index: Any) -> None:
+    """为近似索引设置检索参数（Flat 无需设置）"""
+    kind = index_type_of(index)
+    if kind == "hnsw":
+        index.hnsw.efSearch = KB_HNSW_EF_SEARCH
+    elif kind == "ivfpq":
+        index.nprobe = min(KB_IVF_NPROBE, index.nlist)
+
+
+def retype_store(store: Any, index_type: str, drop_ids: Iterable[str] = ()) -> None:
+    """
+    以指定索引类型重建 LangChain FAISS 向量库的底层索引，可顺带剔除部分文本块。
+
+    Flat / HNSW 的向量可从索引中无损还原；IVF-PQ 是有损压缩，改为用向量库自带的向量模型
+    重新向量化（生产环境经过文本块向量缓存，不产生远端调用）。
+
+    Args:
+        store: langchain_community.vectorstores.FAISS 对象（就地修改）
+        index_type: 目标类型 flat / hnsw / ivfpq
+        drop_ids: 需要一并删除的文本块 ID
+    """
+    drop = set(drop_ids)
+    kept = [(pos, doc_id) for pos, doc_id in sorted(store.index_to_docstore_id.items()) if doc_id not in drop]
+    removed = [doc_id for doc_id in store.index_to_docstore_id.values() if doc_id in drop]
+
+    if kept:
+        positions = np.asarray([pos for pos, _ in kept], dtype=np.int64)
+        if index_type_of(store.index) == "ivfpq":
+            texts = [store.docstore.search(doc_id).page_content for _, doc_id in kept]
+            vectors = np.asarray(store.embedding_function.embed_documents(texts), dtype=np.float32)
+        else:
+            vectors = store.index.reconstruct_batch(positions)
+        # 近似索引的训练样本过少时退回 Flat
+        if index_type == "ivfpq" and len(kept) < 256 * 39:
+            index_type = "flat"
+        store.index = build_faiss_index(vectors, index_type)
+    else:
+        import faiss
+
+        store.index = faiss.IndexFlatL2(store.index.d)
+
+    store.index_to_docstore_id = {i: doc_id for i, (_, doc_id) in enumerate(kept)}
+    if removed:
+        store.docstore.delete(removed)
+    store._mmap_backed = False
+
+
+def optimize_store_index(store: Any) -> Any:
+    """文本块数达到阈值时把 Flat 索引转换为近似索引（单文件大文档的向量库构建后调用）"""
+    current = index_type_of(store.index)
+    target = target_index_type(store.index.ntotal, current)
+    if target != current:
+        logger.info(f"🧭 向量索引 {current} → {target}（{store.index.ntotal} 个文本块）")
+        retype_store(store, target)
+    return store
+
+
+_LEXICAL_NAME = "lexical.pkl"
+
+
+def save_faiss_store(store: Any, folder: Path) -> None:
+    """
+    原子落盘 LangChain FAISS 向量库（index.faiss + index.pkl，挂载了词法索引时另写 lexical.pkl）。
+
+    先写临时文件再 os.replace：其他进程正以内存映射方式读取旧文件时，旧 inode 保持有效，
+    不会因为文件被原地截断而读到损坏数据。
+    """
+    import faiss
+
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    tmp_index = folder / "index.faiss.tmp"
+    faiss.write_index(store.index, str(tmp_index))
+    tmp_pickle = folder / "index.pkl.tmp"
+    with open(tmp_pickle, "wb") as f:
+        pickle.dump((store.docstore, store.index_to_docstore_id), f)
+    os.replace(tmp_index, folder / "index.faiss")
+    os.replace(tmp_pickle, folder / "index.pkl")
+
+    lexical = getattr(store, "_lexical_index", None)
+    if lexical is not None:
+        lexical.save(folder / _LEXICAL_NAME)
+    else:
+        # 没有挂载词法索引时删除旧文件，避免下次加载到与文本块不一致的版本
+        (folder / _LEXICAL_NAME).unlink(missing_ok=True)
+
+
+def load_faiss_store(folder: Path, embeddings: Any, mmap: bool = KB_INDEX_MMAP) -> Any:
+    """
+    加载 save_faiss_store / FAISS.save_local 写出的向量库。
+
+    mmap=True 时索引以只读内存映射方式打开：加载耗时与常驻内存不再随索引体积线性增长，
+    但索引不可修改，写入前需重新完整读取（见 KnowledgeBaseIndex._ensure_writable）。
+    """
+    import faiss
+    from langchain_community.vectorstores import FAISS
+
+    folder = Path(folder)
+    flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY if mmap else 0
+    index = faiss.read_index(str(folder / "index.faiss"), flags)
+    tune_search_params(index)
+    # index.pkl 由本项目自己写出，反序列化是可信的
+    with open(folder / "index.pkl", "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    store = FAISS(embeddings, index, docstore, index_to_docstore_id)
+    store._mmap_backed = mmap
+    lexical_path = folder / _LEXICAL_NAME
+    store._lexical_index = BM25Index.load(lexical_path) if lexical_path.exists() else None
+    return store
+
+
+def get_lexical_index(store: Any, folder: Optional[Path] = None) -> BM25Index:
+    """
+    取向量库挂载的词法索引；没有时从 docstore 现场构建并挂载（给定 folder 时顺带落盘）。
+    """
+    lexical = getattr(store, "_lexical_index", None)
+    if lexical is None:
+        lexical = BM25Index.from_vectorstore(store)
+        store._lexical_index = lexical
+        if folder is not None:
+            lexical.save(Path(folder) / _LEXICAL_NAME)
+    return lexical
+
+
+def _build_segment(store: Optional[Any], ids: List[str]) -> BM25Index:
+    """从向量库 docstore 中取出给定文本块，构建一段词法索引"""
+    if store is None:
+        return BM25Index.build([])
+    return BM25Index.build((doc_id, store.docstore.search(doc_id).page_content) for doc_id in ids)
+
+
+# ==========================================
+# 混合检索与向量服务降级
+# ==========================================
+# 查询向量化的等待上限（秒），超时即按纯词法结果返回
+KB_QUERY_EMBED_TIMEOUT = float(os.getenv("KB_QUERY_EMBED_TIMEOUT", "3"))
+
+# 向量服务失败后的冷却时间（秒）：冷却期内直接走纯词法检索，不再等待超时
+KB_EMBED_COOLDOWN_SECONDS = float(os.getenv("KB_EMBED_COOLDOWN_SECONDS", "60"))
+
+# 两路检索各自召回的候选数 = k × 该倍数
+KB_HYBRID_CANDIDATE_FACTOR = int(os.getenv("KB_HYBRID_CANDIDATE_FACTOR", "4"))
+
+
+class EmbeddingUnavailableError(RuntimeError):
+    """向量服务不可用（冷却期内或调用失败），调用方应降级为纯词法检索"""
+
+
+_query_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="kb-query-embed")
+_embedding_down_until = 0.0
+
+
+def embedding_available() -> bool:
+    """向量服务是否可用（不在失败冷却期内）"""
+    return time.monotonic() >= _embedding_down_until
+
+
+def mark_embedding_unavailable(reason: str, cooldown: float = KB_EMBED_COOLDOWN_SECONDS) -> None:
+    """记录向量服务失败，冷却期内的检索直接降级"""
+    global _embedding_down_until
+    _embedding_down_until = time.monotonic() + cooldown
+    logger.warning(f"⚠️ 向量服务不可用，{cooldown:.0f}s 内降级为纯词法检索：{reason}")
+
+
+def embed_query_with_timeout(store: Any, query: str, timeout: float = KB_QUERY_EMBED_TIMEOUT) -> Optional[List[float]]:
+    """
+    在超时上限内向量化查询。
+
+    Returns:
+        Optional[List[float]]: 查询向量；冷却期内、超时或调用失败时返回 None（后两者会开启冷却期）
+    """
+    if not embedding_available():
+        return None
+    future = _query_executor.submit(store._embed_query, query)
+    try:
+        return future.result(timeout=timeout)
+    except Exception as e:
+        future.cancel()
+        mark_embedding_unavailable(f"{type(e).__name__} - {e}" if str(e) else f"查询向量化超过 {timeout:.0f}s")
+        return None
+
+
+def hybrid_search(store: Any, query: str, k: int = 4) -> Tuple[List[Any], str]:
+    """
+    单个向量库内的词法 + 向量混合检索，两路排序按 RRF 融合。
+
+    Args:
+        store: LangChain FAISS 向量库（没有词法索引时现场构建）
+        query: 查询文本
+        k: 返回的文本块数
+
+    Returns:
+        (文本块列表, 检索模式)：模式为 "hybrid"，查询向量不可用时为 "lexical"
+    """
+    candidates = max(k * KB_HYBRID_CANDIDATE_FACTOR, k)
+    lexical_ids = [doc_id for doc_id, _ in get_lexical_index(store).search(query, candidates)]
+
+    vector_ids: List[str] = []
+    vector = embed_query_with_timeout(store, query)
+    if vector is not None and store.index.ntotal > 0:
+        _, positions = store.index.search(np.asarray([vector], dtype=np.float32), min(candidates, store.index.ntotal))
+        vector_ids = [store.index_to_docstore_id[int(pos)] for pos in positions[0] if pos >= 0]
+
+    documents = []
+    for doc_id in reciprocal_rank_fusion([vector_ids, lexical_ids]):
+        # 词法索引可能包含已被删除的文本块，docstore 查不到时返回提示字符串
+        document = store.docstore.search(doc_id)
+        if not isinstance(document, str):
+            documents.append(document)
+        if len(documents) >= k:
+            break
+    return documents, ("hybrid" if vector is not None else "lexical")
+
+
+def lexical_search_document(path: Path, query: str, k: int = 4) -> List[Any]:
+    """
+    不依赖向量库的纯词法检索：流式解析文档后现场构建 BM25 索引（向量库尚未建成且向量服务不可用时使用）。
+    """
+    chunks = list(iter_document_chunks(path))
+    lexical = BM25Index.build((i, chunk.page_content) for i, chunk in enumerate(chunks))
+    return [chunks[i] for i, _ in lexical.search(query, k)]
+
+
+# ==========================================
+# 跨文档全局索引
+# ==========================================
+# 全局索引在 ./embeddings 下的目录名
+KB_INDEX_DIRNAME = "_kb_global_index"
+
+# 文本块元数据中记录来源文件名的键
+KB_FILE_METADATA_KEY = "kb_file"
+
+_MANIFEST_NAME = "manifest.json"
+# 全局索引按文件分段的词法索引：{文件名: BM25Index}
+_LEXICAL_SEGMENTS_NAME = "lexical_segments.pkl"
+
+
+class KnowledgeBaseIndex:
+    """
+    整个知识库共用的一份 FAISS 索引。
+
+    清单文件（manifest.json）记录每个源文件的 mtime 与其文本块 ID，文件变化时只删除并重建
+    该文件的文本块；按文件过滤检索在候选集内精确计算，不会出现「先取 Top-K 再过滤」
+    导致小文件结果不足的问题。
+
+    文本块数跨过 KB_ANN_THRESHOLD 时自动切换 Flat / 近似索引。近似索引不支持按位置删除，
+    删除文本块时整体重建（向量从索引还原或经缓存重新取得，不产生远端调用）。
+    磁盘索引以内存映射方式加载，首次写入前才完整读入内存。
+
+    混合检索的 BM25 词法索引按文件分段：收录文件时在锁外只对该文件分词，删除文件时丢弃其段；
+    检索时用全部段的统计量合并打分（见 kb_lexical.search_segments），不会因为一次增删而整库重建。
+
+    只有持有索引 worker 租约的进程（见 kb_indexer.WorkerLease）写入；其他进程只读，
+    发现清单被改写时重新加载。索引与清单在首次使用时才从磁盘加载；清单与索引不一致（例如保存中途进程被杀）、
+    或向量模型变化时丢弃旧索引，由下一次 sync 借助文本块向量缓存低成本重建。
+    """
+
+    def __init__(self, store_dir: Path, embeddings: Any, model: str) -> None:
+        self.store_dir = Path(store_dir)
+        self.embeddings = embeddings
+        self.model = model
+        self._lock = threading.RLock()
+        self._store: Optional[Any] = None
+        self._files: Dict[str, Dict[str, Any]] = {}
+        self._segments: Dict[str, BM25Index] = {}
+        self._loaded = False
+        self._dirty = False
+        # 已加载的清单文件版本（mtime_ns），用于发现其他进程写入的新版本
+        self._manifest_version: Optional[int] = None
+
+    # ---------- 持久化 ----------
+    def _manifest_stamp(self) -> Optional[int]:
+        try:
+            return (self.store_dir / _MANIFEST_NAME).stat().st_mtime_ns
+        except OSError:
+            return None
+
+    def _ensure_loaded(self) -> None:
+        """
+        首次使用时加载索引；之后清单被其他进程（持有索引 worker 租约的进程）改写、且本进程没有未落盘的修改时重新加载。
+        重新加载失败（例如对方正写到一半）时保留当前视图，下次调用再试。
+        """
+        stamp = self._manifest_stamp()
+        if self._loaded and (self._dirty or stamp == self._manifest_version):
+            return
+        refreshing = self._loaded
+        self._loaded = True
+        if stamp is None:
+            return
+        manifest_path = self.store_dir / _MANIFEST_NAME
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get("model") != self.model:
+                logger.warning(f"全局索引由 {manifest.get('model')} 构建，与当前模型 {self.model} 不一致，将重建")
+                self._manifest_version = stamp
+                return
+            files = manifest.get("files", {})
+            store = None
+            if any(entry["ids"] for entry in files.values()):
+                store = load_faiss_store(self.store_dir, self.embeddings)
+                if store.index.ntotal != sum(len(entry["ids"]) for entry in files.values()):
+                    raise ValueError("清单与索引的文本块数量不一致")
+                # 全局索引的词法检索只用分段索引，不挂载整库索引（落盘时顺带删掉旧版的 lexical.pkl）
+                store._lexical_index = None
+            segments = self._load_segments(store, files)
+        except Exception as e:
+            if refreshing:
+                logger.debug(f"全局索引重新加载失败，沿用当前版本：{type(e).__name__} - {e}")
+                return
+            logger.warning(f"全局索引加载失败，将重建：{type(e).__name__} - {e}")
+            self._store, self._files, self._segments = None, {}, {}
+            return
+        self._store, self._files, self._segments = store, files, segments
+        self._manifest_version = stamp
+        if refreshing:
+            logger.info(f"🔄 全局索引已由其他进程更新，重新加载（{len(files)} 个文件）")
+
+    def _load_segments(self, store: Optional[Any], files: Dict[str, Dict[str, Any]]) -> Dict[str, BM25Index]:
+        """读取分段词法索引；与清单不一致或缺失的段从 docstore 补建（只涉及这些文件）"""
+        segments_path = self.store_dir / _LEXICAL_SEGMENTS_NAME
+        segments: Dict[str, BM25Index] = {}
+        if segments_path.exists():
+            try:
+                # 分段索引由本项目写在 ./embeddings 下，反序列化是可信的
+                with open(segments_path, "rb") as f:
+                    segments = pickle.load(f)
+            except Exception as e:
+                logger.warning(f"分段词法索引读取失败，将从文本块补建：{type(e).__name__} - {e}")
+        stale = [name for name, entry in files.items() if name not in segments or segments[name].doc_ids != entry["ids"]]
+        for name in stale:
+            segments[name] = _build_segment(store, files[name]["ids"])
+        if stale:
+            # 补建的段在下一次写入落盘时一并保存
+            logger.info(f"🔤 已补建 {len(stale)} 个文件的分段词法索引")
+        return {name: segments[name] for name in files}
+
+    def _ensure_writable(self) -> None:
+        """内存映射加载的索引是只读的：首次修改前完整读入内存"""
+        if self._store is not None and getattr(self._store, "_mmap_backed", False):
+            import faiss
+
+            self._store.index = faiss.read_index(str(self.store_dir / "index.faiss"))
+            tune_search_params(self._store.index)
+            self._store._mmap_backed = False
+
+    def save(self) -> None:
+        """把索引与清单写入磁盘（索引未变化时只写清单）"""
+        with self._lock:
+            self._ensure_loaded()
+            self.store_dir.mkdir(parents=True, exist_ok=True)
+            if self._store is not None and self._dirty:
+                save_faiss_store(self._store, self.store_dir)
+                tmp_segments = self.store_dir / f"{_LEXICAL_SEGMENTS_NAME}.tmp"
+                with open(tmp_segments, "wb") as f:
+                    pickle.dump(self._segments, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_segments, self.store_dir / _LEXICAL_SEGMENTS_NAME)
+                self._dirty = False
+            tmp = self.store_dir / f"{_MANIFEST_NAME}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({"model": self.model, "files": self._files}, f, ensure_ascii=False)
+            os.replace(tmp, self.store_dir / _MANIFEST_NAME)
+            self._manifest_version = self._manifest_stamp()
+
+    # ---------- 增量维护 ----------
+    def files(self) -> Dict[str, Dict[str, Any]]:
+        """已入索引的文件：{文件名: {"mtime": 修改时间, "chunks": 文本块数}}"""
+        with self._lock:
+            self._ensure_loaded()
+            return {name: {"mtime": e["mtime"], "chunks": len(e["ids"])} for name, e in self._files.items()}
+
+    def remove_file(self, file_name: str) -> bool:
+        """从索引中删除一个文件的全部文本块（不落盘）"""
+        with self._lock:
+            self._ensure_loaded()
+            entry = self._files.pop(file_name, None)
+            if entry is None:
+                return False
+            self._segments.pop(file_name, None)
+            self._delete_ids(entry["ids"])
+            RETRIEVAL_CACHE.invalidate(file_name)
+            return True
+
+    def _delete_ids(self, ids: List[str]) -> None:
+        if not ids or self._store is None:
+            return
+        self._ensure_writable()
+        if index_type_of(self._store.index) == "flat":
+            self._store.delete(ids)
+        else:
+            retype_store(self._store, index_type_of(self._store.index), drop_ids=ids)
+        self._dirty = True
+
+    def upsert_file(self, file_name: str, path: Path, mtime: float) -> int:
+        """
+        新增或替换一个文件的文本块（不落盘）。
+
+        文本块流式解析、逐批向量化并写入索引，新版本的文本块全部写入后才替换清单并删除旧版本，
+        重建期间对该文件的检索仍命中旧版本；中途失败时回滚已写入的新文本块。
+
+        Returns:
+            int: 该文件写入的文本块数
+        """
+        ids: List[str] = []
+        texts: List[str] = []
+        # ID 带上本次写入的版本号，新旧版本的文本块可以短暂共存
+        version = uuid.uuid4().hex[:8]
+        try:
+            for batch in iter_chunk_batches(iter_document_chunks(path)):
+                for chunk in batch:
+                    chunk.metadata[KB_FILE_METADATA_KEY] = file_name
+                batch_texts = [chunk.page_content for chunk in batch]
+                # 向量化放在锁外：耗时最长的一步不阻塞其他文件的检索
+                vectors = self.embeddings.embed_documents(batch_texts)
+                batch_ids = [f"{file_name}@{version}#{len(ids) + i}" for i in range(len(batch))]
+                with self._lock:
+                    self._ensure_loaded()
+                    self._add(list(zip(batch_texts, vectors)), [c.metadata for c in batch], batch_ids)
+                ids.extend(batch_ids)
+                texts.extend(batch_texts)
+            # 分词同样在锁外，且只涉及本文件
+            segment = BM25Index.build(zip(ids, texts))
+        except Exception:
+            with self._lock:
+                self._delete_ids(ids)
+            raise
+
+        with self._lock:
+            self.remove_file(file_name)
+            self._files[file_name] = {"mtime": mtime, "ids": ids}
+            self._segments[file_name] = segment
+            RETRIEVAL_CACHE.invalidate(file_name)
+        return len(ids)
+
+    def ensure_file(self, file_name: str, path: Path, mtime: float) -> int:
+        """
+        确保单个文件已按当前版本入索引并落盘（后台索引 worker 逐文件调用）。
+
+        Returns:
+            int: 该文件在索引中的文本块数（mtime 未变化时不重建）
+        """
+        with self._lock:
+            self._ensure_loaded()
+            entry = self._files.get(file_name)
+            if entry is not None and entry["mtime"] == mtime:
+                return len(entry["ids"])
+        chunks = self.upsert_file(file_name, path, mtime)
+        with self._lock:
+            self._maybe_retype()
+        self.save()
+        return chunks
+
+    def _add(self, text_embeddings: List[Tuple[str, List[float]]], metadatas: List[dict], ids: List[str]) -> None:
+        from langchain_community.vectorstores import FAISS
+
+        if self._store is None:
+            self._store = FAISS.from_embeddings(text_embeddings, self.embeddings, metadatas=metadatas, ids=ids)
+        else:
+            self._ensure_writable()
+            self._store.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+        self._dirty = True
+
+    def _maybe_retype(self) -> None:
+        """文本块数跨过阈值时切换索引类型"""
+        if self._store is None:
+            return
+        current = index_type_of(self._store.index)
+        target = target_index_type(self._store.index.ntotal, current)
+        if target != current:
+            logger.info(f"🧭 全局索引 {current} → {target}（{self._store.index.ntotal} 个文本块）")
+            self._ensure_writable()
+            retype_store(self._store, target)
+            self._dirty = True
+
+    def sync(self, files: Dict[str, Tuple[Path, float]]) -> Dict[str, Any]:
+        """
+        让索引与给定的文件集合保持一致：新增 / 修改的文件增量更新，已不存在的文件删除。
+
+        Args:
+            files: {文件名: (路径, mtime)}，通常为知识库目录的当前快照
+
+        Returns:
+            dict: added / updated / removed / failed（文件名列表）与 unchanged（文件数）
+        """
+        summary: Dict[str, Any] = {"added": [], "updated": [], "removed": [], "failed": [], "unchanged": 0}
+        with self._lock:
+            self._ensure_loaded()
+            known = dict(self._files)
+        for name in sorted(set(known) - set(files)):
+            self.remove_file(name)
+            summary["removed"].append(name)
+        for name, (path, mtime) in sorted(files.items()):
+            if name in known and known[name]["mtime"] == mtime:
+                summary["unchanged"] += 1
+                continue
+            try:
+                self.upsert_file(name, path, mtime)
+                summary["updated" if name in known else "added"].append(name)
+            except Exception as e:
+                logger.warning(f"全局索引收录 {name} 失败：{type(e).__name__} - {e}")
+                summary["failed"].append(name)
+        if summary["added"] or summary["updated"] or summary["removed"]:
+            with self._lock:
+                self._maybe_retype()
+            self.save()
+            logger.info(
+                f"📚 全局索引同步：新增 {len(summary['added'])}，更新 {len(summary['updated'])}，"
+                f"删除 {len(summary['removed'])}，未变化 {summary['unchanged']}"
+            )
+        return summary
+
+    # ---------- 检索 ----------
+    def search(self, query: str, k: int = 4, files: Optional[Iterable[str]] = None) -> List[Tuple[Any, float]]:
+        """
+        全库或指定文件集合内的向量检索。
+
+        只检索清单中登记的文本块：重建中途已写入、尚未替换清单的新版本文本块不会出现在结果里。
+
+        Args:
+            query: 查询文本
+            k: 返回的文本块数
+            files: 限定的文件名集合；None 表示全库
+
+        Returns:
+            List[Tuple[Document, float]]: (文本块, L2 距离)，距离升序
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if self._store is None or self._store.index.ntotal == 0:
+                return []
+        # 查询向量化放在锁外：远端调用期间不阻塞后台索引写入
+        vector = np.asarray([self.embeddings.embed_query(query)], dtype=np.float32)
+        with self._lock:
+            if self._store is None or self._store.index.ntotal == 0:
+                return []
+            ranked = self._vector_rank(vector, k, self._searchable_positions(files))
+            return [(self._store.docstore.search(self._store.index_to_docstore_id[pos]), d) for pos, d in ranked]
+
+    def hybrid_search(self, query: str, k: int = 4, files: Optional[Iterable[str]] = None) -> Tuple[List[Any], str]:
+        """
+        全库或指定文件集合内的词法 + 向量混合检索，两路排序按 RRF 融合。
+
+        查询向量化有超时上限（见 embed_query_with_timeout），向量服务不可用时只用词法结果。
+
+        Args:
+            query: 查询文本
+            k: 返回的文本块数
+            files: 限定的文件名集合；None 表示全库
+
+        Returns:
+            (文本块列表, 检索模式)：模式为 "hybrid"，查询向量不可用时为 "lexical"
+        """
+        with self._lock:
+            self._ensure_loaded()
+            store = self._store
+            if store is None or store.index.ntotal == 0:
+                return [], "hybrid"
+        vector = embed_query_with_timeout(store, query)
+        mode = "hybrid" if vector is not None else "lexical"
+
+        with self._lock:
+            store = self._store
+            if store is None or store.index.ntotal == 0:
+                return [], mode
+            positions = self._searchable_positions(files)
+            if positions is not None and positions.size == 0:
+                return [], mode
+            candidates = max(k * KB_HYBRID_CANDIDATE_FACTOR, k)
+            # 段只收录清单中登记的文本块；统计量取全库，按文件过滤不改变词项权重
+            names = list(self._segments) if files is None else [name for name in files if name in self._segments]
+            segments = [self._segments[name] for name in names]
+            lexical_hits = search_segments(segments, query, candidates, corpus=list(self._segments.values()))
+            lexical_ids = [doc_id for doc_id, _ in lexical_hits]
+            vector_ids: List[str] = []
+            if vector is not None:
+                ranked = self._vector_rank(np.asarray([vector], dtype=np.float32), candidates, positions)
+                vector_ids = [store.index_to_docstore_id[pos] for pos, _ in ranked]
+
+            documents = []
+            for doc_id in reciprocal_rank_fusion([vector_ids, lexical_ids]):
+                document = store.docstore.search(doc_id)
+                if not isinstance(document, str):
+                    documents.append(document)
+                if len(documents) >= k:
+                    break
+            return documents, mode
+
+    def _searchable_positions(self, files: Optional[Iterable[str]]) -> Optional[np.ndarray]:
+        """
+        清单中登记的（可选限定文件的）文本块在索引中的位置。
+
+        Returns:
+            Optional[np.ndarray]: 位置数组；None 表示索引中全部文本块都可检索
+        """
+        names = list(self._files) if files is None else [name for name in files if name in self._files]
+        if files is None and sum(len(self._files[name]["ids"]) for name in names) == self._store.index.ntotal:
+            return None
+        wanted = {doc_id for name in names for doc_id in self._files[name]["ids"]}
+        return np.asarray(
+            [pos for pos, doc_id in self._store.index_to_docstore_id.items() if doc_id in wanted], dtype=np.int64
+        )
+
+    def _vector_rank(self, vector: np.ndarray, k: int, positions: Optional[np.ndarray]) -> List[Tuple[int, float]]:
+        """
+        持锁调用：在给定位置（None 表示全部）内按查询向量排序。
+
+        Returns:
+            List[Tuple[int, float]]: (索引位置, L2 距离)，距离升序
+        """
+        index = self._store.index
+        if positions is None:
+            distances, indices = index.search(vector, min(k, index.ntotal))
+            distances, indices = distances[0], indices[0]
+        elif positions.size == 0:
+            return []
+        else:
+            distances, indices = self._filtered_search(index, vector, positions, min(k, positions.size))
+        return [(int(pos), float(distance)) for distance, pos in zip(distances, indices) if pos >= 0]
+
+    @staticmethod
+    def _filtered_search(index: Any, vector: np.ndarray, positions: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        限定候选位置的检索，返回 (距离, 位置)。
+
+        Flat 用 IDSelector 精确检索；HNSW 在过滤后图连通性变差、召回下降，改为还原候选向量后暴力计算；
+        IVF-PQ 探查全部聚类桶，保证候选集中的每个文本块都参与排序。
+        """
+        import faiss
+
+        kind = index_type_of(index)
+        selector = faiss.IDSelectorBatch(positions)
+        if kind == "hnsw":
+            candidates = index.reconstruct_batch(positions)
+            distances = ((candidates - vector) ** 2).sum(axis=1)
+            order = np.argsort(distances)[:k]
+            return distances[order], positions[order]
+        if kind == "ivfpq":
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=index.nlist)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        distances, indices = index.search(vector, k, params=params)
+        return distances[0], indices[0]
+
+    def stats(self) -> Dict[str, Any]:
+        """全局索引统计：files / chunks / index_type / resident_bytes"""
+        with self._lock:
+            self._ensure_loaded()
+            return {
+                "files": len(self._files),
+                "chunks": int(self._store.index.ntotal) if self._store is not None else 0,
+                "index_type": index_type_of(self._store.index) if self._store is not None else "flat",
+                "resident_bytes": (
+                    estimate_vectorstore_bytes(self._store) + sum(seg.nbytes for seg in self._segments.values())
+                    if self._store is not None else 0
+                ),
+            }
@@ -0,0 +1,411 @@
+"""
+知识库索引队列 - 持久化任务队列与后台索引 worker。
+
+本模块提供：
+1. 基于 SQLite 的持久化索引队列（位于 ./embeddings 目录），跨进程共享：
+   Telegram 机器人与独立的盘后日报进程都可以投递任务
+2. 同一文件的重复投递自动合并为一个任务；进程崩溃遗留的 running 任务在 worker 取得租约时重新排队
+3. 后台索引线程：逐个领取任务并构建向量索引，失败按指数退避重试、达到次数上限后放弃；
+   向量服务暂时不可用等可恢复错误只推迟任务，不计入尝试次数
+4. 单 worker 租约：同一队列同时只有一个进程领取任务并写全局索引，其他进程（终端 REPL 等）只投递；
+   持有者退出后由等待中的进程自动接管
+5. 按文件查询索引状态（queued / running / ready / failed）
+
+知识库的三个写入口（上传文档、归档按钮、盘后日报归档）只负责投递，
+向量化在后台完成，用户第一次提问时索引已经就绪，不再在大模型工具调用里现场付费建库。
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 平台：不做跨进程互斥，视为单进程部署
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# 索引队列数据库路径
+KB_INDEX_QUEUE_PATH = Path(os.getenv("KB_INDEX_QUEUE_PATH", "./embeddings/index_queue.sqlite3"))
+
+# worker 轮询间隔（秒）：其他进程投递的任务最迟在一个间隔后被领取
+KB_INDEX_POLL_SECONDS = float(os.getenv("KB_INDEX_POLL_SECONDS", "5"))
+
+# 单个文件的最大尝试次数
+KB_INDEX_MAX_ATTEMPTS = int(os.getenv("KB_INDEX_MAX_ATTEMPTS", "3"))
+
+# 失败重试的退避基数（秒）：第 n 次失败后等待 基数 × 2^(n-1)
+KB_INDEX_RETRY_BASE_SECONDS = float(os.getenv("KB_INDEX_RETRY_BASE_SECONDS", "30"))
+
+# 可恢复错误（如向量服务冷却期）的推迟时间（秒）
+KB_INDEX_DEFER_SECONDS = float(os.getenv("KB_INDEX_DEFER_SECONDS", "60"))
+
+INDEX_STATUSES = ("queued", "running", "ready", "failed")
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+class IndexQueue:
+    """
+    持久化索引队列：每个文件一行，按投递时间先进先出。
+
+    每次操作使用独立连接，多个进程可同时读写；领取任务在 IMMEDIATE 事务内完成，
+    同一任务不会被两个 worker 同时领取。
+    """
+
+    def __init__(self, path: Path = KB_INDEX_QUEUE_PATH) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS index_tasks ("
+                "file_name TEXT PRIMARY KEY, status TEXT NOT NULL, reason TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+                "enqueued_at TEXT, started_at TEXT, finished_at TEXT, chunks INTEGER, error TEXT, "
+                "next_attempt_at REAL NOT NULL DEFAULT 0)"
+            )
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(index_tasks)")}
+            if "next_attempt_at" not in columns:
+                conn.execute("ALTER TABLE index_tasks ADD COLUMN next_attempt_at REAL NOT NULL DEFAULT 0")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def enqueue(self, file_name: str, reason: str = "") -> None:
+        """
+        投递索引任务（文件已在队列中时重置为 queued 并清零重试次数）。
+
+        Args:
+            file_name: 知识库中的文件名
+            reason: 投递来源（upload / archive / daily_report 等），仅用于排查
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO index_tasks (file_name, status, reason, attempts, enqueued_at, next_attempt_at) "
+                "VALUES (?, 'queued', ?, 0, ?, 0) "
+                "ON CONFLICT(file_name) DO UPDATE SET status = 'queued', reason = excluded.reason, attempts = 0, "
+                "enqueued_at = excluded.enqueued_at, error = NULL, next_attempt_at = 0",
+                (file_name, reason, _now()),
+            )
+
+    def claim(self) -> Optional[str]:
+        """
+        领取最早投递、且已到重试时间的一个任务并标记为 running。
+
+        Returns:
+            Optional[str]: 文件名；队列为空时返回 None
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT file_name FROM index_tasks WHERE status = 'queued' AND next_attempt_at <= ? "
+                "ORDER BY enqueued_at, rowid LIMIT 1",
+                (time.time(),),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE index_tasks SET status = 'running', attempts = attempts + 1, started_at = ? WHERE file_name = ?",
+                (_now(), row["file_name"]),
+            )
+            conn.execute("COMMIT")
+            return row["file_name"]
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def complete(self, file_name: str, chunks: int) -> None:
+        """标记任务完成"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE index_tasks SET status = 'ready', finished_at = ?, chunks = ?, error = NULL "
+                "WHERE file_name = ? AND status = 'running'",
+                (_now(), chunks, file_name),
+            )
+
+    def fail(
+        self,
+        file_name: str,
+        error: str,
+        max_attempts: int = KB_INDEX_MAX_ATTEMPTS,
+        retry_base: float = KB_INDEX_RETRY_BASE_SECONDS,
+    ) -> bool:
+        """
+        记录失败：未达到尝试上限时按指数退避重新排队（第 n 次失败后等待 retry_base × 2^(n-1) 秒）。
+
+        Returns:
+            bool: 是否已重新排队
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT attempts FROM index_tasks WHERE file_name = ?", (file_name,)).fetchone()
+            delay = retry_base * 2 ** max((row["attempts"] if row is not None else 1) - 1, 0)
+            conn.execute(
+                "UPDATE index_tasks SET status = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END, "
+                "finished_at = ?, error = ?, next_attempt_at = ? WHERE file_name = ? AND status = 'running'",
+                (max_attempts, _now(), error[:500], time.time() + delay, file_name),
+            )
+            row = conn.execute("SELECT status FROM index_tasks WHERE file_name = ?", (file_name,)).fetchone()
+        return row is not None and row["status"] == "queued"
+
+    def defer(self, file_name: str, error: str, delay: float = KB_INDEX_DEFER_SECONDS) -> None:
+        """可恢复错误：推迟 delay 秒后重新排队，本次领取不计入尝试次数"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE index_tasks SET status = 'queued', attempts = MAX(attempts - 1, 0), error = ?, "
+                "next_attempt_at = ? WHERE file_name = ? AND status = 'running'",
+                (error[:500], time.time() + delay, file_name),
+            )
+
+    def forget(self, file_name: str) -> None:
+        """删除文件的任务记录（文件已从知识库移除）"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM index_tasks WHERE file_name = ?", (file_name,))
+
+    def requeue_stale(self) -> int:
+        """把崩溃遗留的 running 任务重新排队（仅由持有 WorkerLease 的进程调用）"""
+        with self._connect() as conn:
+            return conn.execute("UPDATE index_tasks SET status = 'queued' WHERE status = 'running'").rowcount
+
+    def status(self, file_name: str) -> Optional[Dict[str, Any]]:
+        """单个文件的索引状态；从未投递过时返回 None"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM index_tasks WHERE file_name = ?", (file_name,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def all_status(self) -> Dict[str, Dict[str, Any]]:
+        """全部文件的索引状态：{文件名: 状态记录}"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM index_tasks").fetchall()
+        return {row["file_name"]: dict(row) for row in rows}
+
+    def pending(self) -> List[str]:
+        """排队中与执行中的文件名（按投递顺序）"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT file_name FROM index_tasks WHERE status IN ('queued', 'running') ORDER BY enqueued_at, rowid"
+            ).fetchall()
+        return [row["file_name"] for row in rows]
+
+
+class WorkerLease:
+    """
+    索引 worker 的跨进程独占租约：对队列数据库旁的锁文件加 fcntl.flock 排他锁。
+
+    锁随文件描述符存在，持有进程退出或崩溃时由内核释放，不需要心跳与过期判断。
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self._file: Optional[Any] = None
+        self._held = False
+
+    @property
+    def held(self) -> bool:
+        return self._held
+
+    def acquire(self) -> bool:
+        """
+        非阻塞地尝试取得租约。
+
+        Returns:
+            bool: 本进程是否持有租约（已持有时直接返回 True）
+        """
+        if self._held:
+            return True
+        if fcntl is None:
+            self._held = True
+            return True
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        f = open(self.path, "a+")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        f.seek(0)
+        f.truncate()
+        f.write(f"{os.getpid()}\n")
+        f.flush()
+        self._file, self._held = f, True
+        return True
+
+    def release(self) -> None:
+        """释放租约（未持有时无操作）"""
+        f, self._file, self._held = self._file, None, False
+        if f is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            f.close()
+
+
+class IndexingWorker:
+    """
+    后台索引线程：循环领取队列任务并调用 index_file(文件名) 构建索引。
+
+    只有取得 WorkerLease 后才会重新排队崩溃遗留的任务并开始领取；租约被其他进程持有时，
+    线程按轮询间隔重试，持有者退出后自动接管。
+
+    本进程内投递后可调用 wake() 立即领取；其他进程投递的任务在下一次轮询时领取。
+    index_file 抛出 transient_errors 中的异常时任务只被推迟，不计入尝试次数
+    （例如向量服务冷却期内立即失败的 EmbeddingUnavailableError）。
+    """
+
+    def __init__(
+        self,
+        queue: IndexQueue,
+        index_file: Callable[[str], int],
+        poll_interval: float = KB_INDEX_POLL_SECONDS,
+        transient_errors: Tuple[Type[BaseException], ...] = (),
+        retry_base: float = KB_INDEX_RETRY_BASE_SECONDS,
+        lease: Optional[WorkerLease] = None,
+    ) -> None:
+        self.queue = queue
+        self.lease = lease if lease is not None else WorkerLease(queue.path.with_name(queue.path.name + ".lease"))
+        self.index_file = index_file
+        self.poll_interval = poll_interval
+        self.transient_errors = transient_errors
+        self.retry_base = retry_base
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.processed = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        """启动后台线程（取得租约后才领取任务）"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="kb-indexer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                return
+        self.lease.release()
+
+    def _ensure_lease(self) -> bool:
+        """
+        确保本进程持有租约；首次取得时把上一个持有者遗留的 running 任务重新排队。
+
+        Returns:
+            bool: 是否持有租约
+        """
+        if self.lease.held:
+            return True
+        if not self.lease.acquire():
+            return False
+        stale = self.queue.requeue_stale()
+        logger.info(f"🔑 已取得索引 worker 租约（pid {os.getpid()}）")
+        if stale:
+            logger.info(f"♻️ 索引队列：{stale} 个中断的任务已重新排队")
+        return True
+
+    def wake(self) -> None:
+        """通知 worker 立即检查队列"""
+        self._wake.set()
+
+    def run_once(self) -> Optional[str]:
+        """
+        领取并处理一个任务。
+
+        Returns:
+            Optional[str]: 处理的文件名；队列为空或租约由其他进程持有时返回 None
+        """
+        if not self._ensure_lease():
+            return None
+        file_name = self.queue.claim()
+        if file_name is None:
+            return None
+        started = time.perf_counter()
+        try:
+            chunks = self.index_file(file_name)
+        except self.transient_errors as e:
+            self.queue.defer(file_name, f"{type(e).__name__}: {e}")
+            logger.info(f"⏸️ 索引推迟 {file_name}：{type(e).__name__} - {e}")
+            return file_name
+        except Exception as e:
+            self.failed += 1
+            retried = self.queue.fail(file_name, f"{type(e).__name__}: {e}", retry_base=self.retry_base)
+            logger.warning(f"⚠️ 索引失败 {file_name}（{'已重新排队' if retried else '已放弃'}）：{type(e).__name__} - {e}")
+            return file_name
+        self.queue.complete(file_name, chunks)
+        self.processed += 1
+        logger.info(f"📚 索引就绪 {file_name}：{chunks} 个文本块，耗时 {time.perf_counter() - started:.1f}s")
+        return file_name
+
+    def _run(self) -> None:
+        if not self._ensure_lease():
+            logger.info("⏳ 索引 worker 租约由其他进程持有：本进程只投递任务，持有者退出后自动接管")
+        while not self._stop.is_set():
+            try:
+                while not self._stop.is_set() and self.run_once() is not None:
+                    pass
+            except Exception as e:
+                logger.error(f"索引队列读取失败：{type(e).__name__} - {e}")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+
+_index_queue: Optional[IndexQueue] = None
+_index_worker: Optional[IndexingWorker] = None
+_index_lock = threading.Lock()
+
+
+def get_index_queue() -> IndexQueue:
+    """进程级索引队列单例"""
+    global _index_queue
+    with _index_lock:
+        if _index_queue is None:
+            _index_queue = IndexQueue(KB_INDEX_QUEUE_PATH)
+        return _index_queue
+
+
+def enqueue_kb_file(file_name: str, reason: str = "") -> None:
+    """
+    投递知识库文件的索引任务（任意进程均可调用）；本进程已启动 worker 时立即唤醒。
+    """
+    get_index_queue().enqueue(file_name, reason)
+    if _index_worker is not None:
+        _index_worker.wake()
+
+
+def start_indexing_worker(
+    index_file: Callable[[str], int],
+    transient_errors: Tuple[Type[BaseException], ...] = (),
+) -> IndexingWorker:
+    """
+    启动进程级后台索引 worker（重复调用返回同一个 worker）。
+
+    多个进程都可以调用：只有取得租约的进程领取任务并写全局索引，其余进程的 worker 处于等待状态。
+    """
+    global _index_worker
+    queue = get_index_queue()
+    with _index_lock:
+        if _index_worker is None:
+            _index_worker = IndexingWorker(queue, index_file, transient_errors=transient_errors)
+        worker = _index_worker
+    worker.start()
+    return worker
+
+
+def get_indexing_status(file_name: str) -> Optional[Dict[str, Any]]:
+    """单个知识库文件的索引状态"""
+    return get_index_queue().status(file_name)
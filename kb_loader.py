@@ -0,0 +1,238 @@
+"""
+文档加载引擎 - 知识库文档的流式、并行解析与切块。
+
+本模块提供：
+1. PDF 按页区间分发到进程池并行抽取文本，按页序流式产出（在途任务数有上限）
+2. Markdown / TXT 按段落边界分块流式读取，不把整份文件读入内存
+3. CSV 按行切块：每块只包含完整的行并重复表头，命中的文本块可以独立阅读
+4. 文本块按批次产出，供向量化管道逐批消费
+
+原先的 PyPDFLoader(...).load() 会先把整份 PDF 的全部页面读成列表再切块，峰值内存是文件体积的数倍；
+改为生成器流水线后，任一时刻只持有在途页面与当前批次的文本块，峰值内存与文档大小无关。
+"""
+
+import os
+import csv
+import io
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Iterable, Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+KB_CHUNK_SIZE = 500
+KB_CHUNK_OVERLAP = 50
+
+# PDF 抽取进程数（<= 0 时在调用线程内串行抽取）
+KB_PDF_WORKERS = int(os.getenv("KB_PDF_WORKERS", "2"))
+
+# 每个抽取任务负责的连续页数
+KB_PDF_PAGES_PER_TASK = int(os.getenv("KB_PDF_PAGES_PER_TASK", "8"))
+
+# 页数少于该值的 PDF 直接串行抽取（进程启动开销大于并行收益）
+KB_PDF_PARALLEL_MIN_PAGES = int(os.getenv("KB_PDF_PARALLEL_MIN_PAGES", "24"))
+
+# 纯文本按段落边界读取的块大小（字符）；单段超过 4 倍时在行边界强制截断
+KB_STREAM_BLOCK_CHARS = int(os.getenv("KB_STREAM_BLOCK_CHARS", "20000"))
+
+# 每批交给向量化管道的文本块数
+KB_EMBED_BATCH_CHUNKS = int(os.getenv("KB_EMBED_BATCH_CHUNKS", "200"))
+
+def _splitter() -> Any:
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    return RecursiveCharacterTextSplitter(chunk_size=KB_CHUNK_SIZE, chunk_overlap=KB_CHUNK_OVERLAP)
+
+
+def _document(text: str, metadata: dict) -> Any:
+    from langchain_core.documents import Document
+
+    return Document(page_content=text, metadata=metadata)
+
+
+# ==========================================
+# PDF：进程池按页区间并行抽取
+# ==========================================
+def _extract_pdf_pages(path: str, start: int, end: int) -> List[Tuple[int, str]]:
+    """抽取 [start, end) 页的文本（在子进程中执行，每个任务独立打开文件）"""
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    end = min(end, len(reader.pages))
+    return [(n, reader.pages[n].extract_text(extraction_mode="plain").strip()) for n in range(start, end)]
+
+
+def iter_pdf_pages(path: Path, workers: int = KB_PDF_WORKERS) -> Iterator[Tuple[int, int, str]]:
+    """
+    按页序流式产出 PDF 页面文本。
+
+    Args:
+        path: PDF 路径
+        workers: 抽取进程数（<= 0 或页数较少时串行）
+
+    Yields:
+        (页码（从 0 开始）, 总页数, 页面文本)
+    """
+    from pypdf import PdfReader
+
+    path_str = str(path)
+    total = len(PdfReader(path_str).pages)
+    step = max(KB_PDF_PAGES_PER_TASK, 1)
+    ranges = iter(range(0, total, step))
+
+    if workers <= 0 or total < KB_PDF_PARALLEL_MIN_PAGES:
+        for start in ranges:
+            for page_no, text in _extract_pdf_pages(path_str, start, start + step):
+                yield page_no, total, text
+        return
+
+    # spawn 启动：避免 fork 继承父进程中的线程与锁状态；在途任务数上限保证内存不随页数增长
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        pending = deque()
+        for start in ranges:
+            pending.append(pool.submit(_extract_pdf_pages, path_str, start, start + step))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            pages = pending.popleft().result()
+            start = next(ranges, None)
+            if start is not None:
+                pending.append(pool.submit(_extract_pdf_pages, path_str, start, start + step))
+            for page_no, text in pages:
+                yield page_no, total, text
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_pdf_chunks(path: Path, workers: int = KB_PDF_WORKERS) -> Iterator[Any]:
+    """PDF 逐页切块（与 PyPDFLoader + split_documents 的结果一致）"""
+    splitter = _splitter()
+    for page_no, total, text in iter_pdf_pages(path, workers):
+        if not text:
+            continue
+        page = _document(text, {"source": str(path), "page": page_no, "total_pages": total})
+        yield from splitter.split_documents([page])
+
+
+# ==========================================
+# Markdown / TXT：按段落边界分块读取
+# ==========================================
+def iter_text_blocks(path: Path, block_chars: int = KB_STREAM_BLOCK_CHARS) -> Iterator[str]:
+    """
+    逐行读取文本文件，在累计约 block_chars 字符后的第一个空行处切出一块。
+
+    块边界落在段落之间，切块器在块内的切分结果与整篇切分基本一致；
+    没有空行的超长段落在 4 倍块大小处按行截断。
+    """
+    buffer: List[str] = []
+    size = 0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            buffer.append(line)
+            size += len(line)
+            if (size >= block_chars and not line.strip()) or size >= block_chars * 4:
+                yield "".join(buffer)
+                buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def iter_text_chunks(path: Path) -> Iterator[Any]:
+    splitter = _splitter()
+    for block in iter_text_blocks(path):
+        yield from splitter.split_documents([_document(block, {"source": str(path)})])
+
+
+# ==========================================
+# CSV：按行切块并重复表头
+# ==========================================
+def _csv_line(row: List[str]) -> str:
+    # 行终止符必须包含 \n，含换行的字段才会被加引号
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerow(row)
+    return buffer.getvalue()[:-1]
+
+
+def iter_csv_chunks(path: Path, chunk_size: int = KB_CHUNK_SIZE) -> Iterator[Any]:
+    """
+    CSV 按行切块：每块以表头开头，只包含完整的行，元数据记录行号区间（数据行从 1 开始）。
+
+    单行超过 chunk_size 时独立成块，超长的行再交给切块器切分（每段仍带表头）。
+    """
+    source = str(path)
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        header_line = _csv_line(header)
+        rows: List[str] = []
+        size = len(header_line)
+        row_start = 1
+
+        def flush(row_end: int) -> Any:
+            return _document("\n".join([header_line] + rows), {"source": source, "row_start": row_start, "row_end": row_end})
+
+        row_no = 0
+        for row_no, row in enumerate(reader, start=1):
+            line = _csv_line(row)
+            if not line.strip(","):
+                continue
+            if rows and size + len(line) + 1 > chunk_size:
+                yield flush(row_no - 1)
+                rows, size, row_start = [], len(header_line), row_no
+            if len(header_line) + len(line) + 1 > chunk_size * 4:
+                # 超长单行：切分后每段附上表头
+                for piece in _splitter().split_text(line):
+                    yield _document(f"{header_line}\n{piece}", {"source": source, "row_start": row_no, "row_end": row_no})
+                row_start = row_no + 1
+                continue
+            rows.append(line)
+            size += len(line) + 1
+        if rows:
+            yield flush(row_no)
+
+
+# ==========================================
+# 统一入口
+# ==========================================
+def iter_document_chunks(path: Path) -> Iterator[Any]:
+    """
+    流式解析知识库文档并切块（过滤空白块）。
+
+    Args:
+        path: 文档路径（.pdf / .md / .txt / .csv）
+
+    Yields:
+        Document: 文本块，metadata 含 source（PDF 另含 page / total_pages，CSV 另含 row_start / row_end）
+
+    Raises:
+        ValueError: 不支持的文件格式
+    """
+    path = Path(path)
+    ext = path.suffix.lower()
+    if ext == '.pdf':
+        chunks = iter_pdf_chunks(path)
+    elif ext == '.csv':
+        chunks = iter_csv_chunks(path)
+    elif ext in ('.md', '.txt'):
+        chunks = iter_text_chunks(path)
+    else:
+        raise ValueError(f"不支持的文件格式：{ext}")
+    return (chunk for chunk in chunks if chunk.page_content.strip())
+
+
+def iter_chunk_batches(chunks: Iterable[Any], batch_size: int = KB_EMBED_BATCH_CHUNKS) -> Iterator[List[Any]]:
+    """把文本块流按固定大小分批"""
+    batch: List[Any] = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,285 @@
+"""
+交易流水账本引擎 - 从 transaction_logs.jsonl 回放推导持仓与平均成本。
+
+本模块提供：
+1. 交易流水解析（买入 / 卖出 / 清仓）
+2. 移动加权平均成本法的持仓推导
+3. 快照检查点（每次回放只处理上次快照之后新增的流水）
+"""
+
+import json
+import os
+import re
+import logging
+from pathlib import Path
+from typing import Dict, Any, Optional, Tuple
+
+from filelock import FileLock
+
+from valuation_engine import is_etf_code
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION_LOG_PATH = Path("./memory/transaction_logs.jsonl").resolve()
+LEDGER_SNAPSHOT_PATH = Path("./memory/ledger_snapshot.json").resolve()
+
+# 每累计处理 N 条新流水写入一次检查点，兼顾写盘频率与回放长度
+SNAPSHOT_INTERVAL = int(os.getenv("LEDGER_SNAPSHOT_INTERVAL", "50"))
+
+# 快照格式版本：解析规则变更时递增，旧快照自动作废并全量重放
+SNAPSHOT_VERSION = 2
+
+# 用于识别日志文件是否被整体替换（而非追加）的头部指纹长度
+_HEAD_FINGERPRINT_BYTES = 256
+
+CLEAR_KEYWORDS = ("清仓",)
+SELL_KEYWORDS = ("卖出", "减仓", "卖", "sell")
+BUY_KEYWORDS = ("买入", "加仓", "建仓", "买", "buy")
+
+# 数字中的千分位分隔符（"1,000 股"、"1，200.5"）
+_THOUSANDS_SEPARATOR_RE = re.compile(r'(?<=\d)[,，](?=\d{3}(?!\d))')
+
+
+def parse_transaction_entry(entry: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    将一条交易流水解析为标准交易指令。
+
+    Args:
+        entry: append_transaction_log 写入的流水字典，如：
+            {"timestamp": 1710000000.0, "action": "买入", "target": "AAPL", "details": "苹果公司，100 股，成本 150"}
+
+    Returns:
+        Optional[Dict[str, Any]]: {"ticker", "side", "shares", "price", "company_name"}，
+        side 取值 "buy" / "sell" / "clear"；无法识别的流水（转账、缺少股数等）返回 None。
+    """
+    action = str(entry.get("action", "")).strip().lower()
+    target = str(entry.get("target", "")).strip()
+    details = str(entry.get("details", ""))
+
+    if not action or not target:
+        return None
+
+    if any(k in action for k in CLEAR_KEYWORDS):
+        side = "clear"
+    elif any(k in action for k in SELL_KEYWORDS):
+        side = "sell"
+    elif any(k in action for k in BUY_KEYWORDS):
+        side = "buy"
+    else:
+        return None
+
+    numeric_details = _THOUSANDS_SEPARATOR_RE.sub('', details)
+    shares_match = re.search(r'(\d+(?:\.\d+)?)\s*股', numeric_details)
+    price_match = re.search(r'(?:成本|价格|成交价|单价|均价|@)\s*(\d+(?:\.\d+)?)', numeric_details)
+
+    try:
+        shares = float(shares_match.group(1)) if shares_match else 0.0
+        price = float(price_match.group(1)) if price_match else 0.0
+    except ValueError:
+        logger.warning(f"交易流水数字解析失败，已跳过：{details!r}")
+        return None
+
+    if side == "buy" and (shares <= 0 or not price_match):
+        return None
+    if side == "sell" and shares <= 0:
+        return None
+
+    company_name = "-"
+    first_part = details.replace('，', ',').split(',')[0].split(' ')[0].strip()
+    if first_part and not re.match(r'^\d', first_part):
+        company_name = first_part
+
+    return {
+        "ticker": target.upper(),
+        "side": side,
+        "shares": shares,
+        "price": price,
+        "company_name": company_name,
+    }
+
+
+def apply_transaction(positions: Dict[str, Dict[str, Any]], txn: Dict[str, Any]) -> None:
+    """
+    按移动加权平均成本法将一笔交易应用到持仓（原地修改）。
+
+    买入摊薄/抬升平均成本；卖出只减少股数，不改变剩余持仓的平均成本；
+    卖出数量超过持仓或清仓时移除该标的。
+
+    Args:
+        positions: 内部持仓字典 {ticker: {"shares": float, "cost_basis": float, "company_name": str}}
+        txn: parse_transaction_entry 返回的交易指令
+    """
+    ticker = txn["ticker"]
+    holding = positions.get(ticker)
+
+    if txn["side"] == "clear":
+        positions.pop(ticker, None)
+        return
+
+    if txn["side"] == "sell":
+        if holding is None:
+            return
+        remaining = holding["shares"] - txn["shares"]
+        if remaining <= 1e-9:
+            positions.pop(ticker, None)
+        else:
+            holding["shares"] = remaining
+        return
+
+    if holding is None:
+        positions[ticker] = {
+            "shares": txn["shares"],
+            "cost_basis": txn["price"],
+            "company_name": txn["company_name"],
+        }
+        return
+
+    total_shares = holding["shares"] + txn["shares"]
+    total_cost = holding["shares"] * holding["cost_basis"] + txn["shares"] * txn["price"]
+    holding["shares"] = total_shares
+    holding["cost_basis"] = total_cost / total_shares
+    if holding.get("company_name", "-") == "-":
+        holding["company_name"] = txn["company_name"]
+
+
+def _read_head_fingerprint(log_path: Path) -> str:
+    """读取日志头部字节作为文件身份指纹（用于识别日志被重写）"""
+    with open(log_path, 'rb') as f:
+        return f.read(_HEAD_FINGERPRINT_BYTES).hex()
+
+
+def _load_snapshot(snapshot_path: Path) -> Optional[Dict[str, Any]]:
+    """读取快照文件，格式不合法或版本不符时返回 None"""
+    if not snapshot_path.exists():
+        return None
+    try:
+        with open(snapshot_path, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except (json.JSONDecodeError, OSError) as e:
+        logger.warning(f"账本快照读取失败，将全量重放：{type(e).__name__}")
+        return None
+
+    if not isinstance(snapshot, dict) or snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    return snapshot
+
+
+def _write_snapshot(snapshot_path: Path, snapshot: Dict[str, Any]) -> None:
+    """原子写入快照：先写临时文件再 os.replace，避免进程中断留下半截 JSON"""
+    snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = snapshot_path.with_suffix(".json.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, snapshot_path)
+
+
+def _to_standard_positions(positions: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """将内部持仓转换为 calculate_portfolio_valuation 可直接消费的标准 positions 格式"""
+    result: Dict[str, Dict[str, Any]] = {}
+    for ticker, holding in positions.items():
+        shares = holding["shares"]
+        result[ticker] = {
+            "shares": int(shares) if float(shares).is_integer() else round(shares, 4),
+            "cost_basis": round(holding["cost_basis"], 4),
+            "type": "etf" if is_etf_code(ticker) else "stock",
+            "company_name": holding.get("company_name", "-"),
+        }
+    return result
+
+
+def replay_ledger(
+    log_path: Path = TRANSACTION_LOG_PATH,
+    snapshot_path: Path = LEDGER_SNAPSHOT_PATH,
+    snapshot_interval: int = SNAPSHOT_INTERVAL,
+) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, Any]]:
+    """
+    从交易流水回放推导当前持仓，自快照检查点增量续算。
+
+    快照记录已消费的字节偏移量与对应持仓，每次回放仅从该偏移量开始读取新增行，
+    因此耗时与"快照后新增的交易数"成正比，而非与日志总长度成正比。
+    尚未写完的末行（无换行符）不会被消费，留待下次回放。
+
+    Args:
+        log_path: 交易流水 JSONL 文件路径
+        snapshot_path: 快照文件路径
+        snapshot_interval: 新增多少条流水后刷新一次快照
+
+    Returns:
+        Tuple[Dict, Dict]: (标准 positions 字典, 回放统计)，统计字段包括
+            entries_total / entries_replayed / entries_skipped / snapshot_written / from_snapshot
+    """
+    lock_path = snapshot_path.with_suffix(".json.lock")
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with FileLock(lock_path, timeout=5):
+        if not log_path.exists():
+            return {}, {
+                "entries_total": 0,
+                "entries_replayed": 0,
+                "entries_skipped": 0,
+                "snapshot_written": False,
+                "from_snapshot": False,
+            }
+
+        log_size = log_path.stat().st_size
+        head = _read_head_fingerprint(log_path)
+        snapshot = _load_snapshot(snapshot_path)
+
+        # 日志被截断或整体替换时，旧快照失效，退化为全量重放
+        if snapshot and (snapshot.get("offset", 0) > log_size or snapshot.get("head") != head[:len(snapshot.get("head", ""))]):
+            logger.warning("检测到交易流水被重写，账本快照作废并全量重放")
+            snapshot = None
+
+        positions: Dict[str, Dict[str, Any]] = dict(snapshot["positions"]) if snapshot else {}
+        offset: int = snapshot["offset"] if snapshot else 0
+        entries_total: int = snapshot["entries"] if snapshot else 0
+        replayed = 0
+        skipped = 0
+
+        with open(log_path, 'rb') as f:
+            f.seek(offset)
+            for raw_line in f:
+                if not raw_line.endswith(b"\n"):
+                    break
+                offset += len(raw_line)
+                line = raw_line.strip()
+                if not line:
+                    continue
+                replayed += 1
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    skipped += 1
+                    continue
+
+                try:
+                    txn = parse_transaction_entry(entry) if isinstance(entry, dict) else None
+                except (ValueError, TypeError, AttributeError) as e:
+                    # 单条畸形流水不能中断整个回放
+                    logger.warning(f"交易流水解析异常，已跳过：{type(e).__name__} - {e}")
+                    txn = None
+                if txn is None:
+                    skipped += 1
+                    continue
+                apply_transaction(positions, txn)
+
+        entries_total += replayed
+        snapshot_written = False
+        if replayed >= snapshot_interval or (snapshot is None and replayed > 0):
+            _write_snapshot(snapshot_path, {
+                "version": SNAPSHOT_VERSION,
+                "offset": offset,
+                "entries": entries_total,
+                "head": head,
+                "positions": positions,
+            })
+            snapshot_written = True
+
+    stats = {
+        "entries_total": entries_total,
+        "entries_replayed": replayed,
+        "entries_skipped": skipped,
+        "snapshot_written": snapshot_written,
+        "from_snapshot": snapshot is not None,
+    }
+    return _to_standard_positions(positions), stats
@@ -1,5 +1,6 @@
 import os
 import json
+import threading
 from dotenv import load_dotenv
 from pathlib import Path
 from datetime import datetime
@@ -9,11 +10,24 @@ from valuation_engine import (
     fetch_stock_price_raw,
     fetch_etf_price_raw,
     generate_kline_chart,
-    calculate_portfolio_valuation,
+    generate_portfolio_chart,
+    get_cached_portfolio_valuation,
+    invalidate_valuation_cache,
     parse_user_profile_to_positions,
     format_portfolio_report,
 )
 from daily_job import job_routine
+from ledger_engine import TRANSACTION_LOG_PATH, replay_ledger
+from scenario_engine import (
+    parse_shock_spec,
+    parse_ticker_overrides,
+    build_shock_grid,
+    revalue_portfolio,
+    format_stress_report,
+    unknown_override_tickers,
+)
+from backtest_engine import parse_allocation, run_backtest, format_backtest_report, REBALANCE_FREQUENCIES
+from comparison_engine import COMPARISON_CURRENCIES, compare_tickers, format_comparison_report
 # 使用openai 兼容千问
 from langchain_openai import ChatOpenAI
 from pydantic import SecretStr
@@ -24,12 +38,7 @@ from ddgs import DDGS
 from langchain_core.runnables.history import RunnableWithMessageHistory
 # 新增：用于长效记忆持久化的模块
 from langchain_community.chat_message_histories import FileChatMessageHistory
-# 新增：用于RAG的模块
-from langchain_community.document_loaders import PyPDFLoader, TextLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
 # 新增这个专门针对阿里云的引用
-from langchain_community.embeddings import DashScopeEmbeddings
 # 新增：引入高级终端交互库
 from prompt_toolkit import PromptSession
 from prompt_toolkit.history import InMemoryHistory
@@ -41,8 +50,28 @@ from rich.rule import Rule           # 🌟 新增：自适应分隔线组件
 from langchain.callbacks.base import BaseCallbackHandler
 #添加超时处理逻辑
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
-# 🌟 LRU 缓存装饰器，用于 L1 内存池管理
-from functools import lru_cache
+# 🌟 L1 内存池：按字节预算淘汰的向量库缓存；跨文档全局索引
+from kb_engine import (
+    KB_FILE_METADATA_KEY,
+    KB_INDEX_DIRNAME,
+    RETRIEVAL_CACHE,
+    VECTORSTORE_CACHE,
+    EmbeddingUnavailableError,
+    KnowledgeBaseIndex,
+    build_vectorstore_streaming,
+    embedding_available,
+    get_lexical_index,
+    hybrid_search,
+    lexical_search_document,
+    load_faiss_store,
+    mark_embedding_unavailable,
+    optimize_store_index,
+    save_faiss_store,
+)
+# 🌟 后台索引队列：检索工具只投递未入索引的文件，不在工具调用里现场建库
+from kb_indexer import enqueue_kb_file, get_index_queue, start_indexing_worker
+# 🌟 文本块向量缓存：按 hash(模型, 文本) 复用已付费的向量
+from embedding_engine import EMBEDDING_BACKEND, CachedEmbeddings, create_embeddings, embedding_model_id
 
 # 初始化富文本控制台
 console = Console()
@@ -60,9 +89,13 @@ embedding_key = os.getenv("DASHSCOPE_EMBEDDING_KEY")
 if not dashscope_key:
     raise ValueError("❌ 致命错误：未在 .env 文件或环境变量中找到 DASHSCOPE_API_KEY！请检查配置。")
 
-if not embedding_key:
+# 只有远端向量后端需要 Key；EMBEDDING_BACKEND=local / fake 时知识库检索可完全离线运行
+if EMBEDDING_BACKEND == "dashscope" and not embedding_key:
     raise ValueError("❌ 致命错误：未在 .env 文件或环境变量中找到 DASHSCOPE_EMBEDDING_KEY！请检查配置。")
 
+# 当前向量后端的模型标识：写入索引元数据，后端切换后旧索引不会被误用
+KB_EMBEDDING_MODEL = embedding_model_id(EMBEDDING_BACKEND)
+
 # 安全配置：定义 Agent 的专属活动沙箱
 # 强制设定在当前运行目录下的 "agent_workspace" 文件夹内
 SANDBOX_DIR = Path("./agent_workspace").resolve()
@@ -94,10 +127,6 @@ def _resolve_safe_path(file_path: str, base_dir: Path) -> tuple[Path | None, str
 FAISS_DB_DIR = Path("./embeddings").resolve()
 FAISS_DB_DIR.mkdir(parents=True, exist_ok=True)
 
-# 🌟 LRU 缓存配置：最多缓存 10 个文件的向量索引，防止内存泄漏
-# 每个向量库约 10-50MB，10 个文件约占用 500MB 内存
-MAX_FAISS_CACHE_SIZE = 10
-
 # 定义一个专门存放记忆碎片的目录
 MEMORY_DIR = Path("./memory").resolve()
 MEMORY_DIR.mkdir(parents=True, exist_ok=True)
@@ -200,13 +229,92 @@ def draw_universal_stock_chart(ticker: str, days: int = 30) -> str:
     Returns:
         str: 生成结果与文件路径
     """
-    chart_data = generate_kline_chart(ticker, SANDBOX_DIR, days)
+    # 对话中的图表最终发往 Telegram，使用适配客户端尺寸的位图档位（导出 PDF 时再换用矢量版本）
+    chart_data = generate_kline_chart(ticker, SANDBOX_DIR, days, profile="telegram")
     return (
         f"✅ {chart_data['ticker']} {days}天走势图生成完毕！文件名为：{chart_data['file_name']}。\n"
         f"【摘要】最高：{chart_data['max_price']}, 最低：{chart_data['min_price']}, 最新：{chart_data['latest_close']}。\n"
         f"🚨【强制语法】：必须严格使用 `![走势图](./{chart_data['file_name']})` 嵌入 Markdown 中！"
     )
 
+# ==========================================
+# 插件 1-B：多标的走势总览（小图矩阵）
+# ==========================================
+@tool
+def draw_portfolio_chart(tickers: str = "", days: int = 90, style: str = "sparkline") -> str:
+    """
+    📊【多标的走势总览】：一次批量拉取历史数据，在【一张图】内绘制多只股票的走势小图矩阵。
+    当用户要求查看"全部持仓走势"、"这几只股票最近怎么样"，或在深度分析 / 报告中需要同时展示多个标的走势时，
+    **必须**调用此工具，严禁对每个标的逐个调用 draw_universal_stock_chart。
+    
+    Args:
+        tickers: 逗号分隔的股票代码（如 "AAPL,0700,600519"）。留空则自动使用用户当前的全部持仓。
+        days: 时间跨度（天数），默认 90 天。'半年'传 180，'一年'传 365。
+        style: 面板样式，"sparkline"（收盘价迷你走势，默认）或 "candle"（迷你 K 线）。
+    
+    Returns:
+        str: 生成结果、各标的区间涨跌幅与嵌入语法
+    """
+    try:
+        ticker_list = [t.strip() for t in tickers.replace("，", ",").split(",") if t.strip()]
+        if not ticker_list:
+            positions, error = _load_profile_positions()
+            if error:
+                return error
+            ticker_list = list(positions)
+        
+        chart_data = generate_portfolio_chart(ticker_list, SANDBOX_DIR, days, profile="telegram", style=style)
+        summary_lines = [
+            f"- {ticker}：最新 {item['latest_close']}，区间涨跌 {item['change_percent']:+.2f}%"
+            for ticker, item in chart_data["summary"].items()
+        ]
+        missing_line = f"\n⚠️ 以下标的无历史数据，未绘制：{', '.join(chart_data['missing'])}" if chart_data["missing"] else ""
+        return (
+            f"✅ {len(chart_data['tickers'])} 个标的 {days} 天走势总览图生成完毕！文件名为：{chart_data['file_name']}。\n"
+            f"【摘要】\n" + "\n".join(summary_lines) + missing_line + "\n"
+            f"🚨【强制语法】：必须严格使用 `![走势总览](./{chart_data['file_name']})` 嵌入 Markdown 中！"
+        )
+    except json.JSONDecodeError:
+        return "❌ 持仓记忆文件损坏：JSONDecodeError"
+    except (IndexError, ValueError) as e:
+        return f"❌ 绘图失败：{e}"
+    except Exception as e:
+        return f"❌ 绘图失败：{type(e).__name__} - {str(e)}"
+
+# ==========================================
+# 插件 1-C：多标的归一化对比（叠加图 + 区间统计）
+# ==========================================
+@tool
+def compare_stocks_chart(tickers: str, days: int = 180, currency: str = "native") -> str:
+    """
+    ⚖️【多标的走势对比】：一次批量拉取多个标的的历史，起点统一归一化为 100 后叠加在【一张图】中，
+    并由系统精确计算区间收益、年化波动率、最大回撤、相关性等统计。
+    当用户要求"对比 A 和 B 的走势"、"这几只谁涨得多"、"腾讯和阿里今年表现对比"时**必须**调用此工具，
+    严禁逐个调用 draw_universal_stock_chart 后自行比较，严禁自行估算任何对比数值！
+    
+    Args:
+        tickers: 逗号分隔的股票代码（2~10 个，如 "0700,9988,BABA"）
+        days: 时间跨度（天数），默认 180 天。'一年'传 365。
+        currency: 计价口径，"native"（各自原生货币，默认）或 "CNY"（按历史汇率折算为人民币，跨市场对比真实人民币收益时使用）
+    
+    Returns:
+        str: Markdown 对比统计表与图片嵌入语法
+    """
+    if currency not in COMPARISON_CURRENCIES:
+        return f"❌ 不支持的计价口径：{currency}，可选：{', '.join(COMPARISON_CURRENCIES)}"
+    try:
+        ticker_list = [t.strip() for t in tickers.replace("，", ",").split(",") if t.strip()]
+        comparison = compare_tickers(ticker_list, SANDBOX_DIR, days, currency=currency, profile="telegram")
+        return (
+            f"✅ {len(comparison['tickers'])} 个标的归一化对比图生成完毕！文件名为：{comparison['file_name']}。\n\n"
+            f"{format_comparison_report(comparison)}\n\n"
+            f"🚨【强制语法】：必须严格使用 `![走势对比](./{comparison['file_name']})` 嵌入 Markdown 中！"
+        )
+    except ValueError as e:
+        return f"❌ 对比失败：{e}"
+    except Exception as e:
+        return f"❌ 对比失败：{type(e).__name__} - {str(e)}"
+
 # ==========================================
 # 插件 2：代码搜索工具
 # ==========================================
@@ -308,10 +416,9 @@ def write_local_file(file_path: str, content: str) -> str:
 # ==========================================
 # 🧠 底层向量加载引擎（L1/L2/L3 三级穿透架构）
 # ==========================================
-@lru_cache(maxsize=MAX_FAISS_CACHE_SIZE)
 def _get_or_build_vectorstore(file_name: str, target_path_str: str, current_mtime: float):
     """
-    带 LRU 缓存的向量库加载引擎，实现 L1 内存→L2 硬盘→L3 重建三级穿透。
+    向量库加载引擎，实现 L1 内存→L2 硬盘→L3 重建三级穿透。
     
     Args:
         file_name: 文件名（如 'report.pdf'）
@@ -322,19 +429,40 @@ def _get_or_build_vectorstore(file_name: str, target_path_str: str, current_mtim
         FAISS 向量库对象
     
     Note:
-        - 利用 lru_cache 的 maxsize 限制内存占用（默认最多 10 个文件）
-        - 利用 current_mtime 作为缓存 key 的一部分，文件修改后自动穿透失效
+        - L1 内存池按估算字节数（VECTORSTORE_CACHE_MAX_MB）淘汰，而不是按文件个数
+        - current_mtime 作为条目版本，文件修改后旧索引立即释放并穿透重建
+    """
+    return VECTORSTORE_CACHE.get_or_load(
+        file_name,
+        current_mtime,
+        lambda: _load_or_build_vectorstore(file_name, target_path_str, current_mtime),
+    )
+
+
+def _print_embedding_progress(done: int, total: int) -> None:
+    """向量化进度（缓存未命中的块每落盘一段回调一次）"""
+    console.print(f"[blue dim]   🧮 向量化进度 {done}/{total} ({done / total:.0%})[/blue dim]")
+
+
+def _build_kb_embeddings() -> CachedEmbeddings:
+    """
+    构建知识库向量模型：缓存层 → EMBEDDING_BACKEND 选定的后端（dashscope 为批量并发限速层 → DashScope）。
+
+    Raises:
+        RuntimeError: 向量模型初始化失败
     """
-    doc_cache_dir = FAISS_DB_DIR / f"{file_name}_vstore"
-    meta_file = doc_cache_dir / "meta.json"
-    
     try:
-        embeddings = DashScopeEmbeddings(
-            dashscope_api_key=embedding_key,
-            model="text-embedding-v3",
-        )
+        underlying, model = create_embeddings(EMBEDDING_BACKEND, api_key=embedding_key)
+        return CachedEmbeddings(underlying, model=model, progress=_print_embedding_progress)
     except Exception as e:
         raise RuntimeError(f"向量模型初始化失败：{type(e).__name__} - {str(e)}")
+
+
+def _load_or_build_vectorstore(file_name: str, target_path_str: str, current_mtime: float):
+    """L1 未命中时的加载路径：L2 硬盘持久化索引命中则直接加载，否则 L3 解析、向量化并持久化"""
+    doc_cache_dir = FAISS_DB_DIR / f"{file_name}_vstore"
+    meta_file = doc_cache_dir / "meta.json"
+    embeddings = _build_kb_embeddings()
     
     # ==========================================
     # 💾 尝试 L2 硬盘缓存
@@ -347,13 +475,15 @@ def _get_or_build_vectorstore(file_name: str, target_path_str: str, current_mtim
             if not isinstance(meta, dict):
                 raise TypeError("缓存元数据格式错误")
             
-            if meta.get("mtime") == current_mtime:
+            # 早期元数据没有 embedding 字段，均由 DashScope text-embedding-v3 构建
+            if meta.get("embedding", "text-embedding-v3") != KB_EMBEDDING_MODEL:
+                console.print(f"[bold yellow]♻️ 向量后端已切换 ({meta.get('embedding', 'text-embedding-v3')} → {KB_EMBEDDING_MODEL})，准备重建[/bold yellow]")
+            elif meta.get("mtime") == current_mtime:
                 console.print(f"[bold cyan]💾 L2 命中 (硬盘):[/bold cyan] [cyan dim]加载 {file_name} 的持久化索引[/cyan dim]")
-                vectorstore = FAISS.load_local(
-                    str(doc_cache_dir),
-                    embeddings,
-                    allow_dangerous_deserialization=True
-                )
+                # 内存映射加载：冷启动耗时与常驻内存不随索引体积增长
+                vectorstore = load_faiss_store(doc_cache_dir, embeddings)
+                # 早期构建的索引没有词法索引文件：现场构建并补写（不需要向量服务）
+                get_lexical_index(vectorstore, doc_cache_dir)
                 return vectorstore
         except (json.JSONDecodeError, TypeError) as e:
             console.print(f"[bold red]缓存元数据损坏 ({type(e).__name__})，准备降级重建[/bold red]")
@@ -363,35 +493,33 @@ def _get_or_build_vectorstore(file_name: str, target_path_str: str, current_mtim
     # ==========================================
     # 🔄 L2 未命中：触发 L3 重建并持久化
     # ==========================================
+    if not embedding_available():
+        raise EmbeddingUnavailableError("向量服务处于失败冷却期，暂不重建索引")
+
     console.print(f"[bold blue]🔄 构建索引:[/bold blue] [blue dim]正在对 {file_name} 进行解析、向量化与持久化...[/blue dim]")
     
-    target_path = Path(target_path_str)
-    ext = target_path.suffix.lower()
-    if ext == '.pdf':
-        loader = PyPDFLoader(target_path_str)
-    elif ext in ['.md', '.txt', '.csv']:
-        loader = TextLoader(target_path_str, encoding='utf-8')
-    else:
-        raise ValueError(f"不支持的文件格式：{ext}")
-    
-    docs = loader.load()
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
-    raw_splits = text_splitter.split_documents(docs)
-    splits = [s for s in raw_splits if s.page_content.strip()]
-    
-    if not splits:
+    # 流式解析并逐批构建向量库（只有缓存中从未出现过的文本块才会调用远端向量模型）
+    try:
+        vectorstore = build_vectorstore_streaming(Path(target_path_str), embeddings)
+    except (ConnectionError, TimeoutError, OSError) as e:
+        # 批量层的退避重试已耗尽：开启冷却期，后续检索直接走纯词法降级
+        mark_embedding_unavailable(f"{type(e).__name__} - {e}")
+        raise EmbeddingUnavailableError(f"向量服务不可用：{type(e).__name__} - {e}") from e
+    if vectorstore is None:
         raise ValueError(f"文件 {file_name} 内容为空或无法提取有效文本")
     
-    # 构建新的向量库
-    vectorstore = FAISS.from_documents(splits, embeddings)
+    # 超大文档的文本块数达到阈值时转换为近似索引
+    vectorstore = optimize_store_index(vectorstore)
     
-    # 写入 L2 硬盘
-    doc_cache_dir.mkdir(parents=True, exist_ok=True)
-    vectorstore.save_local(str(doc_cache_dir))
+    # 写入 L2 硬盘（原子替换，不影响其他进程正在映射的旧索引）
+    save_faiss_store(vectorstore, doc_cache_dir)
     with open(meta_file, 'w', encoding='utf-8') as f:
-        json.dump({"mtime": current_mtime, "file_name": file_name}, f)
+        json.dump({"mtime": current_mtime, "file_name": file_name, "embedding": KB_EMBEDDING_MODEL}, f)
     
-    console.print(f"[bold green]✅ 索引构建完成并已持久化到硬盘[/bold green]")
+    console.print(
+        f"[bold green]✅ 索引构建完成并已持久化到硬盘[/bold green] "
+        f"[green dim](向量缓存命中 {embeddings.hits} 块，新增 {embeddings.misses} 块)[/green dim]"
+    )
     return vectorstore
 
 
@@ -412,19 +540,34 @@ def analyze_local_document(file_name: str, query: str) -> str:
         if not target_path.exists():
             return f"❌ 找不到文件：{file_name}。请先使用 list_kb_files 工具查看当前有哪些文件。"
         
-        # 获取文件修改时间戳（用于 lru_cache 自动失效）
+        # 获取文件修改时间戳（作为 L1 内存池条目版本，文件修改后自动失效）
         current_mtime = os.path.getmtime(target_path)
         target_path_str = str(target_path)
         
-        # 🚀 调用底层向量加载引擎（自动 L1/L2/L3 穿透）
-        vectorstore = _get_or_build_vectorstore(file_name, target_path_str, current_mtime)
+        # ⚡ 短时结果缓存：同一问题（含仅标点 / 空白不同的追问）直接复用；mtime 参与命名空间，文件更新后自然失效
+        cache_namespace = ("doc", current_mtime)
+        relevant_docs, mode = RETRIEVAL_CACHE.get(cache_namespace, [file_name], query, 3), "cached"
+        if relevant_docs is None:
+            try:
+                # 🚀 调用底层向量加载引擎（自动 L1/L2/L3 穿透）
+                vectorstore = _get_or_build_vectorstore(file_name, target_path_str, current_mtime)
+            except EmbeddingUnavailableError as e:
+                # 索引尚未建成且向量服务不可用：现场解析文档做纯词法检索
+                console.print(f"[bold yellow]⚠️ 降级检索:[/bold yellow] [yellow dim]{e}，改用关键词检索 {file_name}[/yellow dim]")
+                relevant_docs, mode = lexical_search_document(target_path, query, k=3), "lexical"
+            else:
+                # 🔎 词法（BM25）+ 向量混合检索；查询向量化超时则只用词法结果
+                relevant_docs, mode = hybrid_search(vectorstore, query, k=3)
+            # 降级结果不缓存：向量服务恢复后立即回到混合检索
+            if mode == "hybrid":
+                RETRIEVAL_CACHE.put(cache_namespace, [file_name], query, 3, relevant_docs)
         
-        # 执行检索操作
-        retriever = vectorstore.as_retriever(search_kwargs={"k": 3})
-        relevant_docs = retriever.invoke(query)
+        if not relevant_docs:
+            return f"文档 {file_name} 中没有检索到与「{query}」相关的内容。"
         
         context = "\n---\n".join([doc.page_content for doc in relevant_docs])
-        return f"✅ 从文档 {file_name} 中检索到以下核心信息：\n{context}\n\n请根据以上数据回答。"
+        note = "⚠️ 向量服务暂不可用，以下为关键词检索结果，语义相关性可能不足。\n" if mode == "lexical" else ""
+        return f"✅ 从文档 {file_name} 中检索到以下核心信息：\n{note}{context}\n\n请根据以上数据回答。"
         
     except json.JSONDecodeError:
         return f"❌ 文档元数据损坏：JSONDecodeError"
@@ -440,6 +583,17 @@ def analyze_local_document(file_name: str, query: str) -> str:
 # ==========================================
 # 插件 6：给 Agent 一双“眼睛”去查看知识库
 # ==========================================
+def _list_kb_file_names() -> list[str]:
+    """
+    扫描知识库目录，返回白名单后缀的文件名（按名称排序）。
+
+    Raises:
+        FileNotFoundError: 知识库目录不存在
+        PermissionError: 无权访问知识库目录
+    """
+    return sorted(f.name for f in KB_DIR.iterdir() if f.is_file() and f.suffix.lower() in ALLOWED_EXTENSIONS)
+
+
 @tool
 def list_kb_files() -> str:
     """
@@ -447,8 +601,7 @@ def list_kb_files() -> str:
     它会返回知识库文件夹下所有可用的文件列表。
     """
     try:
-        # 扫描白名单内的所有文件
-        files = [f.name for f in KB_DIR.iterdir() if f.is_file() and f.suffix.lower() in ALLOWED_EXTENSIONS]
+        files = _list_kb_file_names()
         if not files:
             return "当前知识库文件夹为空，没有找到任何支持的文件。"
         return f"知识库中当前有以下文件可以读取:\n" + "\n".join(files)
@@ -459,6 +612,143 @@ def list_kb_files() -> str:
     except Exception as e:
         return f"读取目录出错：{type(e).__name__} - {str(e)}"
 
+# ==========================================
+# 插件 6-B：跨文档全局检索（整个知识库一份索引，增量维护）
+# ==========================================
+_kb_index: KnowledgeBaseIndex | None = None
+_kb_index_lock = threading.Lock()
+
+
+def _get_kb_index() -> KnowledgeBaseIndex:
+    """进程级全局索引单例（首次使用时加载；后台索引线程与工具调用共用）"""
+    global _kb_index
+    with _kb_index_lock:
+        if _kb_index is None:
+            _kb_index = KnowledgeBaseIndex(FAISS_DB_DIR / KB_INDEX_DIRNAME, _build_kb_embeddings(), model=KB_EMBEDDING_MODEL)
+        return _kb_index
+
+
+def _kb_directory_snapshot() -> dict[str, tuple[Path, float]]:
+    """知识库目录快照：{文件名: (路径, mtime)}"""
+    return {name: (KB_DIR / name, os.path.getmtime(KB_DIR / name)) for name in _list_kb_file_names()}
+
+
+def _ensure_index_queued(file_name: str, mtime: float | None) -> None:
+    """
+    确保未入索引 / 已过期的文件在后台索引队列中。
+
+    已在排队或执行中的不重复投递；已放弃（failed）的只有在文件之后又被修改过时才重新投递，
+    避免每次检索都把解析必然失败的文件重新跑一遍。
+    """
+    status = get_index_queue().status(file_name)
+    if status is not None and status["status"] in ("queued", "running"):
+        return
+    if status is not None and status["status"] == "failed" and mtime is not None:
+        finished = datetime.fromisoformat(status["finished_at"]).timestamp() if status.get("finished_at") else 0.0
+        if mtime <= finished:
+            return
+    enqueue_kb_file(file_name, "search")
+
+
+@tool
+def search_knowledge_base(query: str, file_names: str = "") -> str:
+    """
+    在整个知识库中跨文档检索，一次搜索即可覆盖所有研报、日报与笔记，无需先猜测文件名。
+    - 参数 query: 检索问题或关键词。
+    - 参数 file_names: 可选，逗号分隔的文件名，只在这些文件中检索（例如 "report.pdf,盘后日报_20260101.md"）；留空表示全库。
+    返回的每段内容都标注了来源文件，回答时请注明出处。
+    """
+    try:
+        index = _get_kb_index()
+        snapshot = _kb_directory_snapshot()
+        indexed = index.files()
+
+        # 只检索已入索引的文件；新增 / 修改 / 删除的文件交给后台 worker，不在工具调用里现场向量化
+        pending = sorted(
+            name for name, (_, mtime) in snapshot.items() if name not in indexed or indexed[name]["mtime"] != mtime
+        )
+        for name in pending + sorted(set(indexed) - set(snapshot)):
+            _ensure_index_queued(name, snapshot[name][1] if name in snapshot else None)
+
+        files = [name.strip() for name in file_names.split(",") if name.strip()] or None
+        if files:
+            unknown = [name for name in files if name not in snapshot]
+            if unknown:
+                return f"❌ 知识库中没有这些文件：{', '.join(unknown)}。请先使用 list_kb_files 工具查看当前有哪些文件。"
+            pending = [name for name in pending if name in files]
+            files = [name for name in files if name in indexed]
+        elif not set(indexed) <= set(snapshot):
+            # 已删除但尚未移出索引的文件不参与检索
+            files = [name for name in indexed if name in snapshot]
+
+        status_notes = []
+        for name in pending:
+            status = get_index_queue().status(name) or {}
+            if status.get("status") == "failed":
+                status_notes.append(f"{name}（索引失败：{status.get('error') or '未知错误'}）")
+            else:
+                state = "旧版本仍可检索，新版本索引中" if name in indexed else "索引中，暂未参与检索"
+                status_notes.append(f"{name}（{state}）")
+        note = f"\n\n⏳ 以下文件仍在后台索引：{'；'.join(status_notes)}" if status_notes else ""
+
+        if files is not None and not files:
+            return f"指定的文件尚未完成索引，请稍后再试。{note}"
+
+        hits, mode = RETRIEVAL_CACHE.get("kb", files, query, 5), "cached"
+        if hits is None:
+            # 🔎 词法（BM25）+ 向量混合检索；查询向量化超时则只用词法结果
+            hits, mode = index.hybrid_search(query, k=5, files=files)
+            # 降级结果不缓存：向量服务恢复后立即回到混合检索
+            if mode == "hybrid":
+                RETRIEVAL_CACHE.put("kb", files, query, 5, hits)
+        if not hits:
+            return f"知识库为空或没有检索到相关内容。{note}"
+
+        degraded = "⚠️ 向量服务暂不可用，以下为关键词检索结果，语义相关性可能不足。\n" if mode == "lexical" else ""
+        blocks = []
+        for doc in hits:
+            source = doc.metadata.get(KB_FILE_METADATA_KEY, "未知文件")
+            page = doc.metadata.get("page")
+            label = f"{source} · 第 {page + 1} 页" if isinstance(page, int) else source
+            blocks.append(f"【{label}】\n{doc.page_content}")
+        return degraded + "✅ 从知识库中检索到以下核心信息：\n" + "\n---\n".join(blocks) + note + "\n\n请根据以上数据回答，并注明出处。"
+
+    except FileNotFoundError:
+        return "❌ 知识库目录不存在"
+    except RuntimeError as e:
+        return f"❌ 系统错误：{e}"
+    except Exception as e:
+        return f"检索知识库出错：{type(e).__name__} - {str(e)}"
+
+
+def index_kb_file(file_name: str) -> int:
+    """
+    后台索引 worker 的任务函数：为单个知识库文件预建单文件索引并收录进全局索引。
+
+    Args:
+        file_name: 知识库中的文件名
+
+    Returns:
+        int: 全局索引中该文件的文本块数（文件已被删除时返回 0 并从全局索引移除）
+
+    Raises:
+        ValueError: 文件名非法或格式不受支持
+    """
+    target_path, err = _resolve_safe_path(file_name, KB_DIR)
+    if err:
+        raise ValueError(err)
+    index = _get_kb_index()
+    if not target_path.exists():
+        if index.remove_file(file_name):
+            index.save()
+        return 0
+    if target_path.suffix.lower() not in ALLOWED_EXTENSIONS:
+        raise ValueError(f"不支持的文件格式：{target_path.suffix}")
+    mtime = os.path.getmtime(target_path)
+    # 单文件索引（analyze_local_document）与全局索引（search_knowledge_base）共用文本块向量缓存，第二遍不产生远端调用
+    _get_or_build_vectorstore(file_name, str(target_path), mtime)
+    return index.ensure_file(file_name, target_path, mtime)
+
 # ==========================================
 # 插件 7：长期记忆提取
 # ==========================================
@@ -502,6 +792,9 @@ def update_user_memory(key: str, value: str) -> str:
             with open(USER_PROFILE_PATH, 'w', encoding='utf-8') as f:
                 json.dump(data, f, ensure_ascii=False, indent=2)
 
+        # 持仓可能已变化，作废估值结果缓存
+        invalidate_valuation_cache()
+
         return f"✅ 记忆已安全写入（加锁保护）：[{key}] -> '{value}'"
     except json.JSONDecodeError:
         return "❌ 记忆文件损坏：JSONDecodeError"
@@ -515,16 +808,23 @@ def update_user_memory(key: str, value: str) -> str:
 def append_transaction_log(action: str, target: str, details: str) -> str:
     """
     🚨【交易日志指令】：
-    仅当用户明确发生了一笔【交易动作】（如：买入、卖出、转账）时调用。
+    仅当用户明确发生了一笔【交易动作】（如：买入、卖出、清仓、转账）时调用。
     它会像流水账一样把这笔操作追加到数据库中，绝对不会覆盖过去的历史。
+    
+    🚨【账本格式红线】（底层账本引擎会回放流水推导持仓与平均成本）：
+    - 参数 action: 必须是 "买入"、"卖出"、"清仓" 之一（转账等非交易动作可自由填写，不计入持仓）。
+    - 参数 target: 必须是标准股票代码（如 "AAPL", "0700.HK", "513050"），严禁使用自然语言公司名。
+    - 参数 details: 必须按照『[中文公司名称]，X 股，成本 Y』的格式记录，Y 为本笔成交单价。
+      例如：`苹果公司，100 股，成本 150`。
     """
     try:
-        log_path = Path("./memory/transaction_logs.jsonl")
+        log_path = TRANSACTION_LOG_PATH
+        log_path.parent.mkdir(parents=True, exist_ok=True)
         import time
         log_entry = json.dumps({
             "timestamp": time.time(),
             "action": action,     # 例如："买入"
-            "target": target,     # 例如："苹果股票"
+            "target": target,     # 例如："AAPL"
             "details": details    # 例如："100 股，成本 150"
         }, ensure_ascii=False)
         
@@ -539,6 +839,70 @@ def append_transaction_log(action: str, target: str, details: str) -> str:
         return f"记录流水失败：{type(e).__name__} - {str(e)}"
 
 
+# 工具 3：交易账本回放 (推导型)
+@tool
+def get_ledger_positions() -> str:
+    """
+    📒【交易账本持仓推导】：
+    当用户询问"按我的交易记录算，我现在持有多少"、"我的平均成本是多少"，
+    或需要核对交易流水与持仓快照是否一致时调用。
+    此工具会回放 ./memory/transaction_logs.jsonl 中的买入/卖出/清仓流水，
+    按移动加权平均成本法精确推导每个标的的当前股数与平均成本。
+    
+    Returns:
+        str: 账本推导出的持仓 Markdown 表格
+    """
+    try:
+        positions, stats = replay_ledger()
+    except TimeoutError:
+        return "❌ 账本快照锁超时：其他进程正在回放交易流水，请稍后重试"
+    except Exception as e:
+        return f"❌ 账本回放失败：{type(e).__name__} - {str(e)}"
+
+    if not positions:
+        return "📭 交易流水中暂无可推导的持仓（尚未记录任何买入流水或已全部清仓）。"
+
+    lines = [
+        "## 📒 交易账本推导持仓",
+        "",
+        f"**流水总数**: {stats['entries_total']} 条（本次增量回放 {stats['entries_replayed']} 条，"
+        f"无法识别 {stats['entries_skipped']} 条）",
+        "",
+        "| 标的代码 | 名称 | 持仓股数 | 平均成本 |",
+        "| :--- | :--- | :--- | :--- |",
+    ]
+    for ticker, pos in sorted(positions.items()):
+        lines.append(f"| {ticker} | {pos['company_name']} | {pos['shares']} | {pos['cost_basis']:.4f} |")
+    return "\n".join(lines)
+
+
+def _load_profile_positions() -> tuple[dict | None, str | None]:
+    """
+    读取 user_profile.json 并解析为估值引擎的标准 positions。
+
+    Returns:
+        tuple[dict | None, str | None]: (positions, 错误提示)，成功时错误提示为 None
+
+    Raises:
+        json.JSONDecodeError: 持仓记忆文件损坏
+    """
+    if not USER_PROFILE_PATH.exists():
+        return None, "❌ 未找到持仓记忆文件，请先告知我您的持仓情况。"
+
+    with open(USER_PROFILE_PATH, 'r', encoding='utf-8') as f:
+        user_data = json.load(f)
+
+    if not user_data:
+        return None, "❌ 持仓记忆为空，请先告知我您的持仓情况。"
+
+    positions = parse_user_profile_to_positions(user_data)
+
+    if not positions:
+        return None, "❌ 未解析到有效持仓数据，请检查持仓记忆格式。"
+
+    return positions, None
+
+
 # ==========================================
 # 插件 8：个人持仓市值精确计算器
 # ==========================================
@@ -551,28 +915,18 @@ def calculate_exact_portfolio_value() -> str:
     
     此工具会：
     1. 读取 ./memory/user_profile.json 中的持仓数据
-    2. 调用底层估值引擎获取实时股价
+    2. 调用底层估值引擎获取实时股价（短时间内重复盘点直接复用缓存结果，并标注原始计算时间）
     3. 精确计算总市值、总成本、今日盈亏
     
     Returns:
         str: 格式化的 Markdown 报告，包含总资产概览和各持仓明细表格
     """
     try:
-        if not USER_PROFILE_PATH.exists():
-            return "❌ 未找到持仓记忆文件，请先告知我您的持仓情况。"
+        positions, error = _load_profile_positions()
+        if error:
+            return error
         
-        with open(USER_PROFILE_PATH, 'r', encoding='utf-8') as f:
-            user_data = json.load(f)
-        
-        if not user_data:
-            return "❌ 持仓记忆为空，请先告知我您的持仓情况。"
-        
-        positions = parse_user_profile_to_positions(user_data)
-        
-        if not positions:
-            return "❌ 未解析到有效持仓数据，请检查持仓记忆格式。"
-        
-        valuation = calculate_portfolio_valuation(positions)
+        valuation = get_cached_portfolio_valuation(positions)
         markdown_report = format_portfolio_report(valuation)
         
         return markdown_report
@@ -582,6 +936,133 @@ def calculate_exact_portfolio_value() -> str:
     except Exception as e:
         return f"❌ 计算失败：{type(e).__name__} - {str(e)}"
 
+
+# ==========================================
+# 插件 8-B：组合压力测试 (情景网格)
+# ==========================================
+@tool
+def run_stress_test(
+    us_equity: str = "0",
+    hk_equity: str = "0",
+    cn_equity: str = "0",
+    usd_cny: str = "0",
+    hkd_cny: str = "0",
+    ticker_overrides: str = "",
+) -> str:
+    """
+    🌪️【组合压力测试 / 情景分析】：
+    当用户提出"如果港币贬值 3%、恒指跌 10%，我的组合会怎样"、"美股回撤 20% 我亏多少"、
+    "汇率和股价一起跌的最坏情况"之类的假设性问题时，**必须**调用此工具，严禁自行心算！
+
+    所有冲击参数单位均为百分比，每个参数都支持三种写法：
+    - 单值："-10"
+    - 列表："-10,-5,0"
+    - 区间（起点:终点:步长，含终点）："-20:0:2"
+    多个参数同时给出列表/区间时，工具会自动展开为全部组合的情景网格（笛卡尔积）。
+
+    Args:
+        us_equity: 美股持仓的股价冲击，如 "-20"
+        hk_equity: 港股持仓的股价冲击，如恒指跌 10% 传 "-10"
+        cn_equity: A 股持仓（含场内 ETF）的股价冲击
+        usd_cny: 美元兑人民币汇率变动，如美元贬值 3% 传 "-3"
+        hkd_cny: 港币兑人民币汇率变动，如港币贬值 3% 传 "-3"
+        ticker_overrides: 单票冲击覆盖（优先于所属市场冲击），格式 "代码=冲击;代码=冲击"，如 "0700.HK=-15;AAPL=-30:0:10"
+
+    Returns:
+        str: Markdown 压力测试报告（单一情景给出逐票明细，多情景给出分布统计与最差情景）
+    """
+    try:
+        factor_values = {
+            "US": parse_shock_spec(us_equity),
+            "HK": parse_shock_spec(hk_equity),
+            "CN": parse_shock_spec(cn_equity),
+            "USD_CNY": parse_shock_spec(usd_cny),
+            "HKD_CNY": parse_shock_spec(hkd_cny),
+        }
+        factor_values.update(parse_ticker_overrides(ticker_overrides))
+        factor_names, grid = build_shock_grid(factor_values)
+    except ValueError as e:
+        return f"❌ 冲击参数格式错误：{str(e)}"
+
+    try:
+        positions, error = _load_profile_positions()
+        if error:
+            return error
+
+        valuation = get_cached_portfolio_valuation(positions)
+
+        unknown = unknown_override_tickers(valuation, factor_names)
+        if unknown:
+            held = ", ".join(h["ticker"] for h in valuation.get("holdings", []))
+            return (f"❌ 单票冲击覆盖中的代码不在当前持仓中：{', '.join(unknown)}。"
+                    f"当前持仓代码：{held or '无'}。请使用持仓中的代码重新调用。")
+
+        import time
+        start = time.perf_counter()
+        result = revalue_portfolio(valuation, factor_names, grid)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        if not result["tickers"]:
+            return "❌ 所有持仓均查价失败，无法进行压力测试。"
+
+        return format_stress_report(valuation, factor_names, grid, result, elapsed_ms)
+
+    except json.JSONDecodeError:
+        return "❌ 持仓记忆文件损坏：JSONDecodeError"
+    except Exception as e:
+        return f"❌ 压力测试失败：{type(e).__name__} - {str(e)}"
+
+# ==========================================
+# 插件 8-C：组合历史回测 (当前持仓 vs 拟调整配置)
+# ==========================================
+@tool
+def run_portfolio_backtest(
+    allocation: str = "",
+    days: int = 365,
+    rebalance: str = "monthly",
+    cost_bps: float = 10.0,
+) -> str:
+    """
+    ⏪【组合历史回测】：
+    当用户询问"我这套持仓过去一年表现如何"、"如果按 XX 比例配置过去会怎样"、
+    "调仓前后回撤对比"等历史回放问题时调用此工具，严禁自行编造历史收益数据！
+
+    工具始终回放当前持仓（按现有股数买入持有）；若提供 allocation，会同时回放拟调整配置并并列对比。
+    所有市值按历史汇率折算为人民币。
+
+    Args:
+        allocation: 拟调整配置，格式 "代码=权重百分比;代码=权重百分比"，如 "AAPL=40;0700.HK=30;600519=30"；留空则只回放当前持仓
+        days: 回看的自然日天数，默认 365，最长 5 年
+        rebalance: 拟调整配置的再平衡频率，可选 none / weekly / monthly / quarterly
+        cost_bps: 拟调整配置每次再平衡的交易成本（基点），默认 10
+
+    Returns:
+        str: Markdown 回测报告（收益、波动、最大回撤、换手率、月末净值）
+    """
+    if rebalance not in REBALANCE_FREQUENCIES:
+        return f"❌ 不支持的再平衡频率：{rebalance}，可选：{', '.join(REBALANCE_FREQUENCIES)}"
+
+    try:
+        target = parse_allocation(allocation) if allocation.strip() else None
+    except ValueError as e:
+        return f"❌ 配置参数格式错误：{str(e)}"
+
+    try:
+        positions, error = _load_profile_positions()
+        if error and target is None:
+            return error
+
+        backtest = run_backtest(positions or {}, target, days=days, rebalance=rebalance, cost_bps=cost_bps)
+        if not backtest:
+            return "❌ 历史日线数据不足，无法完成回测。"
+
+        return format_backtest_report(backtest)
+
+    except json.JSONDecodeError:
+        return "❌ 持仓记忆文件损坏：JSONDecodeError"
+    except Exception as e:
+        return f"❌ 回测失败：{type(e).__name__} - {str(e)}"
+
 # ==========================================
 # 插件 9：主动触发盘后研报推送 (独立进程版)
 # ==========================================
@@ -868,13 +1349,19 @@ def execute_workspace_cleanup(filenames: str) -> str:
 tools = [get_universal_stock_price,
          get_etf_price,
          draw_universal_stock_chart,
+         draw_portfolio_chart,
+         compare_stocks_chart,
          search_company_ticker,
          read_local_file, write_local_file,
          list_kb_files,
          analyze_local_document,
+         search_knowledge_base,
          update_user_memory,
          append_transaction_log,
+         get_ledger_positions,
          calculate_exact_portfolio_value,
+         run_stress_test,
+         run_portfolio_backtest,
          trigger_daily_report,
          query_job_status,
          create_price_alert,
@@ -936,13 +1423,16 @@ prompt = ChatPromptTemplate.from_messages([
     🔍 核心能力：
     - 遇到 ETF 基金查价（如 513050、159915 等 6 位数字代码），优先调用 `get_etf_price`；
     - 遇到股票查价，调用 `get_universal_stock_price`；
-    - 遇到画图需求，调用 `draw_universal_stock_chart`。
+    - 遇到画图需求，调用 `draw_universal_stock_chart`；需要同时展示多个标的（如全部持仓）走势时，调用 `draw_portfolio_chart` 一次生成一张总览图，严禁逐个标的画图。
+    - 遇到多标的走势对比（"A 和 B 谁涨得多"），调用 `compare_stocks_chart` 生成归一化叠加图与统计表，对比数值只能引用工具结果。
     工具会在底层自动识别美股/A 股/港股，你无需操心市场后缀，直接传入用户给的代码即可。
     ==============================
     🚨【财务计算红线】（最高优先级）：
     当用户询问自己的总资产、总市值、具体盈亏金额，或者要求盘点当前账户资金情况时，
     **绝对禁止自行数学推演或心算！**
     **必须且只能调用 `calculate_exact_portfolio_value` 工具获取精确数据！**
+    当用户提出"如果港币贬值、恒指下跌，我的组合会怎样"等假设性情景问题时，**必须调用 `run_stress_test`**，同样禁止心算！
+    当用户询问持仓或拟调整配置的历史表现时，**必须调用 `run_portfolio_backtest`**，禁止编造历史收益！
     ==============================
     🚨 【记忆存储路由法则】（最高优先级判断逻辑）
     当你接收到用户的新信息时，你必须在脑海中进行分类，并严格调用对应的工具：
@@ -966,13 +1456,13 @@ prompt = ChatPromptTemplate.from_messages([
     - 判断标准：信息时效性极短，交给底层默认的短期滑动窗口记忆处理即可。
     ==============================
      工作流如下：
-    1. 🔍 核心能力：遇到不知道的公司用 search_company_ticker，查本地资料用 analyze_local_document。
+    1. 🔍 核心能力：遇到不知道的公司用 search_company_ticker，查本地资料时，指定了某一份文件用 analyze_local_document，跨文件或不确定在哪份文件里用 search_knowledge_base（一次检索覆盖全库，无需先猜文件名）。
     2. ✍️ 智能输出调度（最高法则）：
        - ⚡ 轻量级问答：如果用户只是单纯询问价格或简单问题，请直接在终端简明扼要地回答。
        - 📝 盘后研报生成：当用户明确要求"盘后研报"、"每日研报"、"推送研报"、"今日市场报告"时，**绝对禁止你自行搜集数据或进行财务核算！** 你必须且只能**立刻唯一**地调用 `trigger_daily_report` 工具，将任务移交给后台引擎。**判断标准：用户意图是触发每日自动化报告流水线，而非针对某只股票或某个公司的专项分析。**
        - 📚 自定义深度分析：当用户要求对某只股票、某个公司或某个主题进行深度分析、生成报告、输出研究文档时，**必须调用 `write_local_file` 保存到文件**，禁止直接在聊天框输出长篇报告内容。无论用户是否明确说"保存"，只要涉及深度分析或报告生成，一律走文件保存流程。例如"帮我分析茅台"、"生成腾讯的研究报告"、"写一篇关于新能源的分析"、"给我一份xxx的深度报告"。
     
-    3. 🖼️ 图文并茂：生成报告时，请务必先调用 draw_universal_stock_chart 生成走势图，并在传给 write_local_file 的 Markdown 内容中，使用 `![图表](./xxx.png)` 将图片嵌入。报告生成后无需向用户解释任何文件格式或交付细节，直接告知报告已生成即可。
+    3. 🖼️ 图文并茂：生成报告时，请务必先调用 draw_universal_stock_chart（单标的）或 draw_portfolio_chart（多标的，一张总览图）生成走势图，并在传给 write_local_file 的 Markdown 内容中，使用 `![图表](./xxx.png)` 将图片嵌入。报告生成后无需向用户解释任何文件格式或交付细节，直接告知报告已生成即可。
     4. 🧠 记忆系统：结合用户历史告知你的持仓情况或偏好进行解读。
     5. 🗂️ 工作区整理：当用户要求清理文件时，**必须两步走**：先调用 `preview_workspace_cleanup` 列出待删文件并展示给用户确认，用户明确同意后再调用 `execute_workspace_cleanup` 执行删除。**严禁跳过预览步骤直接删除。**"""),
     ("placeholder", "{chat_history}"),
@@ -1002,6 +1492,10 @@ if __name__ == "__main__":
     print("\n🤖 股票分析 Agent 已启动！(输入 'quit', 'exit' 或 '退出' 结束对话)")
     print("-" * 60)
     
+    # 终端模式同样启动后台索引 worker，检索工具投递的文件在对话间隙完成向量化；
+    # 机器人进程已持有索引租约时本进程只投递任务，由机器人的 worker 领取并写全局索引
+    start_indexing_worker(index_kb_file, transient_errors=(EmbeddingUnavailableError,))
+    
     # 初始化高级会话（带内存历史记录）
     # 这样你不仅能左右移动光标修改错误，还能按“上/下方向键”调出上一轮问过的问题！
     session = PromptSession(history=InMemoryHistory())
@@ -0,0 +1,286 @@
+"""
+出站图片编码管道 - 按发送目标压缩图表与表格截图。
+
+本模块提供：
+1. 面向发送目标的编码档位：调色板量化 PNG（图表 / 表格等平涂色图形）、JPEG、WebP
+2. 超出目标分辨率的图片按比例缩小（表格截图以 3 倍设备像素比渲染，远超 Telegram 展示尺寸）
+3. 带透明通道的截图在有损格式下按指定底色压平
+4. 按 (路径, 修改时间, 大小, 档位) 缓存编码结果：同一张图在一次广播中只编码一次
+5. 字节节省统计（单张结果与进程内累计）
+6. 广播内的图片复用：同一张图首次上传后记录 file_id，其余接收人不再重复上传
+
+编码结果比原图更大时直接回退原始字节，保证压缩永远不会让上传变慢。
+"""
+
+import io
+import os
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class EncodeTarget:
+    """
+    出站图片编码档位。
+
+    Attributes:
+        fmt: 输出格式（png / jpeg / webp）
+        quality: 有损格式的质量（1-100），png 下忽略
+        colors: png 调色板颜色数；0 表示不量化（无损重新压缩）
+        max_side: 最长边像素上限，超出时等比缩小；0 表示不限制
+        background: 有损格式压平透明通道时使用的底色
+    """
+    fmt: str
+    quality: int = 85
+    colors: int = 0
+    max_side: int = 0
+    background: str = "#131722"
+
+
+# Telegram 照片最长边超过 2560 px 会被服务端再次缩放，多出的像素只会白白增加上传体积
+MEDIA_ENCODE_TARGETS: Dict[str, EncodeTarget] = {
+    "telegram": EncodeTarget(fmt="png", colors=256, max_side=2560),           # 图表 / 表格：文字边缘无损
+    "telegram_jpeg": EncodeTarget(fmt="jpeg", quality=85, max_side=2560),     # 体积优先
+    "webp": EncodeTarget(fmt="webp", quality=80, max_side=2560),              # 网页 / 归档预览
+}
+DEFAULT_MEDIA_TARGET = os.getenv("MEDIA_ENCODE_TARGET", "telegram")
+
+# 编码结果缓存容量（张）
+MEDIA_ENCODE_CACHE_SIZE = int(os.getenv("MEDIA_ENCODE_CACHE_SIZE", "64"))
+
+_FORMAT_EXTENSIONS = {"png": "png", "jpeg": "jpg", "webp": "webp"}
+
+_encode_cache: "OrderedDict[Tuple[str, int, int, str], EncodedImage]" = OrderedDict()
+_encode_cache_lock = threading.Lock()
+_encode_stats = {"images": 0, "cache_hits": 0, "original_bytes": 0, "encoded_bytes": 0}
+_encode_stats_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class EncodedImage:
+    """
+    编码结果。
+
+    Attributes:
+        data: 编码后的图片字节
+        fmt: 实际格式（回退原图时为原图格式）
+        original_bytes: 原图字节数
+        width / height: 输出尺寸
+        filename: 上传时使用的文件名（扩展名与实际格式一致）
+    """
+    data: bytes
+    fmt: str
+    original_bytes: int
+    width: int
+    height: int
+    filename: str
+
+    @property
+    def encoded_bytes(self) -> int:
+        return len(self.data)
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.original_bytes - self.encoded_bytes
+
+    @property
+    def saved_ratio(self) -> float:
+        return self.saved_bytes / self.original_bytes if self.original_bytes else 0.0
+
+
+def get_encode_target(target: str) -> EncodeTarget:
+    """
+    按名称获取编码档位。
+
+    Raises:
+        ValueError: 未知档位
+    """
+    if target not in MEDIA_ENCODE_TARGETS:
+        raise ValueError(f"不支持的编码档位：{target}，可选 {', '.join(MEDIA_ENCODE_TARGETS)}")
+    return MEDIA_ENCODE_TARGETS[target]
+
+
+def _flatten_alpha(image: Any, background: str) -> Any:
+    from PIL import Image
+
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        rgba = image.convert("RGBA")
+        base = Image.new("RGB", rgba.size, background)
+        base.paste(rgba, mask=rgba.getchannel("A"))
+        return base
+    return image.convert("RGB")
+
+
+def encode_image(source: Union[Path, str, bytes], target: str = DEFAULT_MEDIA_TARGET) -> EncodedImage:
+    """
+    按发送目标编码一张图片（纯 CPU，不写盘）。
+
+    Args:
+        source: 图片路径或原始字节
+        target: MEDIA_ENCODE_TARGETS 的键
+
+    Returns:
+        EncodedImage: 编码结果；编码后不小于原图时返回原始字节
+
+    Raises:
+        ValueError: 未知档位
+        OSError: 无法读取或解析图片
+    """
+    from PIL import Image
+
+    spec = get_encode_target(target)
+    if isinstance(source, bytes):
+        raw, stem = source, "image"
+    else:
+        path = Path(source)
+        raw, stem = path.read_bytes(), path.stem
+
+    with Image.open(io.BytesIO(raw)) as opened:
+        original_fmt = (opened.format or "png").lower()
+        image = opened.copy()
+    original_size = image.size
+
+    if spec.max_side and max(image.size) > spec.max_side:
+        scale = spec.max_side / max(image.size)
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    if spec.fmt == "png":
+        if spec.colors:
+            # RGBA 只能用快速八叉树量化；不透明图用中位切分，平涂色块的色带更少
+            has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+            if has_alpha:
+                image = image.convert("RGBA").quantize(colors=spec.colors, method=Image.Quantize.FASTOCTREE)
+            else:
+                image = image.convert("RGB").quantize(colors=spec.colors, method=Image.Quantize.MEDIANCUT)
+        image.save(buffer, format="PNG", optimize=True)
+    elif spec.fmt == "jpeg":
+        _flatten_alpha(image, spec.background).save(
+            buffer, format="JPEG", quality=spec.quality, optimize=True, progressive=True
+        )
+    else:
+        image.save(buffer, format="WEBP", quality=spec.quality, method=4)
+    data = buffer.getvalue()
+
+    if len(data) >= len(raw):
+        result = EncodedImage(raw, original_fmt, len(raw), *original_size, f"{stem}.{_FORMAT_EXTENSIONS.get(original_fmt, original_fmt)}")
+    else:
+        result = EncodedImage(data, spec.fmt, len(raw), image.width, image.height, f"{stem}.{_FORMAT_EXTENSIONS[spec.fmt]}")
+
+    with _encode_stats_lock:
+        _encode_stats["images"] += 1
+        _encode_stats["original_bytes"] += result.original_bytes
+        _encode_stats["encoded_bytes"] += result.encoded_bytes
+    return result
+
+
+def encode_image_cached(path: Union[Path, str], target: str = DEFAULT_MEDIA_TARGET) -> EncodedImage:
+    """
+    带缓存的图片编码：文件未变化（修改时间与大小相同）时直接复用上次的编码结果。
+
+    Args:
+        path: 图片路径
+        target: MEDIA_ENCODE_TARGETS 的键
+
+    Returns:
+        EncodedImage: 编码结果
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    key = (str(path), stat.st_mtime_ns, stat.st_size, target)
+
+    with _encode_cache_lock:
+        cached = _encode_cache.get(key)
+        if cached is not None:
+            _encode_cache.move_to_end(key)
+    if cached is not None:
+        with _encode_stats_lock:
+            _encode_stats["cache_hits"] += 1
+        return cached
+
+    result = encode_image(path, target)
+    logger.info(
+        f"🗜️ 图片编码 {path.name} -> {result.fmt}：{result.original_bytes / 1024:.1f} KB → "
+        f"{result.encoded_bytes / 1024:.1f} KB（节省 {result.saved_ratio:.0%}）"
+    )
+    with _encode_cache_lock:
+        _encode_cache[key] = result
+        while len(_encode_cache) > max(MEDIA_ENCODE_CACHE_SIZE, 0):
+            _encode_cache.popitem(last=False)
+    return result
+
+
+def get_encoding_stats() -> Dict[str, Any]:
+    """
+    进程内累计的编码统计。
+
+    Returns:
+        dict: images / cache_hits / original_bytes / encoded_bytes / saved_bytes / saved_ratio
+    """
+    with _encode_stats_lock:
+        stats = dict(_encode_stats)
+    stats["saved_bytes"] = stats["original_bytes"] - stats["encoded_bytes"]
+    stats["saved_ratio"] = round(stats["saved_bytes"] / stats["original_bytes"], 4) if stats["original_bytes"] else 0.0
+    return stats
+
+
+class OutboundPhotoCache:
+    """
+    一次广播内的出站图片复用：首次发送上传编码后的字节并记录平台返回的 file_id，
+    后续用户直接引用 file_id，同一张图只上传一次。
+    """
+
+    def __init__(self, target: str = DEFAULT_MEDIA_TARGET) -> None:
+        self.target = target
+        self._file_ids: Dict[str, str] = {}
+        self.uploads = 0
+        self.reused = 0
+        self.uploaded_bytes = 0
+        self.saved_bytes = 0
+
+    def resolve(self, path: Union[Path, str]) -> Union[str, EncodedImage]:
+        """
+        获取待发送的图片：已上传过则返回 file_id，否则返回编码结果（由调用方上传）。
+        """
+        key = str(Path(path).resolve())
+        if key in self._file_ids:
+            self.reused += 1
+            return self._file_ids[key]
+        encoded = encode_image_cached(key, self.target)
+        self.uploads += 1
+        self.uploaded_bytes += encoded.encoded_bytes
+        self.saved_bytes += encoded.saved_bytes
+        return encoded
+
+    def remember(self, path: Union[Path, str], file_id: str) -> None:
+        """记录图片上传后平台返回的 file_id"""
+        self._file_ids.setdefault(str(Path(path).resolve()), file_id)
+
+    def summary(self) -> Dict[str, int]:
+        return {
+            "uploads": self.uploads,
+            "reused": self.reused,
+            "uploaded_bytes": self.uploaded_bytes,
+            "saved_bytes": self.saved_bytes,
+        }
+
+
+if __name__ == "__main__":
+    import sys
+
+    # 用法：python media_encoder.py 图片1.png [图片2.png ...]，输出各编码档位的体积对比
+    print("| 文件 | 档位 | 格式 | 尺寸 | 原图 KB | 编码后 KB | 节省 |")
+    print("| :--- | :--- | :--- | :--- | ---: | ---: | ---: |")
+    for arg in sys.argv[1:]:
+        for name in MEDIA_ENCODE_TARGETS:
+            encoded = encode_image(arg, name)
+            print(
+                f"| {Path(arg).name} | {name} | {encoded.fmt} | {encoded.width}×{encoded.height} | "
+                f"{encoded.original_bytes / 1024:.1f} | {encoded.encoded_bytes / 1024:.1f} | {encoded.saved_ratio:.0%} |"
+            )
@@ -8,23 +8,28 @@ import os
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from typing import Final
+from typing import Final, Optional
 
 import markdown
 from tenacity import retry, stop_after_attempt, wait_exponential
 
+from report_model import Report, render_with_report
+
+MARKDOWN_EXTENSIONS: Final = ["tables", "fenced_code", "toc", "nl2br", "sane_lists"]
+
 
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=2, max=10)
 )
-def send_market_report_email(subject: str, markdown_content: str) -> bool:
+def send_market_report_email(subject: str, markdown_content: str, report: Optional[Report] = None) -> bool:
     """
     发送市场报告邮件到指定收件人。
 
     Args:
         subject: 邮件主题。
-        markdown_content: Markdown 格式的邮件正文内容。
+        markdown_content: Markdown 格式的邮件正文内容，可包含持仓对账单占位符。
+        report: 结构化持仓对账单；提供时直接渲染为 HTML 替换占位符，不再经过 Markdown 二次解析。
 
     Returns:
         bool: 发送成功返回 True，失败返回 False。
@@ -46,9 +51,17 @@ def send_market_report_email(subject: str, markdown_content: str) -> bool:
             "SMTP_SERVER, SENDER_EMAIL, SENDER_PASSWORD, RECEIVER_EMAIL"
         )
 
-    html_content: str = markdown.markdown(
+    html_content: str = render_with_report(
+        markdown_content,
+        report,
+        render_text=lambda text: markdown.markdown(text, extensions=MARKDOWN_EXTENSIONS),
+        render_report=Report.to_email_html,
+    )
+    plain_content: str = render_with_report(
         markdown_content,
-        extensions=["tables", "fenced_code", "toc", "nl2br", "sane_lists"]
+        report,
+        render_text=lambda text: text,
+        render_report=Report.to_markdown,
     )
 
     styled_html: str = f"""
@@ -83,7 +96,7 @@ def send_market_report_email(subject: str, markdown_content: str) -> bool:
     msg["From"] = sender_email
     msg["To"] = receiver_email
 
-    part_text: MIMEText = MIMEText(markdown_content, "plain", "utf-8")
+    part_text: MIMEText = MIMEText(plain_content, "plain", "utf-8")
     part_html: MIMEText = MIMEText(styled_html, "html", "utf-8")
 
     msg.attach(part_text)
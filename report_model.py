@@ -0,0 +1,253 @@
+"""
+结构化报告模型 - 一次构建，多渠道直出。
+
+本模块提供：
+1. 报告的结构化表示（章节 / 键值 / 列表 / 表格 / 提示 / 数值指标）
+2. 直出渲染器：Markdown、邮件 HTML、Telegram HTML、表格截图用 HTML
+3. 大模型正文中的报告占位符拼接（正文走 Markdown 管道，结构化报告走直出渲染器）
+
+各输出渠道直接消费结构化对象，不再需要用正则从 Markdown 中重新识别表格，
+也不再需要 markdown.markdown 二次解析。
+"""
+
+import html
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+
+# 盘后研报中由大模型原样输出的持仓对账单占位符，各渠道在发送前替换为结构化报告
+PORTFOLIO_REPORT_PLACEHOLDER = "[[持仓对账单]]"
+
+# Telegram 标题前缀，与 tg_main.translate_to_telegram_html 的标题降级保持一致
+_TELEGRAM_HEADING_PREFIX = {1: "◆", 2: "●", 3: "■"}
+
+
+@dataclass
+class KeyValue:
+    """独立成段的键值对，如 "**计算时间**: 2026-03-09 15:00:00" """
+    label: str
+    value: str
+
+
+@dataclass
+class BulletList:
+    """键值对无序列表"""
+    items: List[KeyValue]
+
+
+@dataclass
+class Paragraph:
+    """普通段落，bold 为 True 时整段加粗"""
+    text: str
+    bold: bool = False
+
+
+@dataclass
+class Note:
+    """提示引用块（如过期价格说明）"""
+    text: str
+
+
+@dataclass
+class Table:
+    """
+    表格。单元格均为已格式化的字符串，bold_cells 记录需要加粗的 (行, 列) 坐标。
+    """
+    headers: List[str]
+    rows: List[List[str]]
+    bold_cells: Set[Tuple[int, int]] = field(default_factory=set)
+
+
+Block = Union[KeyValue, BulletList, Paragraph, Note, Table]
+
+
+@dataclass
+class Section:
+    """报告章节：标题 + 有序内容块"""
+    title: str
+    level: int = 2
+    blocks: List[Block] = field(default_factory=list)
+
+
+@dataclass
+class Report:
+    """
+    结构化报告。
+
+    Attributes:
+        sections: 有序章节
+        metrics: 报告携带的原始数值（供下游直接读取，不必再从文本中解析）
+    """
+    sections: List[Section]
+    metrics: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def tables(self) -> List[Table]:
+        """报告中的全部表格（按出现顺序）"""
+        return [b for s in self.sections for b in s.blocks if isinstance(b, Table)]
+
+    def to_markdown(self) -> str:
+        """渲染为标准 Markdown（与大模型上下文、知识库归档使用的格式一致）"""
+        parts: List[str] = []
+        for section in self.sections:
+            parts.append(f"{'#' * section.level} {section.title}")
+            parts.extend(_block_to_markdown(block) for block in section.blocks)
+        return "\n\n".join(parts)
+
+    def to_email_html(self) -> str:
+        """渲染为邮件正文 HTML 片段（由 notifier 套用统一样式模板）"""
+        parts: List[str] = []
+        for section in self.sections:
+            level = min(max(section.level, 1), 6)
+            parts.append(f"<h{level}>{_escape(section.title)}</h{level}>")
+            parts.extend(_block_to_email_html(block) for block in section.blocks)
+        return "\n".join(parts)
+
+    def to_telegram_html(self) -> str:
+        """渲染为单条 Telegram HTML 文本（表格降级为等宽 <pre> 块）"""
+        rendered = []
+        for kind, payload in self.iter_telegram_parts():
+            rendered.append(payload if kind == "text" else table_to_telegram_pre(payload))
+        return "\n\n".join(rendered)
+
+    def iter_telegram_parts(self) -> List[Tuple[str, Union[str, Table]]]:
+        """
+        按顺序切分为 Telegram 发送单元：连续的非表格内容合并为一个 ("text", html)，
+        每个表格独立为 ("table", Table)，由调用方渲染为图片发送。
+
+        Returns:
+            List[Tuple[str, Union[str, Table]]]: 发送单元列表
+        """
+        parts: List[Tuple[str, Union[str, Table]]] = []
+        buffer: List[str] = []
+
+        def flush() -> None:
+            if buffer:
+                parts.append(("text", "\n\n".join(buffer)))
+                buffer.clear()
+
+        for section in self.sections:
+            prefix = _TELEGRAM_HEADING_PREFIX.get(section.level, "◈")
+            if section.level <= 3:
+                buffer.append(f"<blockquote><b>{prefix} {_escape(section.title)}</b></blockquote>")
+            else:
+                buffer.append(f"<b>{prefix} {_escape(section.title)}</b>")
+            for block in section.blocks:
+                if isinstance(block, Table):
+                    flush()
+                    parts.append(("table", block))
+                else:
+                    buffer.append(_block_to_telegram_html(block))
+        flush()
+        return parts
+
+
+def _escape(text: str) -> str:
+    return html.escape(str(text), quote=False)
+
+
+def _block_to_markdown(block: Block) -> str:
+    if isinstance(block, KeyValue):
+        return f"**{block.label}**: {block.value}"
+    if isinstance(block, BulletList):
+        return "\n".join(f"- **{item.label}**: {item.value}" for item in block.items)
+    if isinstance(block, Paragraph):
+        return f"**{block.text}**" if block.bold else block.text
+    if isinstance(block, Note):
+        return f"> {block.text}"
+    lines = [
+        "| " + " | ".join(block.headers) + " |",
+        "| " + " | ".join(":---" for _ in block.headers) + " |",
+    ]
+    for r, row in enumerate(block.rows):
+        cells = [f"**{cell}**" if (r, c) in block.bold_cells else cell for c, cell in enumerate(row)]
+        lines.append("| " + " | ".join(cells) + " |")
+    return "\n".join(lines)
+
+
+def table_to_html(table: Table) -> str:
+    """将表格渲染为 <table> HTML（邮件正文与 Playwright 表格截图共用）"""
+    head = "".join(f"<th>{_escape(h)}</th>" for h in table.headers)
+    body = []
+    for r, row in enumerate(table.rows):
+        cells = []
+        for c, cell in enumerate(row):
+            text = _escape(cell)
+            cells.append(f"<td><strong>{text}</strong></td>" if (r, c) in table.bold_cells else f"<td>{text}</td>")
+        body.append(f"<tr>{''.join(cells)}</tr>")
+    return f"<table>\n<thead>\n<tr>{head}</tr>\n</thead>\n<tbody>\n" + "\n".join(body) + "\n</tbody>\n</table>"
+
+
+def table_to_telegram_pre(table: Table) -> str:
+    """将表格降级为 Telegram 等宽文本块（截图失败时的兜底）"""
+    lines = [" | ".join(table.headers)]
+    lines.extend(" | ".join(row) for row in table.rows)
+    return f"<pre>{_escape(chr(10).join(lines))}</pre>"
+
+
+def _block_to_email_html(block: Block) -> str:
+    if isinstance(block, KeyValue):
+        return f"<p><strong>{_escape(block.label)}</strong>: {_escape(block.value)}</p>"
+    if isinstance(block, BulletList):
+        items = "".join(f"<li><strong>{_escape(i.label)}</strong>: {_escape(i.value)}</li>" for i in block.items)
+        return f"<ul>{items}</ul>"
+    if isinstance(block, Paragraph):
+        text = _escape(block.text)
+        return f"<p><strong>{text}</strong></p>" if block.bold else f"<p>{text}</p>"
+    if isinstance(block, Note):
+        return f"<blockquote><p>{_escape(block.text)}</p></blockquote>"
+    return table_to_html(block)
+
+
+def _block_to_telegram_html(block: Block) -> str:
+    if isinstance(block, KeyValue):
+        return f"<b>{_escape(block.label)}</b>: {_escape(block.value)}"
+    if isinstance(block, BulletList):
+        return "\n".join(f"🔹 <b>{_escape(i.label)}</b>: {_escape(i.value)}" for i in block.items)
+    if isinstance(block, Paragraph):
+        text = _escape(block.text)
+        return f"<b>{text}</b>" if block.bold else text
+    if isinstance(block, Note):
+        return f"<blockquote>{_escape(block.text)}</blockquote>"
+    return table_to_telegram_pre(block)
+
+
+def split_report_placeholder(text: str, placeholder: str = PORTFOLIO_REPORT_PLACEHOLDER) -> List[str]:
+    """
+    按占位符切分大模型正文。
+
+    Returns:
+        List[str]: 正文片段，结构化报告应插入相邻片段之间；
+        正文中没有占位符时返回单元素列表（调用方应将报告追加到末尾）
+    """
+    return text.split(placeholder)
+
+
+def render_with_report(
+    text: str,
+    report: Optional[Report],
+    render_text: Callable[[str], str],
+    render_report: Callable[[Report], str],
+    fallback: str = "暂无持仓数据",
+    placeholder: str = PORTFOLIO_REPORT_PLACEHOLDER,
+) -> str:
+    """
+    将含占位符的大模型正文与结构化报告拼接为单一渠道的输出。
+
+    Args:
+        text: 大模型生成的 Markdown 正文
+        report: 结构化报告；为 None 时占位符替换为 fallback 文本
+        render_text: 正文片段的渲染函数（如 markdown.markdown）
+        render_report: 结构化报告的直出渲染函数（如 Report.to_email_html）
+        fallback: 没有报告时替换占位符的文本（同样经过 render_text）
+        placeholder: 占位符
+
+    Returns:
+        str: 拼接后的渲染结果
+    """
+    segments = split_report_placeholder(text, placeholder)
+    rendered_report = render_report(report) if report is not None else render_text(fallback)
+    if len(segments) == 1:
+        if report is None:
+            return render_text(text)
+        return render_text(text) + "\n\n" + rendered_report
+    return ("\n\n" + rendered_report + "\n\n").join(render_text(s) if s.strip() else "" for s in segments)
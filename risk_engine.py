@@ -0,0 +1,437 @@
+"""
+组合风险引擎 - 基于日线历史的向量化风险指标计算。
+
+本模块提供：
+1. 价格矩阵对齐（日期 × 标的）与收益率矩阵构建
+2. 年化波动率、相对基准指数的 Beta、历史 VaR / CVaR、最大回撤、相关系数矩阵；
+   单票指标按各自有数据的区间计算，Beta 与相关系数取两两共同有数据的日期，新上市的持仓不会截短其他标的的样本
+3. 组合层面的风险汇总与 Markdown 报告（供盘后研报 PM 节点引用）
+
+所有指标均以 numpy 矩阵运算一次性算出，不在标的维度上做 Python 循环，
+100 个标的 × 3 年日线的计算耗时在毫秒级。
+"""
+
+import logging
+from typing import Dict, Any, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from valuation_engine import BENCHMARK_INDICES, fetch_price_history, format_universal_ticker
+
+logger = logging.getLogger(__name__)
+
+TRADING_DAYS_PER_YEAR = 252
+
+# 默认回看 3 年自然日
+DEFAULT_LOOKBACK_DAYS = 3 * 365
+
+# 计算风险指标所需的最少有效收益率观测数
+MIN_OBSERVATIONS = 20
+
+
+def build_price_matrix(
+    history: Dict[str, pd.DataFrame],
+    tickers: List[str],
+    field: str = "Close",
+    fill: bool = True,
+) -> Tuple[np.ndarray, List[str], pd.DatetimeIndex]:
+    """
+    将多个标的的日线历史对齐为「日期 × 标的」价格矩阵。
+
+    不同市场交易日历不同（A 股 / 港股 / 美股假期错开），取日期并集后向前填充，
+    上市前或缓存缺失的区间保留为 NaN，由收益率构建阶段统一处理。
+
+    Args:
+        history: fetch_price_history 返回的 {格式化代码: OHLCV DataFrame}
+        tickers: 需要参与对齐的格式化代码（决定矩阵列顺序）
+        field: 使用的价格字段，默认收盘价
+        fill: 是否向前填充休市日；计算收益率时应传 False，避免填充值变成虚假的 0 收益
+
+    Returns:
+        Tuple[np.ndarray, List[str], pd.DatetimeIndex]: (价格矩阵 T×N, 实际列顺序, 日期索引)
+    """
+    columns = [t for t in tickers if t in history and field in history[t].columns]
+    if not columns:
+        return np.empty((0, 0)), [], pd.DatetimeIndex([])
+
+    frame = pd.concat({t: history[t][field] for t in columns}, axis=1).sort_index()
+    if fill:
+        frame = frame.ffill()
+    return frame.to_numpy(dtype=float), columns, pd.DatetimeIndex(frame.index)
+
+
+def price_to_returns(prices: np.ndarray) -> np.ndarray:
+    """
+    由价格矩阵计算简单日收益率矩阵。
+
+    任一标的没有价格（休市、停牌、未上市）的日期整行剔除，收益率在各标的都有价格的相邻日期之间计算，
+    跨越剔除日期的涨跌计入下一个共同交易日，而不是把休市日记成 0 收益压低波动率与相关性。
+
+    Args:
+        prices: 价格矩阵 T×N（可含 NaN）
+
+    Returns:
+        np.ndarray: 收益率矩阵 (T'-1)×N，T' 为没有缺失值的日期数
+    """
+    prices = prices[~np.isnan(prices).any(axis=1)]
+    if prices.shape[0] < 2:
+        return np.empty((0, prices.shape[1]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = prices[1:] / prices[:-1] - 1.0
+    return np.nan_to_num(returns, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def price_to_window_returns(prices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    由价格矩阵计算收益率矩阵，每个标的只在自身的数据区间（首个到最后一个有价格的日期）内取值。
+
+    与 price_to_returns 相同，区间内有标的缺价格（休市、停牌）的日期整行剔除，涨跌计入下一个保留日期；
+    但尚未上市或数据已结束的标的不参与剔除判断，对应位置记为 NaN，短历史持仓不会把整个矩阵截短。
+
+    Args:
+        prices: 价格矩阵 T×N（可含 NaN）
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (收益率矩阵 (T'-1)×N，区间外为 NaN；长度为 T 的保留日期掩码)
+    """
+    valid = ~np.isnan(prices)
+    n_rows = prices.shape[0]
+    if n_rows == 0:
+        return np.empty((0, prices.shape[1])), np.zeros(0, dtype=bool)
+    has_data = valid.any(axis=0)
+    first = np.where(has_data, valid.argmax(axis=0), n_rows)
+    last = np.where(has_data, n_rows - 1 - valid[::-1].argmax(axis=0), -1)
+    rows = np.arange(n_rows)[:, None]
+    in_window = (rows >= first) & (rows <= last)
+    keep = valid.any(axis=1) & ~(in_window & ~valid).any(axis=1)
+
+    kept = prices[keep]
+    if kept.shape[0] < 2:
+        return np.empty((0, prices.shape[1])), keep
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = kept[1:] / kept[:-1] - 1.0
+    both_valid = ~np.isnan(kept[1:]) & ~np.isnan(kept[:-1])
+    returns = np.where(both_valid, np.nan_to_num(returns, nan=0.0, posinf=0.0, neginf=0.0), np.nan)
+    return returns, keep
+
+
+def _pairwise_moments(x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    两组收益率（可含 NaN）按列两两取共同有效日期的样本矩：(观测数, 协方差, x 方差, y 方差)，均为 Nx×Ny。
+
+    以掩码矩阵乘法一次算出全部列对，不在列对上做 Python 循环。
+    """
+    mx, my = (~np.isnan(x)).astype(float), (~np.isnan(y)).astype(float)
+    x0, y0 = np.nan_to_num(x), np.nan_to_num(y)
+    n = mx.T @ my
+    sum_x = x0.T @ my
+    sum_y = mx.T @ y0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denominator = np.where(n > 1, n - 1, np.nan)
+        mean_correction = np.where(n > 0, 1.0 / n, 0.0)
+        cov = (x0.T @ y0 - sum_x * sum_y * mean_correction) / denominator
+        var_x = ((x0 ** 2).T @ my - sum_x ** 2 * mean_correction) / denominator
+        var_y = (mx.T @ (y0 ** 2) - sum_y ** 2 * mean_correction) / denominator
+    return n, cov, var_x, var_y
+
+
+def max_drawdown(returns: np.ndarray) -> np.ndarray:
+    """
+    按列计算最大回撤（负数，如 -0.35 表示最大回撤 35%）。
+
+    Args:
+        returns: 收益率矩阵 T×N 或收益率向量 T
+
+    Returns:
+        np.ndarray: 每列的最大回撤（输入为向量时返回 0 维数组）
+    """
+    if returns.shape[0] == 0:
+        return np.zeros(returns.shape[1:])
+    wealth = np.cumprod(1.0 + returns, axis=0)
+    peak = np.maximum.accumulate(np.maximum(wealth, 1.0), axis=0)
+    return (wealth / peak - 1.0).min(axis=0)
+
+
+def compute_risk_metrics(
+    returns: np.ndarray,
+    weights: np.ndarray,
+    benchmark_returns: Optional[np.ndarray] = None,
+    confidence: float = 0.95,
+) -> Dict[str, Any]:
+    """
+    向量化计算单票与组合的风险指标（纯函数，不做任何 I/O）。
+
+    单票指标按各列自身的有效样本计算，Beta 与相关系数取两两共同有效的日期；
+    组合指标只使用全部持仓都有收益率的日期。
+
+    Args:
+        returns: 持仓收益率矩阵 T×N（区间外为 NaN，见 price_to_window_returns）
+        weights: 持仓权重向量 N（按 CNY 市值占比，和为 1）
+        benchmark_returns: 基准指数收益率矩阵 T×K（可含 NaN），与 returns 同一日期轴；None 表示不计算 Beta
+        confidence: VaR / CVaR 置信度，默认 95%
+
+    Returns:
+        dict: {
+            "volatility": N, "var": N, "cvar": N, "max_drawdown": N, "beta": N×K,
+            "correlation": N×N, "observations": N,
+            "portfolio": {"volatility", "var", "cvar", "max_drawdown", "beta": K, "observations"}
+        }，所有数组均为 numpy 类型
+    """
+    n_assets = returns.shape[1]
+    tail = 1.0 - confidence
+    annualizer = np.sqrt(TRADING_DAYS_PER_YEAR)
+
+    # 组合收益只在全部持仓都有数据的日期上计算，并入矩阵末尾，使单票与组合共用同一套向量化计算
+    complete = ~np.isnan(returns).any(axis=1)
+    portfolio_returns = np.where(complete, np.nan_to_num(returns) @ weights, np.nan)
+    stacked = np.column_stack([returns, portfolio_returns])
+    observations = (~np.isnan(stacked)).sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        volatility = np.nanstd(stacked, axis=0, ddof=1) * annualizer
+        var = -np.nanquantile(stacked, tail, axis=0)
+    volatility[observations < 2] = np.nan
+    var[observations == 0] = np.nan
+
+    # NaN 排在末尾，每列取自身样本中最差的 tail_count 个
+    sorted_returns = np.sort(stacked, axis=0)
+    tail_count = np.maximum(1, np.ceil(observations * tail)).astype(int)
+    in_tail = np.arange(stacked.shape[0])[:, None] < tail_count[None, :]
+    cvar = -np.where(in_tail, np.nan_to_num(sorted_returns), 0.0).sum(axis=0) / tail_count
+    cvar[observations == 0] = np.nan
+
+    # 区间外的 NaN 视为 0 收益：区间前后净值不变，不影响区间内的回撤
+    drawdown = max_drawdown(np.nan_to_num(stacked))
+
+    n_pairs, covariance, var_x, var_y = _pairwise_moments(returns, returns)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = covariance / np.sqrt(var_x * var_y)
+    correlation[~np.isfinite(correlation) | (n_pairs < 3)] = 0.0
+    np.fill_diagonal(correlation, 1.0)
+
+    if benchmark_returns is not None and benchmark_returns.size:
+        n_bench, covariance, _, bench_var = _pairwise_moments(stacked, benchmark_returns)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            beta = covariance / np.where(bench_var > 0, bench_var, np.nan)
+        beta[n_bench < 3] = np.nan
+    else:
+        beta = np.full((n_assets + 1, 0), np.nan)
+
+    return {
+        "volatility": volatility[:n_assets],
+        "var": var[:n_assets],
+        "cvar": cvar[:n_assets],
+        "max_drawdown": drawdown[:n_assets],
+        "beta": beta[:n_assets],
+        "correlation": correlation,
+        "observations": observations[:n_assets],
+        "portfolio": {
+            "observations": int(observations[n_assets]),
+            "volatility": volatility[n_assets],
+            "var": var[n_assets],
+            "cvar": cvar[n_assets],
+            "max_drawdown": drawdown[n_assets],
+            "beta": beta[n_assets],
+        },
+    }
+
+
+def _round_or_none(value: float, digits: int = 4) -> Optional[float]:
+    """numpy 标量转为可 JSON 序列化的 float，NaN 转为 None"""
+    value = float(value)
+    return None if np.isnan(value) else round(value, digits)
+
+
+def calculate_portfolio_risk(
+    valuation: Dict[str, Any],
+    lookback_days: int = DEFAULT_LOOKBACK_DAYS,
+    confidence: float = 0.95,
+) -> Dict[str, Any]:
+    """
+    基于 calculate_portfolio_valuation 的估值结果计算组合风险指标。
+
+    权重取自各持仓的 CNY 市值占比；单票收益率使用原生货币计价（未叠加汇率波动）。
+    Beta 相对 BENCHMARK_INDICES 中的全部基准指数分别计算。单票指标按各自的数据区间计算，
+    组合指标覆盖全部持仓的共同区间；自身样本不足 MIN_OBSERVATIONS 的持仓不纳入计算，记入 short_history。
+
+    Args:
+        valuation: calculate_portfolio_valuation 返回的估值字典
+        lookback_days: 回看的自然日天数，默认 3 年
+        confidence: VaR / CVaR 置信度
+
+    Returns:
+        dict: 可 JSON 序列化的风险指标字典；没有任何持仓有足够历史数据时返回空字典
+    """
+    holdings = [
+        h for h in valuation.get("holdings", [])
+        if "error" not in h and h.get("market_value_cny", 0) > 0
+    ]
+    if not holdings:
+        return {}
+
+    ticker_map = {h["ticker"]: format_universal_ticker(h["ticker"]) for h in holdings}
+    benchmark_tickers = list(BENCHMARK_INDICES.values())
+    history = fetch_price_history(list(ticker_map.values()) + benchmark_tickers, days=lookback_days)
+
+    holding_columns = list(dict.fromkeys(ticker_map[h["ticker"]] for h in holdings))
+    available_benchmarks = [t for t in benchmark_tickers if t in history and t not in holding_columns]
+    prices, columns, dates = build_price_matrix(history, holding_columns + available_benchmarks, fill=False)
+
+    bench_columns = [c for c in columns if c in available_benchmarks]
+    # 自身收益率样本不足的持仓（如新股）单独剔除并在报告中注明，其余持仓各用自己的数据区间
+    returns_all, _ = price_to_window_returns(prices)
+    own_observations = dict(zip(columns, (~np.isnan(returns_all)).sum(axis=0).tolist()))
+    short_history = {
+        c: int(own_observations[c]) for c in columns if c in holding_columns and own_observations[c] < MIN_OBSERVATIONS
+    }
+    asset_columns = [c for c in columns if c in holding_columns and c not in short_history]
+    if short_history:
+        logger.info(f"📉 以下持仓历史不足 {MIN_OBSERVATIONS} 个交易日，未纳入风险计算：{', '.join(short_history)}")
+    if not asset_columns:
+        logger.warning("日线历史不足，跳过组合风险计算")
+        return {}
+    kept_idx = [columns.index(c) for c in asset_columns + bench_columns]
+    returns_all, keep = price_to_window_returns(prices[:, kept_idx])
+    asset_idx = list(range(len(asset_columns)))
+    bench_idx = list(range(len(asset_columns), len(kept_idx)))
+
+    # 同一格式化代码可能对应多条持仓记录（如 600519 与 600519.SS），按列合并权重
+    value_by_column: Dict[str, float] = {}
+    name_by_column: Dict[str, str] = {}
+    for h in holdings:
+        column = ticker_map[h["ticker"]]
+        if column in asset_columns:
+            value_by_column[column] = value_by_column.get(column, 0.0) + h["market_value_cny"]
+            name_by_column.setdefault(column, h.get("company_name", "-"))
+    values = np.array([value_by_column[c] for c in asset_columns])
+    weights = values / values.sum()
+
+    metrics = compute_risk_metrics(
+        returns_all[:, asset_idx],
+        weights,
+        returns_all[:, bench_idx] if bench_idx else None,
+        confidence=confidence,
+    )
+
+    bench_names = {ticker: name for name, ticker in BENCHMARK_INDICES.items()}
+    portfolio_value = float(values.sum())
+    portfolio = metrics["portfolio"]
+
+    holding_rows = []
+    for i, column in enumerate(asset_columns):
+        holding_rows.append({
+            "ticker": column,
+            "company_name": name_by_column.get(column, "-"),
+            "weight": _round_or_none(weights[i]),
+            "volatility": _round_or_none(metrics["volatility"][i]),
+            "var": _round_or_none(metrics["var"][i]),
+            "cvar": _round_or_none(metrics["cvar"][i]),
+            "max_drawdown": _round_or_none(metrics["max_drawdown"][i]),
+            "beta": {bench_names[b]: _round_or_none(metrics["beta"][i, j]) for j, b in enumerate(bench_columns)},
+            "observations": int(metrics["observations"][i]),
+        })
+
+    return {
+        "as_of": dates[keep][-1].strftime("%Y-%m-%d"),
+        "observations": portfolio["observations"],
+        "confidence": confidence,
+        "benchmarks": [bench_names[b] for b in bench_columns],
+        "missing_history": [
+            h["ticker"] for h in holdings
+            if ticker_map[h["ticker"]] not in asset_columns and ticker_map[h["ticker"]] not in short_history
+        ],
+        "short_history": short_history,
+        "portfolio": {
+            "market_value_cny": round(portfolio_value, 2),
+            "volatility": _round_or_none(portfolio["volatility"]),
+            "var": _round_or_none(portfolio["var"]),
+            "var_cny": round(float(portfolio["var"]) * portfolio_value, 2),
+            "cvar": _round_or_none(portfolio["cvar"]),
+            "max_drawdown": _round_or_none(portfolio["max_drawdown"]),
+            "beta": {bench_names[b]: _round_or_none(portfolio["beta"][j]) for j, b in enumerate(bench_columns)},
+        },
+        "holdings": holding_rows,
+        "correlation": {
+            "tickers": asset_columns,
+            "matrix": np.round(metrics["correlation"], 4).tolist(),
+        },
+    }
+
+
+def _fmt_pct(value: Optional[float]) -> str:
+    """比例值格式化为百分比字符串，None 显示为 -"""
+    return "-" if value is None else f"{value * 100:.2f}%"
+
+
+def _fmt_num(value: Optional[float]) -> str:
+    """数值格式化为两位小数，None 显示为 -"""
+    return "-" if value is None else f"{value:.2f}"
+
+
+def format_risk_report(risk: Dict[str, Any]) -> str:
+    """
+    将 calculate_portfolio_risk 的结果格式化为 Markdown 风险报告。
+
+    Args:
+        risk: calculate_portfolio_risk 返回的风险指标字典
+
+    Returns:
+        str: Markdown 报告字符串；输入为空时返回占位提示
+    """
+    if not risk:
+        return "暂无足够的历史数据计算风险指标"
+
+    portfolio = risk["portfolio"]
+    confidence_label = f"{risk['confidence'] * 100:.0f}%"
+    benchmarks: List[str] = risk["benchmarks"]
+
+    lines = [
+        "### 🛡️ 组合量化风险指标",
+        "",
+        f"**数据截至**: {risk['as_of']}（{risk['observations']} 个交易日收益率样本）",
+        "",
+        f"- **组合年化波动率**: {_fmt_pct(portfolio['volatility'])}",
+        f"- **单日历史 VaR ({confidence_label})**: {_fmt_pct(portfolio['var'])}（约 ¥{portfolio['var_cny']:,.2f}）",
+        f"- **单日 CVaR ({confidence_label})**: {_fmt_pct(portfolio['cvar'])}",
+        f"- **区间最大回撤**: {_fmt_pct(portfolio['max_drawdown'])}",
+    ]
+    if benchmarks:
+        beta_text = ", ".join(f"{name} {_fmt_num(portfolio['beta'].get(name))}" for name in benchmarks)
+        lines.append(f"- **组合 Beta**: {beta_text}")
+
+    header = "| 标的代码 | 名称 | 权重 | 年化波动率 | VaR | 最大回撤 | " + " | ".join(f"β {name}" for name in benchmarks) + " |"
+    align = "| :--- " * (6 + len(benchmarks)) + "|"
+    lines.extend(["", header, align])
+
+    for row in sorted(risk["holdings"], key=lambda r: r["weight"] or 0, reverse=True):
+        beta_cells = " | ".join(_fmt_num(row["beta"].get(name)) for name in benchmarks)
+        lines.append(
+            f"| {row['ticker']} | {row['company_name']} | {_fmt_pct(row['weight'])} | {_fmt_pct(row['volatility'])} | "
+            f"{_fmt_pct(row['var'])} | {_fmt_pct(row['max_drawdown'])} | {beta_cells} |"
+        )
+
+    tickers: List[str] = risk["correlation"]["tickers"]
+    if len(tickers) >= 2:
+        matrix = np.array(risk["correlation"]["matrix"])
+        upper_i, upper_j = np.triu_indices(len(tickers), k=1)
+        pair_corr = matrix[upper_i, upper_j]
+        top = np.argsort(-pair_corr)[:3]
+        pairs = ", ".join(f"{tickers[upper_i[k]]}/{tickers[upper_j[k]]} {pair_corr[k]:.2f}" for k in top)
+        lines.extend(["", f"**相关性最高的持仓对**: {pairs}"])
+
+    longest = max((row.get("observations", 0) for row in risk["holdings"]), default=0)
+    shorter = [
+        f"{row['ticker']}（{row['observations']} 个交易日）" for row in risk["holdings"]
+        if row.get("observations", longest) < longest
+    ]
+    if shorter:
+        lines.extend(["", f"*组合指标仅覆盖全部持仓共同有数据的 {risk['observations']} 个交易日，"
+                          f"受以下历史较短的持仓限制：{', '.join(shorter)}；单票指标按各自区间计算*"])
+    if risk.get("short_history"):
+        short = ", ".join(f"{ticker}（{count} 个交易日）" for ticker, count in risk["short_history"].items())
+        lines.extend(["", f"*以下持仓历史不足 {MIN_OBSERVATIONS} 个交易日，未纳入风险计算：{short}*"])
+    if risk.get("missing_history"):
+        lines.extend(["", f"*以下持仓缺少历史数据，未纳入风险计算：{', '.join(risk['missing_history'])}*"])
+
+    return "\n".join(lines)
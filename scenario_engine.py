@@ -0,0 +1,295 @@
+"""
+压力测试引擎 - 行情与汇率冲击情景网格的向量化重估。
+
+本模块提供：
+1. 冲击参数解析（单值 / 列表 / 区间步长）
+2. 多因子冲击网格构建（分市场股价、USD/CNY、HKD/CNY、单票覆盖）
+3. 基于 numpy 广播的一次性组合重估（情景 × 持仓）
+4. 压力测试结果的 Markdown 报告
+
+重估直接复用 calculate_portfolio_valuation 的持仓结果与汇率字典，
+不重新查价，数千个情景的计算耗时在毫秒级。
+"""
+
+import logging
+from typing import Dict, Any, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 持仓原生货币 -> 所属市场（用于匹配分市场股价冲击）
+MARKET_BY_CURRENCY: Dict[str, str] = {"USD": "US", "HKD": "HK", "CNY": "CN"}
+MARKET_LABELS: Dict[str, str] = {"US": "美股", "HK": "港股", "CN": "A 股"}
+CURRENCIES: Tuple[str, ...] = ("USD", "HKD", "CNY")
+
+# 单次网格的情景数上限：情景 × 持仓 的 float64 矩阵需常驻内存
+MAX_SCENARIOS = 50_000
+
+
+def parse_shock_spec(spec: str) -> List[float]:
+    """
+    解析冲击参数字符串（单位：百分比）为冲击取值列表（单位：小数）。
+
+    支持三种写法：
+    - 单值："-10" -> [-0.10]
+    - 列表："-10,-5,0" -> [-0.10, -0.05, 0.0]
+    - 区间："-20:0:5"（起点:终点:步长，含终点）-> [-0.20, -0.15, -0.10, -0.05, 0.0]
+
+    Args:
+        spec: 冲击参数字符串，空字符串视为 0
+
+    Returns:
+        List[float]: 去重并保持顺序的冲击取值列表
+
+    Raises:
+        ValueError: 参数格式不正确或区间步长非法
+    """
+    spec = (spec or "").strip().replace('，', ',').replace('%', '')
+    if not spec:
+        return [0.0]
+
+    values: List[float] = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if ':' in part:
+            pieces = part.split(':')
+            if len(pieces) != 3:
+                raise ValueError(f"区间写法应为 起点:终点:步长，收到 '{part}'")
+            start, stop, step = (float(p) for p in pieces)
+            if step <= 0:
+                raise ValueError(f"区间步长必须为正数，收到 '{part}'")
+            count = int(np.floor(abs(stop - start) / step + 1e-9)) + 1
+            direction = 1.0 if stop >= start else -1.0
+            values.extend(start + direction * step * np.arange(count))
+        else:
+            values.append(float(part))
+
+    return [round(v / 100.0, 10) for v in dict.fromkeys(values)] or [0.0]
+
+
+def parse_ticker_overrides(spec: str) -> Dict[str, List[float]]:
+    """
+    解析单票冲击覆盖参数，格式为 "代码=冲击;代码=冲击"，冲击写法同 parse_shock_spec。
+
+    Args:
+        spec: 如 "0700.HK=-15;AAPL=-20:0:10"
+
+    Returns:
+        Dict[str, List[float]]: 大写代码 -> 冲击取值列表（小数）
+
+    Raises:
+        ValueError: 缺少 '=' 分隔符或冲击格式不正确
+    """
+    overrides: Dict[str, List[float]] = {}
+    for item in (spec or "").replace('；', ';').split(';'):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' not in item:
+            raise ValueError(f"单票冲击应写成 代码=冲击，收到 '{item}'")
+        ticker, shock = item.split('=', 1)
+        overrides[ticker.strip().upper()] = parse_shock_spec(shock)
+    return overrides
+
+
+def unknown_override_tickers(valuation: Dict[str, Any], factor_names: List[str]) -> List[str]:
+    """
+    找出单票覆盖因子中不属于当前持仓的代码（如把持仓 00700.HK 写成 0700.HK），这些覆盖在重估中不会生效。
+
+    Args:
+        valuation: 估值字典（含查价失败的持仓在内，均视为已持有）
+        factor_names: 网格因子名
+
+    Returns:
+        List[str]: 未匹配任何持仓的覆盖代码（保持因子顺序）
+    """
+    held = {h["ticker"].upper() for h in valuation.get("holdings", [])}
+    builtin = set(MARKET_BY_CURRENCY.values()) | {f"{c}_CNY" for c in CURRENCIES}
+    return [name for name in factor_names if name not in builtin and name not in held]
+
+
+def build_shock_grid(factor_values: Dict[str, List[float]]) -> Tuple[List[str], np.ndarray]:
+    """
+    将各因子的取值列表展开为笛卡尔积情景网格。
+
+    Args:
+        factor_values: 因子名 -> 冲击取值列表（小数），字典顺序即网格列顺序
+
+    Returns:
+        Tuple[List[str], np.ndarray]: (因子名列表, 情景矩阵 S×F)
+
+    Raises:
+        ValueError: 情景总数超过 MAX_SCENARIOS
+    """
+    names = list(factor_values.keys())
+    axes = [np.asarray(factor_values[name], dtype=float) for name in names]
+    total = int(np.prod([len(a) for a in axes])) if axes else 1
+    if total > MAX_SCENARIOS:
+        raise ValueError(f"情景总数 {total} 超过上限 {MAX_SCENARIOS}，请缩小区间或加大步长")
+    if not axes:
+        return [], np.zeros((1, 0))
+
+    mesh = np.meshgrid(*axes, indexing='ij')
+    grid = np.stack([m.reshape(-1) for m in mesh], axis=1)
+    return names, grid
+
+
+def revalue_portfolio(
+    valuation: Dict[str, Any],
+    factor_names: List[str],
+    grid: np.ndarray,
+) -> Dict[str, Any]:
+    """
+    在情景网格下一次性重估组合（numpy 广播，情景 × 持仓）。
+
+    每个持仓的情景市值 = 原生市值 × (1 + 股价冲击) × 基准汇率 × (1 + 汇率冲击)，
+    其中股价冲击默认取所属市场因子，若该代码存在单票覆盖因子则以覆盖值为准。
+
+    Args:
+        valuation: calculate_portfolio_valuation 返回的估值字典（复用其持仓与汇率）
+        factor_names: 网格因子名，市场因子为 "US"/"HK"/"CN"，汇率因子为 "USD_CNY"/"HKD_CNY"，其余视为单票代码
+        grid: 情景矩阵 S×F（小数）
+
+    Returns:
+        dict: {
+            "tickers": N, "base_values": N, "base_total": float,
+            "scenario_values": S×N, "totals": S, "pnl": S, "pnl_percent": S
+        }
+    """
+    holdings = [h for h in valuation.get("holdings", []) if "error" not in h]
+    exchange_rates = valuation.get("exchange_rates", {})
+    n_scenarios = grid.shape[0]
+    column = {name: i for i, name in enumerate(factor_names)}
+
+    tickers = [h["ticker"] for h in holdings]
+    native_values = np.array([h.get("native_market_value", 0.0) for h in holdings], dtype=float)
+    currency_idx = np.array([CURRENCIES.index(h.get("currency", "CNY")) for h in holdings], dtype=int)
+    base_rates = np.array([exchange_rates.get(f"{c}_CNY", 1.0) for c in CURRENCIES], dtype=float)
+
+    # 1. 股价冲击矩阵 S×N：先按市场广播，再用单票覆盖列替换
+    market_shocks = np.zeros((n_scenarios, len(CURRENCIES)))
+    for j, currency in enumerate(CURRENCIES):
+        market = MARKET_BY_CURRENCY[currency]
+        if market in column:
+            market_shocks[:, j] = grid[:, column[market]]
+    price_shock = market_shocks[:, currency_idx]
+    for i, ticker in enumerate(tickers):
+        key = ticker.upper()
+        if key in column:
+            price_shock[:, i] = grid[:, column[key]]
+
+    # 2. 汇率矩阵 S×3 -> S×N
+    fx_shocks = np.zeros((n_scenarios, len(CURRENCIES)))
+    for j, currency in enumerate(CURRENCIES):
+        factor = f"{currency}_CNY"
+        if factor in column:
+            fx_shocks[:, j] = grid[:, column[factor]]
+    scenario_rates = base_rates * (1.0 + fx_shocks)
+
+    base_values = native_values * base_rates[currency_idx]
+    scenario_values = native_values * (1.0 + price_shock) * scenario_rates[:, currency_idx]
+
+    base_total = float(base_values.sum())
+    totals = scenario_values.sum(axis=1)
+    pnl = totals - base_total
+    pnl_percent = pnl / base_total * 100 if base_total else np.zeros_like(pnl)
+
+    return {
+        "tickers": tickers,
+        "base_values": base_values,
+        "base_total": base_total,
+        "scenario_values": scenario_values,
+        "totals": totals,
+        "pnl": pnl,
+        "pnl_percent": pnl_percent,
+    }
+
+
+def _describe_scenario(factor_names: List[str], row: np.ndarray) -> str:
+    """将一行情景冲击转为可读文本，如 "港股 -10.00%, HKD/CNY -3.00%" """
+    parts = []
+    for name, shock in zip(factor_names, row):
+        if shock == 0:
+            continue
+        label = MARKET_LABELS.get(name, name.replace('_', '/'))
+        parts.append(f"{label} {shock * 100:+.2f}%")
+    return ", ".join(parts) or "无冲击"
+
+
+def format_stress_report(
+    valuation: Dict[str, Any],
+    factor_names: List[str],
+    grid: np.ndarray,
+    result: Dict[str, Any],
+    elapsed_ms: float,
+    top_n: int = 5,
+) -> str:
+    """
+    将压力测试结果格式化为 Markdown 报告。
+
+    单一情景时输出逐票冲击明细；多情景网格时输出分布统计与最差情景列表。
+
+    Args:
+        valuation: 估值字典（提供公司名称）
+        factor_names: 网格因子名
+        grid: 情景矩阵 S×F
+        result: revalue_portfolio 的返回值
+        elapsed_ms: 重估耗时（毫秒）
+        top_n: 网格模式下展示的最差情景数量
+
+    Returns:
+        str: Markdown 报告
+    """
+    names = {h["ticker"]: h.get("company_name", "-") for h in valuation.get("holdings", [])}
+    totals = result["totals"]
+    pnl = result["pnl"]
+    pnl_percent = result["pnl_percent"]
+    n_scenarios = len(totals)
+
+    lines = [
+        "## 🌪️ 组合压力测试",
+        "",
+        f"**基准市值**: ¥{result['base_total']:,.2f}",
+        "",
+        f"**情景数量**: {n_scenarios}（向量化重估耗时 {elapsed_ms:.1f} ms）",
+        "",
+    ]
+
+    if n_scenarios == 1:
+        lines.extend([
+            f"**冲击情景**: {_describe_scenario(factor_names, grid[0])}",
+            "",
+            f"- **情景市值**: ¥{totals[0]:,.2f}",
+            f"- **情景盈亏**: {pnl[0]:+,.2f} ({pnl_percent[0]:+.2f}%)",
+            "",
+            "| 标的代码 | 公司名称 | 基准市值 (CNY) | 情景市值 (CNY) | 变动 (CNY) |",
+            "| :--- | :--- | :--- | :--- | :--- |",
+        ])
+        order = np.argsort(result["base_values"])[::-1]
+        for i in order:
+            base = result["base_values"][i]
+            shocked = result["scenario_values"][0, i]
+            ticker = result["tickers"][i]
+            lines.append(f"| {ticker} | {names.get(ticker, '-')} | ¥{base:,.2f} | ¥{shocked:,.2f} | {shocked - base:+,.2f} |")
+        return "\n".join(lines)
+
+    p5, p50, p95 = np.percentile(pnl, [5, 50, 95])
+    lines.extend([
+        f"- **最差情景盈亏**: {pnl.min():+,.2f} ({pnl_percent.min():+.2f}%)",
+        f"- **最好情景盈亏**: {pnl.max():+,.2f} ({pnl_percent.max():+.2f}%)",
+        f"- **盈亏分位数 (P5 / P50 / P95)**: {p5:+,.2f} / {p50:+,.2f} / {p95:+,.2f}",
+        "",
+        f"### 📉 最差 {min(top_n, n_scenarios)} 个情景",
+        "",
+        "| 排名 | 冲击组合 | 情景市值 (CNY) | 盈亏 (CNY) | 盈亏率 |",
+        "| :--- | :--- | :--- | :--- | :--- |",
+    ])
+    worst = np.argsort(pnl)[:top_n]
+    for rank, s in enumerate(worst, start=1):
+        lines.append(
+            f"| {rank} | {_describe_scenario(factor_names, grid[s])} | ¥{totals[s]:,.2f} | {pnl[s]:+,.2f} | {pnl_percent[s]:+.2f}% |"
+        )
+    return "\n".join(lines)
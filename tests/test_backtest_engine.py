@@ -0,0 +1,175 @@
+"""
+组合回测引擎单元测试模块。
+
+本模块测试 backtest_engine 的向量化回放：
+1. 再平衡日生成与配置解析
+2. 分段向量化模拟与逐日朴素循环一致（净值、换手、成本）
+3. 历史汇率折算与当前持仓 / 拟调整配置的对比回测（Mock 日线历史）
+4. 5 年 × 50 标的规模下的计算耗时
+"""
+
+import sys
+import time
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from backtest_engine import (
+    build_cny_price_matrix,
+    format_backtest_report,
+    parse_allocation,
+    rebalance_mask,
+    run_backtest,
+    simulate_allocation,
+)
+
+
+def _random_prices(t_obs: int, n_assets: int, seed: int = 5) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return 100 * np.cumprod(1 + rng.normal(0.0003, 0.015, size=(t_obs, n_assets)), axis=0)
+
+
+def _naive_simulation(prices, weights, mask, capital, cost_bps):
+    """逐日循环的参考实现：再平衡日收盘按目标权重重新分配股数"""
+    shares = capital * weights / prices[0]
+    equity = [capital]
+    turnovers = []
+    for t in range(1, len(prices)):
+        value = float(shares @ prices[t])
+        if mask[t]:
+            drifted = shares * prices[t] / value
+            turnover = 0.5 * np.abs(drifted - weights).sum()
+            value -= value * 2 * turnover * cost_bps / 10_000
+            shares = value * weights / prices[t]
+            turnovers.append(turnover)
+        equity.append(value)
+    return np.array(equity), np.array(turnovers)
+
+
+class TestRebalanceMask:
+    """测试再平衡日生成。"""
+
+    def test_monthly_marks_last_trading_day(self) -> None:
+        dates = pd.to_datetime(["2026-01-29", "2026-01-30", "2026-02-02", "2026-02-27", "2026-03-02"])
+        mask = rebalance_mask(dates, "monthly")
+        assert mask.tolist() == [True, True, False, True, False]
+        assert rebalance_mask(dates, "none").tolist() == [True, False, False, False, False]
+
+    def test_unknown_frequency_raises(self) -> None:
+        with pytest.raises(ValueError):
+            rebalance_mask(pd.to_datetime(["2026-01-02"]), "daily")
+
+
+class TestParseAllocation:
+    """测试配置解析。"""
+
+    def test_normalizes_and_formats(self) -> None:
+        weights = parse_allocation("aapl=40; 700=30；600519=30%")
+        assert weights == pytest.approx({"AAPL": 0.4, "0700.HK": 0.3, "600519.SS": 0.3})
+
+    def test_invalid_allocation_raises(self) -> None:
+        with pytest.raises(ValueError):
+            parse_allocation("AAPL")
+        with pytest.raises(ValueError):
+            parse_allocation("AAPL=0")
+
+
+class TestSimulateAllocation:
+    """测试分段向量化模拟。"""
+
+    def test_matches_naive_loop_with_costs(self) -> None:
+        dates = pd.bdate_range("2024-01-01", periods=300)
+        prices = _random_prices(300, 4)
+        weights = np.array([0.4, 0.3, 0.2, 0.1])
+        mask = rebalance_mask(dates, "monthly")
+
+        result = simulate_allocation(prices, weights, mask, 100_000.0, cost_bps=10)
+        expected_equity, expected_turnover = _naive_simulation(prices, weights, mask, 100_000.0, 10)
+
+        np.testing.assert_allclose(result["equity"], expected_equity, rtol=1e-10)
+        np.testing.assert_allclose(result["turnover"], expected_turnover, rtol=1e-10)
+        assert result["costs"].sum() > 0
+
+    def test_buy_and_hold_equals_share_value(self) -> None:
+        prices = _random_prices(50, 3)
+        shares = np.array([10.0, 20.0, 30.0])
+        start = shares * prices[0]
+        mask = np.zeros(50, dtype=bool)
+        mask[0] = True
+
+        result = simulate_allocation(prices, start / start.sum(), mask, start.sum())
+
+        np.testing.assert_allclose(result["equity"], prices @ shares)
+        assert len(result["turnover"]) == 0
+
+    def test_5_years_50_tickers_runs_in_milliseconds(self) -> None:
+        dates = pd.bdate_range("2021-01-01", periods=1260)
+        prices = _random_prices(1260, 50)
+        weights = np.full(50, 0.02)
+        mask = rebalance_mask(dates, "weekly")
+
+        simulate_allocation(prices, weights, mask, 1.0)  # 预热
+        start = time.perf_counter()
+        simulate_allocation(prices, weights, mask, 1.0, cost_bps=10)
+        elapsed = time.perf_counter() - start
+
+        assert elapsed < 0.2
+
+
+class TestRunBacktest:
+    """测试基于日线历史的对比回测。"""
+
+    def test_cny_conversion_uses_historical_fx(self) -> None:
+        dates = pd.to_datetime(["2026-01-02", "2026-01-05"])
+        history = {
+            "AAPL": pd.DataFrame({"Close": [10.0, 10.0]}, index=dates),
+            "USDCNY=X": pd.DataFrame({"Close": [7.0, 7.5]}, index=dates),
+        }
+        prices, columns, _ = build_cny_price_matrix(history, ["AAPL", "0700.HK"], {"HKD_CNY": 0.9})
+        assert columns == ["AAPL"]
+        np.testing.assert_allclose(prices[:, 0], [70.0, 75.0])
+
+    @patch('backtest_engine.fetch_exchange_rates')
+    @patch('backtest_engine.fetch_price_history')
+    def test_current_vs_proposed(self, mock_history: MagicMock, mock_rates: MagicMock) -> None:
+        dates = pd.bdate_range("2025-01-01", periods=260)
+        prices = _random_prices(260, 3)
+        mock_history.return_value = {
+            "AAPL": pd.DataFrame({"Close": prices[:, 0]}, index=dates),
+            "0700.HK": pd.DataFrame({"Close": prices[:, 1]}, index=dates),
+            "600519.SS": pd.DataFrame({"Close": prices[:, 2]}, index=dates),
+            "USDCNY=X": pd.DataFrame({"Close": np.full(260, 7.0)}, index=dates),
+        }
+        mock_rates.return_value = {"USD_CNY": 7.0, "HKD_CNY": 0.9, "CNY_CNY": 1.0}
+        positions = {
+            "AAPL": {"shares": 100, "cost_basis": 1.0, "type": "stock"},
+            "600519": {"shares": 10, "cost_basis": 1.0, "type": "stock"},
+        }
+
+        backtest = run_backtest(positions, {"AAPL": 0.5, "0700.HK": 0.5}, rebalance="quarterly", cost_bps=10)
+
+        current = backtest["strategies"]["当前持仓"]
+        proposed = backtest["strategies"]["拟调整配置"]
+        expected_start = 100 * prices[0, 0] * 7.0 + 10 * prices[0, 2]
+        assert current["summary"]["start_value"] == pytest.approx(expected_start, abs=0.01)
+        assert current["summary"]["end_value"] == pytest.approx(100 * prices[-1, 0] * 7.0 + 10 * prices[-1, 2], abs=0.01)
+        assert proposed["summary"]["start_value"] == pytest.approx(expected_start, abs=0.01)
+        assert proposed["rebalances"] == 3  # 3 月、6 月、9 月末；12 月末为回测终点
+        assert proposed["weights"] == {"AAPL": 0.5, "0700.HK": 0.5}
+
+        report = format_backtest_report(backtest)
+        assert "| 指标 | 当前持仓 | 拟调整配置 |" in report
+        assert "月末净值" in report
+
+    @patch('backtest_engine.fetch_price_history')
+    def test_insufficient_history_returns_empty(self, mock_history: MagicMock) -> None:
+        mock_history.return_value = {}
+        with patch('backtest_engine.fetch_exchange_rates', return_value={}):
+            assert run_backtest({"AAPL": {"shares": 1}}) == {}
+        assert "暂无" in format_backtest_report({})
@@ -0,0 +1,368 @@
+"""
+绘图引擎单元测试模块。
+
+本模块测试 chart_engine 的常驻绘图进程池：
+1. 预热后在独立进程中渲染 K 线图
+2. 有界并发与队列深度指标
+3. worker 崩溃后的进程池自愈
+4. 内容寻址图表缓存的命中、键变化与淘汰
+5. 各输出渠道的渲染档位（尺寸 / 矢量格式 / 来源元数据）
+6. 原生 collections 渲染器与基准测试
+7. 多标的小图矩阵（单图拼版与缓存）
+"""
+
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from chart_engine import (
+    ChartRenderPool,
+    _benchmark_case,
+    chart_cache_key,
+    evict_chart_cache,
+    format_benchmark_report,
+    read_chart_source,
+    render_kline,
+    render_kline_chart_cached,
+    render_small_multiples_cached,
+)
+
+
+def _sample_ohlcv(days: int = 30) -> pd.DataFrame:
+    rng = np.random.default_rng(7)
+    close = 100 * np.cumprod(1 + rng.normal(0, 0.01, days))
+    return pd.DataFrame(
+        {
+            "Open": close * 0.995, "High": close * 1.01, "Low": close * 0.99,
+            "Close": close, "Volume": rng.integers(1_000, 5_000, days).astype(float),
+        },
+        index=pd.bdate_range("2026-01-01", periods=days),
+    )
+
+
+@pytest.fixture(autouse=True)
+def _series_dir(tmp_path_factory):
+    series_dir = tmp_path_factory.mktemp("chart_series")
+    with patch('chart_engine.CHART_SERIES_DIR', series_dir):
+        yield series_dir
+
+
+@pytest.fixture(scope="module")
+def process_pool():
+    pool = ChartRenderPool(max_workers=1, max_pending=4)
+    pool.warm_up()
+    yield pool
+    pool.shutdown()
+
+
+class TestChartRenderPool:
+    """测试常驻绘图进程池。"""
+
+    def test_renders_in_worker_process(self, process_pool: ChartRenderPool, tmp_path: Path) -> None:
+        chart_path = tmp_path / "AAPL_chart.png"
+
+        result = process_pool.run(render_kline, _sample_ohlcv(), str(chart_path), "AAPL 30-Day Trend")
+
+        assert result == str(chart_path)
+        assert chart_path.read_bytes()[:8] == b"\x89PNG\r\n\x1a\n"
+        assert process_pool.run(os.getpid) != os.getpid()
+
+    def test_recovers_from_worker_crash(self, process_pool: ChartRenderPool) -> None:
+        restarts = process_pool.stats()["restarts"]
+
+        with pytest.raises(RuntimeError):
+            process_pool.run(os._exit, 1)
+
+        stats = process_pool.stats()
+        assert stats["restarts"] == restarts + 2  # 首次崩溃后重建并重试一次
+        assert stats["failed"] >= 1
+        # 重建后的进程池继续可用
+        assert isinstance(process_pool.run(os.getpid), int)
+
+    def test_timed_out_render_keeps_its_slot(self, process_pool: ChartRenderPool) -> None:
+        with pytest.raises(TimeoutError):
+            process_pool.run(time.sleep, 1.0, timeout=0.2)
+
+        # worker 仍在执行超时的渲染：名额直到其真正结束才归还
+        assert process_pool.stats()["in_flight"] == 1
+        deadline = time.time() + 5
+        while process_pool.stats()["in_flight"] and time.time() < deadline:
+            time.sleep(0.05)
+        assert process_pool.stats()["in_flight"] == 0
+
+    def test_bounded_concurrency_and_queue_depth(self) -> None:
+        pool = ChartRenderPool(max_workers=0, max_pending=2)
+        release = threading.Event()
+
+        threads = [threading.Thread(target=pool.run, args=(release.wait, 2)) for _ in range(2)]
+        for t in threads:
+            t.start()
+        deadline = time.time() + 2
+        while pool.stats()["in_flight"] < 2 and time.time() < deadline:
+            time.sleep(0.01)
+
+        stats = pool.stats()
+        assert stats["in_flight"] == 2
+        assert stats["queue_depth"] == 1  # 内联模式同一时刻只渲染一张
+
+        with pytest.raises(TimeoutError):
+            pool.run(time.sleep, 0, timeout=0.05)
+        assert pool.stats()["rejected"] == 1
+
+        release.set()
+        for t in threads:
+            t.join(timeout=2)
+        final = pool.stats()
+        assert final["in_flight"] == 0
+        assert final["completed"] == 2
+        assert final["peak_queue_depth"] == 1
+
+
+def _fake_render(hist: pd.DataFrame, chart_path: str, title: str, *args) -> str:
+    Path(chart_path).write_bytes(b"png")
+    return chart_path
+
+
+class TestChartCache:
+    """测试内容寻址图表缓存。"""
+
+    @patch('chart_engine.render_kline_chart', side_effect=_fake_render)
+    def test_hit_skips_render(self, mock_render: MagicMock, tmp_path: Path) -> None:
+        hist = _sample_ohlcv()
+
+        first_path, first_hit = render_kline_chart_cached(hist, tmp_path, "0700.HK", 30, "t")
+        second_path, second_hit = render_kline_chart_cached(hist, tmp_path, "0700.HK", 30, "t")
+
+        assert mock_render.call_count == 1
+        assert (first_hit, second_hit) == (False, True)
+        assert first_path == second_path
+        assert first_path.name.startswith("0700_HK_30d_")
+        # 渲染走临时文件后原子替换，不留残余；绘图数据不写进沙盒
+        assert [f.name for f in tmp_path.iterdir()] == [first_path.name]
+
+    @patch('chart_engine.render_kline_chart', side_effect=_fake_render)
+    def test_key_changes_with_days_and_latest_bar(self, mock_render: MagicMock, tmp_path: Path) -> None:
+        hist = _sample_ohlcv()
+        updated = hist.copy()
+        updated.iloc[-1, updated.columns.get_loc("Close")] += 1
+
+        keys = {
+            chart_cache_key("AAPL", 30, hist),
+            chart_cache_key("AAPL", 180, hist),
+            chart_cache_key("AAPL", 30, hist.iloc[:-1]),
+            chart_cache_key("AAPL", 30, updated),
+        }
+        assert len(keys) == 4
+
+        with patch('chart_engine.CHART_STYLE_VERSION', "tv-dark-next"):
+            assert chart_cache_key("AAPL", 30, hist) not in keys
+        assert chart_cache_key("AAPL", 30, hist, "pdf") not in keys
+
+    def test_eviction_by_ttl_and_count(self, tmp_path: Path) -> None:
+        now = time.time()
+        names = [f"AAPL_30d_{i:012x}.png" for i in range(4)]
+        for age_days, name in zip([0, 1, 2, 10], names):
+            path = tmp_path / name
+            path.write_bytes(b"x" * 10)
+            os.utime(path, (now - age_days * 86400, now - age_days * 86400))
+        orphan = tmp_path / f".AAPL_30d_{0:012x}.deadbeef.png"
+        orphan.write_bytes(b"x")
+        os.utime(orphan, (now - 7200, now - 7200))
+        other = tmp_path / "report.md"
+        other.write_text("keep")
+        os.utime(other, (now - 100 * 86400, now - 100 * 86400))
+
+        count, freed = evict_chart_cache(tmp_path, ttl_days=7, max_files=2)
+
+        assert count == 3  # 过期 1 张 + 超量 1 张 + 孤儿临时文件
+        assert freed == 21
+        assert sorted(f.name for f in tmp_path.iterdir()) == sorted([names[0], names[1], "report.md"])
+
+    def test_series_follow_their_chart(self, tmp_path: Path, _series_dir: Path) -> None:
+        kept = _series_dir / f"{0:012x}.json"
+        evicted = _series_dir / f"{1:012x}.json"
+        (tmp_path / f"AAPL_30d_{0:012x}.png").write_bytes(b"x")
+        old_chart = tmp_path / f"AAPL_30d_{1:012x}.png"
+        old_chart.write_bytes(b"x")
+        os.utime(old_chart, (time.time() - 10 * 86400,) * 2)
+        kept.write_bytes(b"s")
+        evicted.write_bytes(b"s")
+
+        count, _ = evict_chart_cache(tmp_path, ttl_days=7, max_files=10)
+
+        assert count == 2
+        assert kept.exists() and not evicted.exists()
+
+
+def test_chart_key_locks_are_per_key_and_released(tmp_path: Path) -> None:
+    from chart_engine import _chart_key_locks, _materialize_chart
+
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_render(path: str) -> None:
+        started.set()
+        release.wait(5)
+        Path(path).write_bytes(b"a")
+
+    worker = threading.Thread(target=_materialize_chart, args=(tmp_path / "a.png", "a" * 16, slow_render))
+    worker.start()
+    try:
+        assert started.wait(5)
+        # 其他缓存键的图不被正在渲染的图阻塞（两个键的哈希末位相同）
+        assert _materialize_chart(tmp_path / "b.png", "b" * 15 + "a", lambda p: Path(p).write_bytes(b"b")) is False
+    finally:
+        release.set()
+        worker.join(timeout=5)
+
+    assert (tmp_path / "a.png").exists()
+    assert "a" * 16 not in _chart_key_locks and "b" * 15 + "a" not in _chart_key_locks
+
+
+class TestRenderProfiles:
+    """测试面向输出渠道的渲染档位。"""
+
+    @pytest.fixture(autouse=True)
+    def _inline_pool(self):
+        with patch('chart_engine.get_chart_pool', return_value=ChartRenderPool(max_workers=0)):
+            yield
+
+    def test_telegram_and_thumbnail_sizes(self, tmp_path: Path) -> None:
+        from PIL import Image
+
+        telegram_path, _ = render_kline_chart_cached(_sample_ohlcv(), tmp_path, "AAPL", 30, "t", "telegram")
+        thumb_path, _ = render_kline_chart_cached(_sample_ohlcv(), tmp_path, "AAPL", 30, "t", "thumbnail")
+
+        with Image.open(telegram_path) as image:
+            assert 1000 <= image.width <= 1280
+        with Image.open(thumb_path) as image:
+            assert image.width <= 400
+        assert thumb_path.stat().st_size < telegram_path.stat().st_size
+        assert read_chart_source(telegram_path) == ("AAPL", 30)
+
+    def test_pdf_profile_is_vector(self, tmp_path: Path) -> None:
+        chart_path, _ = render_kline_chart_cached(_sample_ohlcv(), tmp_path, "0700.HK", 180, "t", "pdf")
+
+        assert chart_path.suffix == ".svg"
+        assert "<svg" in chart_path.read_text(encoding="utf-8")[:2000]
+        assert read_chart_source(chart_path) is None
+
+    def test_pdf_redraw_uses_saved_series(self, tmp_path: Path) -> None:
+        from chart_engine import load_chart_series
+
+        hist = _sample_ohlcv()
+        png_path, _ = render_kline_chart_cached(hist, tmp_path, "AAPL", 30, "AAPL 30-Day Trend", "telegram")
+
+        series = load_chart_series(png_path)
+
+        assert series is not None
+        pd.testing.assert_frame_equal(series["hist"], hist, check_freq=False)
+        svg_path, _ = render_kline_chart_cached(
+            series["hist"], tmp_path, series["ticker"], series["days"], series["title"], "pdf", series["renderer"]
+        )
+        expected, _ = render_kline_chart_cached(hist, tmp_path, "AAPL", 30, "AAPL 30-Day Trend", "pdf")
+        assert svg_path == expected
+        assert load_chart_series(svg_path) is None
+
+    @patch('chart_engine.render_kline_chart', side_effect=_fake_render)
+    def test_series_never_read_from_sandbox(self, mock_render: MagicMock, tmp_path: Path, _series_dir: Path) -> None:
+        from chart_engine import load_chart_series
+
+        png_path, _ = render_kline_chart_cached(_sample_ohlcv(), tmp_path, "AAPL", 30, "t")
+        key = png_path.stem.rsplit("_", 1)[1]
+        # 沙盒内伪造的 pickle 不会被读取
+        (tmp_path / f"{png_path.stem}.series.pkl").write_text("cos\nsystem\n(S'true'\ntR.")
+        assert load_chart_series(png_path) is not None
+
+        # 位图不存在、或数据与缓存键不符时均不返回
+        assert load_chart_series(png_path.with_name(f"MSFT_30d_{key}.png")) is None
+        payload = (_series_dir / f"{key}.json").read_text(encoding="utf-8")
+        (_series_dir / f"{key}.json").write_text(payload.replace('"days": 30', '"days": 31'), encoding="utf-8")
+        assert load_chart_series(png_path) is None
+
+    def test_unknown_profile_raises(self, tmp_path: Path) -> None:
+        with pytest.raises(ValueError):
+            render_kline_chart_cached(_sample_ohlcv(), tmp_path, "AAPL", 30, "t", "retina")
+
+
+class TestNativeRenderer:
+    """测试原生 collections 渲染器。"""
+
+    @pytest.fixture(autouse=True)
+    def _inline_pool(self):
+        with patch('chart_engine.get_chart_pool', return_value=ChartRenderPool(max_workers=0)):
+            yield
+
+    def test_renders_all_profiles_on_reused_canvas(self, tmp_path: Path) -> None:
+        from PIL import Image
+
+        for days in (30, 365):
+            hist = _sample_ohlcv(days)
+            png_path, _ = render_kline_chart_cached(hist, tmp_path, "AAPL", days, "t", "telegram", "native")
+            with Image.open(png_path) as image:
+                assert 1000 <= image.width <= 1280
+            assert read_chart_source(png_path) == ("AAPL", days)
+
+        thumb_path, _ = render_kline_chart_cached(hist, tmp_path, "AAPL", 365, "t", "thumbnail", "native")
+        svg_path, _ = render_kline_chart_cached(hist, tmp_path, "AAPL", 365, "t", "pdf", "native")
+        assert thumb_path.stat().st_size > 0
+        assert "<svg" in svg_path.read_text(encoding="utf-8")[:2000]
+
+    def test_renderer_is_part_of_cache_key(self, tmp_path: Path) -> None:
+        hist = _sample_ohlcv()
+        assert chart_cache_key("AAPL", 30, hist, renderer="native") != chart_cache_key("AAPL", 30, hist, renderer="mplfinance")
+        with pytest.raises(ValueError):
+            chart_cache_key("AAPL", 30, hist, renderer="plotly")
+
+    def test_benchmark_case_and_report(self) -> None:
+        row = _benchmark_case("native", 30, repeats=1, profile="thumbnail")
+
+        assert row["bars"] == 21
+        assert row["wall_ms"] > 0 and row["file_kb"] > 0
+
+        report = format_benchmark_report([dict(row, renderer="mplfinance", wall_ms=200.0), dict(row, wall_ms=100.0)])
+        assert "| native | 30 | 21 | 100.0 | 2.00x |" in report
+
+
+class TestSmallMultiples:
+    """测试多标的小图矩阵。"""
+
+    @pytest.fixture(autouse=True)
+    def _inline_pool(self):
+        with patch('chart_engine.get_chart_pool', return_value=ChartRenderPool(max_workers=0)):
+            yield
+
+    def test_renders_one_figure_and_hits_cache(self, tmp_path: Path) -> None:
+        from PIL import Image
+
+        histories = {t: _sample_ohlcv(60) for t in ("AAPL", "0700.HK", "600519.SS", "TSLA")}
+
+        chart_path, first_hit = render_small_multiples_cached(histories, tmp_path, 90, "t")
+        again_path, second_hit = render_small_multiples_cached(histories, tmp_path, 90, "t")
+        candle_path, _ = render_small_multiples_cached(histories, tmp_path, 90, "t", style="candle")
+
+        assert (first_hit, second_hit) == (False, True)
+        assert again_path == chart_path and candle_path != chart_path
+        assert chart_path.name.startswith("portfolio_90d_")
+        with Image.open(chart_path) as image:
+            assert 1000 <= image.width <= 1280
+        assert read_chart_source(chart_path) is None
+
+    def test_rejects_invalid_input(self, tmp_path: Path) -> None:
+        with pytest.raises(ValueError):
+            render_small_multiples_cached({}, tmp_path, 90, "t")
+        with pytest.raises(ValueError):
+            render_small_multiples_cached({"AAPL": _sample_ohlcv()}, tmp_path, 90, "t", style="heatmap")
+        with patch('chart_engine.MAX_SMALL_MULTIPLES', 2):
+            with pytest.raises(ValueError):
+                render_small_multiples_cached({t: _sample_ohlcv() for t in "ABC"}, tmp_path, 90, "t")
@@ -0,0 +1,117 @@
+"""
+多标的对比引擎单元测试模块。
+
+本模块测试 comparison_engine 的归一化对比：
+1. 起点归一化与向量化区间统计（与逐列朴素计算一致）
+2. 共同起点截取、一次批量拉取与人民币口径的历史汇率折算（Mock 日线历史）
+3. 单张叠加对比图的渲染与缓存
+"""
+
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from chart_engine import ChartRenderPool
+from comparison_engine import compare_tickers, compute_comparison_stats, format_comparison_report, rebase_to_100
+
+
+def _frame(values, start: str = "2026-01-01") -> pd.DataFrame:
+    return pd.DataFrame({"Close": np.asarray(values, dtype=float)}, index=pd.bdate_range(start, periods=len(values)))
+
+
+@pytest.fixture(autouse=True)
+def _inline_pool():
+    with patch('chart_engine.get_chart_pool', return_value=ChartRenderPool(max_workers=0)):
+        yield
+
+
+class TestComparisonStats:
+    """测试归一化与区间统计。"""
+
+    def test_rebase_and_stats_match_naive(self) -> None:
+        rng = np.random.default_rng(3)
+        prices = 50 * np.cumprod(1 + rng.normal(0, 0.02, size=(120, 3)), axis=0)
+        dates = pd.bdate_range("2025-01-01", periods=120)
+
+        rebased = rebase_to_100(prices)
+        stats = compute_comparison_stats(prices, dates)
+
+        assert np.allclose(rebased[0], 100.0)
+        for j in range(3):
+            column = pd.Series(prices[:, j])
+            daily = column.pct_change().dropna()
+            assert stats["total_return"][j] == pytest.approx(prices[-1, j] / prices[0, j] - 1)
+            assert stats["volatility"][j] == pytest.approx(daily.std() * np.sqrt(252))
+            assert stats["max_drawdown"][j] == pytest.approx((column / column.cummax() - 1).min())
+            assert stats["best_day"][j] == pytest.approx(daily.max())
+        assert np.allclose(stats["correlation"], pd.DataFrame(prices).pct_change().dropna().corr().to_numpy())
+
+    def test_flat_series_has_zero_correlation(self) -> None:
+        prices = np.column_stack([np.linspace(10, 12, 30), np.full(30, 5.0)])
+        stats = compute_comparison_stats(prices, pd.bdate_range("2026-01-01", periods=30))
+
+        assert stats["volatility"][1] == 0.0
+        assert stats["correlation"].tolist() == [[1.0, 0.0], [0.0, 1.0]]
+
+
+class TestCompareTickers:
+    """测试批量拉取、共同起点与计价口径。"""
+
+    @patch('comparison_engine.fetch_price_history')
+    def test_common_start_and_single_chart(self, mock_fetch: MagicMock, tmp_path: Path) -> None:
+        mock_fetch.return_value = {
+            "AAPL": _frame(np.linspace(100, 120, 40)),
+            # 晚 10 个交易日上市：归一化基准日应对齐到它的首日
+            "0700.HK": _frame(np.linspace(300, 270, 30), start="2026-01-15"),
+        }
+
+        result = compare_tickers(["AAPL", "700", "TSLA"], tmp_path, days=90)
+
+        mock_fetch.assert_called_once_with(["AAPL", "0700.HK", "TSLA"], days=90)
+        assert result["tickers"] == ["AAPL", "0700.HK"]
+        assert result["missing_history"] == ["TSLA"]
+        assert result["start"] == "2026-01-15"
+        assert result["stats"]["0700.HK"]["rebased_end"] == 90.0
+        assert result["stats"]["AAPL"]["total_return"] == pytest.approx(120 / (100 + 20 * 10 / 39) - 1, abs=1e-4)
+        assert result["file_name"].startswith("compare_90d_")
+        assert (tmp_path / result["file_name"]).stat().st_size > 0
+
+        again = compare_tickers(["AAPL", "0700.HK"], tmp_path, days=90)
+        assert again["cache_hit"] is True
+
+        report = format_comparison_report(result)
+        assert "| AAPL | " in report.split("\n")[7]  # 按区间收益降序
+        assert "TSLA" in report
+
+    @patch('comparison_engine.fetch_price_history')
+    def test_cny_uses_historical_fx(self, mock_fetch: MagicMock, tmp_path: Path) -> None:
+        mock_fetch.return_value = {
+            "AAPL": _frame(np.full(20, 100.0)),
+            "600519.SS": _frame(np.full(20, 1500.0)),
+            "USDCNY=X": _frame(np.linspace(7.0, 7.7, 20)),
+            "HKDCNY=X": _frame(np.full(20, 0.9)),
+        }
+
+        native = compare_tickers(["AAPL", "600519"], tmp_path, days=60)
+        cny = compare_tickers(["AAPL", "600519"], tmp_path, days=60, currency="CNY")
+
+        assert "USDCNY=X" in mock_fetch.call_args[0][0]
+        assert native["stats"]["AAPL"]["total_return"] == 0.0
+        assert cny["stats"]["AAPL"]["total_return"] == pytest.approx(0.1)
+        assert cny["stats"]["600519.SS"]["total_return"] == 0.0
+        assert native["file_name"] != cny["file_name"]
+
+    def test_rejects_invalid_arguments(self, tmp_path: Path) -> None:
+        with pytest.raises(ValueError):
+            compare_tickers(["AAPL"], tmp_path)
+        with pytest.raises(ValueError):
+            compare_tickers(["AAPL", "MSFT"], tmp_path, currency="EUR")
+        with pytest.raises(ValueError):
+            compare_tickers([f"T{chr(65 + i)}" for i in range(11)], tmp_path)
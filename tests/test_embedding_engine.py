@@ -0,0 +1,281 @@
+"""
+向量化引擎单元测试模块。
+
+本模块测试 embedding_engine 的文本块向量缓存与批量向量化管道：
+1. 缓存键区分模型与文本
+2. SQLite 持久化（跨实例复用、float32 往返）
+3. 重建时只为未见过的文本块调用底层模型，结果顺序与输入一致
+4. 批量并发管道：分批、保序、并发上限、令牌桶限速、可恢复错误的退避重试与进度回调
+5. 查询向量持久化 LRU：归一化命中、跨实例复用、按最近使用淘汰
+6. 可插拔向量后端：本地特征哈希与确定性假向量、模型标识隔离、按配置创建
+"""
+
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+import pytest
+from langchain_core.embeddings import Embeddings
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from embedding_engine import (
+    BatchedEmbeddings,
+    CachedEmbeddings,
+    EmbeddingCache,
+    FakeEmbeddings,
+    HashingEmbeddings,
+    RateLimiter,
+    create_embeddings,
+    embedding_cache_key,
+    embedding_model_id,
+    normalize_query,
+)
+
+
+class _CountingEmbeddings(Embeddings):
+    """记录每次调用收到的文本，向量为 [文本长度, 首字符码位]"""
+
+    def __init__(self) -> None:
+        self.calls: List[List[str]] = []
+        self.queries: List[str] = []
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls.append(list(texts))
+        return [[float(len(t)), float(ord(t[0]))] for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self.queries.append(text)
+        return [float(len(text)), 0.0]
+
+
+class TestEmbeddingCache:
+    """测试 SQLite 向量缓存。"""
+
+    def test_key_depends_on_model_and_text(self) -> None:
+        assert embedding_cache_key("m1", "abc") == embedding_cache_key("m1", "abc")
+        assert embedding_cache_key("m1", "abc") != embedding_cache_key("m2", "abc")
+        assert embedding_cache_key("m1", "abc") != embedding_cache_key("m1", "abd")
+
+    def test_persists_across_instances(self, tmp_path: Path) -> None:
+        db = tmp_path / "cache.sqlite3"
+        cache = EmbeddingCache(db)
+        cache.put_many("m", {"k1": [0.5, 1.25], "k2": [3.0, -1.0]})
+        cache.close()
+
+        reopened = EmbeddingCache(db)
+        assert reopened.get_many(["k1", "k2", "k3"]) == {"k1": [0.5, 1.25], "k2": [3.0, -1.0]}
+        assert reopened.count("m") == 2
+        assert reopened.count("other") == 0
+
+    def test_large_batch_lookup(self, tmp_path: Path) -> None:
+        cache = EmbeddingCache(tmp_path / "cache.sqlite3")
+        cache.put_many("m", {f"k{i}": [float(i)] for i in range(2500)})
+
+        found = cache.get_many([f"k{i}" for i in range(2500)])
+
+        assert len(found) == 2500
+        assert found["k1999"] == [1999.0]
+
+
+class TestCachedEmbeddings:
+    """测试缓存包装器。"""
+
+    def test_only_unseen_chunks_are_embedded(self, tmp_path: Path) -> None:
+        underlying = _CountingEmbeddings()
+        cache = EmbeddingCache(tmp_path / "cache.sqlite3")
+        embeddings = CachedEmbeddings(underlying, "text-embedding-v3", cache)
+
+        first = embeddings.embed_documents(["免责声明", "茅台营收", "免责声明"])
+        second = embeddings.embed_documents(["免责声明", "腾讯回购", "茅台营收"])
+
+        # 同批次内的重复块只向量化一次；第二次只有新块调用底层模型
+        assert underlying.calls == [["免责声明", "茅台营收"], ["腾讯回购"]]
+        assert first == [[4.0, ord("免")], [4.0, ord("茅")], [4.0, ord("免")]]
+        assert second == [[4.0, ord("免")], [4.0, ord("腾")], [4.0, ord("茅")]]
+        assert embeddings.hits == 3
+        assert embeddings.misses == 3
+
+    def test_model_name_isolates_vectors(self, tmp_path: Path) -> None:
+        cache = EmbeddingCache(tmp_path / "cache.sqlite3")
+        a, b = _CountingEmbeddings(), _CountingEmbeddings()
+
+        CachedEmbeddings(a, "model-a", cache).embed_documents(["同一段文本"])
+        CachedEmbeddings(b, "model-b", cache).embed_documents(["同一段文本"])
+
+        assert len(a.calls) == 1 and len(b.calls) == 1
+
+    def test_query_is_cached_after_normalization(self, tmp_path: Path) -> None:
+        underlying = _CountingEmbeddings()
+        cache = EmbeddingCache(tmp_path / "cache.sqlite3")
+        embeddings = CachedEmbeddings(underlying, "m", cache)
+
+        assert embeddings.embed_query("茅台的股息率？") == [7.0, 0.0]
+        assert embeddings.embed_query(" 茅台的股息率 ") == [7.0, 0.0]
+        assert CachedEmbeddings(underlying, "m", EmbeddingCache(tmp_path / "cache.sqlite3")).embed_query("茅台的股息率?") == [7.0, 0.0]
+
+        assert underlying.queries == ["茅台的股息率？"]
+        assert (embeddings.query_hits, embeddings.query_misses) == (1, 1)
+        assert underlying.calls == []
+        # 查询向量与同文本的文档向量互不复用
+        assert embeddings.embed_documents(["茅台的股息率？"]) == [[7.0, ord("茅")]]
+
+    def test_query_lru_evicts_least_recently_used(self, tmp_path: Path) -> None:
+        cache = EmbeddingCache(tmp_path / "cache.sqlite3")
+        cache.put_query("m", "q1", [1.0], max_entries=2)
+        cache.put_query("m", "q2", [2.0], max_entries=2)
+        assert cache.get_query("q1") == [1.0]
+
+        cache.put_query("m", "q3", [3.0], max_entries=2)
+
+        assert cache.query_count() == 2
+        assert cache.get_query("q2") is None
+        assert cache.get_query("q1") == [1.0]
+
+    def test_normalize_query(self) -> None:
+        assert normalize_query("  腾讯\t回购  计划！ ") == "腾讯 回购 计划"
+        assert normalize_query("ＡＡＰＬ　财报") == "AAPL 财报"
+
+    def test_faiss_build_reuses_cache(self, tmp_path: Path) -> None:
+        from langchain_community.vectorstores import FAISS
+
+        underlying = _CountingEmbeddings()
+        cache = EmbeddingCache(tmp_path / "cache.sqlite3")
+        texts = ["模板段落 A", "模板段落 B", "今日要闻"]
+
+        FAISS.from_texts(texts, CachedEmbeddings(underlying, "m", cache))
+        rebuilt = FAISS.from_texts(texts + ["新增段落"], CachedEmbeddings(underlying, "m", cache))
+
+        assert underlying.calls[-1] == ["新增段落"]
+        assert rebuilt.index.ntotal == 4
+
+
+class _SlowEmbeddings(_CountingEmbeddings):
+    """每次请求耗时固定，并记录同时在途的最大请求数"""
+
+    def __init__(self, latency: float = 0.02, failures: int = 0, error: type = ConnectionError) -> None:
+        super().__init__()
+        self.latency = latency
+        self.failures = failures
+        self.error = error
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self._lock:
+            if self.failures > 0:
+                self.failures -= 1
+                raise self.error("模拟失败")
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        time.sleep(self.latency)
+        with self._lock:
+            self.in_flight -= 1
+            self.calls.append(list(texts))
+        return [[float(len(t)), float(ord(t[0]))] for t in texts]
+
+
+class TestBatchedEmbeddings:
+    """测试批量、并发、限速管道。"""
+
+    def test_batches_preserve_order_and_bound_concurrency(self) -> None:
+        underlying = _SlowEmbeddings()
+        progress = []
+        embedder = BatchedEmbeddings(
+            underlying, batch_size=3, concurrency=2, rate_limit=0, progress=lambda d, t: progress.append((d, t))
+        )
+        texts = [chr(0x4E00 + i) * (i + 1) for i in range(10)]
+
+        vectors = embedder.embed_documents(texts)
+
+        assert vectors == [[float(i + 1), float(0x4E00 + i)] for i in range(10)]
+        assert sorted(len(c) for c in underlying.calls) == [1, 3, 3, 3]
+        assert underlying.peak == 2
+        assert progress[-1] == (10, 10)
+        assert embedder.last_run["batches"] == 4
+
+    def test_retries_transient_errors(self) -> None:
+        underlying = _SlowEmbeddings(latency=0, failures=2)
+        embedder = BatchedEmbeddings(underlying, batch_size=5, concurrency=1, rate_limit=0, backoff_base=0)
+
+        assert embedder.embed_documents(["甲", "乙"]) == [[1.0, ord("甲")], [1.0, ord("乙")]]
+        assert embedder.retries == 2
+
+    def test_does_not_retry_invalid_request(self) -> None:
+        underlying = _SlowEmbeddings(latency=0, failures=1, error=ValueError)
+        embedder = BatchedEmbeddings(underlying, concurrency=1, rate_limit=0, backoff_base=0)
+
+        with pytest.raises(ValueError):
+            embedder.embed_documents(["甲"])
+        assert embedder.retries == 0
+
+    def test_rate_limiter_caps_request_rate(self) -> None:
+        limiter = RateLimiter(50)
+        started = time.monotonic()
+        for _ in range(75):  # 50 个突发令牌 + 25 个按速率补充
+            limiter.acquire()
+
+        assert time.monotonic() - started >= 0.45
+
+    def test_cache_flushes_segments_with_progress(self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+        monkeypatch.setattr("embedding_engine.EMBEDDING_CACHE_FLUSH_EVERY", 4)
+        underlying = _CountingEmbeddings()
+        cache = EmbeddingCache(tmp_path / "cache.sqlite3")
+        progress = []
+        embeddings = CachedEmbeddings(underlying, "m", cache, progress=lambda d, t: progress.append((d, t)))
+
+        embeddings.embed_documents([f"块{i}" for i in range(10)])
+
+        assert [len(c) for c in underlying.calls] == [4, 4, 2]
+        assert progress == [(4, 10), (8, 10), (10, 10)]
+        assert cache.count("m") == 10
+
+
+class TestBackends:
+    """测试可插拔向量后端。"""
+
+    def test_fake_is_deterministic(self) -> None:
+        a, b = FakeEmbeddings(dim=16), FakeEmbeddings(dim=16)
+
+        assert a.embed_documents(["茅台"]) == b.embed_documents(["茅台"])
+        assert a.embed_query("茅台") != a.embed_query("腾讯")
+        assert len(a.embed_query("茅台")) == 16
+
+    def test_hashing_vectors_are_normalized_and_lexically_close(self) -> None:
+        embeddings = HashingEmbeddings(dim=256)
+        query, near, far = embeddings.embed_documents(["茅台股息率", "贵州茅台的股息率为 3.1%", "美联储维持利率不变"])
+
+        assert abs(sum(v * v for v in near) - 1.0) < 1e-5
+        assert sum(q * n for q, n in zip(query, near)) > sum(q * f for q, f in zip(query, far))
+        assert embeddings.embed_query("") == [0.0] * 256
+
+    def test_local_backend_retrieves_offline(self) -> None:
+        from langchain_community.vectorstores import FAISS
+
+        texts = ["贵州茅台 600519 的股息率为 3.1%。", "腾讯控股宣布 100 亿港元回购。", "美联储维持利率不变。"]
+        store = FAISS.from_texts(texts, HashingEmbeddings())
+
+        assert store.similarity_search("腾讯回购", k=1)[0].page_content == texts[1]
+
+    def test_model_ids_keep_backends_apart(self) -> None:
+        ids = {embedding_model_id(backend) for backend in ("dashscope", "local", "fake")}
+
+        assert len(ids) == 3
+        assert embedding_model_id("dashscope") == "text-embedding-v3"
+        with pytest.raises(ValueError):
+            embedding_model_id("onnx")
+
+    def test_create_embeddings(self) -> None:
+        embeddings, model = create_embeddings("local")
+        assert isinstance(embeddings, HashingEmbeddings)
+        assert model.startswith("local-")
+
+        embeddings, model = create_embeddings("fake")
+        assert isinstance(embeddings, FakeEmbeddings)
+
+        with pytest.raises(ValueError):
+            create_embeddings("dashscope", api_key=None)
@@ -0,0 +1,560 @@
+"""
+知识库引擎单元测试模块。
+
+本模块测试 kb_engine 的向量库内存池与全局索引：
+1. 常驻体积估算（真实 FAISS 平坦索引 + 假向量模型）
+2. 按字节预算的 LRU 淘汰、超预算索引不入池
+3. 文件版本变化与按文件名显式失效时释放旧条目
+4. 同一文件的并发加载只执行一次
+5. 跨文档全局索引：同步、精确过滤检索、增量替换 / 删除、持久化与模型变化重建
+6. 按规模切换 Flat / HNSW / IVF-PQ、近似索引下的删除重建与过滤检索、内存映射加载
+7. 词法 + 向量混合检索（单文件与全局索引）、词法索引随向量库落盘、向量服务超时与冷却期降级
+8. 检索结果短时缓存：归一化命中、TTL 过期、按文件失效、全局索引变化时失效
+"""
+
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import List
+from unittest.mock import patch
+
+import pytest
+from langchain_core.embeddings import Embeddings
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import numpy as np
+
+from kb_engine import (
+    KB_FILE_METADATA_KEY,
+    RETRIEVAL_CACHE,
+    KnowledgeBaseIndex,
+    RetrievalCache,
+    VectorStoreCache,
+    build_vectorstore_streaming,
+    embedding_available,
+    estimate_vectorstore_bytes,
+    hybrid_search,
+    index_type_of,
+    lexical_search_document,
+    load_faiss_store,
+    retype_store,
+    save_faiss_store,
+    target_index_type,
+)
+
+
+def _sized_cache(max_bytes: int) -> VectorStoreCache:
+    """以值本身（整数）作为估算字节数的内存池，便于精确断言淘汰顺序"""
+    return VectorStoreCache(max_bytes, estimate=lambda value: value)
+
+
+class TestEstimate:
+    """测试常驻体积估算。"""
+
+    def test_flat_index_counts_vectors_and_documents(self) -> None:
+        from langchain_community.embeddings import FakeEmbeddings
+        from langchain_community.vectorstores import FAISS
+
+        texts = ["贵州茅台 2025 年报" * 10, "腾讯控股 业绩会纪要" * 10, "苹果 10-K 风险因素" * 10]
+        store = FAISS.from_texts(texts, FakeEmbeddings(size=64))
+
+        estimate = estimate_vectorstore_bytes(store)
+        vector_bytes = 3 * 64 * 4
+        text_bytes = sum(len(t.encode("utf-8")) for t in texts)
+
+        assert estimate >= vector_bytes + text_bytes
+        assert estimate < vector_bytes + text_bytes + 3 * 1024
+
+    def test_unknown_object_is_zero(self) -> None:
+        assert estimate_vectorstore_bytes(object()) == 0
+
+
+class TestVectorStoreCache:
+    """测试按字节预算的内存池。"""
+
+    def test_evicts_least_recently_used_by_bytes(self) -> None:
+        cache = _sized_cache(100)
+        cache.put("a.pdf", 1, 40)
+        cache.put("b.pdf", 1, 40)
+        assert cache.get("a.pdf", 1) == 40  # a 变为最近使用
+
+        cache.put("c.pdf", 1, 40)
+
+        assert cache.get("b.pdf", 1) is None
+        assert cache.get("a.pdf", 1) == 40
+        stats = cache.stats()
+        assert stats["entries"] == 2
+        assert stats["resident_bytes"] == 80
+        assert stats["evictions"] == 1
+
+    def test_many_small_entries_share_budget(self) -> None:
+        cache = _sized_cache(100)
+        for i in range(20):
+            cache.put(f"日报_{i}.md", 1, 5)
+
+        # 按个数限制时只能留 10 个，按字节预算可全部常驻
+        assert cache.stats()["entries"] == 20
+
+    def test_oversized_entry_is_not_cached(self) -> None:
+        cache = _sized_cache(100)
+        cache.put("small.md", 1, 10)
+
+        assert cache.put("huge.pdf", 1, 500) is False
+        assert cache.get("small.md", 1) == 10
+        assert cache.stats()["rejected"] == 1
+
+    def test_version_change_releases_stale_entry(self) -> None:
+        cache = _sized_cache(100)
+        cache.put("report.pdf", 1.0, 60)
+
+        assert cache.get("report.pdf", 2.0) is None
+        stats = cache.stats()
+        assert stats["resident_bytes"] == 0
+        assert stats["invalidations"] == 1
+
+    def test_invalidate_by_name(self) -> None:
+        cache = _sized_cache(100)
+        cache.put("report.pdf", 1, 30)
+
+        assert cache.invalidate("report.pdf") is True
+        assert cache.invalidate("report.pdf") is False
+        assert cache.get("report.pdf", 1) is None
+        assert cache.stats()["resident_bytes"] == 0
+
+    def test_concurrent_loads_run_once(self) -> None:
+        cache = _sized_cache(100)
+        calls = []
+
+        def loader() -> int:
+            calls.append(1)
+            time.sleep(0.05)
+            return 10
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(cache.get_or_load("a.pdf", 1, loader)))
+            for _ in range(8)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert results == [10] * 8
+        assert len(calls) == 1
+
+    def test_hit_rate(self) -> None:
+        cache = _sized_cache(100)
+        cache.get_or_load("a.pdf", 1, lambda: 10)
+        cache.get_or_load("a.pdf", 1, lambda: pytest.fail("不应重复加载"))
+
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["hit_rate"] == 0.5
+
+
+class _KeywordEmbeddings(Embeddings):
+    """按关键词出现次数生成向量的确定性替身，记录向量化的文本块数"""
+
+    KEYWORDS = ["茅台", "腾讯", "苹果", "回购", "营收", "风险"]
+
+    def __init__(self) -> None:
+        self.embedded = 0
+
+    def _vector(self, text: str) -> List[float]:
+        return [float(text.count(word)) for word in self.KEYWORDS]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.embedded += len(texts)
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._vector(text)
+
+
+def _write(kb_dir: Path, name: str, text: str, mtime: float) -> None:
+    path = kb_dir / name
+    path.write_text(text, encoding="utf-8")
+    os.utime(path, (mtime, mtime))
+
+
+def _snapshot(kb_dir: Path) -> dict:
+    return {p.name: (p, p.stat().st_mtime) for p in kb_dir.iterdir()}
+
+
+class TestKnowledgeBaseIndex:
+    """测试跨文档全局索引。"""
+
+    @pytest.fixture
+    def kb(self, tmp_path: Path):
+        kb_dir = tmp_path / "kb"
+        kb_dir.mkdir()
+        _write(kb_dir, "maotai.md", "茅台营收增长。\n\n茅台回购计划。", 1000)
+        _write(kb_dir, "tencent.md", "腾讯回购港股。", 1000)
+        _write(kb_dir, "apple.txt", "苹果风险因素。", 1000)
+        embeddings = _KeywordEmbeddings()
+        index = KnowledgeBaseIndex(tmp_path / "index", embeddings, model="kw")
+        return kb_dir, index, embeddings
+
+    def test_sync_and_cross_document_search(self, kb) -> None:
+        kb_dir, index, _ = kb
+        summary = index.sync(_snapshot(kb_dir))
+
+        assert sorted(summary["added"]) == ["apple.txt", "maotai.md", "tencent.md"]
+        top, _ = index.search("腾讯回购", k=1)[0]
+        assert top.metadata[KB_FILE_METADATA_KEY] == "tencent.md"
+
+    def test_filtered_search_is_exact(self, kb) -> None:
+        kb_dir, index, _ = kb
+        index.sync(_snapshot(kb_dir))
+
+        hits = index.search("腾讯回购", k=5, files=["apple.txt"])
+
+        # 即使最相关的文本块在其他文件，过滤后仍返回目标文件自己的块
+        assert [d.metadata[KB_FILE_METADATA_KEY] for d, _ in hits] == ["apple.txt"]
+        assert index.search("腾讯", files=["missing.md"]) == []
+
+    def test_incremental_replace_and_delete(self, kb) -> None:
+        kb_dir, index, embeddings = kb
+        index.sync(_snapshot(kb_dir))
+        first = embeddings.embedded
+
+        _write(kb_dir, "tencent.md", "腾讯营收超预期。", 2000)
+        (kb_dir / "apple.txt").unlink()
+        summary = index.sync(_snapshot(kb_dir))
+
+        assert summary["updated"] == ["tencent.md"]
+        assert summary["removed"] == ["apple.txt"]
+        assert summary["unchanged"] == 1
+        assert embeddings.embedded - first == 1  # 只向量化被修改文件的文本块
+        assert set(index.files()) == {"maotai.md", "tencent.md"}
+        assert index.stats()["chunks"] == sum(e["chunks"] for e in index.files().values())
+        contents = [d.page_content for d, _ in index.search("腾讯", k=10)]
+        assert "腾讯回购港股。" not in contents
+        assert "腾讯营收超预期。" in contents
+
+    def test_half_written_version_is_not_searchable(self, kb) -> None:
+        kb_dir, index, embeddings = kb
+        index.sync(_snapshot(kb_dir))
+
+        # 模拟 upsert_file 写到一半：新版本文本块已进入索引，但清单尚未替换
+        with index._lock:
+            index._add([("腾讯回购新版本。", embeddings._vector("腾讯回购新版本。"))],
+                       [{KB_FILE_METADATA_KEY: "tencent.md"}], ["tencent.md@pending#0"])
+
+        contents = [d.page_content for d, _ in index.search("腾讯回购", k=10)]
+
+        assert "腾讯回购新版本。" not in contents
+        assert "腾讯回购港股。" in contents
+
+    def test_persists_and_reloads(self, kb, tmp_path: Path) -> None:
+        kb_dir, index, _ = kb
+        index.sync(_snapshot(kb_dir))
+
+        embeddings = _KeywordEmbeddings()
+        reloaded = KnowledgeBaseIndex(tmp_path / "index", embeddings, model="kw")
+        summary = reloaded.sync(_snapshot(kb_dir))
+
+        assert summary["unchanged"] == 3
+        assert embeddings.embedded == 0
+        assert reloaded.search("苹果风险", k=1)[0][0].metadata[KB_FILE_METADATA_KEY] == "apple.txt"
+
+    def test_model_change_discards_index(self, kb, tmp_path: Path) -> None:
+        kb_dir, index, _ = kb
+        index.sync(_snapshot(kb_dir))
+
+        other = KnowledgeBaseIndex(tmp_path / "index", _KeywordEmbeddings(), model="another-model")
+
+        assert other.files() == {}
+        assert sorted(other.sync(_snapshot(kb_dir))["added"]) == ["apple.txt", "maotai.md", "tencent.md"]
+
+
+class _TableEmbeddings(Embeddings):
+    """按文本查表返回预先生成的向量（文本形如 "c{i}"）"""
+
+    def __init__(self, vectors: np.ndarray) -> None:
+        self.vectors = vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.vectors[int(t[1:])].tolist() for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.vectors[int(text[1:])].tolist()
+
+
+def _random_store(n: int, dim: int = 16):
+    from langchain_community.vectorstores import FAISS
+
+    vectors = np.random.default_rng(0).standard_normal((n, dim)).astype(np.float32)
+    embeddings = _TableEmbeddings(vectors)
+    texts = [f"c{i}" for i in range(n)]
+    store = FAISS.from_embeddings(list(zip(texts, vectors.tolist())), embeddings, ids=texts)
+    return store, vectors
+
+
+class TestAnnIndex:
+    """测试索引类型切换与内存映射加载。"""
+
+    def test_target_type_has_hysteresis(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        monkeypatch.setattr("kb_engine.KB_ANN_THRESHOLD", 100)
+        monkeypatch.setattr("kb_engine.KB_ANN_INDEX_TYPE", "hnsw")
+
+        assert target_index_type(99) == "flat"
+        assert target_index_type(100) == "hnsw"
+        assert target_index_type(60, "hnsw") == "hnsw"
+        assert target_index_type(49, "hnsw") == "flat"
+
+    def test_hnsw_retype_and_delete(self) -> None:
+        store, vectors = _random_store(500)
+
+        retype_store(store, "hnsw")
+        assert index_type_of(store.index) == "hnsw"
+        assert store.similarity_search_with_score("c42", k=1)[0][0].page_content == "c42"
+
+        retype_store(store, "hnsw", drop_ids=["c42", "c7"])
+        assert store.index.ntotal == 498
+        assert len(store.docstore._dict) == 498
+        assert store.similarity_search_with_score("c42", k=1)[0][0].page_content != "c42"
+        # 位置映射重新紧凑编号，向量与文本块保持对应
+        pos = next(p for p, doc_id in store.index_to_docstore_id.items() if doc_id == "c100")
+        assert np.allclose(store.index.reconstruct(pos), vectors[100])
+
+    def test_ivfpq_retype_recall(self) -> None:
+        store, _ = _random_store(256 * 39)
+
+        retype_store(store, "ivfpq")
+
+        assert index_type_of(store.index) == "ivfpq"
+        found = sum(
+            store.similarity_search_with_score(f"c{i}", k=5)[0][0].page_content == f"c{i}" for i in range(0, 2000, 20)
+        )
+        assert found >= 80
+
+    def test_ivfpq_falls_back_to_flat_when_too_small(self) -> None:
+        store, _ = _random_store(300)
+        retype_store(store, "ivfpq")
+        assert index_type_of(store.index) == "flat"
+
+    def test_mmap_load_is_read_only_and_not_resident(self, tmp_path: Path) -> None:
+        store, vectors = _random_store(300)
+        retype_store(store, "hnsw")
+        save_faiss_store(store, tmp_path)
+
+        loaded = load_faiss_store(tmp_path, store.embedding_function, mmap=True)
+        full = load_faiss_store(tmp_path, store.embedding_function, mmap=False)
+
+        assert loaded.index.hnsw.efSearch == full.index.hnsw.efSearch
+        assert loaded.similarity_search_with_score("c5", k=1)[0][0].page_content == "c5"
+        assert estimate_vectorstore_bytes(loaded) < estimate_vectorstore_bytes(full) - 300 * 16 * 4 + 1
+
+    def test_global_index_switches_type_and_filters(self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+        monkeypatch.setattr("kb_engine.KB_ANN_THRESHOLD", 4)
+        monkeypatch.setattr("kb_engine.KB_ANN_INDEX_TYPE", "hnsw")
+        kb_dir = tmp_path / "kb"
+        kb_dir.mkdir()
+        _write(kb_dir, "a.md", "\n\n".join(["茅台营收" * 100, "茅台回购" * 100, "腾讯回购" * 100]), 1000)
+        _write(kb_dir, "b.md", "\n\n".join(["苹果风险" * 100, "苹果营收" * 100]), 1000)
+        index = KnowledgeBaseIndex(tmp_path / "index", _KeywordEmbeddings(), model="kw")
+
+        index.sync(_snapshot(kb_dir))
+        assert index.stats()["index_type"] == "hnsw"
+        hits = index.search("腾讯回购", k=2, files=["b.md"])
+        assert {d.metadata[KB_FILE_METADATA_KEY] for d, _ in hits} == {"b.md"}
+
+        # 重新加载（内存映射）后删除文件：先完整读入，再剔除文本块重建 HNSW（仍在滞后区间内）
+        reloaded = KnowledgeBaseIndex(tmp_path / "index", _KeywordEmbeddings(), model="kw")
+        (kb_dir / "a.md").unlink()
+        reloaded.sync(_snapshot(kb_dir))
+        assert reloaded.stats() | {"resident_bytes": 0} == {
+            "files": 1, "chunks": 2, "index_type": "hnsw", "resident_bytes": 0
+        }
+        assert {d.metadata[KB_FILE_METADATA_KEY] for d, _ in reloaded.search("回购", k=5)} == {"b.md"}
+
+        (kb_dir / "b.md").unlink()
+        _write(kb_dir, "c.md", "腾讯回购", 1000)
+        reloaded.sync(_snapshot(kb_dir))
+        assert reloaded.stats()["index_type"] == "flat"
+
+
+class _StalledEmbeddings(_KeywordEmbeddings):
+    """查询向量化卡住的替身（模拟远端服务超时）"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.release = threading.Event()
+
+    def embed_query(self, text: str) -> List[float]:
+        self.release.wait(5)
+        return self._vector(text)
+
+
+class TestHybridSearch:
+    """测试混合检索与降级。"""
+
+    @pytest.fixture(autouse=True)
+    def _reset_breaker(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        monkeypatch.setattr("kb_engine._embedding_down_until", 0.0)
+
+    @pytest.fixture
+    def doc(self, tmp_path: Path) -> Path:
+        path = tmp_path / "notes.md"
+        paragraphs = [f"第{i}段：茅台营收与回购讨论。" for i in range(8)] + ["代码 600519 的股息率为 3.1%。"]
+        path.write_text("\n\n".join(p * 20 for p in paragraphs), encoding="utf-8")
+        return path
+
+    def test_exact_literal_found_by_lexical_side(self, doc: Path) -> None:
+        store = build_vectorstore_streaming(doc, _KeywordEmbeddings())
+
+        documents, mode = hybrid_search(store, "600519 股息率", k=2)
+
+        assert mode == "hybrid"
+        assert "600519" in documents[0].page_content
+
+    def test_lexical_index_persists_with_store(self, doc: Path, tmp_path: Path) -> None:
+        store = build_vectorstore_streaming(doc, _KeywordEmbeddings())
+        save_faiss_store(store, tmp_path / "vstore")
+
+        reloaded = load_faiss_store(tmp_path / "vstore", _KeywordEmbeddings())
+
+        assert reloaded._lexical_index is not None
+        assert len(reloaded._lexical_index) == store.index.ntotal
+        assert estimate_vectorstore_bytes(reloaded) >= reloaded._lexical_index.nbytes
+
+    def test_stalled_embedding_degrades_then_skips(self, doc: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+        monkeypatch.setattr("kb_engine.KB_QUERY_EMBED_TIMEOUT", 0.2)
+        embeddings = _StalledEmbeddings()
+        store = build_vectorstore_streaming(doc, embeddings)
+        try:
+            documents, mode = hybrid_search(store, "600519", k=1)
+            assert mode == "lexical"
+            assert "600519" in documents[0].page_content
+            assert not embedding_available()
+
+            # 冷却期内不再等待超时
+            started = time.perf_counter()
+            _, mode = hybrid_search(store, "茅台回购", k=1)
+            assert mode == "lexical"
+            assert time.perf_counter() - started < 0.1
+        finally:
+            embeddings.release.set()
+
+    def test_global_index_hybrid_search(self, tmp_path: Path) -> None:
+        kb_dir = tmp_path / "kb"
+        kb_dir.mkdir()
+        _write(kb_dir, "a.md", "茅台营收增长。", 1000)
+        _write(kb_dir, "b.md", "代码 600519 的股息率为 3.1%。", 1000)
+        index = KnowledgeBaseIndex(tmp_path / "index", _KeywordEmbeddings(), model="kw")
+        index.sync(_snapshot(kb_dir))
+
+        documents, mode = index.hybrid_search("600519", k=1)
+        assert mode == "hybrid"
+        assert documents[0].metadata[KB_FILE_METADATA_KEY] == "b.md"
+        assert (tmp_path / "index" / "lexical_segments.pkl").exists()
+
+        # 按文件过滤对词法与向量两路同时生效
+        documents, _ = index.hybrid_search("600519", k=2, files=["a.md"])
+        assert [d.metadata[KB_FILE_METADATA_KEY] for d in documents] == ["a.md"]
+
+        # 文件更新后词法索引随之重建，旧文本不再命中
+        _write(kb_dir, "b.md", "腾讯回购港股。", 2000)
+        index.sync(_snapshot(kb_dir))
+        documents, _ = index.hybrid_search("600519", k=2)
+        assert all("600519" not in d.page_content for d in documents)
+
+    def test_global_index_lexical_segments_are_per_file(self, tmp_path: Path) -> None:
+        kb_dir = tmp_path / "kb"
+        kb_dir.mkdir()
+        _write(kb_dir, "a.md", "茅台营收增长。", 1000)
+        _write(kb_dir, "b.md", "代码 600519 的股息率为 3.1%。", 1000)
+        index = KnowledgeBaseIndex(tmp_path / "index", _KeywordEmbeddings(), model="kw")
+        index.sync(_snapshot(kb_dir))
+        segment_a = index._segments["a.md"]
+
+        # 更新 b.md 只重建它自己的段，a.md 的段原样保留
+        _write(kb_dir, "b.md", "腾讯回购港股，代码 0700.HK。", 2000)
+        with patch("kb_engine.BM25Index.from_vectorstore") as full_rebuild:
+            index.sync(_snapshot(kb_dir))
+            documents, _ = index.hybrid_search("0700", k=1)
+        full_rebuild.assert_not_called()
+        assert index._segments["a.md"] is segment_a
+        assert documents[0].metadata[KB_FILE_METADATA_KEY] == "b.md"
+
+        # 重新加载后分段与清单一致，无需补建
+        reloaded = KnowledgeBaseIndex(tmp_path / "index", _KeywordEmbeddings(), model="kw")
+        with patch("kb_engine._build_segment") as rebuild:
+            assert reloaded.hybrid_search("0700", k=1)[0][0].metadata[KB_FILE_METADATA_KEY] == "b.md"
+        rebuild.assert_not_called()
+
+    def test_global_index_degrades_to_lexical(self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+        monkeypatch.setattr("kb_engine.KB_QUERY_EMBED_TIMEOUT", 0.2)
+        kb_dir = tmp_path / "kb"
+        kb_dir.mkdir()
+        _write(kb_dir, "b.md", "代码 600519 的股息率为 3.1%。", 1000)
+        embeddings = _StalledEmbeddings()
+        index = KnowledgeBaseIndex(tmp_path / "index", embeddings, model="kw")
+        index.sync(_snapshot(kb_dir))
+        try:
+            documents, mode = index.hybrid_search("股息率", k=1)
+        finally:
+            embeddings.release.set()
+
+        assert mode == "lexical"
+        assert "股息率" in documents[0].page_content
+
+    def test_lexical_search_without_vectorstore(self, doc: Path) -> None:
+        documents = lexical_search_document(doc, "股息率", k=1)
+
+        assert "股息率" in documents[0].page_content
+
+
+class TestRetrievalCache:
+    """测试检索结果缓存。"""
+
+    def test_hit_after_normalization_and_ttl_expiry(self) -> None:
+        cache = RetrievalCache(ttl=0.05)
+        cache.put("doc", ["a.md"], "茅台的股息率？", 3, ["chunk"])
+
+        assert cache.get("doc", ["a.md"], " 茅台的股息率 ", 3) == ["chunk"]
+        assert cache.get("doc", ["a.md"], "茅台的股息率", 5) is None
+        assert cache.get("kb", ["a.md"], "茅台的股息率", 3) is None
+        time.sleep(0.06)
+        assert cache.get("doc", ["a.md"], "茅台的股息率", 3) is None
+
+    def test_invalidate_by_file_and_global_scope(self) -> None:
+        cache = RetrievalCache()
+        cache.put("kb", ["a.md", "b.md"], "q", 5, 1)
+        cache.put("kb", ["c.md"], "q", 5, 2)
+        cache.put("kb", None, "q", 5, 3)
+
+        assert cache.invalidate("b.md") == 2
+        assert cache.get("kb", ["c.md"], "q", 5) == 2
+        assert cache.get("kb", None, "q", 5) is None
+
+    def test_lru_bound(self) -> None:
+        cache = RetrievalCache(max_entries=2)
+        for i in range(3):
+            cache.put("kb", None, f"q{i}", 5, i)
+
+        assert cache.stats()["entries"] == 2
+        assert cache.get("kb", None, "q0", 5) is None
+
+    def test_global_index_change_invalidates(self, tmp_path: Path) -> None:
+        kb_dir = tmp_path / "kb"
+        kb_dir.mkdir()
+        _write(kb_dir, "maotai.md", "茅台营收增长。", 1000)
+        index = KnowledgeBaseIndex(tmp_path / "index", _KeywordEmbeddings(), model="kw")
+        index.sync(_snapshot(kb_dir))
+        RETRIEVAL_CACHE.put("kb", None, "营收", 5, ["旧结果"])
+        RETRIEVAL_CACHE.put("kb", ["maotai.md"], "营收", 5, ["旧结果"])
+
+        _write(kb_dir, "tencent.md", "腾讯营收。", 1000)
+        index.sync(_snapshot(kb_dir))
+
+        assert RETRIEVAL_CACHE.get("kb", None, "营收", 5) is None
+        assert RETRIEVAL_CACHE.get("kb", ["maotai.md"], "营收", 5) == ["旧结果"]
+        RETRIEVAL_CACHE.clear()
@@ -0,0 +1,233 @@
+"""
+知识库索引队列单元测试模块。
+
+本模块测试 kb_indexer 的持久化队列与后台 worker：
+1. 重复投递合并、先进先出、跨实例持久化
+2. 失败重试的指数退避与次数上限、可恢复错误只推迟不计次、崩溃遗留任务重新排队
+3. 后台线程被唤醒后完成索引并更新状态
+4. 单 worker 租约：非持有者不领取、不重新排队他人的任务，持有者退出后接管
+5. 全局索引的单文件收录（mtime 未变化时跳过）与只读进程的重新加载
+"""
+
+import sys
+import threading
+from pathlib import Path
+from typing import List
+
+import pytest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from kb_indexer import IndexingWorker, IndexQueue, WorkerLease
+
+
+@pytest.fixture
+def queue(tmp_path: Path) -> IndexQueue:
+    return IndexQueue(tmp_path / "queue.sqlite3")
+
+
+class TestIndexQueue:
+    """测试持久化队列。"""
+
+    def test_enqueue_coalesces_and_claims_in_order(self, queue: IndexQueue) -> None:
+        queue.enqueue("a.md", "upload")
+        queue.enqueue("b.md", "archive")
+        queue.enqueue("a.md", "upload")
+
+        assert queue.pending() == ["a.md", "b.md"]
+        assert queue.claim() == "a.md"
+        assert queue.status("a.md")["status"] == "running"
+        assert queue.claim() == "b.md"
+        assert queue.claim() is None
+
+    def test_persists_across_instances(self, tmp_path: Path) -> None:
+        IndexQueue(tmp_path / "queue.sqlite3").enqueue("日报.md", "daily_report")
+
+        reopened = IndexQueue(tmp_path / "queue.sqlite3")
+
+        assert reopened.status("日报.md")["reason"] == "daily_report"
+        assert reopened.claim() == "日报.md"
+
+    def test_fail_retries_until_limit(self, queue: IndexQueue) -> None:
+        queue.enqueue("bad.pdf")
+        for _ in range(2):
+            assert queue.claim() == "bad.pdf"
+            assert queue.fail("bad.pdf", "ConnectionError", max_attempts=3, retry_base=0) is True
+
+        assert queue.claim() == "bad.pdf"
+        assert queue.fail("bad.pdf", "ConnectionError", max_attempts=3, retry_base=0) is False
+        assert queue.status("bad.pdf")["status"] == "failed"
+        assert queue.status("bad.pdf")["attempts"] == 3
+        # 重新上传后清零重试次数
+        queue.enqueue("bad.pdf")
+        assert queue.status("bad.pdf")["attempts"] == 0
+
+    def test_failed_task_backs_off(self, queue: IndexQueue) -> None:
+        queue.enqueue("bad.pdf")
+        queue.claim()
+        queue.fail("bad.pdf", "ConnectionError", retry_base=30)
+
+        assert queue.status("bad.pdf")["status"] == "queued"
+        assert queue.claim() is None
+        # 重新投递（文件被覆盖）立即可领取
+        queue.enqueue("bad.pdf")
+        assert queue.claim() == "bad.pdf"
+
+    def test_defer_does_not_count_attempt(self, queue: IndexQueue) -> None:
+        queue.enqueue("a.md")
+        queue.claim()
+        queue.defer("a.md", "EmbeddingUnavailableError", delay=30)
+
+        assert queue.status("a.md")["attempts"] == 0
+        assert queue.claim() is None
+
+    def test_reenqueue_while_running_is_not_lost(self, queue: IndexQueue) -> None:
+        queue.enqueue("a.md")
+        queue.claim()
+        queue.enqueue("a.md")  # 索引期间文件再次被覆盖
+
+        queue.complete("a.md", 5)
+
+        assert queue.status("a.md")["status"] == "queued"
+
+    def test_requeue_stale(self, queue: IndexQueue) -> None:
+        queue.enqueue("a.md")
+        queue.claim()
+
+        assert queue.requeue_stale() == 1
+        assert queue.claim() == "a.md"
+
+
+class TestIndexingWorker:
+    """测试后台索引线程。"""
+
+    def test_run_once_records_result(self, queue: IndexQueue) -> None:
+        calls: List[str] = []
+
+        def index_file(name: str) -> int:
+            calls.append(name)
+            if name == "broken.pdf":
+                raise ValueError("解析失败")
+            return 12
+
+        worker = IndexingWorker(queue, index_file, retry_base=0)
+        queue.enqueue("ok.md")
+        queue.enqueue("broken.pdf")
+
+        while worker.run_once() is not None:
+            pass
+
+        assert queue.status("ok.md")["status"] == "ready"
+        assert queue.status("ok.md")["chunks"] == 12
+        assert queue.status("broken.pdf")["status"] == "failed"
+        assert "解析失败" in queue.status("broken.pdf")["error"]
+        assert calls.count("broken.pdf") == 3
+        assert (worker.processed, worker.failed) == (1, 3)
+
+    def test_transient_errors_are_deferred(self, queue: IndexQueue) -> None:
+        calls: List[str] = []
+
+        def index_file(name: str) -> int:
+            calls.append(name)
+            raise TimeoutError("向量服务冷却中")
+
+        worker = IndexingWorker(queue, index_file, transient_errors=(TimeoutError,))
+        queue.enqueue("a.md")
+
+        while worker.run_once() is not None:
+            pass
+
+        assert calls == ["a.md"]
+        assert queue.status("a.md")["status"] == "queued"
+        assert queue.status("a.md")["attempts"] == 0
+        assert worker.failed == 0
+
+    def test_background_thread_wakes_on_enqueue(self, queue: IndexQueue) -> None:
+        done = threading.Event()
+
+        def index_file(name: str) -> int:
+            done.set()
+            return 1
+
+        worker = IndexingWorker(queue, index_file, poll_interval=60)
+        worker.start()
+        try:
+            queue.enqueue("new.md")
+            worker.wake()
+            assert done.wait(5)
+        finally:
+            worker.stop(timeout=5)
+
+        assert queue.status("new.md")["status"] == "ready"
+
+
+class TestWorkerLease:
+    """测试单 worker 租约。"""
+
+    def test_lease_is_exclusive_until_released(self, tmp_path: Path) -> None:
+        first, second = WorkerLease(tmp_path / "q.lease"), WorkerLease(tmp_path / "q.lease")
+
+        assert first.acquire() and first.held
+        assert not second.acquire()
+        first.release()
+        assert second.acquire()
+        second.release()
+
+    def test_only_holder_claims_and_requeues(self, queue: IndexQueue) -> None:
+        calls: List[str] = []
+        holder = IndexingWorker(queue, lambda name: calls.append(name) or 1)
+        standby = IndexingWorker(queue, lambda name: calls.append(f"standby:{name}") or 1)
+        queue.enqueue("a.md")
+        queue.enqueue("b.md")
+        assert holder._ensure_lease()
+        assert queue.claim() == "a.md"  # 持有者正在处理 a.md
+
+        # 非持有者既不领取任务，也不把持有者执行中的任务改回排队
+        assert standby.run_once() is None
+        assert queue.status("a.md")["status"] == "running"
+        assert queue.status("b.md")["status"] == "queued"
+
+        # 持有者退出后由等待中的进程接管，并重新排队其遗留任务
+        holder.stop()
+        while standby.run_once() is not None:
+            pass
+        standby.stop()
+        assert sorted(calls) == ["standby:a.md", "standby:b.md"]
+        assert queue.status("a.md")["status"] == "ready"
+
+
+class TestEnsureFile:
+    """测试全局索引的单文件收录。"""
+
+    def test_skips_unchanged_file(self, tmp_path: Path) -> None:
+        from langchain_community.embeddings import FakeEmbeddings
+
+        from kb_engine import KnowledgeBaseIndex
+
+        doc = tmp_path / "notes.md"
+        doc.write_text("贵州茅台营业收入同比增长。\n\n腾讯控股回购股份。", encoding="utf-8")
+        index = KnowledgeBaseIndex(tmp_path / "index", FakeEmbeddings(size=8), model="fake")
+
+        chunks = index.ensure_file("notes.md", doc, 1.0)
+        index.upsert_file = None  # 再次调用若重建会报错
+
+        assert chunks >= 1
+        assert index.ensure_file("notes.md", doc, 1.0) == chunks
+        assert (tmp_path / "index" / "manifest.json").exists()
+
+    def test_reader_reloads_after_holder_writes(self, tmp_path: Path) -> None:
+        from langchain_community.embeddings import FakeEmbeddings
+
+        from kb_engine import KnowledgeBaseIndex
+
+        doc = tmp_path / "notes.md"
+        doc.write_text("贵州茅台营业收入同比增长。", encoding="utf-8")
+        writer = KnowledgeBaseIndex(tmp_path / "index", FakeEmbeddings(size=8), model="fake")
+        reader = KnowledgeBaseIndex(tmp_path / "index", FakeEmbeddings(size=8), model="fake")
+        assert reader.files() == {}
+
+        writer.ensure_file("notes.md", doc, 1.0)
+
+        assert set(reader.files()) == {"notes.md"}
+        assert "茅台" in reader.hybrid_search("茅台", k=1)[0][0].page_content
@@ -0,0 +1,105 @@
+"""
+词法检索引擎单元测试模块。
+
+本模块测试 kb_lexical 的倒排索引：
+1. 中英文混排分词（字符 n-gram、股票代码整体与分段）
+2. BM25 排序：精确字面量命中、稀有词权重高于常见字
+3. 落盘往返与空索引
+4. 分段检索与整库索引打分一致
+5. 倒数排名融合
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from kb_lexical import BM25Index, reciprocal_rank_fusion, search_segments, tokenize
+
+
+class TestTokenize:
+    """测试分词。"""
+
+    def test_chinese_ngrams_and_ascii_words(self) -> None:
+        assert tokenize("茅台600519") == ["茅", "台", "茅台", "600519"]
+        assert tokenize("腾讯 0700.HK 涨 3.5%", ngram=1) == ["腾", "讯", "0700.hk", "0700", "hk", "涨", "3.5", "3", "5"]
+
+    def test_punctuation_is_ignored(self) -> None:
+        assert tokenize("，。！？ ---") == []
+
+
+class TestBM25Index:
+    """测试 BM25 检索。"""
+
+    DOCS = {
+        "a": "贵州茅台（600519）2025 年营业收入同比增长 15%，直销占比提升。",
+        "b": "腾讯控股（0700.HK）宣布回购，营业收入稳健。",
+        "c": "苹果 AAPL 风险因素：供应链集中在大中华区。",
+        "d": "宏观：美联储议息会议维持利率不变，营业收入预期下调。",
+    }
+
+    def _index(self) -> BM25Index:
+        return BM25Index.build(self.DOCS.items())
+
+    def test_exact_ticker_and_name(self) -> None:
+        index = self._index()
+
+        assert index.search("600519", k=1)[0][0] == "a"
+        assert index.search("0700", k=1)[0][0] == "b"
+        assert index.search("aapl 风险", k=1)[0][0] == "c"
+        assert index.search("美联储", k=1)[0][0] == "d"
+
+    def test_rare_terms_outweigh_common_ones(self) -> None:
+        hits = self._index().search("腾讯营业收入", k=4)
+
+        # 「营业收入」出现在三篇文档中，「腾讯」只在一篇
+        assert hits[0][0] == "b"
+        assert [doc_id for doc_id, _ in hits[1:]] and all(score < hits[0][1] for _, score in hits[1:])
+
+    def test_allowed_restricts_candidates(self) -> None:
+        hits = self._index().search("营业收入", k=4, allowed={"b", "c"})
+
+        assert [doc_id for doc_id, _ in hits] == ["b"]
+
+    def test_no_match_returns_empty(self) -> None:
+        assert self._index().search("英伟达", k=3) == []
+
+    def test_save_and_load(self, tmp_path: Path) -> None:
+        index = self._index()
+        index.save(tmp_path / "lexical.pkl")
+
+        reloaded = BM25Index.load(tmp_path / "lexical.pkl")
+
+        assert reloaded.search("回购", k=2) == index.search("回购", k=2)
+        assert not (tmp_path / "lexical.pkl.tmp").exists()
+
+    def test_segments_score_like_one_index(self) -> None:
+        items = list(self.DOCS.items())
+        segments = [BM25Index.build(items[:1]), BM25Index.build(items[1:3]), BM25Index.build(items[3:])]
+        merged = self._index()
+
+        for query in ("营业收入", "腾讯营业收入", "美联储 利率"):
+            expected = merged.search(query, k=4)
+            hits = search_segments(segments, query, k=4)
+            assert [doc_id for doc_id, _ in hits] == [doc_id for doc_id, _ in expected]
+            assert [score for _, score in hits] == pytest.approx([score for _, score in expected])
+
+        # 只检索部分段时统计量仍取全库
+        hits = search_segments(segments[1:2], "营业收入", k=4, corpus=segments)
+        assert hits == [hit for hit in merged.search("营业收入", k=4) if hit[0] == "b"]
+
+    def test_empty_index(self) -> None:
+        index = BM25Index.build([])
+
+        assert len(index) == 0
+        assert index.search("茅台") == []
+
+
+def test_reciprocal_rank_fusion() -> None:
+    fused = reciprocal_rank_fusion([["x", "y", "z"], ["z", "x"]])
+
+    assert fused[0] == "x"
+    assert fused.index("z") < fused.index("y")
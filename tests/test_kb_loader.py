@@ -0,0 +1,153 @@
+"""
+文档加载引擎单元测试模块。
+
+本模块测试 kb_loader 的流式切块流水线：
+1. PDF 进程池并行抽取按页序产出，结果与串行抽取一致
+2. Markdown / TXT 按段落边界分块读取，内存峰值与文件大小无关
+3. CSV 按行切块：表头重复、行号区间、引号内换行、超长单行
+4. 分批与不支持格式的报错
+"""
+
+import sys
+import tracemalloc
+from pathlib import Path
+
+import pytest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from kb_loader import (
+    KB_CHUNK_SIZE,
+    iter_chunk_batches,
+    iter_csv_chunks,
+    iter_document_chunks,
+    iter_pdf_pages,
+    iter_text_blocks,
+)
+
+
+def _make_pdf(path: Path, pages: int) -> None:
+    import matplotlib
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    with matplotlib.rc_context({"pdf.fonttype": 42}), PdfPages(path) as pdf:
+        for i in range(pages):
+            fig = plt.figure(figsize=(4, 3))
+            fig.text(0.1, 0.5, f"page {i} revenue keyword{i}")
+            pdf.savefig(fig)
+            plt.close(fig)
+
+
+class TestPdf:
+    """测试 PDF 并行抽取。"""
+
+    @pytest.fixture(scope="class")
+    def pdf_path(self, tmp_path_factory: pytest.TempPathFactory) -> Path:
+        path = tmp_path_factory.mktemp("pdf") / "report.pdf"
+        _make_pdf(path, 30)
+        return path
+
+    def test_parallel_matches_serial_in_page_order(self, pdf_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+        monkeypatch.setattr("kb_loader.KB_PDF_PAGES_PER_TASK", 4)
+
+        parallel = list(iter_pdf_pages(pdf_path, workers=2))
+        serial = list(iter_pdf_pages(pdf_path, workers=0))
+
+        assert parallel == serial
+        assert [page_no for page_no, _, _ in parallel] == list(range(30))
+        assert parallel[7] == (7, 30, "page 7 revenue keyword7")
+
+    def test_chunks_carry_page_metadata(self, pdf_path: Path) -> None:
+        chunks = list(iter_document_chunks(pdf_path))
+
+        assert len(chunks) == 30
+        assert chunks[12].metadata == {"source": str(pdf_path), "page": 12, "total_pages": 30}
+
+    def test_early_close_does_not_hang(self, pdf_path: Path) -> None:
+        pages = iter_pdf_pages(pdf_path, workers=2)
+        assert next(pages)[0] == 0
+        pages.close()
+
+
+class TestText:
+    """测试纯文本流式读取。"""
+
+    def test_blocks_break_on_paragraphs(self, tmp_path: Path) -> None:
+        path = tmp_path / "notes.md"
+        path.write_text("".join(f"第{i}段" + "文" * 300 + "\n\n" for i in range(50)), encoding="utf-8")
+
+        blocks = list(iter_text_blocks(path, block_chars=2000))
+
+        assert "".join(blocks) == path.read_text(encoding="utf-8")
+        assert all(block.endswith("\n\n") for block in blocks)
+        assert max(len(block) for block in blocks) < 2000 + 400
+
+    def test_long_paragraph_is_capped(self, tmp_path: Path) -> None:
+        path = tmp_path / "wall.txt"
+        path.write_text("无空行的长段落\n" * 2000, encoding="utf-8")
+
+        blocks = list(iter_text_blocks(path, block_chars=1000))
+
+        assert max(len(block) for block in blocks) <= 4000 + 10
+
+    def test_peak_memory_is_flat(self, tmp_path: Path) -> None:
+        path = tmp_path / "big.md"
+        paragraph = "贵州茅台营业收入同比增长，直销渠道占比提升，批价保持稳定。" * 6 + "\n\n"
+        with open(path, "w", encoding="utf-8") as f:
+            for i in range(3000):
+                f.write(f"## 第{i}节\n\n" + paragraph * 5)
+        list(iter_text_blocks(path, block_chars=100))  # 预先导入切块器
+
+        tracemalloc.start()
+        count = sum(len(batch) for batch in iter_chunk_batches(iter_document_chunks(path)))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        assert count > 7000
+        # 文件约 7.6 MB，整篇加载切块的峰值在 30 MB 以上
+        assert peak < 4 * 1024 * 1024
+
+
+class TestCsv:
+    """测试 CSV 按行切块。"""
+
+    def test_rows_are_whole_with_header(self, tmp_path: Path) -> None:
+        path = tmp_path / "holdings.csv"
+        lines = ["ticker,name,note"] + [f"T{i:03d},公司{i},{'备注' * 20}" for i in range(40)]
+        lines.insert(5, 'Q004,"带换行\n的名称",引号内换行')
+        path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+        chunks = list(iter_csv_chunks(path))
+
+        assert all(c.page_content.startswith("ticker,name,note\n") for c in chunks)
+        assert all(len(c.page_content) <= KB_CHUNK_SIZE for c in chunks)
+        body_rows = [row for c in chunks for row in c.page_content.split("\n")[1:]]
+        assert sum(row.startswith("T") for row in body_rows) == 40
+        assert '"带换行' in "\n".join(body_rows)
+        assert chunks[0].metadata["row_start"] == 1
+        assert all(a.metadata["row_end"] + 1 == b.metadata["row_start"] for a, b in zip(chunks, chunks[1:]))
+        assert chunks[-1].metadata["row_end"] == 41
+
+    def test_overlong_row_is_split_with_header(self, tmp_path: Path) -> None:
+        path = tmp_path / "wide.csv"
+        path.write_text("id,text\n1,short\n2," + "长" * 3000 + "\n3,tail\n", encoding="utf-8")
+
+        chunks = list(iter_csv_chunks(path))
+
+        long_pieces = [c for c in chunks if c.metadata["row_start"] == 2 == c.metadata["row_end"]]
+        assert len(long_pieces) > 1
+        assert all(c.page_content.startswith("id,text\n") for c in long_pieces)
+        assert chunks[-1].page_content == "id,text\n3,tail"
+
+
+class TestEntry:
+    """测试统一入口。"""
+
+    def test_unsupported_extension(self, tmp_path: Path) -> None:
+        with pytest.raises(ValueError):
+            iter_document_chunks(tmp_path / "a.docx")
+
+    def test_batches(self) -> None:
+        assert [len(b) for b in iter_chunk_batches(range(7), batch_size=3)] == [3, 3, 1]
@@ -0,0 +1,158 @@
+"""
+交易账本引擎单元测试模块。
+
+本模块测试 ledger_engine 的流水解析、平均成本推导与快照增量回放逻辑。
+"""
+
+import json
+import sys
+from pathlib import Path
+from typing import Any, Dict, List
+from unittest.mock import patch
+
+import pytest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import ledger_engine
+from ledger_engine import apply_transaction, parse_transaction_entry, replay_ledger
+
+
+def _write_log(log_path: Path, entries: List[Dict[str, Any]], mode: str = "w") -> None:
+    """按 append_transaction_log 的格式写入流水"""
+    with open(log_path, mode, encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def _buy(target: str, shares: int, price: float) -> Dict[str, Any]:
+    return {"timestamp": 0, "action": "买入", "target": target, "details": f"测试公司，{shares} 股，成本 {price}"}
+
+
+def _sell(target: str, shares: int, price: float) -> Dict[str, Any]:
+    return {"timestamp": 0, "action": "卖出", "target": target, "details": f"{shares} 股，价格 {price}"}
+
+
+class TestParseTransactionEntry:
+    """测试流水解析。"""
+
+    def test_parse_buy(self) -> None:
+        txn = parse_transaction_entry({"action": "买入", "target": "aapl", "details": "苹果公司，100 股，成本 150.5"})
+        assert txn == {"ticker": "AAPL", "side": "buy", "shares": 100.0, "price": 150.5, "company_name": "苹果公司"}
+
+    def test_parse_clear_takes_priority(self) -> None:
+        txn = parse_transaction_entry({"action": "清仓卖出", "target": "TSLA", "details": "全部卖出"})
+        assert txn is not None
+        assert txn["side"] == "clear"
+
+    def test_unrecognized_entries_return_none(self) -> None:
+        assert parse_transaction_entry({"action": "转账", "target": "券商账户", "details": "10000 元"}) is None
+        assert parse_transaction_entry({"action": "买入", "target": "AAPL", "details": "买了一些"}) is None
+
+    def test_bare_dot_price_is_not_a_number(self) -> None:
+        assert parse_transaction_entry({"action": "买入", "target": "AAPL", "details": "100 股，价格 ."}) is None
+        txn = parse_transaction_entry({"action": "卖出", "target": "AAPL", "details": "50 股，价格 ."})
+        assert txn is not None and txn["price"] == 0.0
+
+    def test_thousands_separators(self) -> None:
+        txn = parse_transaction_entry({"action": "买入", "target": "600519", "details": "贵州茅台，1,000 股，成本 1，520.5"})
+        assert txn is not None
+        assert (txn["shares"], txn["price"], txn["company_name"]) == (1000.0, 1520.5, "贵州茅台")
+
+
+class TestApplyTransaction:
+    """测试移动加权平均成本法。"""
+
+    def test_average_cost_on_repeated_buys(self) -> None:
+        positions: Dict[str, Dict[str, Any]] = {}
+        apply_transaction(positions, {"ticker": "AAPL", "side": "buy", "shares": 100, "price": 150.0, "company_name": "-"})
+        apply_transaction(positions, {"ticker": "AAPL", "side": "buy", "shares": 100, "price": 250.0, "company_name": "-"})
+        assert positions["AAPL"]["shares"] == 200
+        assert positions["AAPL"]["cost_basis"] == pytest.approx(200.0)
+
+    def test_sell_keeps_average_cost_and_oversell_removes(self) -> None:
+        positions = {"AAPL": {"shares": 200.0, "cost_basis": 200.0, "company_name": "-"}}
+        apply_transaction(positions, {"ticker": "AAPL", "side": "sell", "shares": 50, "price": 300.0, "company_name": "-"})
+        assert positions["AAPL"]["shares"] == 150
+        assert positions["AAPL"]["cost_basis"] == pytest.approx(200.0)
+
+        apply_transaction(positions, {"ticker": "AAPL", "side": "sell", "shares": 999, "price": 300.0, "company_name": "-"})
+        assert "AAPL" not in positions
+
+
+class TestReplayLedger:
+    """测试快照检查点的增量回放。"""
+
+    def test_missing_log_returns_empty(self, tmp_path: Path) -> None:
+        positions, stats = replay_ledger(tmp_path / "none.jsonl", tmp_path / "snap.json")
+        assert positions == {}
+        assert stats["entries_total"] == 0
+
+    def test_full_replay_outputs_standard_positions(self, tmp_path: Path) -> None:
+        log_path = tmp_path / "transaction_logs.jsonl"
+        _write_log(log_path, [_buy("AAPL", 100, 150), _buy("513050", 1000, 1.2), _sell("AAPL", 40, 180)])
+
+        positions, stats = replay_ledger(log_path, tmp_path / "snap.json")
+
+        assert positions["AAPL"] == {"shares": 60, "cost_basis": 150.0, "type": "stock", "company_name": "测试公司"}
+        assert positions["513050"]["type"] == "etf"
+        assert stats["entries_replayed"] == 3
+        assert stats["snapshot_written"] is True
+
+    def test_incremental_replay_only_processes_new_entries(self, tmp_path: Path) -> None:
+        log_path = tmp_path / "transaction_logs.jsonl"
+        snap_path = tmp_path / "snap.json"
+        _write_log(log_path, [_buy("AAPL", 100, 100)] * 5)
+        replay_ledger(log_path, snap_path, snapshot_interval=2)
+
+        _write_log(log_path, [_buy("AAPL", 100, 200)], mode="a")
+        with patch.object(ledger_engine, "apply_transaction", wraps=apply_transaction) as spy:
+            positions, stats = replay_ledger(log_path, snap_path, snapshot_interval=2)
+
+        assert spy.call_count == 1
+        assert stats["from_snapshot"] is True
+        assert stats["entries_total"] == 6
+        assert positions["AAPL"]["shares"] == 600
+        assert positions["AAPL"]["cost_basis"] == pytest.approx(700 * 100 / 600, rel=1e-4)
+
+    def test_malformed_entries_are_skipped(self, tmp_path: Path) -> None:
+        log_path = tmp_path / "transaction_logs.jsonl"
+        _write_log(log_path, [
+            _buy("AAPL", 100, 100),
+            {"action": "买入", "target": "TSLA", "details": "10 股，价格 ."},
+            {"action": "买入", "target": "MSFT", "details": ["10 股"]},
+            {"action": "买入", "target": "AAPL", "details": "测试公司，1,000 股，成本 100"},
+        ])
+
+        positions, stats = replay_ledger(log_path, tmp_path / "snap.json")
+
+        assert positions["AAPL"]["shares"] == 1100
+        assert stats["entries_skipped"] == 2
+
+    def test_partial_trailing_line_is_deferred(self, tmp_path: Path) -> None:
+        log_path = tmp_path / "transaction_logs.jsonl"
+        snap_path = tmp_path / "snap.json"
+        _write_log(log_path, [_buy("AAPL", 100, 100)])
+        with open(log_path, "a", encoding="utf-8") as f:
+            f.write('{"action": "买入", "target": "TSLA"')
+
+        positions, _ = replay_ledger(log_path, snap_path)
+        assert "TSLA" not in positions
+
+        with open(log_path, "a", encoding="utf-8") as f:
+            f.write(', "details": "10 股，成本 200"}\n')
+        positions, _ = replay_ledger(log_path, snap_path, snapshot_interval=1)
+        assert positions["TSLA"]["shares"] == 10
+
+    def test_rewritten_log_invalidates_snapshot(self, tmp_path: Path) -> None:
+        log_path = tmp_path / "transaction_logs.jsonl"
+        snap_path = tmp_path / "snap.json"
+        _write_log(log_path, [_buy("AAPL", 100, 100), _buy("MSFT", 10, 300)])
+        replay_ledger(log_path, snap_path)
+
+        _write_log(log_path, [_buy("NVDA", 5, 800)])
+        positions, stats = replay_ledger(log_path, snap_path)
+
+        assert set(positions) == {"NVDA"}
+        assert stats["from_snapshot"] is False
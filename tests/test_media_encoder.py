@@ -0,0 +1,127 @@
+"""
+出站图片编码管道单元测试模块。
+
+本模块测试 media_encoder 的编码与复用：
+1. 调色板 PNG / JPEG / WebP 各档位的输出格式与体积
+2. 超大截图的等比缩小与透明通道压平
+3. 编码结果缓存与字节节省统计
+4. 广播内同一张图只上传一次（file_id 复用）
+"""
+
+import io
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from media_encoder import (
+    EncodedImage,
+    OutboundPhotoCache,
+    encode_image,
+    encode_image_cached,
+    get_encoding_stats,
+)
+
+
+def _chart_like_png(path: Path, size=(1200, 600), mode: str = "RGB") -> Path:
+    """生成平涂色块 + 抗锯齿噪声的图表样图（无损 PNG 体积偏大，适合量化）"""
+    rng = np.random.default_rng(11)
+    pixels = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+    pixels[:] = (19, 23, 34)
+    for i in range(0, size[0], 8):
+        top = int(size[1] * (0.3 + 0.4 * rng.random()))
+        pixels[top:top + 40, i:i + 5] = (8, 153, 129) if rng.random() > 0.5 else (242, 54, 69)
+    pixels = np.clip(pixels.astype(int) + rng.integers(0, 3, pixels.shape), 0, 255).astype(np.uint8)
+    image = Image.fromarray(pixels)
+    if mode == "RGBA":
+        image = image.convert("RGBA")
+        image.putpixel((0, 0), (0, 0, 0, 0))
+    image.save(path, format="PNG")
+    return path
+
+
+class TestEncodeImage:
+    """测试各编码档位。"""
+
+    def test_palette_png_shrinks_chart(self, tmp_path: Path) -> None:
+        source = _chart_like_png(tmp_path / "AAPL_30d_0123456789ab.png")
+
+        encoded = encode_image(source, "telegram")
+
+        assert encoded.fmt == "png"
+        assert encoded.filename == "AAPL_30d_0123456789ab.png"
+        assert encoded.saved_ratio > 0.3
+        with Image.open(io.BytesIO(encoded.data)) as image:
+            assert image.mode == "P"
+            assert image.size == (1200, 600)
+
+    def test_lossy_targets_and_alpha_flatten(self, tmp_path: Path) -> None:
+        source = _chart_like_png(tmp_path / "table.png", mode="RGBA")
+
+        jpeg = encode_image(source, "telegram_jpeg")
+        webp = encode_image(source, "webp")
+
+        assert (jpeg.fmt, jpeg.filename) == ("jpeg", "table.jpg")
+        with Image.open(io.BytesIO(jpeg.data)) as image:
+            assert image.mode == "RGB"
+            assert image.getpixel((0, 0)) == pytest.approx((19, 23, 34), abs=12)
+        assert webp.fmt == "webp" and webp.encoded_bytes < webp.original_bytes
+
+    def test_downscales_retina_screenshot(self, tmp_path: Path) -> None:
+        source = _chart_like_png(tmp_path / "table_render.png", size=(3600, 900))
+
+        encoded = encode_image(source, "telegram")
+
+        assert (encoded.width, encoded.height) == (2560, 640)
+
+    def test_never_grows_and_rejects_unknown_target(self, tmp_path: Path) -> None:
+        tiny = tmp_path / "tiny.png"
+        Image.new("P", (4, 4)).save(tiny, format="PNG")
+
+        encoded = encode_image(tiny, "telegram_jpeg")
+        assert encoded.data == tiny.read_bytes()
+        assert (encoded.fmt, encoded.saved_bytes, encoded.filename) == ("png", 0, "tiny.png")
+
+        with pytest.raises(ValueError):
+            encode_image(tiny, "avif")
+
+
+class TestEncodeCacheAndReuse:
+    """测试编码缓存与广播复用。"""
+
+    def test_cache_hits_until_file_changes(self, tmp_path: Path) -> None:
+        source = _chart_like_png(tmp_path / "chart.png")
+        before = get_encoding_stats()
+
+        first = encode_image_cached(source, "telegram")
+        second = encode_image_cached(source, "telegram")
+        stats = get_encoding_stats()
+
+        assert first is second
+        assert stats["images"] == before["images"] + 1
+        assert stats["cache_hits"] == before["cache_hits"] + 1
+        assert stats["saved_bytes"] - before["saved_bytes"] == first.saved_bytes
+
+        _chart_like_png(source, size=(800, 400))
+        os.utime(source, ns=(source.stat().st_atime_ns, source.stat().st_mtime_ns + 1_000_000))
+        assert encode_image_cached(source, "telegram") is not first
+
+    def test_broadcast_uploads_each_photo_once(self, tmp_path: Path) -> None:
+        source = _chart_like_png(tmp_path / "chart.png")
+        photos = OutboundPhotoCache("telegram")
+
+        first = photos.resolve(source)
+        assert isinstance(first, EncodedImage)
+        photos.remember(source, "file-id-1")
+
+        assert [photos.resolve(source) for _ in range(3)] == ["file-id-1"] * 3
+        summary = photos.summary()
+        assert (summary["uploads"], summary["reused"]) == (1, 3)
+        assert summary["uploaded_bytes"] == first.encoded_bytes
+        assert summary["saved_bytes"] == first.saved_bytes
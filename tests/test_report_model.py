@@ -0,0 +1,113 @@
+"""
+结构化报告模型单元测试模块。
+
+本模块测试 report_model 的多渠道直出渲染：
+1. 持仓对账单 Markdown 输出与结构化数据一致
+2. 邮件 HTML / Telegram HTML 直出（转义、表格、加粗单元格）
+3. 大模型正文占位符拼接
+"""
+
+import sys
+from pathlib import Path
+from typing import Any, Dict
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from report_model import (
+    PORTFOLIO_REPORT_PLACEHOLDER,
+    Report,
+    Section,
+    Table,
+    render_with_report,
+)
+from valuation_engine import build_portfolio_report, format_portfolio_report
+
+
+def _sample_valuation() -> Dict[str, Any]:
+    return {
+        "exchange_rates": {"USD_CNY": 7.1, "HKD_CNY": 0.9},
+        "holdings": [
+            {
+                "ticker": "AAPL", "company_name": "苹果", "currency_symbol": "$", "current_price": 200.0,
+                "shares": 10, "native_cost_value": 1500.0, "native_market_value": 2000.0,
+                "market_value_cny": 14200.0, "profit_loss_cny": 3550.0, "profit_loss_percent": 33.33,
+            },
+            {"ticker": "TSLA", "company_name": "特斯拉", "error": "获取价格失败：<Timeout>"},
+        ],
+        "total_market_value": 14200.0,
+        "total_cost": 10650.0,
+        "total_profit_loss": 3550.0,
+        "profit_loss_percent": 33.33,
+        "calculation_time": "2026-03-09 15:00:00",
+    }
+
+
+class TestPortfolioReport:
+    """测试持仓对账单的结构化构建。"""
+
+    def test_markdown_matches_legacy_layout(self) -> None:
+        markdown_text = format_portfolio_report(_sample_valuation())
+        lines = markdown_text.split("\n")
+
+        assert lines[0] == "## 💰 持仓市值与盈亏对账单"
+        assert "**计算时间**: 2026-03-09 15:00:00" in lines
+        assert "- **总市值**: ¥14,200.00" in lines
+        assert "| 标的代码 | 公司名称 | 最新价 | 持仓成本 | 原生市值 | 折合人民币 (CNY) | 绝对盈亏 (CNY) | 盈亏率 |" in lines
+        assert "| AAPL | 苹果 | $200.00 | $150.00 | $2,000.00 | ¥14,200.00 | +3,550.00 | +33.33% |" in lines
+        assert "| **TSLA** | 特斯拉 | ❌ 获取价格失败：<Timeout> | - | - | - | - | - |" in lines
+        assert lines[-1] == "**【账户总计】当前折合总市值：¥14,200.00，累计总盈亏：+3,550.00**"
+
+    def test_structured_data_is_exposed(self) -> None:
+        report = build_portfolio_report(_sample_valuation())
+
+        assert report.metrics["total_market_value"] == 14200.0
+        assert len(report.tables) == 1
+        assert [row[0] for row in report.tables[0].rows] == ["AAPL", "TSLA"]
+
+
+class TestChannelRenderers:
+    """测试各渠道直出渲染。"""
+
+    def test_email_html_escapes_and_bolds(self) -> None:
+        email_html = build_portfolio_report(_sample_valuation()).to_email_html()
+
+        assert "<h2>💰 持仓市值与盈亏对账单</h2>" in email_html
+        assert "<td><strong>TSLA</strong></td>" in email_html
+        assert "&lt;Timeout&gt;" in email_html
+        assert "<li><strong>总市值</strong>: ¥14,200.00</li>" in email_html
+
+    def test_telegram_parts_split_tables(self) -> None:
+        report = build_portfolio_report(_sample_valuation())
+        parts = report.iter_telegram_parts()
+
+        assert [kind for kind, _ in parts] == ["text", "table", "text"]
+        assert "<blockquote><b>● 💰 持仓市值与盈亏对账单</b></blockquote>" in parts[0][1]
+        assert "🔹 <b>总市值</b>: ¥14,200.00" in parts[0][1]
+        assert isinstance(parts[1][1], Table)
+        assert "<b>【账户总计】" in parts[2][1]
+
+        single = report.to_telegram_html()
+        assert "<pre>标的代码 | 公司名称" in single
+
+
+class TestRenderWithReport:
+    """测试大模型正文与结构化报告的占位符拼接。"""
+
+    def test_placeholder_is_replaced(self) -> None:
+        report = Report(sections=[Section("对账单", level=2)])
+        text = f"# 研报\n\n{PORTFOLIO_REPORT_PLACEHOLDER}\n\n## 结论"
+
+        merged = render_with_report(text, report, render_text=lambda t: t, render_report=Report.to_markdown)
+
+        assert merged == "# 研报\n\n\n\n## 对账单\n\n\n\n## 结论"
+
+    def test_missing_placeholder_appends_report(self) -> None:
+        report = Report(sections=[Section("对账单", level=2)])
+
+        merged = render_with_report("正文", report, render_text=lambda t: t, render_report=Report.to_markdown)
+        assert merged == "正文\n\n## 对账单"
+
+        assert render_with_report(
+            PORTFOLIO_REPORT_PLACEHOLDER, None, render_text=lambda t: t, render_report=Report.to_markdown
+        ) == "\n\n暂无持仓数据\n\n"
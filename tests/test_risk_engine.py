@@ -0,0 +1,211 @@
+"""
+组合风险引擎单元测试模块。
+
+本模块测试 risk_engine 的向量化风险指标计算：
+1. 波动率 / Beta / VaR / 最大回撤 / 相关系数与逐列朴素算法的一致性
+2. 各标的自身数据区间与两两共同日期上的指标（短历史持仓不截短其他标的）
+3. 基于估值结果的组合风险汇总（Mock 日线历史）
+4. 100 标的 × 3 年规模下的计算耗时
+"""
+
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from risk_engine import (
+    build_price_matrix,
+    calculate_portfolio_risk,
+    compute_risk_metrics,
+    format_risk_report,
+    max_drawdown,
+    price_to_returns,
+    price_to_window_returns,
+)
+
+
+def _random_returns(t_obs: int, n_assets: int, seed: int = 7) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.normal(0.0005, 0.02, size=(t_obs, n_assets))
+
+
+class TestVectorizedMetrics:
+    """测试向量化指标与朴素逐列算法的一致性。"""
+
+    def test_matches_naive_computation(self) -> None:
+        returns = _random_returns(500, 4)
+        bench = returns[:, :1] * 0.5 + _random_returns(500, 1, seed=11) * 0.5
+        weights = np.array([0.4, 0.3, 0.2, 0.1])
+
+        metrics = compute_risk_metrics(returns, weights, bench)
+
+        for i in range(4):
+            col = returns[:, i]
+            assert metrics["volatility"][i] == pytest.approx(col.std(ddof=1) * np.sqrt(252))
+            assert metrics["var"][i] == pytest.approx(-np.percentile(col, 5))
+            expected_beta = np.cov(col, bench[:, 0])[0, 1] / bench[:, 0].var(ddof=1)
+            assert metrics["beta"][i, 0] == pytest.approx(expected_beta)
+
+        np.testing.assert_allclose(metrics["correlation"], np.corrcoef(returns.T), atol=1e-10)
+        portfolio_returns = returns @ weights
+        assert metrics["portfolio"]["volatility"] == pytest.approx(portfolio_returns.std(ddof=1) * np.sqrt(252))
+
+    def test_max_drawdown_known_path(self) -> None:
+        # 1.0 -> 1.1 -> 0.55 -> 0.66：峰值 1.1，谷底 0.55，回撤 50%
+        returns = np.array([[0.1], [-0.5], [0.2]])
+        assert max_drawdown(returns)[0] == pytest.approx(-0.5)
+
+    def test_price_to_returns_drops_missing_dates(self) -> None:
+        # 第 1 行未上市、第 3 行第二个标的休市：两行剔除，休市期间的涨幅计入下一个共同交易日
+        prices = np.array([[np.nan, 10.0], [5.0, 10.0], [5.5, np.nan], [6.0, 12.1]])
+        returns = price_to_returns(prices)
+        np.testing.assert_allclose(returns, [[0.2, 0.21]])
+
+    def test_window_returns_ignore_unlisted_periods(self) -> None:
+        # 第一个标的第 3 天才上市，不剔除之前的日期；第 4 行第二个标的休市（区间内缺价）仍整行剔除
+        prices = np.array([[np.nan, 10.0], [np.nan, 11.0], [5.0, 12.0], [5.5, np.nan], [6.0, 13.2]])
+        returns, keep = price_to_window_returns(prices)
+
+        np.testing.assert_array_equal(keep, [True, True, True, False, True])
+        np.testing.assert_allclose(returns, [[np.nan, 0.1], [np.nan, 12 / 11 - 1], [0.2, 0.1]])
+
+    def test_short_history_uses_own_and_pairwise_windows(self) -> None:
+        returns = _random_returns(300, 3)
+        bench = returns[:, :1] * 0.5 + _random_returns(300, 1, seed=11) * 0.5
+        returns[:270, 2] = np.nan  # 第三个标的只有最近 30 天
+
+        metrics = compute_risk_metrics(returns, np.array([0.5, 0.3, 0.2]), bench)
+
+        # 长历史标的的指标不受影响
+        full = compute_risk_metrics(returns[:, :2], np.array([0.6, 0.4]), bench)
+        assert metrics["volatility"][0] == pytest.approx(full["volatility"][0])
+        assert metrics["beta"][1, 0] == pytest.approx(full["beta"][1, 0])
+        assert metrics["correlation"][0, 1] == pytest.approx(full["correlation"][0, 1])
+        # 短历史标的按自身 30 天、与其他标的按共同 30 天计算
+        recent = returns[270:]
+        assert metrics["volatility"][2] == pytest.approx(recent[:, 2].std(ddof=1) * np.sqrt(252))
+        assert metrics["correlation"][0, 2] == pytest.approx(np.corrcoef(recent[:, 0], recent[:, 2])[0, 1])
+        expected_beta = np.cov(recent[:, 2], bench[270:, 0])[0, 1] / bench[270:, 0].var(ddof=1)
+        assert metrics["beta"][2, 0] == pytest.approx(expected_beta)
+        assert metrics["observations"].tolist() == [300, 300, 30]
+        assert metrics["portfolio"]["observations"] == 30
+
+    def test_100_holdings_3_years_runs_in_milliseconds(self) -> None:
+        returns = _random_returns(756, 100)
+        bench = _random_returns(756, 4, seed=3)
+        weights = np.full(100, 0.01)
+
+        compute_risk_metrics(returns, weights, bench)  # 预热
+        start = time.perf_counter()
+        compute_risk_metrics(returns, weights, bench)
+        elapsed = time.perf_counter() - start
+
+        assert elapsed < 0.2
+
+
+class TestPriceMatrix:
+    """测试跨市场交易日历的对齐。"""
+
+    def test_union_calendar_without_fill(self) -> None:
+        history = {
+            "AAPL": pd.DataFrame({"Close": [1.0, 2.0]}, index=pd.to_datetime(["2026-01-02", "2026-01-05"])),
+            "0700.HK": pd.DataFrame({"Close": [3.0, 4.0]}, index=pd.to_datetime(["2026-01-02", "2026-01-06"])),
+        }
+        prices, _, _ = build_price_matrix(history, ["AAPL", "0700.HK"], fill=False)
+
+        assert np.isnan(prices[1, 1]) and np.isnan(prices[2, 0])
+
+    def test_union_calendar_forward_fill(self) -> None:
+        history = {
+            "AAPL": pd.DataFrame({"Close": [1.0, 2.0]}, index=pd.to_datetime(["2026-01-02", "2026-01-05"])),
+            "0700.HK": pd.DataFrame({"Close": [3.0, 4.0]}, index=pd.to_datetime(["2026-01-02", "2026-01-06"])),
+        }
+        prices, columns, dates = build_price_matrix(history, ["AAPL", "0700.HK", "MISSING"])
+
+        assert columns == ["AAPL", "0700.HK"]
+        assert len(dates) == 3
+        np.testing.assert_allclose(prices[:, 1], [3.0, 3.0, 4.0])
+
+
+class TestCalculatePortfolioRisk:
+    """测试基于估值结果的组合风险汇总。"""
+
+    @patch('risk_engine.fetch_price_history')
+    def test_portfolio_risk_from_valuation(self, mock_history: MagicMock) -> None:
+        dates = pd.bdate_range("2025-01-01", periods=120)
+        rng = np.random.default_rng(1)
+
+        def make_frame() -> pd.DataFrame:
+            return pd.DataFrame({"Close": 100 * np.cumprod(1 + rng.normal(0, 0.01, len(dates)))}, index=dates)
+
+        mock_history.return_value = {
+            "AAPL": make_frame(),
+            "600519.SS": make_frame(),
+            "000300.SS": make_frame(),
+            "^NDX": make_frame(),
+        }
+        valuation: Dict[str, Any] = {
+            "holdings": [
+                {"ticker": "AAPL", "company_name": "苹果", "market_value_cny": 75000.0},
+                {"ticker": "600519", "company_name": "茅台", "market_value_cny": 25000.0},
+                {"ticker": "0700.HK", "error": "获取价格失败"},
+            ]
+        }
+
+        risk = calculate_portfolio_risk(valuation)
+
+        assert risk["observations"] == 119
+        assert risk["benchmarks"] == ["沪深 300", "纳斯达克 100"]
+        weights = {row["ticker"]: row["weight"] for row in risk["holdings"]}
+        assert weights == {"AAPL": 0.75, "600519.SS": 0.25}
+        assert risk["portfolio"]["var_cny"] == pytest.approx(risk["portfolio"]["var"] * 100000, rel=1e-2)
+        assert len(risk["correlation"]["matrix"]) == 2
+
+        report = format_risk_report(risk)
+        assert "组合年化波动率" in report
+        assert "| AAPL | 苹果 | 75.00% |" in report
+
+    @patch('risk_engine.fetch_price_history')
+    def test_short_history_holding_is_reported_not_fatal(self, mock_history: MagicMock) -> None:
+        dates = pd.bdate_range("2025-01-01", periods=120)
+        rng = np.random.default_rng(2)
+
+        def make_frame(periods: int) -> pd.DataFrame:
+            return pd.DataFrame(
+                {"Close": 100 * np.cumprod(1 + rng.normal(0, 0.01, periods))}, index=dates[-periods:]
+            )
+
+        mock_history.return_value = {"AAPL": make_frame(120), "MSFT": make_frame(40), "NEWCO": make_frame(10)}
+        valuation = {
+            "holdings": [
+                {"ticker": "AAPL", "company_name": "苹果", "market_value_cny": 60000.0},
+                {"ticker": "MSFT", "company_name": "微软", "market_value_cny": 30000.0},
+                {"ticker": "NEWCO", "company_name": "新股", "market_value_cny": 10000.0},
+            ]
+        }
+
+        risk = calculate_portfolio_risk(valuation)
+
+        assert risk["short_history"] == {"NEWCO": 9}
+        assert risk["missing_history"] == []
+        assert {row["ticker"]: row["observations"] for row in risk["holdings"]} == {"AAPL": 119, "MSFT": 39}
+        assert risk["observations"] == 39
+        report = format_risk_report(risk)
+        assert "NEWCO（9 个交易日）" in report
+        assert "MSFT（39 个交易日）" in report
+
+    @patch('risk_engine.fetch_price_history')
+    def test_insufficient_history_returns_empty(self, mock_history: MagicMock) -> None:
+        mock_history.return_value = {}
+        valuation = {"holdings": [{"ticker": "AAPL", "market_value_cny": 100.0}]}
+
+        assert calculate_portfolio_risk(valuation) == {}
+        assert "暂无" in format_risk_report({})
@@ -0,0 +1,145 @@
+"""
+压力测试引擎单元测试模块。
+
+本模块测试 scenario_engine 的情景网格重估：
+1. 冲击参数解析（单值 / 列表 / 区间 / 单票覆盖）与未持有的覆盖代码识别
+2. 分市场股价冲击、汇率冲击与单票覆盖的重估结果与逐情景朴素算法一致
+3. 数千情景规模下的计算耗时
+"""
+
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict
+
+import numpy as np
+import pytest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from scenario_engine import (
+    build_shock_grid,
+    format_stress_report,
+    parse_shock_spec,
+    parse_ticker_overrides,
+    revalue_portfolio,
+    unknown_override_tickers,
+)
+
+
+def _sample_valuation() -> Dict[str, Any]:
+    """构造与 calculate_portfolio_valuation 返回结构一致的估值字典"""
+    return {
+        "exchange_rates": {"USD_CNY": 7.2, "HKD_CNY": 0.92, "CNY_CNY": 1.0},
+        "holdings": [
+            {"ticker": "AAPL", "company_name": "苹果", "currency": "USD", "native_market_value": 10000.0},
+            {"ticker": "0700.HK", "company_name": "腾讯", "currency": "HKD", "native_market_value": 50000.0},
+            {"ticker": "600519", "company_name": "茅台", "currency": "CNY", "native_market_value": 30000.0},
+            {"ticker": "TSLA", "error": "获取价格失败"},
+        ],
+    }
+
+
+class TestParseShockSpec:
+    """测试冲击参数解析。"""
+
+    def test_single_list_and_range(self) -> None:
+        assert parse_shock_spec("-10") == [-0.1]
+        assert parse_shock_spec("-10, -5，0") == [-0.1, -0.05, 0.0]
+        assert parse_shock_spec("-20:0:5") == pytest.approx([-0.2, -0.15, -0.1, -0.05, 0.0])
+        assert parse_shock_spec("") == [0.0]
+
+    def test_invalid_range_raises(self) -> None:
+        with pytest.raises(ValueError):
+            parse_shock_spec("-20:0:0")
+        with pytest.raises(ValueError):
+            parse_shock_spec("-20:0")
+
+    def test_ticker_overrides(self) -> None:
+        overrides = parse_ticker_overrides("0700.hk=-15; AAPL=-10,0")
+        assert overrides == {"0700.HK": [-0.15], "AAPL": [-0.1, 0.0]}
+        with pytest.raises(ValueError):
+            parse_ticker_overrides("AAPL-10")
+
+    def test_unknown_override_tickers(self) -> None:
+        factor_values = {"HK": [-0.1], "USD_CNY": [0.0]}
+        factor_values.update(parse_ticker_overrides("00700.HK=-15;aapl=-10;tsla=-5;NVDA=-20"))
+        names, _ = build_shock_grid(factor_values)
+
+        # 查价失败的 TSLA 仍属于持仓；00700.HK 与持仓 0700.HK 写法不同，不会生效
+        assert unknown_override_tickers(_sample_valuation(), names) == ["00700.HK", "NVDA"]
+
+
+class TestRevaluePortfolio:
+    """测试向量化重估与朴素算法的一致性。"""
+
+    def test_single_scenario_hkd_and_hang_seng(self) -> None:
+        valuation = _sample_valuation()
+        names, grid = build_shock_grid({"HK": [-0.10], "HKD_CNY": [-0.03]})
+
+        result = revalue_portfolio(valuation, names, grid)
+
+        base = 10000 * 7.2 + 50000 * 0.92 + 30000
+        expected = 10000 * 7.2 + 50000 * 0.9 * 0.92 * 0.97 + 30000
+        assert result["tickers"] == ["AAPL", "0700.HK", "600519"]
+        assert result["base_total"] == pytest.approx(base)
+        assert result["totals"][0] == pytest.approx(expected)
+
+    def test_grid_matches_naive_loop(self) -> None:
+        valuation = _sample_valuation()
+        names, grid = build_shock_grid({
+            "US": [-0.2, 0.0],
+            "HK": [-0.1, 0.05],
+            "USD_CNY": [-0.03, 0.02],
+            "0700.HK": [-0.3, 0.0],
+        })
+        assert grid.shape == (16, 4)
+
+        result = revalue_portfolio(valuation, names, grid)
+
+        for s, (us, hk, usd, tencent) in enumerate(grid):
+            # 单票覆盖优先于所属市场冲击，港股市场冲击对腾讯不生效
+            expected = 10000 * (1 + us) * 7.2 * (1 + usd) + 50000 * (1 + tencent) * 0.92 + 30000
+            assert result["totals"][s] == pytest.approx(expected)
+
+    def test_too_many_scenarios_raises(self) -> None:
+        with pytest.raises(ValueError):
+            build_shock_grid({"US": list(range(100)), "HK": list(range(100)), "CN": list(range(100))})
+
+    def test_thousands_of_scenarios_run_fast(self) -> None:
+        valuation = _sample_valuation()
+        valuation["holdings"] = [
+            {"ticker": f"T{i}", "currency": ("USD", "HKD", "CNY")[i % 3], "native_market_value": 1000.0 + i}
+            for i in range(50)
+        ]
+        names, grid = build_shock_grid({
+            "US": parse_shock_spec("-30:0:3"),
+            "HK": parse_shock_spec("-30:0:3"),
+            "USD_CNY": parse_shock_spec("-5:5:1"),
+            "HKD_CNY": parse_shock_spec("-5:5:2"),
+        })
+        assert grid.shape[0] == 11 * 11 * 11 * 6
+
+        start = time.perf_counter()
+        result = revalue_portfolio(valuation, names, grid)
+        elapsed = time.perf_counter() - start
+
+        assert elapsed < 0.5
+        assert np.all(np.isfinite(result["totals"]))
+
+
+class TestFormatStressReport:
+    """测试报告格式化。"""
+
+    def test_single_and_grid_reports(self) -> None:
+        valuation = _sample_valuation()
+        names, grid = build_shock_grid({"HK": [-0.10], "HKD_CNY": [-0.03]})
+        report = format_stress_report(valuation, names, grid, revalue_portfolio(valuation, names, grid), 1.0)
+        assert "港股 -10.00%, HKD/CNY -3.00%" in report
+        assert "| 0700.HK | 腾讯 |" in report
+
+        names, grid = build_shock_grid({"US": [-0.2, 0.0], "HK": [-0.1, 0.0]})
+        report = format_stress_report(valuation, names, grid, revalue_portfolio(valuation, names, grid), 1.0)
+        assert "最差 4 个情景" in report
+        assert "| 1 | 美股 -20.00%, 港股 -10.00% |" in report
@@ -401,3 +401,341 @@ class TestExchangeRatesMock:
             expected_mv = 200.0 * 100 * 7.25
             assert result["total_market_value"] == pytest.approx(expected_mv, rel=1e-2)
             assert result["exchange_rates"] == custom_rates
+
+
+class TestValuationDeadline:
+    """测试常驻线程池与整体估值截止时间的缓存降级。"""
+
+    @patch('valuation_engine._load_history_cache', return_value=None)
+    @patch('valuation_engine.fetch_stock_price_raw')
+    @patch('valuation_engine.fetch_exchange_rates')
+    def test_slow_holding_falls_back_to_cached_price(
+        self,
+        mock_fetch_rates: MagicMock,
+        mock_fetch_stock: MagicMock,
+        mock_history_cache: MagicMock
+    ) -> None:
+        """
+        测试慢请求不阻塞整体估值。
+        
+        断言:
+        - 超时持仓使用最近一次成功查价的缓存价格，并标记 stale
+        - 无任何缓存的超时持仓返回 error 行，不计入总市值
+        - Markdown 报告中标注过期价格
+        """
+        import threading
+        import valuation_engine
+        from valuation_engine import format_portfolio_report, get_valuation_executor
+
+        mock_fetch_rates.return_value = {"USD_CNY": 7.0, "HKD_CNY": 0.9, "CNY_CNY": 1.0}
+        release = threading.Event()
+
+        def stock_price_side_effect(ticker: str, date: str | None = None) -> Dict[str, Any]:
+            if ticker in ("0700.HK", "TSLA"):
+                release.wait(5)
+                raise TimeoutError("akshare hung")
+            return {"ticker": ticker, "open": 198.0, "close": 200.0, "date": "2026-03-09"}
+
+        mock_fetch_stock.side_effect = stock_price_side_effect
+        valuation_engine._record_last_quote("0700.HK", 300.0)
+
+        positions: Dict[str, Dict[str, Any]] = {
+            "AAPL": {"shares": 100, "cost_basis": 150.0},
+            "0700.HK": {"shares": 50, "cost_basis": 280.0, "company_name": "腾讯"},
+            "TSLA": {"shares": 10, "cost_basis": 100.0},
+        }
+
+        try:
+            result = calculate_portfolio_valuation(positions, deadline=0.2)
+        finally:
+            release.set()
+
+        holdings_by_ticker = {h["ticker"]: h for h in result["holdings"]}
+        assert holdings_by_ticker["AAPL"].get("stale") is None
+        assert holdings_by_ticker["0700.HK"]["stale"] is True
+        assert holdings_by_ticker["0700.HK"]["current_price"] == 300.0
+        assert "error" in holdings_by_ticker["TSLA"]
+        assert result["stale_tickers"] == ["0700.HK"]
+        assert result["total_market_value"] == pytest.approx(200.0 * 100 * 7.0 + 300.0 * 50 * 0.9)
+
+        report = format_portfolio_report(result)
+        assert "HK$300.00 ⏳" in report
+        assert "已使用最近缓存价格估值：0700.HK" in report
+
+        # 常驻线程池跨调用复用
+        assert get_valuation_executor() is get_valuation_executor()
+
+
+    @patch('valuation_engine._load_history_cache', return_value=None)
+    @patch('valuation_engine.fetch_stock_price_raw')
+    @patch('valuation_engine.fetch_exchange_rates')
+    def test_late_requests_are_not_resubmitted_and_rates_share_deadline(
+        self,
+        mock_fetch_rates: MagicMock,
+        mock_fetch_stock: MagicMock,
+        mock_history_cache: MagicMock
+    ) -> None:
+        """
+        测试迟到请求不堆积、汇率受同一截止时间约束。
+        
+        断言:
+        - 汇率超时时使用最近一次成功汇率并标记 exchange_rates_stale
+        - 上一次估值仍在执行的查价不会被重复投递
+        """
+        import threading
+        import valuation_engine
+
+        release = threading.Event()
+        valuation_engine._last_exchange_rates = {"USD_CNY": 7.1, "HKD_CNY": 0.91, "CNY_CNY": 1.0}
+
+        def slow_rates() -> Dict[str, float]:
+            release.wait(5)
+            return {"USD_CNY": 7.2, "HKD_CNY": 0.92, "CNY_CNY": 1.0}
+
+        def slow_stock(ticker: str, date: str | None = None) -> Dict[str, Any]:
+            release.wait(5)
+            return {"ticker": ticker, "close": 200.0}
+
+        mock_fetch_rates.side_effect = slow_rates
+        mock_fetch_stock.side_effect = slow_stock
+        valuation_engine._record_last_quote("NVDA", 100.0)
+        positions = {"NVDA": {"shares": 10, "cost_basis": 90.0}}
+
+        try:
+            first = calculate_portfolio_valuation(positions, deadline=0.1)
+            second = calculate_portfolio_valuation(positions, deadline=0.1)
+        finally:
+            release.set()
+
+        assert first["exchange_rates_stale"] is True
+        assert first["exchange_rates"]["USD_CNY"] == 7.1
+        assert second["holdings"][0]["current_price"] == 100.0
+        assert mock_fetch_stock.call_count == 1
+        assert mock_fetch_rates.call_count == 1
+        assert first["exchange_rates_source"] == "last_known"
+
+    @patch('valuation_engine.fetch_exchange_rates')
+    def test_rates_timeout_without_history_uses_labeled_defaults(self, mock_fetch_rates: MagicMock) -> None:
+        """
+        测试汇率超时且从未成功获取过汇率时，明确标注使用了内置默认汇率。
+        
+        断言:
+        - exchange_rates_source 为 default，汇率等于 DEFAULT_EXCHANGE_RATES
+        - 报告提示默认汇率可能偏差较大，而不是「最近一次汇率」
+        """
+        import threading
+        import valuation_engine
+        from valuation_engine import DEFAULT_EXCHANGE_RATES, build_portfolio_report
+
+        release = threading.Event()
+        valuation_engine._last_exchange_rates = None
+
+        def slow_rates() -> Dict[str, float]:
+            release.wait(5)
+            return {"USD_CNY": 7.2, "HKD_CNY": 0.92, "CNY_CNY": 1.0}
+
+        mock_fetch_rates.side_effect = slow_rates
+
+        try:
+            valuation = calculate_portfolio_valuation({}, deadline=0.1)
+        finally:
+            release.set()
+
+        assert valuation["exchange_rates_source"] == "default"
+        assert valuation["exchange_rates"] == DEFAULT_EXCHANGE_RATES
+        report = build_portfolio_report(valuation).to_markdown()
+        assert "内置默认汇率" in report
+        assert "最近一次汇率" not in report
+
+
+class TestValuationCache:
+    """测试估值结果的短时缓存与失效。"""
+
+    @pytest.fixture(autouse=True)
+    def _clear_cache(self):
+        from valuation_engine import invalidate_valuation_cache
+        invalidate_valuation_cache()
+        yield
+        invalidate_valuation_cache()
+
+    @patch('valuation_engine.calculate_portfolio_valuation')
+    def test_repeat_request_hits_cache_with_original_time(self, mock_calculate: MagicMock) -> None:
+        """
+        测试短时间内重复估值直接命中缓存。
+        
+        断言:
+        - 相同持仓只计算一次，返回原始计算时间并标记 cache_hit
+        - 持仓变化或显式失效后重新计算
+        """
+        from valuation_engine import build_portfolio_report, get_cached_portfolio_valuation, invalidate_valuation_cache
+
+        mock_calculate.return_value = {
+            "total_market_value": 100.0, "total_cost": 80.0, "total_profit_loss": 20.0,
+            "profit_loss_percent": 25.0, "holdings": [], "exchange_rates": {},
+            "calculation_time": "2026-03-09 15:00:00",
+        }
+        positions = {"AAPL": {"shares": 1, "cost_basis": 80.0}}
+
+        first = get_cached_portfolio_valuation(positions)
+        second = get_cached_portfolio_valuation({"AAPL": {"cost_basis": 80.0, "shares": 1}})
+
+        assert mock_calculate.call_count == 1
+        assert "cache_hit" not in first
+        assert second["cache_hit"] is True
+        assert second["calculation_time"] == "2026-03-09 15:00:00"
+        assert "缓存结果" in build_portfolio_report(second).to_markdown()
+
+        get_cached_portfolio_valuation({"AAPL": {"shares": 2, "cost_basis": 80.0}})
+        assert mock_calculate.call_count == 2
+
+        invalidate_valuation_cache()
+        get_cached_portfolio_valuation(positions)
+        assert mock_calculate.call_count == 3
+
+    @patch('valuation_engine.calculate_portfolio_valuation')
+    def test_new_quote_snapshot_or_ttl_expiry_recomputes(self, mock_calculate: MagicMock) -> None:
+        """
+        测试行情快照版本变化或 TTL 过期后缓存失效。
+        """
+        import valuation_engine
+        from valuation_engine import get_cached_portfolio_valuation
+
+        mock_calculate.return_value = {"holdings": [], "calculation_time": "t"}
+        positions = {"AAPL": {"shares": 1, "cost_basis": 80.0}}
+
+        get_cached_portfolio_valuation(positions)
+        valuation_engine._record_last_quote("AAPL", 123456.0)
+        get_cached_portfolio_valuation(positions)
+        assert mock_calculate.call_count == 2
+
+        get_cached_portfolio_valuation(positions, ttl=-1)
+        assert mock_calculate.call_count == 3
+
+    @patch('valuation_engine.calculate_portfolio_valuation')
+    def test_late_quote_during_calculation_invalidates(self, mock_calculate: MagicMock) -> None:
+        """
+        测试估值期间到达的迟到查价让缓存失效，而估值自身写入的查价不会。
+        """
+        import valuation_engine
+        from valuation_engine import get_cached_portfolio_valuation
+
+        def calculate(positions: Dict[str, Any]) -> Dict[str, Any]:
+            # AAPL 实时查价成功（自身写入）；TSLA 超时降级，其迟到查价在估值结束前返回
+            valuation_engine._record_last_quote("AAPL", 201.0)
+            valuation_engine._record_last_quote("TSLA", 99.0)
+            return {
+                "holdings": [
+                    {"ticker": "AAPL", "current_price": 201.0},
+                    {"ticker": "TSLA", "current_price": 90.0, "stale": True},
+                ],
+                "calculation_time": "t",
+            }
+
+        mock_calculate.side_effect = calculate
+        valuation_engine._record_last_quote("TSLA", 90.0)
+        positions = {"AAPL": {"shares": 1, "cost_basis": 80.0}, "TSLA": {"shares": 1, "cost_basis": 80.0}}
+
+        get_cached_portfolio_valuation(positions)
+        get_cached_portfolio_valuation(positions)
+        assert mock_calculate.call_count == 2
+
+        # 第二次估值期间缓存价格没有外部变化：之后的请求命中
+        assert get_cached_portfolio_valuation(positions)["cache_hit"] is True
+
+    @patch('valuation_engine.calculate_portfolio_valuation')
+    def test_concurrent_requests_compute_once(self, mock_calculate: MagicMock) -> None:
+        """
+        测试并发的重复请求只触发一次真实估值。
+        """
+        import threading
+        import time as _time
+        from concurrent.futures import ThreadPoolExecutor
+        from valuation_engine import get_cached_portfolio_valuation
+
+        def slow_calculate(positions: Dict[str, Any]) -> Dict[str, Any]:
+            _time.sleep(0.2)
+            return {"holdings": [], "calculation_time": "t"}
+
+        mock_calculate.side_effect = slow_calculate
+        positions = {"AAPL": {"shares": 1, "cost_basis": 80.0}}
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(lambda _: get_cached_portfolio_valuation(positions), range(4)))
+
+        assert mock_calculate.call_count == 1
+        assert sum(1 for r in results if r.get("cache_hit")) == 3
+
+
+class TestPortfolioChart:
+    """测试多标的走势总览图的批量生成。"""
+
+    @patch('valuation_engine.render_small_multiples_cached')
+    @patch('valuation_engine.fetch_price_history')
+    def test_single_batch_fetch_and_one_render(self, mock_fetch: MagicMock, mock_render: MagicMock, tmp_path: Path) -> None:
+        """
+        测试多标的只批量拉取一次历史、只渲染一张图。
+        
+        断言:
+        - 重复代码去重，无历史数据的标的记入 missing
+        - 摘要包含最新收盘价与区间涨跌幅
+        """
+        import pandas as pd
+        from valuation_engine import generate_portfolio_chart
+
+        index = pd.bdate_range("2026-01-01", periods=3)
+        mock_fetch.return_value = {
+            "AAPL": pd.DataFrame({"Close": [100.0, 105.0, 110.0]}, index=index),
+            "TSLA": pd.DataFrame(),
+        }
+        mock_render.return_value = (tmp_path / "portfolio_90d_0123456789ab.png", False)
+
+        result = generate_portfolio_chart(["AAPL", "TSLA", "AAPL"], tmp_path, 90)
+
+        mock_fetch.assert_called_once_with(["AAPL", "TSLA"], days=90)
+        assert mock_render.call_count == 1
+        assert list(mock_render.call_args[0][0]) == ["AAPL"]
+        assert result["tickers"] == ["AAPL"]
+        assert result["missing"] == ["TSLA"]
+        assert result["summary"]["AAPL"] == {"latest_close": 110.0, "change_percent": 10.0}
+        assert result["file_name"] == "portfolio_90d_0123456789ab.png"
+
+    @patch('valuation_engine.fetch_price_history', return_value={})
+    def test_no_history_raises(self, mock_fetch: MagicMock, tmp_path: Path) -> None:
+        from valuation_engine import generate_portfolio_chart
+
+        with pytest.raises(IndexError):
+            generate_portfolio_chart(["AAPL"], tmp_path)
+
+
+class TestHistoryCache:
+    """测试日线历史硬盘缓存的合并写入。"""
+
+    def test_short_refresh_keeps_earlier_history(self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+        """
+        测试短回看窗口的刷新不截短长窗口缓存。
+        
+        断言:
+        - 与已有缓存首尾相接时保留更早的数据与起始日期
+        - 与已有缓存之间有空档时只保留新数据
+        """
+        import pandas as pd
+        from valuation_engine import _load_history_cache, _save_history_cache
+
+        monkeypatch.setattr("valuation_engine.HISTORY_CACHE_DIR", tmp_path)
+        long_index = pd.bdate_range("2025-01-01", "2025-12-31")
+        _save_history_cache("AAPL", "2025-01-01", pd.DataFrame({"Close": 1.0}, index=long_index))
+
+        recent_index = pd.bdate_range("2025-12-01", "2026-01-09")
+        _save_history_cache("AAPL", "2025-12-01", pd.DataFrame({"Close": 2.0}, index=recent_index))
+
+        cached = _load_history_cache("AAPL")
+        assert cached["start"] == "2025-01-01"
+        assert cached["data"].index[0] == long_index[0]
+        assert cached["data"].index[-1] == recent_index[-1]
+        assert (cached["data"].loc["2025-12-01":, "Close"] == 2.0).all()
+        assert cached["data"].index.is_unique
+
+        gap_index = pd.bdate_range("2026-06-01", "2026-06-30")
+        _save_history_cache("AAPL", "2026-06-01", pd.DataFrame({"Close": 3.0}, index=gap_index))
+
+        assert _load_history_cache("AAPL")["start"] == "2026-06-01"
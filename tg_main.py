@@ -1,4 +1,5 @@
 import ast
+import html
 import os
 import re
 import time
@@ -11,7 +12,7 @@ import uuid
 from filelock import FileLock
 from datetime import datetime
 from pathlib import Path
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, BotCommand, Bot
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, BotCommand, Bot, InputFile
 from telegram.constants import ParseMode, ChatAction
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 from dotenv import load_dotenv
@@ -29,8 +30,13 @@ from playwright.async_api import async_playwright
 from langchain_core.callbacks import AsyncCallbackHandler
 
 # 🌟 无缝引入咱们精心打磨的底层 Agent 引擎
-from main import agent_with_chat_history, get_user_profile
-from valuation_engine import fetch_stock_price_raw
+from main import agent_with_chat_history, get_user_profile, _load_profile_positions, _list_kb_file_names, index_kb_file
+from valuation_engine import fetch_stock_price_raw, get_cached_portfolio_valuation, build_portfolio_report
+from chart_engine import get_chart_pool, load_chart_series, render_kline_chart_cached
+from media_encoder import EncodedImage, OutboundPhotoCache, encode_image_cached
+from kb_engine import EmbeddingUnavailableError, get_vectorstore_cache_stats, invalidate_vectorstore
+from kb_indexer import enqueue_kb_file, get_index_queue, start_indexing_worker
+from report_model import Report, Table, table_to_html, table_to_telegram_pre, split_report_placeholder
 
 
 
@@ -160,6 +166,24 @@ async def post_init(application: Application):
         BotCommand("alert", "🔔 设定盯盘价格预警"),
     ])
     logger.info("✅ 左下角全局菜单 (Bot Commands) 注入成功！")
+    
+    # 🎨 预热绘图进程池：启动阶段拉起 worker 并完成 mplfinance 导入，首张 K 线图无需冷启动
+    try:
+        await asyncio.to_thread(get_chart_pool().warm_up)
+    except Exception as e:
+        logger.warning(f"⚠️ 绘图进程池预热失败，将在首次绘图时懒加载：{e}")
+
+    # 📚 启动后台索引 worker：补录从未排队过的存量文件，盘后日报进程投递的任务由 worker 轮询领取
+    try:
+        # 向量服务冷却期内的失败只推迟任务，不消耗重试次数
+        start_indexing_worker(index_kb_file, transient_errors=(EmbeddingUnavailableError,))
+        known = await asyncio.to_thread(get_index_queue().all_status)
+        backlog = [name for name in await asyncio.to_thread(_list_kb_file_names) if name not in known]
+        for name in backlog:
+            await asyncio.to_thread(enqueue_kb_file, name, "backfill")
+        logger.info(f"✅ 后台索引 worker 已启动（补录 {len(backlog)} 份存量文件）")
+    except Exception as e:
+        logger.warning(f"⚠️ 后台索引 worker 启动失败，知识库将在首次检索时现场建索引：{e}")
 
 
 @authorized
@@ -180,21 +204,13 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @authorized
 async def portfolio_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    快捷路由：个人持仓与盈亏盘点（调用大模型）
+    快捷路由：个人持仓与盈亏盘点（宏指令直通，绕过大模型）
     
     Args:
         update: Telegram Update 对象
         context: Telegram Context 对象
     """
-    message = update.message
-    
-    # 调用大模型处理持仓核算
-    user_msg = "帮我精确计算当前总市值和持仓盈亏，并生成财务明细报表。"
-    await message.reply_text(
-        f"<blockquote><b>⚡ 原生菜单指令注入：</b>\n<i>精确核算总市值</i></blockquote>",
-        parse_mode=ParseMode.HTML
-    )
-    await execute_agent_task(user_msg, message, update.effective_user.id, context, update)
+    await run_portfolio_macro(update.message)
 
 
 async def _dispatch_report_task(message: Message, job_id: str) -> None:
@@ -266,21 +282,13 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @authorized
 async def kb_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    快捷路由：调阅历史情报档案（调用大模型）
+    快捷路由：调阅历史情报档案（宏指令直通，绕过大模型）
     
     Args:
         update: Telegram Update 对象
         context: Telegram Context 对象
     """
-    message = update.message
-    
-    # 调用大模型处理知识库查询
-    user_msg = "列出知识库里现在有哪些文件可以读取？"
-    await message.reply_text(
-        f"<blockquote><b>⚡ 原生菜单指令注入：</b>\n<i>查看知识库文件</i></blockquote>",
-        parse_mode=ParseMode.HTML
-    )
-    await execute_agent_task(user_msg, message, update.effective_user.id, context, update)
+    await run_kb_list_macro(update.message)
 
 
 @authorized
@@ -344,6 +352,8 @@ class AsyncTelegramCallbackHandler(AsyncCallbackHandler):
             "get_etf_price": "📊 正在拉取 ETF 基金核心数据...",
             # 绘图引擎类
             "draw_universal_stock_chart": "🎨 正在启动绘图引擎渲染 K 线...",
+            "draw_portfolio_chart": "🧩 正在批量拉取历史并拼版多标的走势总览...",
+            "compare_stocks_chart": "⚖️ 正在归一化多标的走势并计算对比统计...",
             # 搜索类
             "search_company_ticker": "🔍 正在全网检索股票代码...",
             # 文件操作类
@@ -352,11 +362,15 @@ class AsyncTelegramCallbackHandler(AsyncCallbackHandler):
             "list_kb_files": "🗂️ 正在扫描知识库文件索引...",
             # RAG 检索类
             "analyze_local_document": "📚 正在穿透本地向量库检索研报...",
+            "search_knowledge_base": "🗃️ 正在跨文档检索整个知识库...",
             # 记忆系统类
             "update_user_memory": "🧠 正在将关键信息写入长期记忆库...",
             "append_transaction_log": "📜 正在追加交易日志流水账...",
+            "get_ledger_positions": "📒 正在回放交易流水推导持仓成本...",
             # 财务计算类
             "calculate_exact_portfolio_value": "🧮 正在使用程序精确核算财务数据...",
+            "run_stress_test": "🌪️ 正在向量化重估压力测试情景网格...",
+            "run_portfolio_backtest": "⏪ 正在按历史汇率向量化回放组合净值...",
             # 研报任务类
             "trigger_daily_report": "🚀 正在将研报任务投递至独立进程...",
             "query_job_status": "📡 正在追踪后台任务执行状态..."
@@ -372,6 +386,51 @@ class AsyncTelegramCallbackHandler(AsyncCallbackHandler):
         await self._safe_edit(ui_text)
 
 
+# 👑 极客级 CSS：暗黑金融终端质感（Markdown 表格截图与结构化报告表格截图共用）
+TABLE_IMAGE_CSS = """
+:root { --bg: #1A1D21; --border: #2D3239; --text: #E3E5E8; --header-bg: #22262B; --stripe: #1E2126; }
+html, body {
+    background-color: var(--bg);
+    font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, "Helvetica Neue", Arial, sans-serif, "Apple Color Emoji", "Segoe UI Emoji", "Segoe UI Symbol";
+    margin: 0; padding: 20px;
+    -webkit-font-smoothing: antialiased;
+    -moz-osx-font-smoothing: grayscale;
+}
+#capture_area {
+    /* 🌟 核心修复 1：摒弃 inline-block，使用 max-content 绝对贴合内容 */
+    width: max-content; 
+    background-color: var(--bg); 
+    padding: 16px;
+    border: 1px solid var(--border);
+    /* 🌟 核心修复 2：更改盒模型计算方式，防止 padding 引起的亚像素抖动 */
+    box-sizing: border-box;
+    /* 🌟 核心修复 3：暴力裁切，把超出整数边界的 0.x 像素底色直接切掉 */
+    overflow: hidden;
+}
+table { border-collapse: collapse; color: var(--text); font-size: 14px; margin: 0; }
+th, td { padding: 12px 16px; text-align: left; border-bottom: 1px solid var(--border); }
+th {
+    background-color: var(--header-bg); font-weight: 600; color: #A0A5AD;
+    text-transform: uppercase; font-size: 12px; letter-spacing: 0.5px;
+}
+tr:last-child td { border-bottom: none; }
+tr:nth-child(even) td { background-color: var(--stripe); }
+"""
+
+
+async def _screenshot_table_html(page, html_table: str, img_path: Path) -> None:
+    """将一段 <table> HTML 注入已打开的无头浏览器页面，并对表格区域做像素级裁切截图"""
+    full_html = f"<!DOCTYPE html><html><head><style>{TABLE_IMAGE_CSS}</style></head><body><div id='capture_area'>{html_table}</div></body></html>"
+    await page.set_content(full_html)
+    
+    element = await page.wait_for_selector('#capture_area')
+    
+    # 🌟 终极防线：注入 JS 计算真实亚像素宽度，并向上取整锁定物理像素，彻底封死右侧缝隙！
+    await element.evaluate("el => el.style.width = Math.ceil(el.getBoundingClientRect().width) + 'px'")
+    
+    await element.screenshot(path=str(img_path), omit_background=True)
+
+
 async def render_markdown_table_to_image(text: str) -> tuple[str, list[str]]:
     """
     🚀 终极视觉拦截器：利用 Playwright 浏览器内核，将 Markdown 表格渲染为具有 Bloomberg 质感的 Web UI 并精准截图。
@@ -385,37 +444,6 @@ async def render_markdown_table_to_image(text: str) -> tuple[str, list[str]]:
 
     image_paths = []
     
-    # 👑 极客级 CSS：暗黑金融终端质感
-    css = """
-    :root { --bg: #1A1D21; --border: #2D3239; --text: #E3E5E8; --header-bg: #22262B; --stripe: #1E2126; }
-    html, body {
-        background-color: var(--bg);
-        font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, "Helvetica Neue", Arial, sans-serif, "Apple Color Emoji", "Segoe UI Emoji", "Segoe UI Symbol";
-        margin: 0; padding: 20px;
-        -webkit-font-smoothing: antialiased;
-        -moz-osx-font-smoothing: grayscale;
-    }
-    #capture_area {
-        /* 🌟 核心修复 1：摒弃 inline-block，使用 max-content 绝对贴合内容 */
-        width: max-content; 
-        background-color: var(--bg); 
-        padding: 16px;
-        border: 1px solid var(--border);
-        /* 🌟 核心修复 2：更改盒模型计算方式，防止 padding 引起的亚像素抖动 */
-        box-sizing: border-box;
-        /* 🌟 核心修复 3：暴力裁切，把超出整数边界的 0.x 像素底色直接切掉 */
-        overflow: hidden;
-    }
-    table { border-collapse: collapse; color: var(--text); font-size: 14px; margin: 0; }
-    th, td { padding: 12px 16px; text-align: left; border-bottom: 1px solid var(--border); }
-    th {
-        background-color: var(--header-bg); font-weight: 600; color: #A0A5AD;
-        text-transform: uppercase; font-size: 12px; letter-spacing: 0.5px;
-    }
-    tr:last-child td { border-bottom: none; }
-    tr:nth-child(even) td { background-color: var(--stripe); }
-    """
-    
     # 启动极其轻量的无头浏览器
     async with async_playwright() as p:
         browser = await p.chromium.launch(headless=True, args=['--no-sandbox', '--disable-gpu'])
@@ -427,26 +455,14 @@ async def render_markdown_table_to_image(text: str) -> tuple[str, list[str]]:
                 # 1. 纯净转换：Markdown 表格 -> HTML <table>
                 html_table = markdown.markdown(md_table, extensions=['tables'])
                 
-                # 2. 组装完整网页
-                full_html = f"<!DOCTYPE html><html><head><style>{css}</style></head><body><div id='capture_area'>{html_table}</div></body></html>"
-                
-                # 3. 注入浏览器并等待渲染
-                await page.set_content(full_html)
-                
-                # 4. 魔法时刻：精准锁定 div，无视背景进行像素级裁切截图！
+                # 2. 注入浏览器渲染并截图
                 img_filename = f"table_render_{int(time.time())}_{idx}.png"
                 img_path = (SANDBOX_DIR / img_filename).resolve()
-                
-                element = await page.wait_for_selector('#capture_area')
-                
-                # 🌟 终极防线：注入 JS 计算真实亚像素宽度，并向上取整锁定物理像素，彻底封死右侧缝隙！
-                await element.evaluate("el => el.style.width = Math.ceil(el.getBoundingClientRect().width) + 'px'")
-                
-                await element.screenshot(path=str(img_path), omit_background=True)
+                await _screenshot_table_html(page, html_table, img_path)
                 
                 image_paths.append(str(img_path))
                 
-                # 5. 替换原文文本
+                # 3. 替换原文文本
                 img_markdown = f"\n\n![表格](./{img_filename})\n\n"
                 text = text.replace(md_table, img_markdown)
                 
@@ -459,6 +475,55 @@ async def render_markdown_table_to_image(text: str) -> tuple[str, list[str]]:
     return text, image_paths
 
 
+async def render_report_for_telegram(report: Report) -> tuple[list[tuple[str, str, str]], list[str]]:
+    """
+    🚀 结构化报告直出：表格由结构化数据直接生成 HTML 截图，无需正则识别与 Markdown 二次解析。
+    
+    Args:
+        report: 结构化报告
+    
+    Returns:
+        tuple: (发送单元列表, 临时图片路径列表)。发送单元为 ("text", html, "") 或 ("photo", 图片路径, caption_html)，
+        表格前紧邻的文本会作为该表格图片的 caption；截图失败的表格降级为等宽文本。
+    """
+    parts = report.iter_telegram_parts()
+    table_images: dict[int, str] = {}
+    image_paths: list[str] = []
+    
+    tables = [(i, payload) for i, (kind, payload) in enumerate(parts) if kind == "table"]
+    if tables:
+        try:
+            async with async_playwright() as p:
+                browser = await p.chromium.launch(headless=True, args=['--no-sandbox', '--disable-gpu'])
+                page = await browser.new_page(device_scale_factor=3)
+                for i, table in tables:
+                    try:
+                        img_path = (SANDBOX_DIR / f"table_render_{int(time.time())}_{uuid.uuid4().hex[:6]}.png").resolve()
+                        await _screenshot_table_html(page, table_to_html(table), img_path)  # type: ignore[arg-type]
+                        table_images[i] = str(img_path)
+                        image_paths.append(str(img_path))
+                    except Exception as e:
+                        logger.error(f"Playwright 结构化表格渲染失败：{e}")
+                await browser.close()
+        except Exception as e:
+            logger.error(f"Playwright 启动失败，结构化表格降级为文本：{e}")
+    
+    units: list[tuple[str, str, str]] = []
+    for i, (kind, payload) in enumerate(parts):
+        if kind == "text":
+            # 紧邻表格图片之前的文本留作 caption
+            if i + 1 in table_images:
+                continue
+            units.append(("text", payload, ""))  # type: ignore[arg-type]
+        elif i in table_images:
+            caption = parts[i - 1][1] if i > 0 and parts[i - 1][0] == "text" else ""
+            units.append(("photo", table_images[i], caption))  # type: ignore[arg-type]
+        else:
+            units.append(("text", table_to_telegram_pre(payload), ""))  # type: ignore[arg-type]
+    
+    return units, image_paths
+
+
 async def convert_md_to_pdf(md_path: Path) -> Path:
     """
     将 agent_workspace 中的 .md 文件渲染为 PDF，内嵌图片。
@@ -477,10 +542,26 @@ async def convert_md_to_pdf(md_path: Path) -> Path:
     # MD -> HTML（启用表格 + 代码块扩展）
     html_body = markdown.markdown(md_text, extensions=['tables', 'fenced_code'])
 
+    # 📐 K 线缓存图在 PDF 中换用矢量版本（pdf 渲染档位），打印 / 缩放不失真；
+    # 用位图旁保存的同一份绘图数据重绘，不重新拉取行情，PDF 与聊天中的图保持一致
+    vector_charts: dict[str, Path] = {}
+    for src in set(re.findall(r'src="([^"]+)"', html_body)):
+        series = load_chart_series((SANDBOX_DIR / Path(src).name).resolve())
+        if series is None:
+            continue
+        try:
+            vector_path, _ = await asyncio.to_thread(
+                render_kline_chart_cached, series["hist"], SANDBOX_DIR, series["ticker"], series["days"],
+                series["title"], "pdf", series["renderer"]
+            )
+            vector_charts[src] = vector_path
+        except Exception as e:
+            logger.warning(f"矢量 K 线图生成失败，PDF 沿用位图：{e}")
+
     # 将 <img src="./xxx.png"> 中的相对路径替换为 file:// 绝对路径，确保 Playwright 能加载图片
     def resolve_img_src(match: re.Match) -> str:
         src = match.group(1)
-        img_file = (SANDBOX_DIR / Path(src).name).resolve()
+        img_file = vector_charts.get(src) or (SANDBOX_DIR / Path(src).name).resolve()
         if img_file.exists():
             return f'src="file://{img_file}"'
         return match.group(0)
@@ -580,6 +661,18 @@ def translate_to_telegram_html(text: str) -> str:
     return text
 
 
+def outbound_photo(img_path: Path | str, encoded: EncodedImage | None = None) -> InputFile:
+    """
+    出站图片编码：按 MEDIA_ENCODE_TARGET 压缩后再上传（图表 / 表格截图体积通常下降 60% 以上），编码失败时原样发送。
+    """
+    try:
+        encoded = encoded or encode_image_cached(img_path)
+        return InputFile(encoded.data, filename=encoded.filename)
+    except Exception as e:
+        logger.warning(f"图片编码失败，原样发送：{type(e).__name__} - {e}")
+        return InputFile(Path(img_path).read_bytes(), filename=Path(img_path).name)
+
+
 async def send_with_caption_split(
     message,
     photo,
@@ -741,16 +834,16 @@ async def execute_agent_task(
                 
                 if img_path.exists():
                     try:
-                        with open(img_path, 'rb') as photo:
-                            if raw_caption:
-                                html_caption = translate_to_telegram_html(raw_caption)
-                                await send_with_caption_split(
-                                    message, photo, html_caption
-                                )
-                                is_consumed[i-1] = True
-                            else:
-                                # 纯图片发送（无前置文本）
-                                await message.reply_photo(photo=photo)
+                        photo = outbound_photo(img_path)
+                        if raw_caption:
+                            html_caption = translate_to_telegram_html(raw_caption)
+                            await send_with_caption_split(
+                                message, photo, html_caption
+                            )
+                            is_consumed[i-1] = True
+                        else:
+                            # 纯图片发送（无前置文本）
+                            await message.reply_photo(photo=photo)
                     except Exception as e:
                         logger.error(f"发送图片失败：{e}")
                 else:
@@ -821,6 +914,197 @@ async def execute_agent_task(
             pass
 
 
+# ==========================================
+# ⚡ 宏指令直通 (Deterministic Macro)：固定动作直接调用底层函数，绕过大模型
+# ==========================================
+# 宏指令结果下方"追加 AI 点评"按钮的回调数据前缀（后接对账单编号）
+MACRO_COMMENTARY_CALLBACK = "macro_comment:portfolio"
+
+# 已发送对账单的 Markdown 暂存：{对账单编号: Markdown}。回调数据限 64 字节，只能携带编号；
+# 点评直接解读用户看到的那份对账单，不重新估值（两次估值之间行情可能已变化）
+MACRO_COMMENTARY_MAX_REPORTS = int(os.getenv("MACRO_COMMENTARY_MAX_REPORTS", "64"))
+_commentary_reports: dict[str, str] = {}
+
+
+def _stash_commentary_report(report_md: str) -> str:
+    """暂存对账单并返回编号（超出上限时淘汰最早的）"""
+    report_id = uuid.uuid4().hex[:12]
+    _commentary_reports[report_id] = report_md
+    while len(_commentary_reports) > MACRO_COMMENTARY_MAX_REPORTS:
+        _commentary_reports.pop(next(iter(_commentary_reports)))
+    return report_id
+
+# AI 点评 Prompt：对账单已由引擎精确核算，大模型只负责解读，不再重复调用估值工具
+MACRO_COMMENTARY_PROMPT = (
+    "以下是系统刚刚精确核算的持仓对账单，数据已是最终结果，请勿再次调用估值工具。"
+    "请基于这些数据给出简短的持仓点评（集中度、盈亏结构、汇率敞口）与风险提示：\n\n{report}"
+)
+
+# 单条 Telegram 文本消息的安全长度（上限 4096，预留 HTML 标签余量）
+TG_TEXT_CHUNK_LIMIT = 3800
+
+
+async def _reply_report_units(message: Message, units: list[tuple[str, str, str]]) -> None:
+    """在当前会话中依次回复结构化报告的直出渲染单元"""
+    for kind, payload, caption in units:
+        if kind == "photo":
+            photo = outbound_photo(payload)
+            if caption:
+                await send_with_caption_split(message, photo, caption)
+            else:
+                await message.reply_photo(photo=photo)
+        else:
+            try:
+                await message.reply_text(payload, parse_mode=ParseMode.HTML)
+            except Exception as e:
+                logger.warning(f"HTML 渲染失败，降级为纯文本发送：{e}")
+                await message.reply_text(re.sub(r'<[^>]+>', '', payload))
+        # 微小延迟，保证 Telegram 服务器按顺序排布气泡
+        await asyncio.sleep(0.2)
+
+
+async def run_portfolio_macro(message: Message) -> None:
+    """
+    ⚡ 宏指令：持仓盘点直通车。
+    
+    直接读取持仓记忆并调用估值引擎（命中估值缓存时毫秒级返回），由结构化报告直出渲染器发送，
+    全程不经过大模型；结果下方附带"追加 AI 点评"按钮，按需在后台生成解读。
+    
+    Args:
+        message: Telegram Message 对象，用于发送回复
+    """
+    status_msg = await message.reply_text(
+        "<blockquote><b>⚡ 宏指令直通：精确核算总市值</b></blockquote>\n<i>⏳ 正在拉取实时行情...</i>",
+        parse_mode=ParseMode.HTML
+    )
+    image_paths: list[str] = []
+    try:
+        positions, error = await asyncio.to_thread(_load_profile_positions)
+        if error:
+            await status_msg.edit_text(error)
+            return
+        
+        # 估值引擎是同步阻塞调用，放入线程池避免卡住事件循环
+        valuation = await asyncio.to_thread(get_cached_portfolio_valuation, positions)
+        report = build_portfolio_report(valuation)
+        units, image_paths = await render_report_for_telegram(report)
+        
+        await status_msg.delete()
+        await _reply_report_units(message, units)
+        
+        report_id = _stash_commentary_report(report.to_markdown())
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🧠 追加 AI 持仓点评", callback_data=f"{MACRO_COMMENTARY_CALLBACK}:{report_id}")]
+        ])
+        await message.reply_text("如需解读，可点击下方按钮在后台追加 AI 点评。", reply_markup=keyboard)
+    
+    except json.JSONDecodeError:
+        await status_msg.edit_text("❌ 持仓记忆文件损坏：JSONDecodeError")
+    except Exception as e:
+        logger.error(f"[run_portfolio_macro] 持仓盘点失败：{e}")
+        try:
+            await status_msg.edit_text(f"⚠️ 持仓盘点失败：{type(e).__name__} - {str(e)}")
+        except Exception:
+            await message.reply_text(f"⚠️ 持仓盘点失败：{type(e).__name__} - {str(e)}")
+    finally:
+        # 清理本次产生的临时表格渲染图片
+        for _tmp_path in image_paths:
+            try:
+                Path(_tmp_path).unlink(missing_ok=True)
+            except Exception:
+                pass
+
+
+async def run_portfolio_commentary(
+    message: Message,
+    user_id: int,
+    context: ContextTypes.DEFAULT_TYPE,
+    update: Update,
+    report_md: str | None = None
+) -> None:
+    """
+    宏指令的可选 AI 点评：以用户刚看到的对账单作为上下文，交给大模型做解读。
+    
+    Args:
+        message: Telegram Message 对象，用于发送回复
+        user_id: 用户唯一标识符，用于 session 隔离
+        context: Telegram Context 对象
+        update: Telegram Update 对象
+        report_md: 宏指令已发送的对账单 Markdown；暂存已被淘汰（如进程重启）时为 None，改为重新估值
+    """
+    if report_md is None:
+        try:
+            positions, error = await asyncio.to_thread(_load_profile_positions)
+            if error:
+                await message.reply_text(error)
+                return
+            valuation = await asyncio.to_thread(get_cached_portfolio_valuation, positions)
+            report_md = build_portfolio_report(valuation).to_markdown()
+        except Exception as e:
+            logger.error(f"[run_portfolio_commentary] 对账单准备失败：{e}")
+            await message.reply_text(f"⚠️ AI 点评准备失败：{type(e).__name__} - {str(e)}")
+            return
+    
+    await execute_agent_task(MACRO_COMMENTARY_PROMPT.format(report=report_md), message, user_id, context, update)
+
+
+KB_INDEX_STATUS_ICONS = {"ready": "✅", "queued": "⏳", "running": "🔄", "failed": "❌"}
+
+
+async def run_kb_list_macro(message: Message) -> None:
+    """
+    ⚡ 宏指令：知识库档案清单直通车（直接扫描知识库目录，绕过大模型）。
+    
+    Args:
+        message: Telegram Message 对象，用于发送回复
+    """
+    try:
+        files = await asyncio.to_thread(_list_kb_file_names)
+    except FileNotFoundError:
+        await message.reply_text("❌ 知识库目录不存在")
+        return
+    except Exception as e:
+        logger.error(f"[run_kb_list_macro] 知识库扫描失败：{e}")
+        await message.reply_text(f"⚠️ 知识库读取失败：{type(e).__name__} - {str(e)}")
+        return
+    
+    if not files:
+        await message.reply_text("📭 当前知识库为空，可直接向我发送 PDF / Markdown / TXT / CSV 文件进行归档。")
+        return
+    
+    try:
+        index_status = await asyncio.to_thread(get_index_queue().all_status)
+    except Exception as e:
+        logger.warning(f"[run_kb_list_macro] 索引状态读取失败：{e}")
+        index_status = {}
+    
+    header = f"<blockquote><b>📚 历史情报档案（共 {len(files)} 份）</b></blockquote>"
+    cache = get_vectorstore_cache_stats()
+    footer = (
+        f"<i>🧠 向量索引内存池：{cache['entries']} 份常驻，{cache['resident_bytes'] / 1024 / 1024:.1f} / "
+        f"{cache['max_bytes'] / 1024 / 1024:.0f} MB，命中率 {cache['hit_rate']:.0%}</i>\n"
+        "<i>✅ 索引就绪 ⏳ 排队中 🔄 索引中 ❌ 索引失败 📄 未入队</i>\n"
+        "<i>💡 直接说「从 xxx 中检索……」即可让 AI 调阅对应档案。</i>"
+    )
+    
+    # 按安全长度把文件清单切成多条消息
+    chunks: list[str] = []
+    current = header
+    for name in files:
+        status = index_status.get(name, {}).get("status")
+        line = f"{KB_INDEX_STATUS_ICONS.get(status, '📄')} <code>{html.escape(name)}</code>"
+        if len(current) + len(line) + 1 > TG_TEXT_CHUNK_LIMIT:
+            chunks.append(current)
+            current = line
+        else:
+            current += "\n" + line
+    chunks.append(current + "\n\n" + footer)
+    
+    for chunk in chunks:
+        await message.reply_text(chunk, parse_mode=ParseMode.HTML)
+        await asyncio.sleep(0.2)
+
+
 async def price_watcher_routine(context: ContextTypes.DEFAULT_TYPE):
     """🌟 纯 Python 轻量级盯盘引擎 (每 5 分钟执行，0 Token 消耗)"""
     import logging
@@ -1034,6 +1318,8 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # 物理下载
         await tg_file.download_to_drive(custom_path=save_path)
+        invalidate_vectorstore(file_name)  # 同名文件被覆盖时释放内存中的旧索引
+        await asyncio.to_thread(enqueue_kb_file, file_name, "upload")
         dl_cost = time.time() - start_dl_time
 
         # 4. 🌟 UX 状态瞬间跳变：明确告知用户下载已完成，现在是算力消耗时间！
@@ -1162,6 +1448,8 @@ async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE
             dest = (KB_DIR / md_name).resolve()
             import shutil
             shutil.copy2(str(md_path), str(dest))
+            invalidate_vectorstore(md_name)
+            await asyncio.to_thread(enqueue_kb_file, md_name, "archive")
             await query.message.reply_text(f"✅ 已归档至知识库：<code>{md_name}</code>", parse_mode=ParseMode.HTML)
         except Exception as e:
             logger.error(f"归档失败 [{md_name}]：{e}")
@@ -1183,11 +1471,23 @@ async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE
             await send_dashboard(query.message, query.from_user.first_name)
         return
 
+    # 🌟 5. 宏指令点评：在后台追加 AI 解读，不阻塞后续按钮与消息
+    if cmd == MACRO_COMMENTARY_CALLBACK or cmd.startswith(f"{MACRO_COMMENTARY_CALLBACK}:"):
+        report_md = _commentary_reports.pop(cmd.split(":", 2)[2], None) if cmd.count(":") == 2 else None
+        if query.message and isinstance(query.message, Message):
+            context.application.create_task(
+                run_portfolio_commentary(query.message, user_id, context, update, report_md)
+            )
+        return
+
     user_msg = ""
     
-    # 路由表：将隐藏指令映射为精确的工程 Prompt
+    # 路由表：将隐藏指令映射为宏指令或精确的工程 Prompt
     if cmd == "cmd_portfolio":
-        user_msg = "帮我精确计算当前总市值和持仓盈亏，并生成财务明细报表。"
+        # ⚡ 宏指令直通：直接调用估值引擎，结构化报告直出渲染
+        if query.message and isinstance(query.message, Message):
+            await run_portfolio_macro(query.message)
+        return
         
     elif cmd == "cmd_daily_report":
         # ⚡ 脊髓反射启动：复用公共派发函数
@@ -1207,7 +1507,9 @@ async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
         
     elif cmd == "cmd_kb_list":
-        user_msg = "列出知识库里现在有哪些文件可以读取？"
+        if query.message and isinstance(query.message, Message):
+            await run_kb_list_macro(query.message)
+        return
         
     elif cmd == "cmd_alert":
         text = (
@@ -1235,12 +1537,107 @@ async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE
         await execute_agent_task(user_msg, query.message, user_id, context, update)  # type: ignore
 
 
-async def broadcast_to_telegram(text: str):
+async def _broadcast_photo(bot: Bot, user_id: int, img_path: Path | str, html_caption: str, photos: OutboundPhotoCache) -> None:
+    """广播单张图片：同一张图首次上传编码后的字节，之后的用户直接复用 Telegram file_id；编码失败时原样上传"""
+    try:
+        resolved: str | EncodedImage | None = photos.resolve(img_path)
+    except (OSError, ValueError) as e:
+        # 含 PIL.UnidentifiedImageError（OSError 子类）：图片损坏或格式无法识别
+        logger.warning(f"图片编码失败，原样发送：{type(e).__name__} - {e}")
+        resolved = None
+    if isinstance(resolved, str):
+        photo = resolved
+    elif resolved is None:
+        photo = InputFile(Path(img_path).read_bytes(), filename=Path(img_path).name)
+    else:
+        photo = outbound_photo(img_path, resolved)
+    if html_caption:
+        sent = await _broadcast_photo_with_caption(bot, user_id, photo, html_caption)
+    else:
+        sent = await bot.send_photo(chat_id=user_id, photo=photo)
+    if not isinstance(resolved, str) and sent is not None and sent.photo:
+        photos.remember(img_path, sent.photo[-1].file_id)
+
+
+async def _broadcast_markdown_chunks(bot: Bot, user_id: int, chunks: list[str], photos: OutboundPhotoCache) -> None:
+    """向单个用户依次发送图文混排切片（图片携带前置文本作为 caption）"""
+    is_consumed = [False] * len(chunks)
+    for i, chunk in enumerate(chunks):
+        chunk = chunk.strip()
+        if not chunk: continue
+        
+        img_match = re.match(r'^!\[.*?\]\((.*?)\)$', chunk)
+        if img_match:
+            img_filename = img_match.group(1).replace("./", "")
+            img_path = (SANDBOX_DIR / img_filename).resolve()
+            
+            raw_caption = ""
+            if i > 0 and not is_consumed[i-1]:
+                prev_chunk = chunks[i-1].strip()
+                if not re.match(r'^!\[.*?\]\(.*?\)$', prev_chunk):
+                    raw_caption = prev_chunk
+                    
+            if img_path.exists() and img_path.stat().st_size > 0:
+                html_caption = translate_to_telegram_html(raw_caption) if raw_caption else ""
+                await _broadcast_photo(bot, user_id, img_path, html_caption, photos)
+                if raw_caption:
+                    is_consumed[i-1] = True
+            else:
+                logger.warning(f"图片文件不存在或为空：{img_path}")
+            await asyncio.sleep(0.3) # 防封锁限流
+            
+        else:
+            next_is_image = (i + 1 < len(chunks) and re.match(r'^!\[.*?\]\(.*?\)$', chunks[i+1].strip()))
+            if next_is_image: continue
+            
+            html_text = translate_to_telegram_html(chunk)
+            await _broadcast_html_text(bot, user_id, html_text)
+            await asyncio.sleep(0.3)
+
+
+async def _broadcast_photo_with_caption(bot: Bot, user_id: int, photo, html_caption: str) -> Message:
+    """发送带 HTML caption 的图片，超长时截断并把剩余部分作为文本补发；返回图片消息"""
+    # 降级截断处理
+    try:
+        if len(html_caption) <= 1024:
+            return await bot.send_photo(chat_id=user_id, photo=photo, caption=html_caption, parse_mode=ParseMode.HTML, show_caption_above_media=True)
+        # 开启图片沉底魔法
+        sent = await bot.send_photo(chat_id=user_id, photo=photo, caption=html_caption[:1021]+"...", parse_mode=ParseMode.HTML, show_caption_above_media=True)
+        # 修复吞字 Bug
+        await bot.send_message(chat_id=user_id, text=html_caption[1021:], parse_mode=ParseMode.HTML)
+        return sent
+    except Exception:
+        fallback = re.sub(r'<[^>]+>', '', html_caption)
+        # 降级模式也开启魔法参数
+        return await bot.send_photo(chat_id=user_id, photo=photo, caption=fallback[:1024], show_caption_above_media=True)
+
+
+async def _broadcast_html_text(bot: Bot, user_id: int, html_text: str) -> None:
+    """发送 HTML 文本，渲染失败时降级为纯文本"""
+    try:
+        await bot.send_message(chat_id=user_id, text=html_text, parse_mode=ParseMode.HTML)
+    except Exception:
+        fallback = re.sub(r'<[^>]+>', '', html_text)
+        await bot.send_message(chat_id=user_id, text=fallback)
+
+
+async def _broadcast_report_units(bot: Bot, user_id: int, units: list[tuple[str, str, str]], photos: OutboundPhotoCache) -> None:
+    """向单个用户发送结构化报告的直出渲染单元"""
+    for kind, payload, caption in units:
+        if kind == "photo":
+            await _broadcast_photo(bot, user_id, payload, caption, photos)
+        else:
+            await _broadcast_html_text(bot, user_id, payload)
+        await asyncio.sleep(0.3)
+
+
+async def broadcast_to_telegram(text: str, report: Report | None = None):
     """
     🌟 服务端主动推送引擎：供 daily_job 跨进程调用，复用高级图文渲染引擎下发研报
     
     Args:
-        text: 待发送的研报 Markdown 文本
+        text: 待发送的研报 Markdown 文本（可包含持仓对账单占位符）
+        report: 结构化持仓对账单；提供时由直出渲染器替换占位符（正文中缺少占位符则追加到末尾）
     """
     if not TG_BOT_TOKEN or not ALLOWED_USER_IDS:
         logger.warning("未配置 Telegram Token 或白名单，无法进行推送。")
@@ -1248,11 +1645,22 @@ async def broadcast_to_telegram(text: str):
         
     bot = Bot(token=TG_BOT_TOKEN)
     
-    # 1. 拦截并使用 Playwright 渲染表格
-    final_text, table_render_paths = await render_markdown_table_to_image(text)
+    # 1. 大模型正文按占位符切段，各段拦截并使用 Playwright 渲染表格，再做图文切片混排
+    segments_chunks: list[list[str]] = []
+    table_render_paths: list[str] = []
+    for segment in split_report_placeholder(text):
+        final_text, paths = await render_markdown_table_to_image(segment)
+        table_render_paths.extend(paths)
+        segments_chunks.append(re.split(r'(!\[.*?\]\(.*?\))', final_text))
+    
+    # 2. 结构化报告直出（表格直接由数据截图，不经过正则识别）
+    report_units: list[tuple[str, str, str]] = []
+    if report is not None:
+        report_units, paths = await render_report_for_telegram(report)
+        table_render_paths.extend(paths)
     
-    # 2. 图文切片混排
-    chunks = re.split(r'(!\[.*?\]\(.*?\))', final_text)
+    # 3. 出站图片：首次上传压缩后的字节，其余用户复用 file_id
+    photos = OutboundPhotoCache()
     
     for user_id in ALLOWED_USER_IDS:
         try:
@@ -1263,62 +1671,23 @@ async def broadcast_to_telegram(text: str):
                 parse_mode=ParseMode.HTML
             )
             
-            # 依次发送切片
-            is_consumed = [False] * len(chunks)
-            for i, chunk in enumerate(chunks):
-                chunk = chunk.strip()
-                if not chunk: continue
-                
-                img_match = re.match(r'^!\[.*?\]\((.*?)\)$', chunk)
-                if img_match:
-                    img_filename = img_match.group(1).replace("./", "")
-                    img_path = (SANDBOX_DIR / img_filename).resolve()
-                    
-                    raw_caption = ""
-                    if i > 0 and not is_consumed[i-1]:
-                        prev_chunk = chunks[i-1].strip()
-                        if not re.match(r'^!\[.*?\]\(.*?\)$', prev_chunk):
-                            raw_caption = prev_chunk
-                            
-                    if img_path.exists() and img_path.stat().st_size > 0:
-                        with open(img_path, 'rb') as photo:
-                            if raw_caption:
-                                html_caption = translate_to_telegram_html(raw_caption)
-                                # 降级截断处理
-                                try:
-                                    if len(html_caption) <= 1024:
-                                        await bot.send_photo(chat_id=user_id, photo=photo, caption=html_caption, parse_mode=ParseMode.HTML, show_caption_above_media=True)
-                                    else:
-                                        # 开启图片沉底魔法
-                                        await bot.send_photo(chat_id=user_id, photo=photo, caption=html_caption[:1021]+"...", parse_mode=ParseMode.HTML, show_caption_above_media=True)
-                                        # 修复吞字 Bug
-                                        await bot.send_message(chat_id=user_id, text=html_caption[1021:], parse_mode=ParseMode.HTML)
-                                except Exception:
-                                    fallback = re.sub(r'<[^>]+>', '', html_caption)
-                                    # 降级模式也开启魔法参数
-                                    await bot.send_photo(chat_id=user_id, photo=photo, caption=fallback[:1024], show_caption_above_media=True)
-                                is_consumed[i-1] = True
-                            else:
-                                await bot.send_photo(chat_id=user_id, photo=photo)
-                    else:
-                        logger.warning(f"图片文件不存在或为空：{img_path}")
-                    await asyncio.sleep(0.3) # 防封锁限流
-                    
-                else:
-                    next_is_image = (i + 1 < len(chunks) and re.match(r'^!\[.*?\]\(.*?\)$', chunks[i+1].strip()))
-                    if next_is_image: continue
-                    
-                    html_text = translate_to_telegram_html(chunk)
-                    try:
-                        await bot.send_message(chat_id=user_id, text=html_text, parse_mode=ParseMode.HTML)
-                    except Exception:
-                        fallback = re.sub(r'<[^>]+>', '', html_text)
-                        await bot.send_message(chat_id=user_id, text=fallback)
-                    await asyncio.sleep(0.3)
+            # 依次发送正文切片，在占位符处插入结构化报告
+            for idx, chunks in enumerate(segments_chunks):
+                await _broadcast_markdown_chunks(bot, user_id, chunks, photos)
+                is_last = idx == len(segments_chunks) - 1
+                if report_units and (not is_last or len(segments_chunks) == 1):
+                    await _broadcast_report_units(bot, user_id, report_units, photos)
                     
         except Exception as e:
             logger.error(f"向用户 {user_id} 推送失败：{e}")
 
+    media = photos.summary()
+    if media["uploads"]:
+        logger.info(
+            f"🗜️ 广播图片上传 {media['uploads']} 次（{media['uploaded_bytes'] / 1024:.1f} KB，编码节省 "
+            f"{media['saved_bytes'] / 1024:.1f} KB），复用 file_id {media['reused']} 次"
+        )
+
     # 清理临时表格渲染图片（广播完成后统一删除）
     for _tmp_path in table_render_paths:
         try:
@@ -4,14 +4,22 @@
 本模块提供：
 1. 全球股票价格查询（支持美股/A 股/港股）
 2. A 股 ETF 价格查询（双源降级）
-3. K 线图生成
+3. K 线图生成（单标的 K 线 / 多标的小图矩阵）
 4. 持仓估值计算
+5. 日线历史批量获取（带硬盘缓存）
+6. 持仓对账单结构化报告
 """
 
+import os
+import copy
+import json
+import atexit
+import hashlib
 import socket
+import threading
+import time
 import yfinance as yf
 import akshare as ak
-import mplfinance as mpf
 import pandas as pd
 from pathlib import Path
 from datetime import datetime, timedelta
@@ -19,7 +27,10 @@ from typing import Dict, Any, Optional, List
 import logging
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
 import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from chart_engine import get_render_profile, get_renderer, render_kline_chart_cached, render_small_multiples_cached
+from report_model import Report, Section, KeyValue, BulletList, Paragraph, Note, Table
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +47,48 @@ DEFAULT_EXCHANGE_RATES = {
     "CNY_CNY": 1.0
 }
 
+# 全球核心基准指数（盘后指数播报与 Beta 计算共用）
+BENCHMARK_INDICES: Dict[str, str] = {
+    "沪深 300": "000300.SS",
+    "恒生指数": "^HSI",
+    "恒生科技指数": "HSTECH.HK",
+    "纳斯达克 100": "^NDX",
+}
+
+# 日线历史硬盘缓存：同一交易日内的重复查询直接命中本地，不再穿透 yfinance
+HISTORY_CACHE_DIR = Path("./memory/history_cache").resolve()
+HISTORY_CACHE_TTL_SECONDS = int(os.getenv("HISTORY_CACHE_TTL_SECONDS", "21600"))
+
+# 持仓估值的常驻查价线程池：进程内复用，避免每次估值重复创建/销毁线程
+VALUATION_MAX_WORKERS = int(os.getenv("VALUATION_MAX_WORKERS", "10"))
+
+# 整体估值截止时间：超时未返回的持仓降级使用最近一次缓存价格，不再等待最慢的请求
+VALUATION_DEADLINE_SECONDS = float(os.getenv("VALUATION_DEADLINE_SECONDS", "20"))
+
+_valuation_executor: Optional[ThreadPoolExecutor] = None
+_valuation_executor_lock = threading.Lock()
+
+# 仍在线程池中执行的查价/汇率任务：{任务键: Future}。同一键在上一次任务返回前不重复投递，
+# 超过截止时间的迟到任务因此最多各占一个线程，不会随重复估值堆积占满线程池
+_inflight_fetches: Dict[str, Future] = {}
+_inflight_fetches_lock = threading.Lock()
+
+# 最近一次成功获取的汇率：汇率请求超过估值截止时间时降级使用
+_last_exchange_rates: Optional[Dict[str, float]] = None
+
+# 进程内最近一次成功查价缓存：{原始代码: {"price": float, "time": "YYYY-MM-DD HH:MM:SS"}}
+_last_quotes: Dict[str, Dict[str, Any]] = {}
+_last_quotes_lock = threading.Lock()
+
+# 行情快照版本号：任何持仓的缓存价格发生变化（含超时后在后台返回的迟到查价）时递增
+_quote_snapshot_version = 0
+
+# 估值结果短时缓存：连续点击"盘点持仓"时直接复用，按 持仓哈希 + 行情快照版本 命中
+VALUATION_CACHE_TTL_SECONDS = int(os.getenv("VALUATION_CACHE_TTL_SECONDS", "60"))
+_valuation_cache: Dict[str, Dict[str, Any]] = {}
+_valuation_inflight: Dict[str, threading.Event] = {}
+_valuation_cache_lock = threading.Lock()
+
 
 @retry(
     stop=stop_after_attempt(2),
@@ -149,6 +202,20 @@ def detect_ticker_currency(ticker: str) -> str:
         return "CNY"
 
 
+def is_etf_code(code: str) -> bool:
+    """
+    判断持仓代码是否为 A 股 ETF。
+    
+    Args:
+        code: 持仓代码（如 513180, 600519, AAPL）
+    
+    Returns:
+        bool: 6 位数字且前缀为沪市 50/51/58、深市 15/16 时返回 True，防止普通 6 位 A 股被误判
+    """
+    return (code.isdigit() and len(code) == 6 and
+            code.startswith(('50', '51', '58', '15', '16')))
+
+
 def format_universal_ticker(ticker: str) -> str:
     """
     智能推断股票市场并格式化为 yfinance 识别的代码。
@@ -375,7 +442,13 @@ def fetch_etf_price_raw(etf_code: str, date: Optional[str] = None) -> Dict[str,
         raise RuntimeError(f"akshare 查询失败：{ak_error}")
 
 
-def generate_kline_chart(ticker: str, save_dir: Path, days: int = 30) -> Dict[str, Any]:
+def generate_kline_chart(
+    ticker: str,
+    save_dir: Path,
+    days: int = 30,
+    profile: str = "telegram",
+    renderer: Optional[str] = None,
+) -> Dict[str, Any]:
     """
     生成股票 K 线走势图（支持自定义时间跨度）。
     
@@ -383,6 +456,9 @@ def generate_kline_chart(ticker: str, save_dir: Path, days: int = 30) -> Dict[st
         ticker: 股票代码
         save_dir: 图片保存目录
         days: K 线图的时间跨度（天数），默认 30 天
+        profile: 渲染档位，由调用方按输出渠道选择：
+            "telegram"（≈1280 px 位图）/ "pdf"（矢量 SVG）/ "thumbnail"（缩略图）
+        renderer: K 线渲染器，"mplfinance" 或 "native"（collections 直绘），None 时使用 CHART_RENDERER 配置
     
     Returns:
         dict: {
@@ -390,13 +466,18 @@ def generate_kline_chart(ticker: str, save_dir: Path, days: int = 30) -> Dict[st
             "min_price": xxx,
             "latest_close": xxx,
             "file_name": "...",
-            "file_path": "..."
+            "file_path": "...",
+            "cache_hit": bool
         }
     
     Raises:
         IndexError: 无历史数据
         KeyError: 数据字段缺失
+        ValueError: 未知渲染档位或渲染器
+        TimeoutError: 绘图排队或渲染超时
     """
+    get_render_profile(profile)
+    renderer = get_renderer(renderer)
     formatted_ticker = format_universal_ticker(ticker)
     stock = yf.Ticker(formatted_ticker)
     
@@ -410,57 +491,10 @@ def generate_kline_chart(ticker: str, save_dir: Path, days: int = 30) -> Dict[st
     if hist.empty:
         raise IndexError(f"未找到 {formatted_ticker} 的历史数据，无法绘图")
     
-    safe_name = formatted_ticker.replace('.', '_')
-    chart_filename = f"{safe_name}_30d_chart.png"
-    chart_path = (save_dir / chart_filename).resolve()
-    
-    # 🌟 终极 UI 升级：TradingView 旗舰暗黑风格 (无边框悬浮质感)
-    # 1. 极致色彩：采用 TradingView 官方经典的翠绿与猩红
-    mc = mpf.make_marketcolors(
-        up='#089981',             # TV 经典翠绿
-        down='#f23645',           # TV 经典猩红
-        edge='inherit',           # 边框与主体同色，消除发虚感
-        wick='inherit',           # 影线与主体同色
-        volume='in'               # 成交量颜色跟随 K 线涨跌
-    )
-    
-    # 2. 旗舰质感：去边框化、深邃蓝灰背景、极度弱化网格
-    s = mpf.make_mpf_style(
-        marketcolors=mc,
-        figcolor='#131722',       # TV 经典外框背景色（深邃蓝灰）
-        facecolor='#131722',      # 图表内背景色（无缝融合）
-        edgecolor='#131722',      # 隐藏坐标系边框，打造悬浮感
-        gridcolor='#1e222d',      # 极度弱化的网格线
-        gridstyle=':',            # 点状网格，绝不喧宾夺主
-        rc={
-            'text.color': '#d1d4dc',            # 柔和的银灰色文字
-            'axes.labelcolor': '#d1d4dc',
-            'xtick.color': '#d1d4dc',
-            'ytick.color': '#d1d4dc',
-            'axes.spines.top': False,           # 🔪 物理切除顶部边框
-            'axes.spines.right': False,         # 🔪 物理切除右侧边框
-            'axes.spines.left': False,          # 🔪 物理切除左侧边框
-            'axes.spines.bottom': False,        # 🔪 物理切除底部边框
-            'font.size': 10,
-            'font.weight': 'bold',              # 字体加粗更具科技感
-            'lines.linewidth': 1.5              # 稍微加粗均线，增加发光感
-        }
-    )
-
-    # 3. 视网膜级输出 (400 DPI) 与自适应留白
-    save_dict = dict(fname=str(chart_path), dpi=400, bbox_inches='tight', pad_inches=0.2)
-
-    # 4. 宽屏渲染，注入定制的霓虹色均线
-    mpf.plot(
-        hist, 
-        type='candle', 
-        volume=True, 
-        style=s, 
-        title=f"\n{formatted_ticker} {days}-Day Trend", 
-        mav=(5, 10),
-        mavcolors=['#c481ec', '#2962ff'], # 🌟 视觉点睛：霓虹紫 + 电光蓝 均线
-        figsize=(12, 6),                  # 🎬 升级为 2:1 的宽屏影院比例，K 线更舒展
-        savefig=save_dict
+    # 🎨 内容寻址缓存：同一标的、跨度与最新 K 线的图直接复用；
+    # 未命中时交给常驻预热的绘图进程池渲染（TradingView 旗舰暗黑风格），调用线程只等待结果，不持有 GIL
+    chart_path, cache_hit = render_kline_chart_cached(
+        hist, save_dir, formatted_ticker, days, f"\n{formatted_ticker} {days}-Day Trend", profile, renderer
     )
     
     max_price = round(float(hist['High'].max()), 2)
@@ -472,84 +506,437 @@ def generate_kline_chart(ticker: str, save_dir: Path, days: int = 30) -> Dict[st
         "max_price": max_price,
         "min_price": min_price,
         "latest_close": latest_close,
-        "file_name": chart_filename,
-        "file_path": str(chart_path)
+        "file_name": chart_path.name,
+        "file_path": str(chart_path),
+        "cache_hit": cache_hit
+    }
+
+
+def generate_portfolio_chart(
+    tickers: List[str],
+    save_dir: Path,
+    days: int = 90,
+    profile: str = "telegram",
+    style: str = "sparkline",
+) -> Dict[str, Any]:
+    """
+    批量拉取日线历史，在一张图内绘制多个标的的小图矩阵（替代逐个标的调用 generate_kline_chart）。
+    
+    Args:
+        tickers: 股票代码列表（原始代码即可，内部自动格式化）
+        save_dir: 图片保存目录
+        days: 时间跨度（天数），默认 90 天
+        profile: 渲染档位（telegram / pdf / thumbnail）
+        style: 面板样式，"sparkline"（迷你走势）或 "candle"（迷你 K 线）
+    
+    Returns:
+        dict: {
+            "tickers": [...],            # 实际绘制的格式化代码（按输入顺序）
+            "missing": [...],            # 无历史数据、未能绘制的代码
+            "summary": {代码: {"latest_close": xxx, "change_percent": xxx}},
+            "file_name": "...",
+            "file_path": "...",
+            "cache_hit": bool
+        }
+    
+    Raises:
+        IndexError: 所有标的均无历史数据
+        ValueError: 标的数量超过上限、未知面板样式或渲染档位
+        TimeoutError: 绘图排队或渲染超时
+    """
+    formatted_tickers = list(dict.fromkeys(format_universal_ticker(t) for t in tickers))
+    history = fetch_price_history(formatted_tickers, days=days)
+    
+    panels = {
+        t: history[t] for t in formatted_tickers
+        if t in history and not history[t].empty and "Close" in history[t].columns
+    }
+    missing = [t for t in formatted_tickers if t not in panels]
+    if not panels:
+        raise IndexError(f"未找到 {', '.join(formatted_tickers)} 的历史数据，无法绘图")
+    
+    chart_path, cache_hit = render_small_multiples_cached(
+        panels, save_dir, days, f"\nPortfolio {days}-Day Trend", profile, style
+    )
+    
+    summary = {}
+    for ticker, hist in panels.items():
+        closes = hist["Close"]
+        first_close = float(closes.iloc[0])
+        summary[ticker] = {
+            "latest_close": round(float(closes.iloc[-1]), 2),
+            "change_percent": round((float(closes.iloc[-1]) / first_close - 1) * 100, 2) if first_close else 0.0,
+        }
+    
+    return {
+        "tickers": list(panels),
+        "missing": missing,
+        "summary": summary,
+        "file_name": chart_path.name,
+        "file_path": str(chart_path),
+        "cache_hit": cache_hit
     }
 
 
-def _calculate_single_position(
+def _history_cache_path(formatted_ticker: str) -> Path:
+    """日线历史缓存文件路径（代码中的特殊字符替换为下划线）"""
+    safe_name = ''.join(c if c.isalnum() else '_' for c in formatted_ticker)
+    return HISTORY_CACHE_DIR / f"{safe_name}.pkl"
+
+
+def _load_history_cache(formatted_ticker: str) -> Optional[Dict[str, Any]]:
+    """
+    读取单个标的的日线历史缓存。
+    
+    Returns:
+        Optional[dict]: {"fetched_at": float, "start": "YYYY-MM-DD", "data": DataFrame}，不存在或损坏返回 None
+    """
+    cache_path = _history_cache_path(formatted_ticker)
+    if not cache_path.exists():
+        return None
+    try:
+        payload = pd.read_pickle(cache_path)
+    except Exception as e:
+        logger.debug(f"日线缓存 {formatted_ticker} 读取失败：{type(e).__name__}")
+        return None
+    if not isinstance(payload, dict) or not isinstance(payload.get("data"), pd.DataFrame):
+        return None
+    return payload
+
+
+def _save_history_cache(formatted_ticker: str, start: str, data: pd.DataFrame) -> None:
+    """
+    原子写入单个标的的日线历史缓存。
+
+    已有缓存的起始日期更早且与新数据首尾相接时，保留其更早的部分并合并：
+    短回看窗口的刷新不会把长窗口的缓存截短，导致下一次长窗口查询重新全量拉取。
+    """
+    existing = _load_history_cache(formatted_ticker)
+    if existing is not None and not existing["data"].empty and not data.empty:
+        old = existing["data"]
+        old_start = existing.get("start", "9999-12-31")
+        if old_start < start and old.index[-1] >= data.index[0]:
+            data = pd.concat([old[old.index < data.index[0]], data])
+            start = old_start
+    HISTORY_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cache_path = _history_cache_path(formatted_ticker)
+    tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        pd.to_pickle({"fetched_at": time.time(), "start": start, "data": data}, tmp_path)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning(f"日线缓存 {formatted_ticker} 写入失败：{e}")
+        tmp_path.unlink(missing_ok=True)
+
+
+def _normalize_history_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """统一日线数据格式：去时区、按日期升序、剔除收盘价缺失的行"""
+    df = df.copy()
+    index = pd.to_datetime(df.index)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    df.index = index.normalize()
+    df = df[~df.index.duplicated(keep='last')].sort_index()
+    return df.dropna(subset=['Close'])
+
+
+def _download_history_batch(formatted_tickers: List[str], start: str) -> Dict[str, pd.DataFrame]:
+    """
+    通过 yf.download 一次性批量拉取多个标的的日线历史。
+    
+    Args:
+        formatted_tickers: 已格式化的 yfinance 代码列表
+        start: 起始日期 'YYYY-MM-DD'
+    
+    Returns:
+        Dict[str, DataFrame]: 成功获取的标的 -> OHLCV 日线
+    """
+    try:
+        raw = yf.download(
+            formatted_tickers,
+            start=start,
+            group_by='ticker',
+            auto_adjust=False,
+            progress=False,
+            threads=True,
+            timeout=20,
+        )
+    except Exception as e:
+        logger.warning(f"批量拉取日线历史失败：{type(e).__name__} - {e}")
+        return {}
+
+    if raw is None or raw.empty:
+        return {}
+
+    result: Dict[str, pd.DataFrame] = {}
+    for ticker in formatted_tickers:
+        try:
+            if isinstance(raw.columns, pd.MultiIndex):
+                if ticker not in raw.columns.get_level_values(0):
+                    continue
+                df = raw[ticker]
+            else:
+                df = raw
+            if 'Close' not in df.columns:
+                continue
+            df = _normalize_history_frame(df)
+            if not df.empty:
+                result[ticker] = df
+        except (KeyError, ValueError) as e:
+            logger.debug(f"解析 {ticker} 日线历史失败：{type(e).__name__}")
+    return result
+
+
+def fetch_price_history(tickers: List[str], days: int = 365) -> Dict[str, pd.DataFrame]:
+    """
+    批量获取多个标的的日线 OHLCV 历史（硬盘缓存优先，未命中的标的合并为一次批量请求）。
+    
+    Args:
+        tickers: 股票代码列表（原始代码即可，内部自动格式化，如 600519 -> 600519.SS）
+        days: 回看的自然日天数，默认 365 天
+    
+    Returns:
+        Dict[str, pd.DataFrame]: 格式化代码 -> 以日期为索引的 OHLCV DataFrame（升序、去时区）。
+        拉取失败且无任何缓存的标的不会出现在结果中。
+    
+    Note:
+        缓存在 HISTORY_CACHE_TTL_SECONDS 内有效且覆盖所需起始日期时直接命中；
+        网络失败时降级使用已过期的缓存，保证下游风险/回测引擎仍有数据可用。
+    """
+    start_dt = (datetime.now() - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
+    start = start_dt.strftime("%Y-%m-%d")
+    now = time.time()
+
+    result: Dict[str, pd.DataFrame] = {}
+    stale: Dict[str, pd.DataFrame] = {}
+    missing: List[str] = []
+
+    for raw_ticker in dict.fromkeys(tickers):
+        formatted = format_universal_ticker(raw_ticker)
+        if formatted in result or formatted in missing:
+            continue
+        cached = _load_history_cache(formatted)
+        if cached is not None:
+            data = cached["data"]
+            is_fresh = now - cached.get("fetched_at", 0) <= HISTORY_CACHE_TTL_SECONDS
+            if is_fresh and cached.get("start", "9999-12-31") <= start:
+                result[formatted] = data[data.index >= start_dt]
+                continue
+            stale[formatted] = data[data.index >= start_dt]
+        missing.append(formatted)
+
+    if missing:
+        downloaded = _download_history_batch(missing, start)
+        for formatted in missing:
+            df = downloaded.get(formatted)
+            if df is not None:
+                _save_history_cache(formatted, start, df)
+                result[formatted] = df
+            elif formatted in stale and not stale[formatted].empty:
+                logger.warning(f"{formatted} 日线拉取失败，降级使用过期缓存")
+                result[formatted] = stale[formatted]
+
+    return result
+
+
+def get_valuation_executor() -> ThreadPoolExecutor:
+    """
+    获取进程级常驻的估值查价线程池（懒加载，线程安全）。
+    
+    Returns:
+        ThreadPoolExecutor: 最大线程数由 VALUATION_MAX_WORKERS 控制
+    """
+    global _valuation_executor
+    with _valuation_executor_lock:
+        if _valuation_executor is None:
+            _valuation_executor = ThreadPoolExecutor(
+                max_workers=VALUATION_MAX_WORKERS,
+                thread_name_prefix="valuation"
+            )
+            atexit.register(_valuation_executor.shutdown, wait=False, cancel_futures=True)
+        return _valuation_executor
+
+
+def _record_last_quote(ticker: str, price: float) -> None:
+    """记录一次成功查价，供后续估值超时降级使用；价格变化时递增行情快照版本"""
+    global _quote_snapshot_version
+    with _last_quotes_lock:
+        previous = _last_quotes.get(ticker)
+        if previous is None or previous["price"] != price:
+            _quote_snapshot_version += 1
+        _last_quotes[ticker] = {"price": price, "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+
+
+def get_quote_snapshot_version() -> int:
+    """获取当前行情快照版本号"""
+    with _last_quotes_lock:
+        return _quote_snapshot_version
+
+
+def _snapshot_quote_prices(tickers: List[str]) -> Dict[str, Optional[float]]:
+    """读取若干持仓当前的缓存价格（无缓存为 None）"""
+    with _last_quotes_lock:
+        return {ticker: _last_quotes[ticker]["price"] if ticker in _last_quotes else None for ticker in tickers}
+
+
+def _get_cached_quote(ticker: str) -> Optional[Dict[str, Any]]:
+    """
+    获取持仓的最近缓存价格：优先进程内最近一次成功查价，其次日线硬盘缓存的最后收盘价。
+    
+    Returns:
+        Optional[Dict[str, Any]]: {"price": float, "time": str}，两级缓存都未命中时返回 None
+    """
+    with _last_quotes_lock:
+        quote = _last_quotes.get(ticker)
+    if quote is not None:
+        return dict(quote)
+
+    cached = _load_history_cache(format_universal_ticker(ticker))
+    if cached is not None and not cached["data"].empty and "Close" in cached["data"].columns:
+        data = cached["data"]
+        return {"price": round(float(data["Close"].iloc[-1]), 4), "time": data.index[-1].strftime("%Y-%m-%d") + " 收盘"}
+    return None
+
+
+def _build_position_row(
     ticker: str,
     position: Dict[str, Any],
+    current_price: float,
     exchange_rates: Dict[str, float]
 ) -> Dict[str, Any]:
+    """由现价计算单一持仓的原生/人民币市值与盈亏行"""
+    shares = position.get("shares", 0)
+    cost_basis = position.get("cost_basis", 0)
+    
+    currency = detect_ticker_currency(ticker)
+    exchange_rate = exchange_rates.get(f"{currency}_CNY", 1.0)
+    
+    native_market_value = current_price * shares
+    native_cost_value = cost_basis * shares
+    native_profit_loss = native_market_value - native_cost_value
+    profit_loss_percent = (native_profit_loss / native_cost_value * 100) if native_cost_value != 0 else 0
+    
+    market_value_cny = native_market_value * exchange_rate
+    cost_value_cny = native_cost_value * exchange_rate
+    profit_loss_cny = market_value_cny - cost_value_cny
+    
+    currency_symbol = {"USD": "$", "HKD": "HK$", "CNY": "¥"}.get(currency, "¥")
+    
+    return {
+        "ticker": ticker,
+        "company_name": position.get("company_name", "-"),
+        "shares": shares,
+        "current_price": current_price,
+        "currency": currency,
+        "currency_symbol": currency_symbol,
+        "exchange_rate": exchange_rate,
+        "native_market_value": round(native_market_value, 2),
+        "native_cost_value": round(native_cost_value, 2),
+        "native_profit_loss": round(native_profit_loss, 2),
+        "market_value_cny": round(market_value_cny, 2),
+        "cost_value_cny": round(cost_value_cny, 2),
+        "profit_loss_cny": round(profit_loss_cny, 2),
+        "profit_loss_percent": round(profit_loss_percent, 2)
+    }
+
+
+def _submit_fetch(executor: ThreadPoolExecutor, key: str, fn: Any, *args: Any) -> Future:
     """
-    计算单一持仓的市值与盈亏（内部纯函数，用于并发执行）。
+    向估值线程池投递网络请求；同一任务键已有未完成的请求时直接复用该 Future。
+    
+    Args:
+        executor: 估值线程池
+        key: 任务键（持仓代码或汇率）
+        fn: 实际执行的函数
+        *args: 透传给 fn 的参数
+    
+    Returns:
+        Future: 新投递或复用的任务
+    """
+    with _inflight_fetches_lock:
+        future = _inflight_fetches.get(key)
+        if future is not None and not future.done():
+            return future
+        future = executor.submit(fn, *args)
+        _inflight_fetches[key] = future
+
+    def _forget(done_future: Future) -> None:
+        with _inflight_fetches_lock:
+            if _inflight_fetches.get(key) is done_future:
+                del _inflight_fetches[key]
+
+    future.add_done_callback(_forget)
+    return future
+
+
+def _fetch_position_price(ticker: str, position: Dict[str, Any]) -> float:
+    """
+    查询单一持仓的现价（内部函数，用于并发执行），成功后刷新缓存价格。
     
     Args:
         ticker: 股票代码
         position: 持仓信息字典，包含 shares, cost_basis, type, company_name
-        exchange_rates: 汇率字典
     
     Returns:
-        dict: 包含该持仓的完整估值信息，如果发生异常则返回包含 "error" 的字典
+        float: 现价（原生币种）
     """
-    shares = position.get("shares", 0)
-    cost_basis = position.get("cost_basis", 0)
-    company_name = position.get("company_name", "-")
-    is_etf = position.get("type", "stock") == "etf"
+    if position.get("type", "stock") == "etf":
+        price_data = fetch_etf_price_raw(ticker)
+        current_price = price_data.get("current_price", price_data.get("close"))
+    else:
+        price_data = fetch_stock_price_raw(ticker)
+        current_price = price_data["close"]
     
-    try:
-        if is_etf:
-            price_data = fetch_etf_price_raw(ticker)
-            current_price = price_data.get("current_price", price_data.get("close"))
-        else:
-            price_data = fetch_stock_price_raw(ticker)
-            current_price = price_data["close"]
-        
-        currency = detect_ticker_currency(ticker)
-        exchange_rate = exchange_rates.get(f"{currency}_CNY", 1.0)
-        
-        native_market_value = current_price * shares
-        native_cost_value = cost_basis * shares
-        native_profit_loss = native_market_value - native_cost_value
-        profit_loss_percent = (native_profit_loss / native_cost_value * 100) if native_cost_value != 0 else 0
-        
-        market_value_cny = native_market_value * exchange_rate
-        cost_value_cny = native_cost_value * exchange_rate
-        profit_loss_cny = market_value_cny - cost_value_cny
-        
-        currency_symbol = {"USD": "$", "HKD": "HK$", "CNY": "¥"}.get(currency, "¥")
-        
-        return {
-            "ticker": ticker,
-            "company_name": company_name,
-            "shares": shares,
-            "current_price": current_price,
-            "currency": currency,
-            "currency_symbol": currency_symbol,
-            "exchange_rate": exchange_rate,
-            "native_market_value": round(native_market_value, 2),
-            "native_cost_value": round(native_cost_value, 2),
-            "native_profit_loss": round(native_profit_loss, 2),
-            "market_value_cny": round(market_value_cny, 2),
-            "cost_value_cny": round(cost_value_cny, 2),
-            "profit_loss_cny": round(profit_loss_cny, 2),
-            "profit_loss_percent": round(profit_loss_percent, 2)
-        }
-        
-    except Exception as e:
+    _record_last_quote(ticker, current_price)
+    return current_price
+
+
+def _fetch_and_record_exchange_rates() -> Dict[str, float]:
+    """获取实时汇率并记录为最近一次成功汇率"""
+    global _last_exchange_rates
+    rates = fetch_exchange_rates()
+    _last_exchange_rates = dict(rates)
+    return rates
+
+
+def _calculate_stale_position(
+    ticker: str,
+    position: Dict[str, Any],
+    exchange_rates: Dict[str, float]
+) -> Dict[str, Any]:
+    """
+    估值截止时间已到但查价未返回时，使用最近缓存价格计算持仓并标记为过期。
+    
+    Returns:
+        dict: 带 "stale": True 与 "price_time" 的持仓行；无任何缓存价格时返回包含 "error" 的字典
+    """
+    quote = _get_cached_quote(ticker)
+    if quote is None:
         return {
             "ticker": ticker,
-            "company_name": company_name,
-            "shares": shares,
-            "error": f"获取价格失败：{type(e).__name__} - {str(e)}"
+            "company_name": position.get("company_name", "-"),
+            "shares": position.get("shares", 0),
+            "error": f"查价超时（>{VALUATION_DEADLINE_SECONDS:g}s）且无缓存价格"
         }
+    
+    row = _build_position_row(ticker, position, quote["price"], exchange_rates)
+    row["stale"] = True
+    row["price_time"] = quote["time"]
+    return row
 
 
-def calculate_portfolio_valuation(positions: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+def calculate_portfolio_valuation(
+    positions: Dict[str, Dict[str, Any]],
+    deadline: Optional[float] = None
+) -> Dict[str, Any]:
     """
     计算持仓组合的精确总市值与今日总盈亏（统一折算为 CNY）。
     
+    汇率与各持仓查价一起投递到常驻线程池并共享一个整体截止时间；超时未返回的持仓不再阻塞报告，
+    而是降级使用最近缓存价格并以 "stale": True 标记，超时的汇率降级使用最近一次成功汇率，
+    本进程尚无成功汇率时使用内置默认汇率（exchange_rates_source 区分两者）
+    （未完成的请求在后台继续执行，其结果会刷新缓存供下次使用；同一代码的迟到请求返回前不会重复投递）。
+    
     Args:
         positions: 持仓字典，格式如：
             {
@@ -557,6 +944,7 @@ def calculate_portfolio_valuation(positions: Dict[str, Dict[str, Any]]) -> Dict[
                 "600519": {"shares": 50, "cost_basis": 1800.0},
                 "513050": {"shares": 1000, "cost_basis": 1.2, "type": "etf"}
             }
+        deadline: 整体截止时间（秒），默认 VALUATION_DEADLINE_SECONDS
     
     Returns:
         dict: {
@@ -576,32 +964,60 @@ def calculate_portfolio_valuation(positions: Dict[str, Dict[str, Any]]) -> Dict[
                 ...
             ],
             "exchange_rates": {...},
-            "currency_unit": "CNY"
+            "currency_unit": "CNY",
+            "stale_tickers": ["0700.HK", ...],
+            "exchange_rates_stale": False,
+            "exchange_rates_source": "live"   # live / last_known（最近一次成功汇率）/ default（内置默认汇率）
         }
     """
-    exchange_rates = fetch_exchange_rates()
+    if deadline is None:
+        deadline = VALUATION_DEADLINE_SECONDS
+    
     holdings_result = []
+    stale_tickers: List[str] = []
     total_market_value_cny = 0.0
     total_cost_cny = 0.0
     
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_ticker = {
-            executor.submit(_calculate_single_position, ticker, position, exchange_rates): ticker
-            for ticker, position in positions.items()
-        }
-        
-        for future in as_completed(future_to_ticker):
-            ticker_key = future_to_ticker[future]
+    executor = get_valuation_executor()
+    rates_future = _submit_fetch(executor, "__exchange_rates__", _fetch_and_record_exchange_rates)
+    future_to_ticker = {
+        _submit_fetch(executor, ticker, _fetch_position_price, ticker, position): ticker
+        for ticker, position in positions.items()
+    }
+    done, not_done = wait([rates_future, *future_to_ticker], timeout=deadline)
+    
+    exchange_rates_stale = rates_future not in done
+    if not exchange_rates_stale:
+        exchange_rates, exchange_rates_source = rates_future.result(), "live"
+    elif _last_exchange_rates is not None:
+        logger.warning(f"汇率获取超过 {deadline:g}s 截止时间，降级使用最近一次汇率")
+        exchange_rates, exchange_rates_source = dict(_last_exchange_rates), "last_known"
+    else:
+        logger.warning(f"汇率获取超过 {deadline:g}s 截止时间且本进程尚无成功汇率，降级使用内置默认汇率")
+        exchange_rates, exchange_rates_source = dict(DEFAULT_EXCHANGE_RATES), "default"
+    
+    for future, ticker_key in future_to_ticker.items():
+        position = positions[ticker_key]
+        if future in done:
             try:
-                result = future.result()
+                result = _build_position_row(ticker_key, position, future.result(), exchange_rates)
             except Exception as e:
-                logger.error(f"持仓 {ticker_key} 估值计算失败：{type(e).__name__} - {e}")
-                result = {"ticker": ticker_key, "error": str(e)}
-            holdings_result.append(result)
-            
+                result = {
+                    "ticker": ticker_key,
+                    "company_name": position.get("company_name", "-"),
+                    "shares": position.get("shares", 0),
+                    "error": f"获取价格失败：{type(e).__name__} - {str(e)}"
+                }
+        else:
+            logger.warning(f"持仓 {ticker_key} 查价超过 {deadline:g}s 截止时间，降级使用缓存价格")
+            result = _calculate_stale_position(ticker_key, position, exchange_rates)
             if "error" not in result:
-                total_market_value_cny += result["market_value_cny"]
-                total_cost_cny += result["cost_value_cny"]
+                stale_tickers.append(ticker_key)
+        holdings_result.append(result)
+        
+        if "error" not in result:
+            total_market_value_cny += result["market_value_cny"]
+            total_cost_cny += result["cost_value_cny"]
     
     total_profit_loss_cny = total_market_value_cny - total_cost_cny
     total_profit_loss_percent = (total_profit_loss_cny / total_cost_cny * 100) if total_cost_cny != 0 else 0
@@ -614,10 +1030,96 @@ def calculate_portfolio_valuation(positions: Dict[str, Dict[str, Any]]) -> Dict[
         "holdings": holdings_result,
         "exchange_rates": exchange_rates,
         "currency_unit": "CNY",
+        "stale_tickers": stale_tickers,
+        "exchange_rates_stale": exchange_rates_stale,
+        "exchange_rates_source": exchange_rates_source,
         "calculation_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     }
 
 
+def _positions_cache_key(positions: Dict[str, Dict[str, Any]]) -> str:
+    """持仓内容哈希（与字典顺序无关）"""
+    payload = json.dumps(positions, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def invalidate_valuation_cache() -> None:
+    """清空估值结果缓存（持仓记忆被修改时调用）"""
+    with _valuation_cache_lock:
+        _valuation_cache.clear()
+    logger.info("估值结果缓存已失效")
+
+
+def get_cached_portfolio_valuation(
+    positions: Dict[str, Dict[str, Any]],
+    ttl: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    带短时缓存的持仓估值：持仓哈希与行情快照版本均未变化且未超过 TTL 时直接返回上次结果。
+    
+    快照版本在估值开始前读取：估值期间到达的迟到查价会让版本号前进，缓存随之失效。
+    估值自身写入的查价同样会推进版本号，因此版本变化时再逐一比对持仓的缓存价格，
+    与该结果所用价格一致（只有本次估值自己的更新）时仍视为命中。
+    同一持仓的并发请求只会触发一次真实估值，其余请求等待并复用其结果。
+    
+    Args:
+        positions: 标准持仓字典（同 calculate_portfolio_valuation）
+        ttl: 缓存有效期（秒），默认 VALUATION_CACHE_TTL_SECONDS
+    
+    Returns:
+        dict: 估值字典。命中缓存时 calculation_time 保持原始计算时间，并附带
+        "cache_hit": True 与 "cache_age_seconds"
+    """
+    if ttl is None:
+        ttl = VALUATION_CACHE_TTL_SECONDS
+    key = _positions_cache_key(positions)
+    
+    while True:
+        with _valuation_cache_lock:
+            entry = _valuation_cache.get(key)
+            if entry is not None:
+                age = time.time() - entry["stored_at"]
+                unchanged = (
+                    entry["version"] == get_quote_snapshot_version()
+                    or _snapshot_quote_prices(list(entry["quotes"])) == entry["quotes"]
+                )
+                if age <= ttl and unchanged:
+                    result = copy.deepcopy(entry["result"])
+                    result["cache_hit"] = True
+                    result["cache_age_seconds"] = int(age)
+                    return result
+                _valuation_cache.pop(key, None)
+            
+            inflight = _valuation_inflight.get(key)
+            if inflight is None:
+                inflight = threading.Event()
+                _valuation_inflight[key] = inflight
+                break
+        # 已有相同持仓的估值在途：等待其完成后重新检查缓存
+        inflight.wait()
+    
+    try:
+        version = get_quote_snapshot_version()
+        quotes = _snapshot_quote_prices(list(positions))
+        result = calculate_portfolio_valuation(positions)
+        # 实时查价成功的持仓由本次估值写入了缓存价格；其余持仓的缓存价格应保持估值开始时的值
+        for row in result.get("holdings", []):
+            if "error" not in row and not row.get("stale") and row.get("ticker") in quotes:
+                quotes[row["ticker"]] = row["current_price"]
+        with _valuation_cache_lock:
+            _valuation_cache[key] = {
+                "version": version,
+                "quotes": quotes,
+                "stored_at": time.time(),
+                "result": copy.deepcopy(result),
+            }
+        return result
+    finally:
+        with _valuation_cache_lock:
+            _valuation_inflight.pop(key, None)
+        inflight.set()
+
+
 def parse_user_profile_to_positions(user_data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
     """
     将用户持仓记忆文件（user_profile.json）中的自然语言持仓描述解析为标准 positions 格式。
@@ -666,14 +1168,10 @@ def parse_user_profile_to_positions(user_data: Dict[str, Any]) -> Dict[str, Dict
             shares = int(shares_match.group(1))
             cost_basis = float(cost_match.group(1))
             
-            # ETF 前缀：沪市 50/51/58，深市 15/16，防止普通6位A股被误判
-            is_etf = (key.isdigit() and len(key) == 6 and
-                      key.startswith(('50', '51', '58', '15', '16')))
-            
             positions[ticker] = {
                 "shares": shares,
                 "cost_basis": cost_basis,
-                "type": "etf" if is_etf else "stock",
+                "type": "etf" if is_etf_code(key) else "stock",
                 "company_name": company_name
             }
         except Exception:
@@ -682,16 +1180,16 @@ def parse_user_profile_to_positions(user_data: Dict[str, Any]) -> Dict[str, Dict
     return positions
 
 
-def format_portfolio_report(valuation: Dict[str, Any]) -> str:
+def build_portfolio_report(valuation: Dict[str, Any]) -> Report:
     """
-    将 calculate_portfolio_valuation 返回的估值字典格式化为标准 Markdown 表格报告（多货币支持）。
+    将 calculate_portfolio_valuation 返回的估值字典构建为结构化报告（多货币支持）。
     按持仓市值降序排列，优先展示重仓标的。
     
     Args:
         valuation: calculate_portfolio_valuation 返回的估值字典
     
     Returns:
-        str: 格式化的 Markdown 报告字符串（包含标准表格）
+        Report: 结构化报告，可直接渲染为 Markdown / 邮件 HTML / Telegram HTML / 表格截图
     """
     exchange_rates = valuation.get("exchange_rates", DEFAULT_EXCHANGE_RATES)
     
@@ -720,6 +1218,7 @@ def format_portfolio_report(valuation: Dict[str, Any]) -> str:
                 "ticker": holding['ticker'],
                 "company_name": holding.get('company_name', '-'),
                 "has_error": False,
+                "stale": holding.get('stale', False),
                 "currency_symbol": currency_symbol,
                 "current_price": current_price,
                 "cost_basis": cost_basis,
@@ -735,48 +1234,79 @@ def format_portfolio_report(valuation: Dict[str, Any]) -> str:
         reverse=True
     )
     
-    markdown_lines = [
-        "## 💰 持仓市值与盈亏对账单",
-        "",
-        f"**计算时间**: {valuation['calculation_time']}",
-        "",
-        f"**参考汇率**: USD/CNY={exchange_rates.get('USD_CNY', 7.20):.4f}, HKD/CNY={exchange_rates.get('HKD_CNY', 0.92):.4f}",
-        "",
-        "### 📊 总资产概览",
-        "",
-        f"- **总市值**: ¥{valuation['total_market_value']:,.2f}",
-        f"- **总成本**: ¥{valuation['total_cost']:,.2f}",
-        f"- **累计盈亏**: ¥{valuation['total_profit_loss']:,.2f} ({valuation['profit_loss_percent']:+.2f}%)",
-        "",
-        "### 📈 持仓明细",
-        "",
-        "| 标的代码 | 公司名称 | 最新价 | 持仓成本 | 原生市值 | 折合人民币 (CNY) | 绝对盈亏 (CNY) | 盈亏率 |",
-        "| :--- | :--- | :--- | :--- | :--- | :--- | :--- | :--- |",
-    ]
+    table = Table(headers=["标的代码", "公司名称", "最新价", "持仓成本", "原生市值", "折合人民币 (CNY)", "绝对盈亏 (CNY)", "盈亏率"], rows=[])
     
     for detail in sorted_details:
         if detail.get('has_error', False):
-            markdown_lines.append(
-                f"| **{detail['ticker']}** | {detail['company_name']} | ❌ {detail['error_message']} | - | - | - | - | - |"
-            )
+            table.bold_cells.add((len(table.rows), 0))
+            table.rows.append([detail['ticker'], detail['company_name'], f"❌ {detail['error_message']}", "-", "-", "-", "-", "-"])
         else:
             currency_symbol = detail.get('currency_symbol', '¥')
-            current_price = detail.get('current_price', 0)
-            cost_basis = detail.get('cost_basis', 0)
-            native_value = detail.get('native_value', 0)
-            cny_value = detail.get('cny_value', 0)
-            cny_profit = detail.get('cny_profit', 0)
-            pnl_percent = detail.get('pnl_percent', 0)
-            
-            markdown_lines.append(
-                f"| {detail['ticker']} | {detail['company_name']} | {currency_symbol}{current_price:.2f} | {currency_symbol}{cost_basis:.2f} | {currency_symbol}{native_value:,.2f} | ¥{cny_value:,.2f} | {cny_profit:+,.2f} | {pnl_percent:+.2f}% |"
-            )
-    
-    summary_line = f"**【账户总计】当前折合总市值：¥{valuation['total_market_value']:,.2f}，累计总盈亏：{valuation['total_profit_loss']:+,.2f}**"
+            stale_mark = " ⏳" if detail.get('stale', False) else ""
+            table.rows.append([
+                detail['ticker'],
+                detail['company_name'],
+                f"{currency_symbol}{detail.get('current_price', 0):.2f}{stale_mark}",
+                f"{currency_symbol}{detail.get('cost_basis', 0):.2f}",
+                f"{currency_symbol}{detail.get('native_value', 0):,.2f}",
+                f"¥{detail.get('cny_value', 0):,.2f}",
+                f"{detail.get('cny_profit', 0):+,.2f}",
+                f"{detail.get('pnl_percent', 0):+.2f}%",
+            ])
+    
+    detail_blocks: List[Any] = [table]
+    
+    calculation_time_label = valuation['calculation_time']
+    if valuation.get('cache_hit'):
+        calculation_time_label += f"（⚡ 缓存结果，{valuation.get('cache_age_seconds', 0)} 秒前计算）"
+    
+    stale_holdings = [h for h in valuation['holdings'] if h.get('stale')]
+    if stale_holdings:
+        stale_desc = "，".join(f"{h['ticker']}（{h.get('price_time', '未知时间')}）" for h in stale_holdings)
+        detail_blocks.append(Note(f"⏳ 以下持仓实时查价超时，已使用最近缓存价格估值：{stale_desc}"))
+    if valuation.get('exchange_rates_source') == "default":
+        detail_blocks.append(Note("⚠️ 实时汇率获取超时且暂无历史汇率，已使用内置默认汇率折算，结果可能偏差较大"))
+    elif valuation.get('exchange_rates_stale'):
+        detail_blocks.append(Note("⏳ 实时汇率获取超时，已使用最近一次汇率折算"))
+    
+    detail_blocks.append(Paragraph(
+        f"【账户总计】当前折合总市值：¥{valuation['total_market_value']:,.2f}，累计总盈亏：{valuation['total_profit_loss']:+,.2f}",
+        bold=True
+    ))
+    
+    return Report(
+        sections=[
+            Section("💰 持仓市值与盈亏对账单", level=2, blocks=[
+                KeyValue("计算时间", calculation_time_label),
+                KeyValue("参考汇率", f"USD/CNY={exchange_rates.get('USD_CNY', 7.20):.4f}, HKD/CNY={exchange_rates.get('HKD_CNY', 0.92):.4f}"),
+            ]),
+            Section("📊 总资产概览", level=3, blocks=[
+                BulletList([
+                    KeyValue("总市值", f"¥{valuation['total_market_value']:,.2f}"),
+                    KeyValue("总成本", f"¥{valuation['total_cost']:,.2f}"),
+                    KeyValue("累计盈亏", f"¥{valuation['total_profit_loss']:,.2f} ({valuation['profit_loss_percent']:+.2f}%)"),
+                ]),
+            ]),
+            Section("📈 持仓明细", level=3, blocks=detail_blocks),
+        ],
+        metrics={
+            "total_market_value": valuation['total_market_value'],
+            "total_cost": valuation['total_cost'],
+            "total_profit_loss": valuation['total_profit_loss'],
+            "profit_loss_percent": valuation['profit_loss_percent'],
+            "calculation_time": valuation['calculation_time'],
+        }
+    )
+
+
+def format_portfolio_report(valuation: Dict[str, Any]) -> str:
+    """
+    将 calculate_portfolio_valuation 返回的估值字典格式化为标准 Markdown 表格报告（多货币支持）。
     
-    markdown_lines.extend([
-        "",
-        summary_line
-    ])
+    Args:
+        valuation: calculate_portfolio_valuation 返回的估值字典
     
-    return "\n".join(markdown_lines)
+    Returns:
+        str: 格式化的 Markdown 报告字符串（包含标准表格）
+    """
+    return build_portfolio_report(valuation).to_markdown()